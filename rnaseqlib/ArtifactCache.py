@@ -0,0 +1,211 @@
+##
+## ArtifactCache: records which pipeline step outputs are
+## up to date, keyed on the content of their inputs and
+## the settings they were made with
+##
+import os
+import sys
+import time
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+
+def hash_file_contents(filename, chunk_size=4 * 1024 * 1024):
+    """
+    Return SHA1 of the contents of a file.
+    """
+    file_hash = hashlib.sha1()
+    with open(filename, "rb") as input_file:
+        while True:
+            chunk = input_file.read(chunk_size)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Manifest of the outputs (artifacts) of pipeline steps for a
+    sample, stored as a JSON file.
+
+    Each step is keyed on the SHA1 of the contents of its input
+    files, the step's settings and a step version. A step is done
+    if the manifest has an entry for it with the same key, and its
+    outputs are unchanged (in size and modification time) since
+    they were recorded. Steps write their outputs to a temporary
+    directory, and the outputs are moved into place and recorded
+    only once the step completes, so a step that was killed midway
+    is never treated as done.
+
+    Hashes of input files are cached in the manifest along with
+    the files' size and modification time, so an input is only
+    re-hashed when it changes.
+    """
+    def __init__(self, manifest_fname):
+        self.manifest_fname = os.path.abspath(manifest_fname)
+        utils.make_dir(os.path.dirname(self.manifest_fname))
+        self.lock_fname = "%s.lock" %(self.manifest_fname)
+
+
+    def load_manifest(self):
+        """
+        Load manifest from file.
+        """
+        manifest = {"steps": {}, "hashes": {}}
+        if os.path.isfile(self.manifest_fname):
+            with open(self.manifest_fname) as manifest_file:
+                manifest.update(json.load(manifest_file))
+        return manifest
+
+
+    def update_manifest(self, update_func):
+        """
+        Apply 'update_func' to the manifest and save it. The
+        manifest is locked while it's being updated, so that
+        processes running steps of the same sample can update
+        it concurrently.
+        """
+        with open(self.lock_fname, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                manifest = self.load_manifest()
+                update_func(manifest)
+                tmp_fname = "%s.tmp.%d" %(self.manifest_fname, os.getpid())
+                with open(tmp_fname, "w") as manifest_file:
+                    json.dump(manifest, manifest_file, indent=1,
+                              sort_keys=True)
+                os.rename(tmp_fname, self.manifest_fname)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def hash_file(self, filename):
+        """
+        Return SHA1 of the contents of file, using the hash cached
+        in the manifest if the file did not change since.
+        """
+        filename = os.path.abspath(filename)
+        fingerprint = utils.get_files_fingerprint([filename])
+        if fingerprint is None:
+            raise Exception, "Cannot find input file %s" %(filename)
+        cached = self.load_manifest()["hashes"].get(filename)
+        if (cached is not None) and (cached[0] == fingerprint):
+            return cached[1]
+        file_hash = hash_file_contents(filename)
+        def record_hash(manifest):
+            manifest["hashes"][filename] = [fingerprint, file_hash]
+        self.update_manifest(record_hash)
+        return file_hash
+
+
+    def get_step_key(self, step_name, inputs, settings=None, version=1):
+        """
+        Return key of a step: SHA1 of the step's name and version,
+        the contents of its input files and its settings.
+        """
+        key_fields = {"step": step_name,
+                      "version": version,
+                      "inputs": [self.hash_file(f) for f in inputs],
+                      "settings": settings}
+        return hashlib.sha1(json.dumps(key_fields,
+                                       sort_keys=True)).hexdigest()
+
+
+    def is_step_done(self, step_name, key, outputs):
+        """
+        Return True if the step was completed with the given key
+        and its outputs are unchanged since.
+        """
+        entry = self.load_manifest()["steps"].get(step_name)
+        if (entry is None) or (entry["key"] != key):
+            return False
+        for output_fname in outputs:
+            output_fname = os.path.abspath(output_fname)
+            recorded = entry["outputs"].get(output_fname)
+            if (recorded is None) or \
+               (recorded != utils.get_files_fingerprint([output_fname])):
+                return False
+        return True
+
+
+    def run_step(self, step_name, inputs, outputs, step_func,
+                 settings=None,
+                 version=1,
+                 logger=None):
+        """
+        Run step unless it is done already (see 'is_step_done').
+
+        Args:
+        - step_name: name of step, unique within the sample
+        - inputs: input filenames of step
+        - outputs: output filenames of step (with distinct basenames)
+        - step_func: function called with a list of temporary
+          filenames to write the outputs to, in order of 'outputs'
+
+        Kwargs:
+        - settings: settings the outputs depend on (must be
+          serializable as JSON)
+        - version: version of the step, to be increased when the
+          step changes in a way that changes its outputs
+        - logger: logger to log messages to
+
+        Returns True if the step was run, False if it was done.
+        """
+        outputs = [os.path.abspath(f) for f in outputs]
+        basenames = [os.path.basename(f) for f in outputs]
+        if len(set(basenames)) != len(basenames):
+            raise Exception, "Outputs of step %s must have distinct " \
+                  "basenames." %(step_name)
+        key = self.get_step_key(step_name, inputs, settings=settings,
+                                version=version)
+        if self.is_step_done(step_name, key, outputs):
+            if logger is not None:
+                logger.info("Step %s is up to date, skipping.." %(step_name))
+            return False
+        if logger is not None:
+            logger.info("Running step %s" %(step_name))
+        # Forget the step's previous outputs
+        def remove_step(manifest):
+            manifest["steps"].pop(step_name, None)
+        self.update_manifest(remove_step)
+        # Write outputs in a temporary directory next to the first
+        # output so that they can be moved into place by renaming
+        outputs_dir = os.path.dirname(outputs[0])
+        utils.make_dir(outputs_dir)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_%s." %(step_name),
+                                   dir=outputs_dir)
+        try:
+            tmp_outputs = [os.path.join(tmp_dir, basename) \
+                           for basename in basenames]
+            step_func(tmp_outputs)
+            for tmp_output, output_fname in zip(tmp_outputs, outputs):
+                if not os.path.isfile(tmp_output):
+                    raise Exception, "Step %s did not output %s" \
+                          %(step_name, output_fname)
+            for tmp_output, output_fname in zip(tmp_outputs, outputs):
+                utils.make_dir(os.path.dirname(output_fname))
+                os.rename(tmp_output, output_fname)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Record the step as done with its outputs
+        output_fingerprints = \
+            dict([(output_fname,
+                   utils.get_files_fingerprint([output_fname])) \
+                  for output_fname in outputs])
+        def record_step(manifest):
+            manifest["steps"][step_name] = {"key": key,
+                                            "outputs": output_fingerprints,
+                                            "time": utils.get_strtime()}
+        self.update_manifest(record_step)
+        return True
+
+
+    def __repr__(self):
+        return "ArtifactCache(%s)" %(self.manifest_fname)
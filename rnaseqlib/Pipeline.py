@@ -19,12 +19,15 @@ import rnaseqlib.mapping.bedtools_utils as bedtools_utils
 import rnaseqlib.ribo
 import rnaseqlib.ribo.ribo_utils as ribo_utils
 import rnaseqlib.QualityControl as qc
+import rnaseqlib.ArtifactCache as artifact_cache
+import rnaseqlib.StepScheduler as step_scheduler
 import rnaseqlib.RNABase as rna_base
 import rnaseqlib.clip
 import rnaseqlib.clip.clip_utils as clip_utils
 import rnaseqlib.fastq_utils as fastq_utils
 import rnaseqlib.bam
 import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.coverage.coverage_utils as coverage_utils
 import rnaseqlib.motif
 import rnaseqlib.motif.homer_utils as homer_utils
 import rnaseqlib.motif.meme_utils as meme_utils
@@ -35,6 +38,13 @@ from rnaseqlib.paths import *
 
 import cluster_utils.cluster as cluster
 
+# Memory (in GB) assumed for a pipeline step (or for each
+# process of a step) beyond its own estimate
+STEP_MEM_GB = 1
+GB = 1024.**3
+# Lengths of kmers to find enriched kmers of
+KMER_LENS = [4,5,6,7,8]
+
 class Sample:
     """ 
     A sample to run on. For paired-end, represents a
@@ -63,6 +73,8 @@ class Sample:
         self.unique_bam_filename = None
         # rRNA subtracted BAM filename
         self.ribosub_bam_filename = None
+        # Unique and rRNA subtracted BAM filename
+        self.unique_ribosub_bam_filename = None
         # Duplicate-subtracted unique filename
         self.rmdups_bam_filename = None
         # Unique BAM after duplicate-subtraction filename
@@ -184,6 +196,8 @@ class Pipeline:
         self.collapsed_seq_filename = None
         # Cluster objects to use 
         self.my_cluster = None
+        # Bundles of samples run together in one job, if any
+        self.samples_bundles = None
         # Pipeline output subdirectories
         self.pipeline_outdirs = {}
         # RPKM directory for teh pipeline
@@ -439,12 +453,17 @@ class Pipeline:
         Load cluster submission object for the particular
         pipeline settings we were given.
         """
+        mapping_settings = self.settings_info["mapping"]
         self.my_cluster = \
-            cluster.Cluster(self.settings_info["mapping"]["cluster_type"],
+            cluster.Cluster(mapping_settings["cluster_type"],
                             self.output_dir,
                             self.logger,
-                            cluster_queue=self.settings_info["mapping"]["cluster_queue"],
-                            cluster_memory=self.settings_info["mapping"]["cluster_memory"])
+                            cluster_queue=mapping_settings["cluster_queue"],
+                            cluster_memory=mapping_settings["cluster_memory"],
+                            max_jobs=mapping_settings.get("local_max_jobs"),
+                            max_cpus=mapping_settings.get("local_max_cpus"),
+                            max_mem_gb=mapping_settings.get("local_max_mem_gb"),
+                            num_retries=mapping_settings.get("job_retries", 0))
         
 
     def load_sequence_files(self):
@@ -546,7 +565,8 @@ class Pipeline:
             self.logger.info("Trimming polyAs..")
             trimmed_filename = \
                 ribo_utils.trim_polyA_ends(sample.rawdata.seq_filename,
-                                           self.pipeline_outdirs["rawdata"])
+                                           self.pipeline_outdirs["rawdata"],
+                                           num_procs=self.settings_info["mapping"]["num_processors"])
             # Adjust the trimmed file to be the "reads" sequence file for this
             # sample
             sample.rawdata.reads_filename = trimmed_filename
@@ -558,7 +578,8 @@ class Pipeline:
                 clip_utils.trim_clip_adaptors(sample.rawdata.seq_filename,
                                               self.adaptors_filename,
                                               self.pipeline_outdirs["rawdata"],
-                                              self.logger)
+                                              self.logger,
+                                              num_procs=self.settings_info["mapping"]["num_processors"])
             sample.rawdata.reads_filename = trimmed_filename
             # Create collapsed versions of sequence files
             sample.rawdata.collapsed_seq_filename = \
@@ -586,8 +607,28 @@ class Pipeline:
         return None
             
             
+    def get_sample_cache(self, sample):
+        """
+        Return the artifact cache of a sample, which records
+        the sample's pipeline steps that are up to date.
+        """
+        manifest_fname = os.path.join(self.output_dir, "manifests",
+                                      "%s.manifest.json" %(sample.label))
+        return artifact_cache.ArtifactCache(manifest_fname)
+
+
     def run_on_samples(self):
+        """
+        Launch a job for each sample, or for every
+        'samples_per_job' samples if set in [pipeline]
+        (the samples of a job are run one at a time.)
+        Return the job IDs.
+        """
         samples_job_ids = []
+        samples_jobs = []
+        # Each sample's steps use up to 'max_cpus' CPUs
+        max_cpus = self.settings_info["pipeline"]["max_cpus"]
+        samples_per_job = self.settings_info["pipeline"]["samples_per_job"]
         for sample in self.samples:
             self.logger.info("Processing sample %s" %(sample))
             job_name = "pipeline_run_%s" %(sample.label)
@@ -598,9 +639,23 @@ class Pipeline:
                   self.settings_filename,
                   self.output_dir)
             self.logger.info("Executing: %s" %(sample_cmd))
-            job_id = self.my_cluster.launch_job(sample_cmd, job_name)
+            if samples_per_job > 1:
+                samples_jobs.append((sample_cmd, job_name))
+                continue
+            job_id = self.my_cluster.launch_job(sample_cmd, job_name,
+                                                ppn=max_cpus)
             self.logger.info("Job launched with ID %s" %(job_id))
             samples_job_ids.append(job_id)
+        if samples_per_job > 1:
+            self.samples_bundles = \
+                self.my_cluster.launch_bundles(samples_jobs,
+                                               samples_per_job,
+                                               bundle_label="pipeline_run",
+                                               ppn=max_cpus)
+            for bundle in self.samples_bundles:
+                self.logger.info("Job for %d samples launched with ID %s" \
+                                 %(len(bundle.commands), bundle.job_id))
+                samples_job_ids.append(bundle.job_id)
         return samples_job_ids
             
         
@@ -620,6 +675,13 @@ class Pipeline:
         job_ids = self.run_on_samples()
         # Wait until all jobs completed 
         self.my_cluster.wait_on_jobs(job_ids)
+        if self.samples_bundles is not None:
+            # Report on samples that were run together
+            statuses = self.my_cluster.wait_on_bundles(self.samples_bundles)
+            for job_name, exit_code in sorted(statuses.items()):
+                if exit_code != 0:
+                    self.logger.warning("%s failed (exit code: %s)" \
+                                        %(job_name, str(exit_code)))
         # Compile all the QC results
         self.compile_qc_output()
         # Compile all the analysis results
@@ -628,6 +690,116 @@ class Pipeline:
         self.logger.info("Run completed!")
 
 
+    def get_sample_scheduler(self, sample):
+        """
+        Return scheduler of the pipeline steps of a sample, as
+        a graph of the steps and the steps they depend on.
+
+        Steps that process reads or BAMs across processes use
+        'num_processors' CPUs and the rest use one CPU. Steps
+        take the memory estimated by 'get_steps_mem_gb'. The
+        steps of the sample run concurrently within the
+        [pipeline] settings 'max_cpus' and 'max_mem_gb'.
+        """
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        steps_mem_gb = self.get_steps_mem_gb()
+        scheduler = \
+            step_scheduler.StepScheduler(max_cpus=self.settings_info["pipeline"]["max_cpus"],
+                                         max_mem_gb=self.settings_info["pipeline"]["max_mem_gb"],
+                                         logger=self.logger)
+        scheduler.add_step("preprocess_reads",
+                           lambda: self.preprocess_reads(sample),
+                           num_cpus=num_processors)
+        scheduler.add_step("map_reads",
+                           lambda: self.map_reads(sample),
+                           depends_on=["preprocess_reads"],
+                           num_cpus=num_processors,
+                           mem_gb=steps_mem_gb["map_reads"])
+        scheduler.add_step("run_qc",
+                           lambda: self.run_qc(sample),
+                           depends_on=["map_reads"],
+                           mem_gb=steps_mem_gb["run_qc"])
+        ##
+        ## Analysis steps
+        ##
+        # RPKMs are normalized by the number of mapped reads from QC
+        scheduler.add_step("output_rpkms",
+                           lambda: self.output_rpkms(sample),
+                           depends_on=["run_qc"],
+                           num_cpus=num_processors,
+                           mem_gb=steps_mem_gb["output_rpkms"])
+        if sample.sample_type in ["riboseq", "clipseq"]:
+            scheduler.add_step("output_bigWigs",
+                               lambda: self.output_bigWigs(sample),
+                               depends_on=["map_reads"])
+        if sample.sample_type == "clipseq":
+            scheduler.add_step("output_events_mapping",
+                               lambda: self.output_events_mapping(sample),
+                               depends_on=["map_reads"])
+            scheduler.add_step("output_reads_as_bed",
+                               lambda: self.output_reads_as_bed(sample),
+                               depends_on=["map_reads"])
+            scheduler.add_step("output_clusters",
+                               lambda: self.output_clusters(sample),
+                               depends_on=["output_reads_as_bed"])
+            scheduler.add_step("output_clip_sequences",
+                               lambda: self.output_clip_sequences(sample),
+                               depends_on=["output_clusters"])
+            # Motifs from the clusters and from their sequences
+            scheduler.add_step("output_homer_motifs",
+                               lambda: self.output_homer_motifs(sample),
+                               depends_on=["output_clusters"])
+            scheduler.add_step("output_enriched_kmers",
+                               lambda: self.output_enriched_kmers(sample),
+                               depends_on=["output_clip_sequences"],
+                               num_cpus=num_processors,
+                               mem_gb=steps_mem_gb["output_enriched_kmers"])
+        return scheduler
+
+
+    def get_steps_mem_gb(self):
+        """
+        Return mapping from the memory-heavy pipeline steps to
+        estimates of the memory (in GB) they take, from the
+        settings and the sizes of the files they load:
+
+          - map_reads: the mapper holds its genome index
+          - run_qc: the read ID hashes of a DistinctCounter
+          - output_rpkms: exons coverage of the largest table in
+            each process and in the merge of their results
+          - output_enriched_kmers: kmer counts in each process
+        """
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        mapper = self.settings_info["mapping"]["mapper"]
+        index_bytes = 0
+        if mapper in ["bowtie", "tophat"]:
+            index_filename = \
+                self.settings_info["mapping"]["%s_index" %(mapper)]
+            index_bytes = sum([os.path.getsize(index_fname) \
+                               for index_fname in glob.glob("%s*" %(index_filename))])
+        coverage_bytes = 0
+        for const_exons in self.rna_base.tables_to_const_exons.values():
+            if const_exons.gff_filename is None or \
+               not os.path.isfile(const_exons.gff_filename):
+                continue
+            coverage_bytes = \
+                max(coverage_bytes,
+                    coverage_utils.estimate_exons_coverage_bytes(const_exons.gff_filename))
+        # Dense kmer counts arrays of 8-byte counts
+        kmers_bytes = \
+            sum([8 * 4**min(kmer_len, kmer_utils.MAX_DENSE_KMER_LEN) \
+                 for kmer_len in KMER_LENS])
+        steps_mem_gb = {
+            "map_reads": STEP_MEM_GB + index_bytes / GB,
+            "run_qc": STEP_MEM_GB + (8 * bam_utils.DISTINCT_BUFFER_SIZE) / GB,
+            "output_rpkms": \
+                STEP_MEM_GB + ((1 + num_processors) * coverage_bytes) / GB,
+            "output_enriched_kmers": \
+                num_processors * (STEP_MEM_GB + kmers_bytes / GB)
+            }
+        return steps_mem_gb
+
+
     def run_on_sample(self, label):
         try:
             self.logger.info("Running on sample: %s" %(label))
@@ -638,18 +810,18 @@ class Pipeline:
                 self.logger.info("Cannot find sample %s! Exiting.." \
                                  %(label))
                 sys.exit(1)
-            # Pre-process the data if needed
-            self.logger.info("Preprocessing reads")
-            sample = self.preprocess_reads(sample)
-            # Map the data
-            self.logger.info("Mapping reads")
-            sample = self.map_reads(sample)
-            # Perform QC
-            self.logger.info("Running QC")
-            sample = self.run_qc(sample)
-            # Run gene expression analysis
-            self.logger.info("Running analysis")
-            sample = self.run_analysis(sample)
+            # Preprocess, map, run QC and run analysis on the
+            # data, running independent steps concurrently
+            scheduler = self.get_sample_scheduler(sample)
+            try:
+                scheduler.run()
+            finally:
+                # Record the time each step took
+                timings_dir = os.path.join(self.output_dir, "timings")
+                utils.make_dir(timings_dir)
+                scheduler.output_timings(os.path.join(timings_dir,
+                                                      "%s.timings.txt" \
+                                                      %(sample.label)))
         except:
             self.logger.exception("Failed while running on sample %s" \
                                   %(label))
@@ -660,8 +832,10 @@ class Pipeline:
         """
         Map reads using a read mapper.
 
-        Also creates a BAM file containing only the uniquely mapped
-        reads, which is used for downstream analyses (e.g. in QC).
+        Also creates BAM files containing only the uniquely mapped
+        reads, only the rRNA-subtracted reads and only the uniquely
+        mapped rRNA-subtracted reads, which are used for downstream
+        analyses (e.g. in QC).
         """
         self.logger.info("Mapping reads for sample: %s" %(sample.label))
         mapper = self.settings_info["mapping"]["mapper"]
@@ -712,27 +886,18 @@ class Pipeline:
         ##
         ## Post processing of BAM reads
         ##
-        # Index the main BAM file
-        self.index_bam(sample.bam_filename)
         # Create a directory for processed BAMs
         sample.processed_bam_dir = \
             os.path.join(self.pipeline_outdirs["mapping"],
                          sample.label,
                          "processed_bams")
         utils.make_dir(sample.processed_bam_dir)
-        # Get the uniquely mapping reads
-        sample.unique_bam_filename = self.get_unique_reads(sample)
-        # Get the ribo-subtracted mapping reads
-        sample.ribosub_bam_filename = self.get_ribosub_bam_reads(sample)
-        # Sort and index the ribo-subtracted mapped reads BAM
+        # Sort and index the main BAM file
         sample.bam_filename = \
-            self.sort_and_index_bam(sample.bam_filename)
-        # Sort and index the unique BAM reads
-        sample.unique_bam_filename = \
-            self.sort_and_index_bam(sample.unique_bam_filename)
-        # Sort and index the ribosubtracted BAM reads
-        sample.ribosub_bam_filename = \
-            self.sort_and_index_bam(sample.ribosub_bam_filename)
+            self.sort_and_index_bam(sample, sample.bam_filename)
+        # Get the uniquely mapping reads, the ribo-subtracted
+        # reads and the unique ribo-subtracted reads
+        sample = self.split_bam_reads(sample)
         ##
         ## Remove duplicates optionally for CLIP
         ##
@@ -740,7 +905,7 @@ class Pipeline:
         return sample
 
 
-    def rmdups_bam(self, bam_filename, output_dir):
+    def rmdups_bam(self, sample, bam_filename, output_dir):
         """
         Remove duplicates using samtools rmdups
         from given BAM filename.  Assumes reads are
@@ -753,20 +918,22 @@ class Pipeline:
         self.logger.info("Removing duplicates from BAM..")
         rmdups_bam_filename = os.path.join(output_dir,
                                            "%s.rmdups.bam" %(output_basename))
-        if os.path.isfile(rmdups_bam_filename):
-            self.logger.info("%s exists, skipping duplication removal." \
-                             %(rmdups_bam_filename))
-            return rmdups_bam_filename
         self.logger.info("  Input: %s" %(bam_filename))
         self.logger.info("  Output: %s" %(rmdups_bam_filename))
-        rmdup_cmd = "samtools rmdup -s %s %s" %(bam_filename,
-                                                rmdups_bam_filename)
-        self.logger.info("  Executing: %s" %(rmdup_cmd))
-        t1 = time.time()
-        os.system(rmdup_cmd)
-        t2 = time.time()
-        self.logger.info("Duplicates removal completed in %.2f mins" \
-                         %((t2 - t1)/60.))
+        def rmdups(tmp_outputs):
+            t1 = time.time()
+            utils.run_cmd("samtools rmdup -s %s %s" %(bam_filename,
+                                                      tmp_outputs[0]),
+                          logger=self.logger)
+            t2 = time.time()
+            self.logger.info("Duplicates removal completed in %.2f mins" \
+                             %((t2 - t1)/60.))
+        sample_cache = self.get_sample_cache(sample)
+        sample_cache.run_step("rmdups_bam.%s" %(output_basename),
+                              [bam_filename],
+                              [rmdups_bam_filename],
+                              rmdups,
+                              logger=self.logger)
         return rmdups_bam_filename
 
 
@@ -781,19 +948,19 @@ class Pipeline:
         self.logger.info("  Removing duplicates..")
         # Get the non-duplicate version of BAM file
         sample.rmdups_bam_filename = \
-            self.rmdups_bam(sample.bam_filename,
+            self.rmdups_bam(sample, sample.bam_filename,
                             sample.processed_bam_dir)
         # Get the non-duplicate version of the unique BAM file
         sample.rmdups_unique_bam_filename = \
-            self.rmdups_bam(sample.unique_bam_filename,
+            self.rmdups_bam(sample, sample.unique_bam_filename,
                             sample.processed_bam_dir)
         self.logger.info("  Sorting and indexing duplicate-removed BAMs..")
         # Sort and index the non-duplicate BAM
         sample.rmdups_bam_filename = \
-            self.sort_and_index_bam(sample.rmdups_bam_filename)
+            self.sort_and_index_bam(sample, sample.rmdups_bam_filename)
         # Sort and index the non-duplicate unique BAM
         sample.rmdups_unique_bam_filename = \
-            self.sort_and_index_bam(sample.rmdups_unique_bam_filename)
+            self.sort_and_index_bam(sample, sample.rmdups_unique_bam_filename)
         self.logger.info("Postprocessing of CLIP-Seq BAMs completed.")
         
         
@@ -808,7 +975,7 @@ class Pipeline:
             os.system(index_cmd)
 
 
-    def sort_and_index_bam(self, bam_filename):
+    def sort_and_index_bam(self, sample, bam_filename):
         """
         Sort and index the BAM for the sample.
 
@@ -821,83 +988,37 @@ class Pipeline:
                                            "%s.sorted" %(bam_basename))
         self.logger.info("Sorting %s as %s" %(bam_filename,
                                               sorted_bam_filename))
-        sort_cmd = "samtools sort %s %s" %(bam_filename,
-                                           sorted_bam_filename)
-        job_name = "sorted_bam_%s" %(bam_basename)
         expected_bam_filename = "%s.bam" %(sorted_bam_filename)
-        if not os.path.isfile(expected_bam_filename):
-            os.system(sort_cmd)
-        # Index the sorted BAM
-        self.index_bam(expected_bam_filename)
+        def sort_and_index(tmp_outputs):
+            # samtools sort takes the prefix of the sorted BAM
+            tmp_sorted_prefix = tmp_outputs[0].rsplit(".bam", 1)[0]
+            utils.run_cmd("samtools sort %s %s" %(bam_filename,
+                                                  tmp_sorted_prefix),
+                          logger=self.logger)
+            # Index the sorted BAM
+            utils.run_cmd("samtools index %s" %(tmp_outputs[0]),
+                          logger=self.logger)
+        sample_cache = self.get_sample_cache(sample)
+        sample_cache.run_step("sort_and_index_bam.%s" %(bam_basename),
+                              [bam_filename],
+                              [expected_bam_filename,
+                               "%s.bai" %(expected_bam_filename)],
+                              sort_and_index,
+                              logger=self.logger)
         return expected_bam_filename
 
 
-    def get_ribosub_bam_reads(self, sample, chr_ribo="chrRibo"):
-        """
-        Subtract the rRNA-mapping reads away from the BAM file
-        and create a new BAM file.
+    def split_bam_reads(self, sample, chr_ribo="chrRibo"):
         """
-        self.logger.info("Getting rRNA-subtracted BAM file for %s" \
-                         %(sample.label))
-        mapped_reads = pysam.Samfile(sample.bam_filename, "rb")
-        if not sample.bam_filename.endswith(".bam"):
-            self.logger.critical("BAM %s file does not end in .bam" \
-                                 %(sample.bam_filename))
-        bam_basename = os.path.basename(sample.bam_filename)
-        ribosub_bam_filename = \
-            os.path.join(sample.processed_bam_dir,
-                         "%s.ribosub.bam" %(bam_basename[0:-4]))
-        self.logger.info("Getting rRNA-subtracted reads for %s" \
-                         %(sample.label))
-        self.logger.info("  - Output file: %s" %(ribosub_bam_filename))
-        if not os.path.isfile(ribosub_bam_filename):
-            # Get the ribosomal rRNA mapping reads
-            ribo_read_ids = {}
-            ribo_reads = []
-            try:
-                ribo_reads = mapped_reads.fetch(reference=chr_ribo,
-                                                start=None,
-                                                end=None,
-                                                multiple_iterators=True)
-            except:
-                self.logger.warning("Could not fetch %s from %s" \
-                                    %(chr_ribo,
-                                      sample.bam_filename))
-            for ribo_read in ribo_reads:
-                ribo_read_ids[ribo_read.qname] = True
-            num_ribo_reads = len(ribo_read_ids)
-            if num_ribo_reads == 0:
-                self.logger.warning("Could not find any rRNA mapping reads " \
-                                    "in %s" %(sample.bam_filename))
-            else:
-                self.logger.info("Subtracting %d rRNA reads from %s" \
-                                 %(num_ribo_reads,
-                                   sample.bam_filename))
-                self.logger.info("  - Subtracted BAM: %s" \
-                                 %(ribosub_bam_filename))
-            ribosub_bam = pysam.Samfile(ribosub_bam_filename, "wb",
-                                        # Use original file's headers
-                                        template=mapped_reads)
-            for read in mapped_reads:
-                # If the read has any mapping to rRNA, then
-                # skip it
-                if read.qname in ribo_read_ids:
-                    continue
-                ribosub_bam.write(read)
-            ribosub_bam.close()
-        else:
-            self.logger.info("Found %s. Skipping.." \
-                             %(ribosub_bam_filename))
-        mapped_reads.close()
-        return ribosub_bam_filename
-        
+        Get the uniquely mapping reads, the rRNA-subtracted reads
+        and the uniquely mapping rRNA-subtracted reads from the
+        sample's BAM file, putting each in a new sorted and
+        indexed BAM file.
 
-    def get_unique_reads(self, sample):
-        """
-        Get only the uniquely mapping reads from the reads BAM
-        file and put them in a new file.
+        All three BAM files are created in a single pass over
+        the sorted BAM file of the sample.
         """
-        self.logger.info("Getting unique reads for %s" %(sample.label))
+        self.logger.info("Splitting BAM reads for %s" %(sample.label))
         if not os.path.isfile(sample.bam_filename):
             bam_error = "Error: Cannot find BAM file %s\n" \
                         "Did your mapping step work? Check the Tophat/Bowtie " \
@@ -905,39 +1026,55 @@ class Pipeline:
                         %(sample.bam_filename)
             self.logger.critical(bam_error)
             sys.exit(1)
-        mapped_reads = pysam.Samfile(sample.bam_filename, "rb")
         if not sample.bam_filename.endswith(".bam"):
             self.logger.critical("BAM %s file does not end in .bam" \
                                  %(sample.bam_filename))
-        bam_basename = os.path.basename(sample.bam_filename)
-        unique_bam_filename = \
-            os.path.join(sample.processed_bam_dir,
-                         "%s.unique.bam" %(bam_basename[0:-4]))
-        self.logger.info("Getting unique reads for %s" \
-                         %(sample.label))
-        self.logger.info("  - Output file: %s" \
-                         %(unique_bam_filename))
-        if not os.path.isfile(unique_bam_filename):
-            # Get unique reads if file for them does not already
-            # exist
-            unique_reads = pysam.Samfile(unique_bam_filename, "wb",
-                                         # Use original file's headers
-                                         template=mapped_reads)
-            num_unique = 0
-            for read in mapped_reads:
-                # Keep only reads with 'NH' tag equal to 1
-                if ("NH", 1) in read.tags:
-                    unique_reads.write(read)
-                    num_unique += 1
-            if num_unique == 0:
+        bam_basename = os.path.basename(sample.bam_filename)[0:-4]
+        # Name outputs after the unsorted BAM file
+        if bam_basename.endswith(".sorted"):
+            bam_basename = bam_basename[0:-len(".sorted")]
+        output_fnames = {}
+        for output_type, output_ext in [("unique", "unique"),
+                                        ("ribosub", "ribosub"),
+                                        ("unique_ribosub", "unique.ribosub")]:
+            output_fnames[output_type] = \
+                os.path.join(sample.processed_bam_dir,
+                             "%s.%s.sorted.bam" %(bam_basename,
+                                                  output_ext))
+            self.logger.info("  - Output file: %s" \
+                             %(output_fnames[output_type]))
+        output_types = sorted(output_fnames.keys())
+        # Outputs are the split BAMs and their indexes
+        step_outputs = []
+        for output_type in output_types:
+            step_outputs.extend([output_fnames[output_type],
+                                 "%s.bai" %(output_fnames[output_type])])
+        def split_reads(tmp_outputs):
+            t1 = time.time()
+            tmp_fnames = dict(zip(output_types, tmp_outputs[0::2]))
+            num_reads = bam_utils.split_bam_reads(sample.bam_filename,
+                                                  tmp_fnames,
+                                                  chr_ribo=chr_ribo)
+            t2 = time.time()
+            if num_reads["unique"] == 0:
                 self.logger.warning("No unique reads found in %s" \
                                     %(sample.bam_filename))
-            unique_reads.close()
-        else:
-            self.logger.info("Found %s. Skipping.." \
-                             %(unique_bam_filename))
-        mapped_reads.close()
-        return unique_bam_filename
+            if num_reads["ribosub"] == 0:
+                self.logger.warning("No rRNA-subtracted reads found in %s" \
+                                    %(sample.bam_filename))
+            self.logger.info("Splitting BAM reads took %.2f minutes." \
+                             %((t2 - t1)/60.))
+        sample_cache = self.get_sample_cache(sample)
+        sample_cache.run_step("split_bam_reads",
+                              [sample.bam_filename],
+                              step_outputs,
+                              split_reads,
+                              settings={"chr_ribo": chr_ribo},
+                              logger=self.logger)
+        sample.unique_bam_filename = output_fnames["unique"]
+        sample.ribosub_bam_filename = output_fnames["ribosub"]
+        sample.unique_ribosub_bam_filename = output_fnames["unique_ribosub"]
+        return sample
     
 
     def run_qc(self, sample):
@@ -947,35 +1084,56 @@ class Pipeline:
         self.logger.info("Running QC on %s" %(sample.label))
         # Retrieve QC object for sample
         qc_obj = self.qc_objects[sample.label]
-        if qc_obj.qc_loaded:
-            # Don't load QC information if it already exists
-            self.logger.info("QC objects already loaded.")
-        else:
+        def compute_qc(tmp_outputs):
             # Run QC metrics
             qc_obj.compute_qc()
             # Output QC to file
-            qc_obj.output_qc()
+            qc_obj.output_qc(output_filename=tmp_outputs[0])
+        # QC depends on the BAM files, the raw reads and the
+        # regions that reads are counted in
+        qc_inputs = qc_obj.get_input_files()
+        sample_cache = self.get_sample_cache(sample)
+        sample_cache.run_step("run_qc",
+                              qc_inputs,
+                              [qc_obj.qc_filename],
+                              compute_qc,
+                              logger=self.logger)
         sample.qc = qc_obj
         return sample
         
 
+    def load_sample_qc(self, sample):
+        """
+        Load QC object of sample from its QC output.
+        """
+        self.logger.info("Loading QC output for %s" %(sample.label))
+        sample.qc = qc.QualityControl(sample, self)
+        return sample.qc
+
+
     def compile_qc_output(self):
         """
         Compile QC output for all samples.
+
+        QC output is compiled incrementally: only the QC output of
+        samples that changed since the last compilation is loaded
+        (see 'qc.compile_qc_stats'.)
         """
         self.logger.info("Compiling QC output for all samples...")
-        # Load QC information from existing files
-        self.load_qc()
-        # Get a compiled object representing the QC
-        # for all samples in the pipeline
-        qc_stats = qc.QCStats(self.samples,
-                              self.qc_header,
-                              self.qc_objects)
-        qc_stats.compile_qc()
         qc_output_filename = os.path.join(self.pipeline_outdirs["qc"],
                                           "qc_stats.txt")
+        # Get a compiled object representing the QC
+        # for all samples in the pipeline
+        qc_stats = qc.compile_qc_stats(self.samples,
+                                       self.pipeline_outdirs["qc"],
+                                       qc_output_filename,
+                                       self.qc_objects,
+                                       self.load_sample_qc)
+        self.qc_header = qc_stats.qc_header
         self.logger.info("Outputting QC to: %s" %(qc_output_filename))
         qc_stats.to_csv(qc_output_filename)
+        qc.save_compiled_fingerprints(qc_output_filename,
+                                      qc_stats.fingerprints)
 
 
     def compile_analysis_output(self):
@@ -990,22 +1148,38 @@ class Pipeline:
     def compile_rpkms_output(self):
         """
         Compile and output RPKMs for all samples.
+
+        Each sample's RPKMs and exons coverage are added to the
+        columnar stores of the RPKM tables (see ExpressionStore)
+        when they're first compiled or when they change, and the
+        combined tables are output from the stores.
         """
-        # Load RPKMs for all samples
-        self.load_rpkms()
-        # Output RPKM tables
+        sample_labels = [sample.label for sample in self.samples]
         # Order in which table columns should be serialized:
         # Gene ID first, followed by gene symbol, the counts for each sample,
         # followed by the exons used in the calculation and the
         # gene description
         fieldnames = ["gene_id", "gene_symbol"]
-        fieldnames.extend(["rpkm_%s" %(sample.label) \
-                           for sample in self.samples])
-        fieldnames.extend(["counts_%s" %(sample.label) \
-                           for sample in self.samples])
+        fieldnames.extend(["rpkm_%s" %(label) for label in sample_labels])
+        fieldnames.extend(["counts_%s" %(label) for label in sample_labels])
         fieldnames.extend(["gene_desc", "exons"])
-        for table_name, rpkm_table in self.rpkm_tables.iteritems():
-            if rpkm_table is None: continue
+        for table_name in self.rna_base.rpkm_table_names:
+            rpkm_store = rpkm_utils.update_rpkm_stores(self.samples,
+                                                       self.rpkm_dir,
+                                                       table_name,
+                                                       na_val=self.na_val)
+            if rpkm_store is None:
+                continue
+            # Skip the table unless all samples have RPKMs for it
+            if not all([rpkm_store.has_sample(label) \
+                        for label in sample_labels]):
+                continue
+            gene_table = self.rna_base.gene_tables[table_name.split(".")[0]]
+            rpkm_table = \
+              rpkm_utils.get_rpkm_table_from_store(rpkm_store,
+                                                   sample_labels,
+                                                   gene_table=gene_table)
+            self.rpkm_tables[table_name] = rpkm_table
             rpkm_table_filename = os.path.join(self.rpkm_dir,
                                                "%s.rpkm.txt" %(table_name))
             rpkm_table.to_csv(rpkm_table_filename,
@@ -1022,11 +1196,32 @@ class Pipeline:
         self.logger.info("Outputting RPKMs for sample: %s" \
                          %(sample.label))
         sample_rpkm_outdir = os.path.join(self.rpkm_dir, sample.label)
-        rpkm_tables = rpkm_utils.output_rpkm(sample,
-                                             sample_rpkm_outdir,
+        sample_cache = self.get_sample_cache(sample)
+        read_len = self.settings_info["mapping"]["readlen"]
+        for table_name, const_exons in \
+            self.rna_base.tables_to_const_exons.iteritems():
+            rpkm_fname = os.path.join(sample_rpkm_outdir,
+                                      "%s.rpkm" %(table_name))
+            coverage_fname = os.path.join(sample_rpkm_outdir,
+                                          "%s.coverage.txt" %(table_name))
+            def output_table_rpkm(tmp_outputs,
+                                  table_name=table_name,
+                                  const_exons=const_exons):
+                rpkm_utils.output_table_rpkm(sample,
+                                             table_name,
+                                             const_exons,
+                                             tmp_outputs[0],
                                              self.settings_info,
-                                             self.rna_base,
                                              self.logger)
+            # RPKMs depend on the number of mapped reads from QC
+            sample_cache.run_step("output_rpkms.%s" %(table_name),
+                                  [sample.ribosub_bam_filename,
+                                   const_exons.gff_filename,
+                                   sample.qc.qc_filename],
+                                  [rpkm_fname, coverage_fname],
+                                  output_table_rpkm,
+                                  settings={"readlen": read_len},
+                                  logger=self.logger)
         return sample
 
     
@@ -1053,32 +1248,34 @@ class Pipeline:
             utils.get_gff_filenames_in_dir(self.gff_events_dir)
         gff_labels = [os.path.basename(utils.trim_gff_ext(f)) \
                       for f in gff_filenames]
+        sample_cache = self.get_sample_cache(sample)
         # Run tagBam against all events, outputting a BAM for each
         for gff_fname, gff_label in zip(gff_filenames, gff_labels):
             bam_events_fname = \
                 os.path.join(sample_events_bam_outdir,
                              "%s.bam" %(gff_label))
-            if os.path.isfile(bam_events_fname):
-                self.logger.info("Found %s, skipping.." %(bam_events_fname))
-            else:
-                # Map BAM reads to events GFF
-                bedtools_utils.multi_tagBam(sample.unique_bam_filename,
-                                            [gff_fname],
-                                            [gff_label],
-                                            bam_events_fname,
-                                            self.logger)
             # Run coverageBed against all events
             coverage_events_fname = \
                 os.path.join(sample_events_bed_outdir,
                              "%s.bed" %(gff_label))
-            if os.path.isfile(coverage_events_fname):
-                self.logger.info("Found %s, skipping.." \
-                                 %(coverage_events_fname))
-            else:
-                bedtools_utils.coverageBed(sample.unique_bam_filename,
-                                           gff_fname,
-                                           coverage_events_fname,
-                                           self.logger)
+            def map_events(tmp_outputs):
+                # Map BAM reads to events GFF
+                if bedtools_utils.multi_tagBam(sample.unique_bam_filename,
+                                               [gff_fname],
+                                               [gff_label],
+                                               tmp_outputs[0],
+                                               self.logger) is None:
+                    raise Exception, "tagBam failed on %s" %(gff_fname)
+                if bedtools_utils.coverageBed(sample.unique_bam_filename,
+                                              gff_fname,
+                                              tmp_outputs[1],
+                                              self.logger) is None:
+                    raise Exception, "coverageBed failed on %s" %(gff_fname)
+            sample_cache.run_step("output_events_mapping.%s" %(gff_label),
+                                  [sample.unique_bam_filename, gff_fname],
+                                  [bam_events_fname, coverage_events_fname],
+                                  map_events,
+                                  logger=self.logger)
         self.logger.info("Events mapping completed.")
 
 
@@ -1095,6 +1292,7 @@ class Pipeline:
         self.logger.info("Outputting reads as BED for %s" %(sample.label))
         sample_bed_dir = os.path.join(self.bed_dir, sample.label)
         utils.make_dir(sample_bed_dir)
+        sample_cache = self.get_sample_cache(sample)
         for bam_label in bams_to_convert:
             bam_fname = bams_to_convert[bam_label]
             bam_basename = \
@@ -1102,12 +1300,18 @@ class Pipeline:
             bed_fname = \
                 os.path.join(sample_bed_dir, "%s.bed" %(bam_basename))
             sample.reads_bed_fnames[bam_label] = bed_fname
-            if os.path.isfile(bed_fname):
-                self.logger.info("Found %s, skipping.." %(bed_fname))
-                continue
-            bam_utils.bam_to_bed(bam_fname, bed_fname,
-                                 extend_read_to_len=extend_read_to_len,
-                                 skip_junctions=skip_junctions)
+            def bam_to_bed(tmp_outputs):
+                bam_utils.bam_to_bed(bam_fname, tmp_outputs[0],
+                                     extend_read_to_len=extend_read_to_len,
+                                     skip_junctions=skip_junctions)
+            sample_cache.run_step("output_reads_as_bed.%s" %(bam_label),
+                                  [bam_fname],
+                                  [bed_fname],
+                                  bam_to_bed,
+                                  settings={"extend_read_to_len": \
+                                              extend_read_to_len,
+                                            "skip_junctions": skip_junctions},
+                                  logger=self.logger)
         self.logger.info("Done outputting reads as BED.")
 
 
@@ -1133,6 +1337,16 @@ class Pipeline:
         # Record sample's clusters directory
         sample.clusters_dir = sample_clusters_dir
         utils.make_dir(sample_clusters_dir)
+        if not os.path.isfile(self.genes_gff_fname):
+            self.logger.critical("Cannot annotate clusters with genes " \
+                                 "since GFF %s not found." \
+                                 %(self.genes_gff_fname))
+            sys.exit(1)
+        self.logger.info("Mapping clusters to GFF files from: %s" \
+                         %(self.gff_events_dir))
+        gff_filenames = \
+            utils.get_gff_filenames_in_dir(self.gff_events_dir)
+        sample_cache = self.get_sample_cache(sample)
         ##
         ## For rRNA-subtracted BAM and the unique BAM,
         ## find the clusters and intersect clusters with
@@ -1147,52 +1361,61 @@ class Pipeline:
             sample.clusters_fnames[bam_label] = \
                 "%s.clusters.bed" %(os.path.join(sample_clusters_dir,
                                                  bed_basename))
-            # Final command: convert, cluster, merge
-            t1 = time.time()
-            self.logger.info("Filtering clusters..")
-            if not os.path.isfile(self.genes_gff_fname):
-                self.logger.critical("Cannot annotate clusters with genes " \
-                                     "since GFF %s not found." \
-                                     %(self.genes_gff_fname))
-                sys.exit(1)
-            clusters_fname = \
-                clip_utils.output_clip_clusters(self.logger,
-                                                bed_fname_to_use,
-                                                sample.clusters_fnames[bam_label],
-                                                self.genes_gff_fname,
-                                                cluster_dist=cluster_dist)
-            # Filter the clusters
             sample.filtered_clusters_fnames[bam_label] = \
-                clip_utils.filter_clusters(self.logger,
-                                           sample.clusters_fnames[bam_label],
-                                           os.path.dirname(clusters_fname))
-            self.logger.info("Filtered clusters outputted to: %s" \
-                             %(sample.filtered_clusters_fnames[bam_label]))
-            # Filter the clusters
-            t2 = time.time()
-            if clusters_fname is None:
-                self.logger.critical("Cluster for %s finding failed." \
-                                     %(sample.label))
-                sys.exit(1)
-            self.logger.info("Cluster finding took %.2f minutes" \
-                             %((t2 - t1)/60.))
-            ##
-            ## Merge the resulting clusters with every event file
-            ##
-            self.logger.info("Mapping clusters to GFF files from: %s" \
-                             %(self.gff_events_dir))
-            gff_filenames = \
-                utils.get_gff_filenames_in_dir(self.gff_events_dir)
-            # Make directory for clusters intersected with events
+                clip_utils.get_filtered_clusters_fname(sample.clusters_fnames[bam_label],
+                                                       sample_clusters_dir)
+            # Directory for clusters intersected with events
             event_clusters_dir = os.path.join(sample_clusters_dir,
                                               "by_events",
                                               bam_label)
-            utils.make_dir(event_clusters_dir)
-            # Intersect current clusters with GFF events
-            clip_utils.intersect_clusters_with_gff(self.logger,
-                                                   clusters_fname,
-                                                   gff_filenames,
-                                                   event_clusters_dir)
+            event_clusters_fnames = \
+                [os.path.join(event_clusters_dir,
+                              "%s.clusters.bed" \
+                              %(os.path.basename(utils.trim_gff_ext(f)))) \
+                 for f in gff_filenames]
+            def find_clusters(tmp_outputs):
+                # Final command: convert, cluster, merge
+                t1 = time.time()
+                clusters_fname = \
+                    clip_utils.output_clip_clusters(self.logger,
+                                                    bed_fname_to_use,
+                                                    tmp_outputs[0],
+                                                    self.genes_gff_fname,
+                                                    cluster_dist=cluster_dist)
+                if clusters_fname is None:
+                    raise Exception, "Cluster finding for %s failed." \
+                          %(sample.label)
+                # Filter the clusters
+                self.logger.info("Filtering clusters..")
+                clip_utils.filter_clusters(self.logger,
+                                           clusters_fname,
+                                           os.path.dirname(tmp_outputs[1]))
+                t2 = time.time()
+                self.logger.info("Cluster finding took %.2f minutes" \
+                                 %((t2 - t1)/60.))
+                ##
+                ## Merge the resulting clusters with every event file
+                ##
+                # Intersect current clusters with GFF events
+                intersected_fnames = \
+                    clip_utils.intersect_clusters_with_gff(self.logger,
+                                                           clusters_fname,
+                                                           gff_filenames,
+                                                           os.path.dirname(tmp_outputs[0]))
+                if len(intersected_fnames) != len(gff_filenames):
+                    raise Exception, "Could not intersect clusters of %s " \
+                          "with all GFF files." %(sample.label)
+            sample_cache.run_step("output_clusters.%s" %(bam_label),
+                                  [bed_fname_to_use,
+                                   self.genes_gff_fname] + gff_filenames,
+                                  [sample.clusters_fnames[bam_label],
+                                   sample.filtered_clusters_fnames[bam_label]] + \
+                                  event_clusters_fnames,
+                                  find_clusters,
+                                  settings={"cluster_dist": cluster_dist},
+                                  logger=self.logger)
+            self.logger.info("Filtered clusters outputted to: %s" \
+                             %(sample.filtered_clusters_fnames[bam_label]))
             self.logger.info("Finished outputting clusters.")
 
 
@@ -1290,13 +1513,20 @@ class Pipeline:
             sample.filtered_clusters_seqs_fnames = clusters_seqs_fnames
 
 
-    def output_motifs(self, sample):
+    def get_motifs_outdir(self, sample):
         """
-        Wrapper to all motif finding methods.
+        Return motifs output directory of sample.
         """
         sample.motifs_outdir = os.path.join(self.motifs_dir,
                                             sample.label)
         utils.make_dir(sample.motifs_outdir)
+        return sample.motifs_outdir
+
+
+    def output_motifs(self, sample):
+        """
+        Wrapper to all motif finding methods.
+        """
         # Find enriched kmers 
         self.output_enriched_kmers(sample)
         # Find motifs
@@ -1304,7 +1534,7 @@ class Pipeline:
                   
 
     def output_enriched_kmers(self, sample,
-                              kmer_lens=[4,5,6,7,8],
+                              kmer_lens=KMER_LENS,
                               num_shuffles=100):
         """
         Output enriched kmers by kmer counting methods.
@@ -1312,7 +1542,8 @@ class Pipeline:
         self.logger.info("Outputting enriched motifs for %s" \
                          %(sample.label))
         # Enriched kmers directory
-        sample.kmers_dir = os.path.join(sample.motifs_outdir, "kmers")
+        sample.kmers_dir = os.path.join(self.get_motifs_outdir(sample),
+                                        "kmers")
         utils.make_dir(sample.kmers_dir)
         # Output enriched Kmers for both types of filtered clusters
         for bam_type in sample.filtered_clusters_seqs_fnames:
@@ -1324,7 +1555,8 @@ class Pipeline:
                                                    clusters_fname,
                                                    output_dir,
                                                    kmer_lens,
-                                                   num_shuffles=100)
+                                                   num_shuffles=100,
+                                                   num_procs=self.settings_info["mapping"]["num_processors"])
 
 
     def output_homer_motifs(self, sample,
@@ -1346,7 +1578,7 @@ class Pipeline:
             homer_utils.run_homer(self.logger,
                                   sample.filtered_clusters_fnames[bam_label],
                                   self.rna_base.genome,
-                                  os.path.join(sample.motifs_outdir,
+                                  os.path.join(self.get_motifs_outdir(sample),
                                                bam_label,
                                                "no_rna"),
                                   homer_params)
@@ -1372,19 +1604,25 @@ class Pipeline:
         # and for the uniquely mapping BAM
         bams_to_convert = [sample.ribosub_bam_filename,
                            sample.unique_bam_filename]
+        sample_cache = self.get_sample_cache(sample)
         for bam_fname in bams_to_convert:
-            bam_basename = \
-                os.path.basename(sample.ribosub_bam_filename)
+            bam_basename = os.path.basename(bam_fname)
             bam_basename = bam_basename.rsplit(".bam", 1)[0]
             bigWig_fname = os.path.join(tracks_outdir,
                                         "%s.bigWig" %(bam_basename))
-            if os.path.isfile(bigWig_fname):
-                self.logger.info("Found %s, skipping.." %(bigWig_fname))
-                continue
-            # Convert BAM file to bigWig file
-            bam_utils.bam_to_bigWig_file(bam_fname,
-                                         bigWig_fname,
-                                         self.rna_base.genome)
+            def bam_to_bigWig(tmp_outputs):
+                # Convert BAM file to bigWig file
+                if bam_utils.bam_to_bigWig_file(bam_fname,
+                                                tmp_outputs[0],
+                                                self.rna_base.genome) is None:
+                    raise Exception, "Could not convert %s to bigWig." \
+                          %(bam_fname)
+            sample_cache.run_step("output_bigWigs.%s" %(bam_basename),
+                                  [bam_fname],
+                                  [bigWig_fname],
+                                  bam_to_bigWig,
+                                  settings={"genome": self.rna_base.genome},
+                                  logger=self.logger)
             self.logger.info("  - Output file: %s" %(bigWig_fname))
         self.logger.info("Done outputting bigWigs.")
 
@@ -1,13 +1,18 @@
 import os
 import sys
 import time
+import itertools
 
 import logging
 import csv
 
 import rnaseqlib
 import rnaseqlib.fastx_utils as fastx_utils
+import rnaseqlib.fastq_utils as fastq_utils
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
+import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.bam_parallel as bam_parallel
+import rnaseqlib.mapping.IntervalIndex as interval_index
 import rnaseqlib.utils as utils
 
 import numpy
@@ -19,6 +24,26 @@ import pysam
 from collections import defaultdict
 
 
+def get_qc_filename(qc_outdir, sample_label):
+    """
+    Return QC output filename of a sample.
+    """
+    return os.path.join(qc_outdir, sample_label,
+                        "%s.qc.txt" %(sample_label))
+
+
+def load_qc_results(qc_filename):
+    """
+    Load QC header and QC field values (as strings) from a
+    sample's QC output file.
+    """
+    with open(qc_filename, "r") as qc_file:
+        qc_in = csv.DictReader(qc_file, delimiter="\t")
+        qc_header = qc_in.fieldnames
+        qc_results = qc_in.next()
+    return qc_header, qc_results
+
+
 class QualityControl:
     """ 
     Quality control object. Defined for
@@ -72,8 +97,7 @@ class QualityControl:
         # Regions output dir
         self.regions_outdir = os.path.join(self.sample_outdir, "regions")
         utils.make_dir(self.regions_outdir)
-        self.qc_filename = os.path.join(self.sample_outdir,
-                                        "%s.qc.txt" %(self.sample.label))
+        self.qc_filename = get_qc_filename(self.qc_outdir, self.sample.label)
         self.qc_loaded = False
         # use ensGene gene table for QC computations
         self.gene_table = self.pipeline.rna_base.gene_tables["ensGene"]
@@ -89,12 +113,9 @@ class QualityControl:
         self.logger.info("Attempting to load QC from file...")
         if os.path.isfile(self.qc_filename):
             self.logger.info("Loaded: %s" %(self.qc_filename))
-            qc_in = csv.DictReader(open(self.qc_filename, "r"),
-                                   delimiter="\t")
-            # Load existing header
-            self.qc_header = qc_in.fieldnames
-            # Load QC field values
-            self.qc_results = qc_in.next()
+            # Load existing header and QC field values
+            self.qc_header, self.qc_results = \
+                load_qc_results(self.qc_filename)
             self.qc_loaded = True
             
 
@@ -113,22 +134,16 @@ class QualityControl:
             # Paired-end
             mate_reads = []
             for mate_rawdata in self.sample.rawdata:
-                num_reads = 0
-                fastx_entries = \
-                    fastx_utils.get_fastx_entries(mate_rawdata.reads_filename)
-                for entry in fastx_entries:
-                    num_reads += 1
+                num_reads = \
+                    fastx_utils.count_fastx_entries(mate_rawdata.reads_filename)
                 mate_reads.append(num_reads)
             pair_num_reads = ",".join(map(str, mate_reads))
             return pair_num_reads
         else:
             self.logger.info("Getting number of single-end reads.")
-            num_reads = 0
             # Single-end
-            fastx_entries = \
-                fastx_utils.get_fastx_entries(self.sample.rawdata.reads_filename)
-            for entry in fastx_entries:
-                num_reads += 1
+            num_reads = \
+                fastx_utils.count_fastx_entries(self.sample.rawdata.reads_filename)
             return num_reads
 
             
@@ -144,8 +159,11 @@ class QualityControl:
 
     def get_num_unique_mapped(self):
         self.logger.info("Getting number of unique reads.")
+        # The unique BAM only has uniquely mapping reads, so the
+        # count can be taken from its index
         num_unique_mapped = \
-            count_nondup_reads(self.sample.unique_bam_filename)
+            count_nondup_reads(self.sample.unique_bam_filename,
+                               all_unique=True)
         return num_unique_mapped
 
 
@@ -323,6 +341,25 @@ class QualityControl:
         return [r[0] for r in region_files], [r[1] for r in region_files]
 
 
+    def get_input_files(self):
+        """
+        Get the files that QC is computed from: the sample's BAM
+        files, its reads files (FASTA/FASTQ) and the region files
+        reads are counted in.
+        """
+        input_files = [self.sample.bam_filename,
+                       self.sample.unique_bam_filename,
+                       self.sample.ribosub_bam_filename]
+        if self.sample.paired:
+            input_files.extend([mate_rawdata.reads_filename \
+                                for mate_rawdata in self.sample.rawdata])
+        else:
+            input_files.append(self.sample.rawdata.reads_filename)
+        region_files, region_labels = self.get_region_files()
+        input_files.extend(region_files)
+        return input_files
+
+
     def compute_region_lens(self):
         """
         Compute the lengths of the relevant regions
@@ -363,27 +400,24 @@ class QualityControl:
                 self.logger.critical("Cannot find regions filename for %s" \
                                      %(fname))
                 sys.exit(1)
-        self.qc_regions_bam = \
-            os.path.join(self.regions_outdir, "qc_regions.bam")
-        if not os.path.isfile(self.qc_regions_bam):
-            num_regions = len(region_filenames)
-            self.logger.info("Mapping reads to %d region types." \
-                             %(num_regions))
-            # Compute which reads map to each region
-            region_results = \
-                bedtools_utils.multi_tagBam(self.sample.unique_bam_filename,
-                                            region_filenames,
-                                            region_labels,
-                                            self.qc_regions_bam,
-                                            self.logger)
-            if region_results is None:
-                self.logger.critical("Mapping of reads to QC regions failed.")
-                sys.exit(1)
-        else:
-            self.logger.info("QC regions BAM %s found, skipping.." \
-                             %(self.qc_regions_bam))
-        region_counts = \
-            self.count_reads_in_qc_regions(self.qc_regions_bam)
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        # Index the regions and classify the uniquely mapped
+        # reads against them directly
+        self.logger.info("Indexing %d region types." \
+                         %(len(region_filenames)))
+        regions_index = load_qc_regions_index(region_filenames,
+                                              region_labels)
+        self.logger.info("Counting reads in: %s" \
+                         %(self.sample.unique_bam_filename))
+        t1 = time.time()
+        region_counts, self.region_counts_by_transcript = \
+            count_qc_regions_in_bam(self.sample.unique_bam_filename,
+                                    regions_index,
+                                    num_processors=num_processors)
+        t2 = time.time()
+        self.logger.info("Counting reads in QC regions took %.2f minutes." \
+                         %((t2 - t1)/60.))
+        self.record_region_counts(region_counts)
         self.logger.info("Done counting reads in QC regions.")
 
 
@@ -396,67 +430,21 @@ class QualityControl:
             self.logger.critical("Cannot found reads, BAM file %s not found." \
                                  %(qc_regions_bam))
             return
-        # Count reads in exons
-        bam_file = pysam.Samfile(qc_regions_bam, "rb")
         self.logger.info("Counting reads in: %s" %(qc_regions_bam))
-        region_counts = defaultdict(int)
+        num_processors = self.settings_info["mapping"]["num_processors"]
         ##
         ## Map transcripts to region types and hits
         ##
-        self.region_counts_by_transcript = \
-            defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-        for bam_read in bam_file:
-            # Read aligns to region of interest
-            regions_field = None
-            try:
-                regions_field = bam_read.opt("YB")
-            except KeyError:
-                continue
-            region_coordinates, regions_detected = \
-                bedtools_utils.parse_tagBam_region(regions_field)
-            for region_info in region_coordinates:
-                curr_region, region_type, transcripts = \
-                    region_info
-                for curr_transcript in transcripts:
-                    transcript_info = \
-                        self.region_counts_by_transcript[curr_transcript]
-                    transcript_info[region_type][curr_region] += 1
-            ## Rules for counting regions
-            ##
-            # Count junction reads but do not use them
-            # in counting regions
-            # (3 signals "N" in cigar string)
-            # First check if it's a junction
-            if (len(bam_read.cigar) > 1) and \
-               (3 in [c[0] for c in bam_read.cigar]):
-                # It's a junction read
-                region_counts["num_junctions"] += 1
-            # Then check if it's a tRNA
-            if "tRNAs" in regions_detected:
-                # It's a tRNA
-                region_counts["num_tRNAs"] += 1
-                continue
-            # Check if it's in a CDS region
-            if "cds_only.merged_exons" in regions_detected:
-                region_counts["num_cds"] += 1
-                continue
-            # Check if it's in a 3' UTR
-            if "3p_utrs" in regions_detected:
-                region_counts["num_3p_utr"] += 1
-                continue
-            # Check if it's in a 5' UTR
-            if "5p_utrs" in regions_detected:
-                region_counts["num_5p_utr"] += 1
-                continue
-            # Check if it's in a generic exonic region
-            # which is non-CDS, non-UTR
-            if "merged_exons" in regions_detected:
-                region_counts["num_other_exons"] += 1
-            elif ("introns" in regions_detected) and \
-                 (len(regions_detected) == 1):
-                # It maps to an intron and only an intron, count it
-                # as intronic read
-                region_counts["num_introns"] += 1
+        region_counts, self.region_counts_by_transcript = \
+            count_qc_regions(qc_regions_bam,
+                             num_processors=num_processors)
+        self.record_region_counts(region_counts)
+
+
+    def record_region_counts(self, region_counts):
+        """
+        Record the counts of reads in QC regions in the QC results.
+        """
         self.qc_results["num_cds"] = region_counts["num_cds"]
         self.qc_results["num_introns"] = region_counts["num_introns"]
         self.qc_results["num_3p_utr"] = region_counts["num_3p_utr"]
@@ -758,19 +746,25 @@ class QualityControl:
         return self.qc_results
         
         
-    def output_qc(self):
+    def output_qc(self, output_filename=None):
         """
         Output QC metrics for sample.
-        """
-        if os.path.isfile(self.qc_filename):
-            print "SKIPPING %s, since %s already exists..." \
-                %(self.sample.label,
-                  self.qc_filename)
-            return None
+
+        Kwargs:
+        - output_filename: file to output to. By default, output
+          to the sample's QC file unless it exists.
+        """
+        if output_filename is None:
+            output_filename = self.qc_filename
+            if os.path.isfile(self.qc_filename):
+                print "SKIPPING %s, since %s already exists..." \
+                    %(self.sample.label,
+                      self.qc_filename)
+                return None
         # Header for QC output file for sample
         qc_df = pandas.DataFrame([self.qc_results])
         # Write QC information as csv
-        qc_df.to_csv(self.qc_filename,
+        qc_df.to_csv(output_filename,
                      cols=self.qc_header,
                      na_rep=self.na_val,
                      float_format="%.3f",
@@ -779,40 +773,32 @@ class QualityControl:
         
 
     def get_seq_cycle_profile(self, fastq_filename,
-                              first_n_seqs=None):
+                              first_n_seqs=None,
+                              random_n_seqs=None):
         """
         Compute the average 'N' bases (unable to sequence)
         as a function of the position of the read.
+
+        Kwargs:
+        - first_n_seqs: only look at first N reads
+        - random_n_seqs: only look at a random sample of N reads
+
+        See 'compute_cycle_profile' for base composition and
+        quality scores by position.
         """
-        fastq_entries = fastx_utils.get_read_fastx(fastq_filename)
-        # Mapping from position in read to number of Ns
-        num_n_bases = defaultdict(int)
-        # Mapping from position in read to total number of
-        # reads in that position
-        num_reads = defaultdict(int)
-        num_entries = 0
         print "Computing sequence cycle profile for: %s" %(fastq_filename)
+        num_seqs, sampling = None, "first"
         if first_n_seqs != None:
             print "Looking at first %d sequences only" %(first_n_seqs)
-        for entry in fastq_entries:
-            if first_n_seqs != None:
-                # Stop at requested number of entries if asked to
-                if num_entries >= first_n_seqs:
-                    break
-            header1, seq, header2, qual = entry
-            seq_len = len(seq)
-            for n in range(seq_len):
-                if seq[n] == "N":
-                    # Record occurrences of N
-                    num_n_bases[n] += 1
-                num_reads[n] += 1
-            num_entries += 1
-        # Compute percentage of N along each position
-        percent_n = []
-        for base_pos in range(max(num_reads.keys())):
-            curr_percent_n = \
-                float(num_n_bases[base_pos]) / num_reads[base_pos]
-            percent_n.append(curr_percent_n)
+            num_seqs = first_n_seqs
+        elif random_n_seqs != None:
+            print "Looking at random %d sequences only" %(random_n_seqs)
+            num_seqs, sampling = random_n_seqs, "random"
+        profile = compute_cycle_profile(fastq_filename,
+                                        num_seqs=num_seqs,
+                                        sampling=sampling)
+        # Percentage of N along each position
+        percent_n = list(profile.get_percent_n())
         return percent_n
 
         
@@ -821,10 +807,19 @@ class QCStats:
     Represntation of QC stats for a set of samples.
     """
     def __init__(self, samples, qc_header, qc_objects,
-                 sample_header="sample"):
+                 sample_header="sample",
+                 compiled_results=None):
         self.samples = samples
         self.sample_header = sample_header
         self.qc_objects = qc_objects
+        # Mapping from sample label to QC results taken from
+        # previously compiled QC stats, for samples whose
+        # QC output is unchanged
+        if compiled_results is None:
+            compiled_results = {}
+        self.compiled_results = compiled_results
+        # Fingerprints of the samples' QC output
+        self.fingerprints = None
         self.qc_stats = None
         self.qc_header = qc_header
         self.na_val = "NA"
@@ -850,7 +845,10 @@ class QCStats:
         qc_entries = []
         for sample in self.samples:
             # Copy sample's QC results
-            sample_qc_results = self.qc_objects[sample.label].qc_results
+            if sample.label in self.compiled_results:
+                sample_qc_results = self.compiled_results[sample.label]
+            else:
+                sample_qc_results = self.qc_objects[sample.label].qc_results
             qc_entry = sample_qc_results.copy()
             # Record sample name
             qc_entry[self.sample_header] = sample.label
@@ -876,26 +874,556 @@ class QCStats:
                              index=False,
                              cols=output_header)
 
+# Key of the compiled output's own fingerprint in fingerprints files
+COMPILED_FINGERPRINT_KEY = "#compiled"
+
+
+def get_qc_fingerprints(qc_outdir, sample_labels):
+    """
+    Return mapping from sample label to the fingerprint of
+    its QC output file.
+    """
+    return dict([(label,
+                  utils.get_files_fingerprint([get_qc_filename(qc_outdir,
+                                                               label)])) \
+                 for label in sample_labels])
+
+
+def load_compiled_qc(qc_stats_filename, fingerprints,
+                     sample_header="sample"):
+    """
+    Load QC results of samples from compiled QC stats, for
+    the samples whose QC output is unchanged since the stats
+    were compiled (see 'compile_qc_stats').
+
+    Args:
+    - qc_stats_filename: compiled QC stats filename
+    - fingerprints: mapping from sample label to the current
+      fingerprint of the sample's QC output
+
+    Returns the QC header of the compiled stats and a mapping
+    from sample label to its QC results (as strings), or None
+    and an empty mapping if there are no usable compiled stats.
+    """
+    compiled_fingerprints = \
+        utils.load_fingerprints(get_fingerprints_fname(qc_stats_filename))
+    # The compiled stats must be the ones the fingerprints were
+    # saved with
+    stats_fingerprint = utils.get_files_fingerprint([qc_stats_filename])
+    if (stats_fingerprint is None) or \
+       (compiled_fingerprints.get(COMPILED_FINGERPRINT_KEY) != \
+        stats_fingerprint):
+        return None, {}
+    qc_stats = pandas.read_csv(qc_stats_filename, sep="\t",
+                               dtype=str,
+                               keep_default_na=False)
+    qc_header = list(qc_stats.columns[1:])
+    compiled_results = {}
+    for qc_entry in qc_stats.to_dict("records"):
+        label = qc_entry.pop(sample_header)
+        if (label not in fingerprints) or (fingerprints[label] is None):
+            continue
+        if compiled_fingerprints.get(label) != fingerprints[label]:
+            continue
+        compiled_results[label] = qc_entry
+    return qc_header, compiled_results
+
+
+def compile_qc_stats(samples, qc_outdir, qc_stats_filename,
+                     qc_objects, load_qc_object,
+                     sample_header="sample"):
+    """
+    Compile QC stats of samples incrementally: samples whose
+    QC output is unchanged since 'qc_stats_filename' was compiled
+    are taken from it, and only the other samples' QC output is
+    loaded. The result is the same as compiling all samples.
+
+    Args:
+    - samples: samples to compile
+    - qc_outdir: QC output directory
+    - qc_stats_filename: compiled QC stats filename
+    - qc_objects: mapping from sample label to QC object, updated
+      with the QC objects that are loaded
+    - load_qc_object: function that loads the QC object of a sample
+
+    Returns a QCStats object, with the samples' fingerprints in
+    its 'fingerprints' attribute (to be saved with
+    'save_compiled_fingerprints' once the stats are output.)
+    """
+    sample_labels = [sample.label for sample in samples]
+    fingerprints = get_qc_fingerprints(qc_outdir, sample_labels)
+    compiled_header, compiled_results = \
+        load_compiled_qc(qc_stats_filename, fingerprints,
+                         sample_header=sample_header)
+    for sample in samples:
+        if sample.label in compiled_results:
+            continue
+        qc_objects[sample.label] = load_qc_object(sample)
+    print "Reusing compiled QC stats for %d of %d samples" \
+        %(len(compiled_results), len(samples))
+    # Get QC header from first sample
+    first_label = sample_labels[0]
+    if first_label in compiled_results:
+        qc_header = compiled_header
+    else:
+        qc_header = qc_objects[first_label].qc_header
+    qc_stats = QCStats(samples, qc_header, qc_objects,
+                       sample_header=sample_header,
+                       compiled_results=compiled_results)
+    qc_stats.compile_qc()
+    qc_stats.fingerprints = fingerprints
+    return qc_stats
+
+
+def get_fingerprints_fname(compiled_filename):
+    """
+    Return filename of the fingerprints of the sample outputs
+    that a compiled output was made from.
+    """
+    return "%s.fingerprints" %(compiled_filename)
+
+
+def save_compiled_fingerprints(compiled_filename, fingerprints):
+    """
+    Save fingerprints of sample outputs along with the
+    fingerprint of the compiled output made from them.
+    """
+    fingerprints = dict(fingerprints)
+    fingerprints[COMPILED_FINGERPRINT_KEY] = \
+        utils.get_files_fingerprint([compiled_filename])
+    utils.save_fingerprints(get_fingerprints_fname(compiled_filename),
+                            fingerprints)
+
+
+##
+## Sequencing cycle profiles
+##
+class CycleProfile:
+    """
+    Per-cycle (position in read) profile of the bases and
+    quality scores of a set of reads.
+
+    Reads are added in batches, and each batch is converted to
+    a matrix of bytes (one row per read, one column per cycle)
+    so that the counts are computed with numpy rather than
+    base by base.
+    """
+    def __init__(self):
+        self.num_reads = 0
+        # Counts of each byte value at each cycle, for
+        # sequences and for qualities
+        self.seq_counts = numpy.zeros((0, 256), dtype=numpy.int64)
+        self.qual_counts = numpy.zeros((0, 256), dtype=numpy.int64)
+
+
+    def resize(self, num_cycles):
+        """
+        Grow the counts to have at least 'num_cycles' cycles.
+        """
+        curr_cycles = self.seq_counts.shape[0]
+        if num_cycles <= curr_cycles:
+            return
+        extra_counts = numpy.zeros((num_cycles - curr_cycles, 256),
+                                   dtype=numpy.int64)
+        self.seq_counts = numpy.vstack([self.seq_counts, extra_counts])
+        self.qual_counts = numpy.vstack([self.qual_counts, extra_counts])
+
+
+    def add_batch(self, seqs, quals):
+        """
+        Add a batch of reads, given as lists of sequences and
+        qualities.
+        """
+        if len(seqs) == 0:
+            return
+        seq_matrix = lines_to_byte_matrix(seqs)
+        qual_matrix = lines_to_byte_matrix(quals)
+        self.resize(max(seq_matrix.shape[1], qual_matrix.shape[1]))
+        for cycle in xrange(seq_matrix.shape[1]):
+            self.seq_counts[cycle] += \
+                numpy.bincount(seq_matrix[:, cycle], minlength=256)
+        for cycle in xrange(qual_matrix.shape[1]):
+            self.qual_counts[cycle] += \
+                numpy.bincount(qual_matrix[:, cycle], minlength=256)
+        self.num_reads += len(seqs)
+
+
+    def get_num_cycle_reads(self):
+        """
+        Return number of reads that have a base at each cycle.
+        """
+        # Byte value 0 is used for padding of shorter reads
+        return self.seq_counts[:, 1:].sum(axis=1)
+
+
+    def get_percent_n(self):
+        """
+        Return the fraction of 'N' bases at each cycle.
+        """
+        return self.get_base_fractions()["N"]
+
+
+    def get_base_fractions(self, bases="ACGTN"):
+        """
+        Return mapping from base to the fraction of reads that
+        have that base at each cycle.
+        """
+        num_cycle_reads = self.get_num_cycle_reads().astype(float)
+        base_fractions = {}
+        for base in bases:
+            base_fractions[base] = \
+                self.seq_counts[:, ord(base)] / num_cycle_reads
+        return base_fractions
+
+
+    def get_qual_hist(self, phred_offset=33):
+        """
+        Return matrix of counts of each quality score (column)
+        at each cycle (row), for quality scores from 0 up to
+        the highest score seen.
+        """
+        qual_hist = self.qual_counts[:, phred_offset:127]
+        seen_quals = numpy.nonzero(qual_hist.sum(axis=0))[0]
+        if len(seen_quals) == 0:
+            return qual_hist[:, 0:0]
+        return qual_hist[:, 0:(seen_quals[-1] + 1)]
+
+
+    def get_mean_quals(self, phred_offset=33):
+        """
+        Return the mean quality score at each cycle.
+        """
+        qual_hist = self.get_qual_hist(phred_offset=phred_offset)
+        quals = numpy.arange(qual_hist.shape[1])
+        return (qual_hist * quals).sum(axis=1) / \
+            qual_hist.sum(axis=1).astype(float)
+
+
+def lines_to_byte_matrix(lines):
+    """
+    Convert list of lines (without newlines) to a matrix of bytes
+    with one row per line. Lines shorter than the longest line are
+    padded with zeros.
+    """
+    num_lines = len(lines)
+    line_lens = numpy.fromiter(itertools.imap(len, lines), dtype=numpy.int64,
+                               count=num_lines)
+    max_len = int(line_lens.max())
+    if (line_lens == max_len).all():
+        joined_lines = "".join(lines)
+    else:
+        joined_lines = "".join([line.ljust(max_len, "\0") \
+                                for line in lines])
+    byte_matrix = numpy.frombuffer(joined_lines, dtype=numpy.uint8)
+    return byte_matrix.reshape((num_lines, max_len))
+
+
+def sample_fastq_reads(fastq_filename, num_seqs,
+                       batch_size=50000,
+                       seed=None):
+    """
+    Return a uniformly random sample of 'num_seqs' reads from
+    FASTQ file, as lists of sequences and qualities, in a
+    single pass over the file.
+
+    Each read is given a random key and the reads with the
+    smallest keys are kept. Once 'num_seqs' reads are kept,
+    only reads whose key is smaller than the largest kept key
+    can enter the sample, so memory stays bounded by twice
+    the sample size.
+    """
+    rand = numpy.random.RandomState(seed)
+    sample_keys = numpy.zeros(0)
+    sample_seqs, sample_quals = [], []
+    # Largest key of the sample once it has 'num_seqs' reads
+    max_key = 1.0
+
+    def trim_sample(sample_keys, sample_seqs, sample_quals):
+        kept = numpy.argpartition(sample_keys, num_seqs - 1)[0:num_seqs]
+        return (sample_keys[kept],
+                [sample_seqs[n] for n in kept],
+                [sample_quals[n] for n in kept])
+
+    for headers, seqs, headers2, quals in \
+        fastq_utils.read_fastq_columns(fastq_filename,
+                                       batch_size=batch_size):
+        keys = rand.random_sample(len(seqs))
+        candidates = numpy.nonzero(keys < max_key)[0]
+        if len(candidates) == 0:
+            continue
+        sample_keys = numpy.concatenate([sample_keys, keys[candidates]])
+        sample_seqs.extend([seqs[n] for n in candidates])
+        sample_quals.extend([quals[n] for n in candidates])
+        # Trim the sample only once it's twice as large as needed,
+        # so that the cost of trimming is spread over many reads
+        if len(sample_keys) >= 2 * num_seqs:
+            sample_keys, sample_seqs, sample_quals = \
+                trim_sample(sample_keys, sample_seqs, sample_quals)
+            max_key = sample_keys.max()
+    if len(sample_keys) > num_seqs:
+        sample_keys, sample_seqs, sample_quals = \
+            trim_sample(sample_keys, sample_seqs, sample_quals)
+    return sample_seqs, sample_quals
+
+
+def compute_cycle_profile(fastq_filename,
+                          num_seqs=None,
+                          sampling="first",
+                          batch_size=50000,
+                          seed=None):
+    """
+    Compute the sequencing cycle profile (CycleProfile) of
+    a FASTQ file in one pass.
+
+    Kwargs:
+    - num_seqs: if given, only use this many reads
+    - sampling: how to choose the 'num_seqs' reads, either
+      'first' (first reads in the file) or 'random' (uniformly
+      random sample of reads)
+    - batch_size: number of reads processed at a time
+    - seed: random seed for 'random' sampling
+    """
+    if sampling not in ["first", "random"]:
+        raise Exception, "Unknown sampling %s." %(sampling)
+    profile = CycleProfile()
+    if (num_seqs is not None) and (sampling == "random"):
+        sample_seqs, sample_quals = \
+            sample_fastq_reads(fastq_filename, num_seqs,
+                               batch_size=batch_size,
+                               seed=seed)
+        for start in xrange(0, len(sample_seqs), batch_size):
+            profile.add_batch(sample_seqs[start:start + batch_size],
+                              sample_quals[start:start + batch_size])
+        return profile
+    for headers, seqs, headers2, quals in \
+        fastq_utils.read_fastq_columns(fastq_filename,
+                                       batch_size=batch_size):
+        if num_seqs is not None:
+            num_left = num_seqs - profile.num_reads
+            if num_left <= 0:
+                break
+            seqs, quals = seqs[0:num_left], quals[0:num_left]
+        profile.add_batch(seqs, quals)
+    return profile
+
+
 ##
 ## Misc. QC functions
 ##
-def count_nondup_reads(bam_in):
+def region_counts_dict():
+    """
+    Mapping from region to number of reads.
+    """
+    return defaultdict(int)
+
+
+def transcript_counts_dict():
+    """
+    Mapping from region type to region to number of reads.
+    """
+    return defaultdict(region_counts_dict)
+
+
+def add_qc_read(bam_read, region_coordinates, regions_detected,
+                region_counts, region_counts_by_transcript):
+    """
+    Add read to the counts of reads in QC regions.
+
+    Args:
+    - bam_read: the read
+    - region_coordinates: list of (region, region type, transcripts)
+      for each region the read maps to
+    - regions_detected: list of the region types of each region
+      the read maps to
+    - region_counts: counts of reads by region type
+    - region_counts_by_transcript: counts of reads by transcript,
+      region type and region
+    """
+    for region_info in region_coordinates:
+        curr_region, region_type, transcripts = \
+            region_info
+        for curr_transcript in transcripts:
+            transcript_info = \
+                region_counts_by_transcript[curr_transcript]
+            transcript_info[region_type][curr_region] += 1
+    ## Rules for counting regions
+    ##
+    # Count junction reads but do not use them
+    # in counting regions
+    # (3 signals "N" in cigar string)
+    # First check if it's a junction
+    if (len(bam_read.cigar) > 1) and \
+       (3 in [c[0] for c in bam_read.cigar]):
+        # It's a junction read
+        region_counts["num_junctions"] += 1
+    # Then check if it's a tRNA
+    if "tRNAs" in regions_detected:
+        # It's a tRNA
+        region_counts["num_tRNAs"] += 1
+        return
+    # Check if it's in a CDS region
+    if "cds_only.merged_exons" in regions_detected:
+        region_counts["num_cds"] += 1
+        return
+    # Check if it's in a 3' UTR
+    if "3p_utrs" in regions_detected:
+        region_counts["num_3p_utr"] += 1
+        return
+    # Check if it's in a 5' UTR
+    if "5p_utrs" in regions_detected:
+        region_counts["num_5p_utr"] += 1
+        return
+    # Check if it's in a generic exonic region
+    # which is non-CDS, non-UTR
+    if "merged_exons" in regions_detected:
+        region_counts["num_other_exons"] += 1
+    elif ("introns" in regions_detected) and \
+         (len(regions_detected) == 1):
+        # It maps to an intron and only an intron, count it
+        # as intronic read
+        region_counts["num_introns"] += 1
+
+
+def count_qc_regions_in_shard(qc_regions_bam, shard):
+    """
+    Count reads mapping to various QC regions in a shard of
+    the BAM produced by tagBam.
+
+    Returns the counts of reads by region type and the counts
+    of reads in each region of each transcript.
+    """
+    bam_file = pysam.Samfile(qc_regions_bam, "rb")
+    region_counts = defaultdict(int)
+    region_counts_by_transcript = defaultdict(transcript_counts_dict)
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        # Read aligns to region of interest
+        regions_field = None
+        try:
+            regions_field = bam_read.opt("YB")
+        except KeyError:
+            continue
+        region_coordinates, regions_detected = \
+            bedtools_utils.parse_tagBam_region(regions_field)
+        add_qc_read(bam_read, region_coordinates, regions_detected,
+                    region_counts, region_counts_by_transcript)
+    bam_file.close()
+    return region_counts, region_counts_by_transcript
+
+
+def count_qc_regions(qc_regions_bam, num_processors=1):
+    """
+    Count reads mapping to various QC regions in the BAM
+    produced by tagBam, processing the BAM one chromosome
+    at a time using 'num_processors' processes.
+
+    Returns the counts of reads by region type and the counts
+    of reads in each region of each transcript.
+    """
+    shard_results = \
+        bam_parallel.map_bam_shards(qc_regions_bam,
+                                    count_qc_regions_in_shard,
+                                    num_processors=num_processors)
+    region_counts = \
+        bam_parallel.merge_counts([defaultdict(int)] + \
+                                  [r[0] for r in shard_results])
+    region_counts_by_transcript = \
+        bam_parallel.merge_counts([defaultdict(transcript_counts_dict)] + \
+                                  [r[1] for r in shard_results])
+    return region_counts, region_counts_by_transcript
+
+
+def load_qc_regions_index(region_filenames, region_labels):
+    """
+    Load QC regions BED files into an interval index, labeling
+    the regions of each file by its label.
+    """
+    regions_index = interval_index.IntervalIndex()
+    for region_fname, region_label in zip(region_filenames, region_labels):
+        regions_index.add_bed_file(region_fname, region_label)
+    return regions_index.build()
+
+
+def count_qc_regions_in_bam_shard(bam_fname, shard, regions_index,
+                                  trans_prefix="ENS"):
+    """
+    Count reads mapping to various QC regions in a shard of
+    a BAM file, using an index of the QC regions.
+
+    As with tagBam (called with -f 1), a read maps to a region
+    if its alignment is contained in the region.
+
+    Returns the counts of reads by region type and the counts
+    of reads in each region of each transcript.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    chrom = shard[0]
+    region_counts = defaultdict(int)
+    region_counts_by_transcript = defaultdict(transcript_counts_dict)
+    # Mapping from region to its (region, region type, transcripts),
+    # so that each region is formatted once per shard
+    regions_info = {}
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        if bam_read.is_unmapped:
+            continue
+        matches = regions_index.find(chrom, bam_read.pos, bam_read.aend,
+                                     contained=True)
+        if len(matches) == 0:
+            continue
+        region_coordinates = []
+        regions_detected = []
+        for match in matches:
+            if match not in regions_info:
+                start, end, label, name, strand = match
+                curr_transcripts = set()
+                if name is not None:
+                    curr_transcripts = set([t for t in name.split(",") \
+                                            if t.startswith(trans_prefix)])
+                regions_info[match] = ("%s:%d-%d" %(chrom, start, end),
+                                       label,
+                                       curr_transcripts)
+            region_coordinates.append(regions_info[match])
+            regions_detected.append(match[2])
+        add_qc_read(bam_read, region_coordinates, regions_detected,
+                    region_counts, region_counts_by_transcript)
+    bam_file.close()
+    return region_counts, region_counts_by_transcript
+
+
+def count_qc_regions_in_bam(bam_fname, regions_index, num_processors=1):
+    """
+    Count reads mapping to various QC regions in a BAM file,
+    using an index of the QC regions (see 'load_qc_regions_index')
+    instead of a BAM produced by tagBam.
+
+    Returns the counts of reads by region type and the counts
+    of reads in each region of each transcript.
+    """
+    shard_results = \
+        bam_parallel.map_bam_shards(bam_fname,
+                                    count_qc_regions_in_bam_shard,
+                                    shard_args=(regions_index,),
+                                    num_processors=num_processors)
+    region_counts = \
+        bam_parallel.merge_counts([defaultdict(int)] + \
+                                  [r[0] for r in shard_results])
+    region_counts_by_transcript = \
+        bam_parallel.merge_counts([defaultdict(transcript_counts_dict)] + \
+                                  [r[1] for r in shard_results])
+    return region_counts, region_counts_by_transcript
+
+
+def count_nondup_reads(bam_in, all_unique=False):
     """
     Return number of BAM reads that appear in the file, excluding
     duplicates (i.e. only count unique read ids/QNAMEs.)
 
-    Takes a filename or a stream.
+    Takes a filename or a stream. Counting is done in bounded
+    memory (see bam_utils.count_distinct_reads.) If 'all_unique'
+    is True, the BAM is known to have only uniquely mapping reads.
     """
-    bam_reads = bam_in
-    if isinstance(bam_in, basestring):
-        # We're passed a filename
-        if not os.path.isfile(bam_in):
-            print "WARNING: Could not find BAM file %s" %(bam_in)
-            return 0
-        else:
-            bam_reads = pysam.Samfile(bam_in, "rb")
-    bam_reads_ids = {}
-    for read in bam_reads:
-        bam_reads_ids[read.qname] = True
-    num_reads = len(bam_reads_ids.keys())
+    if isinstance(bam_in, basestring) and (not os.path.isfile(bam_in)):
+        print "WARNING: Could not find BAM file %s" %(bam_in)
+        return 0
+    num_reads = bam_utils.count_distinct_reads(bam_in,
+                                               all_unique=all_unique)
     return num_reads
@@ -0,0 +1,193 @@
+##
+## StepScheduler: runs the pipeline steps of a sample as a
+## dependency graph, running independent steps concurrently
+## within a budget of CPUs and memory
+##
+import os
+import sys
+import time
+import threading
+
+import rnaseqlib
+
+
+class Step:
+    """
+    A pipeline step: a function with the steps it depends
+    on and the resources it uses.
+    """
+    def __init__(self, name, func, depends_on=[],
+                 num_cpus=1,
+                 mem_gb=1):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.num_cpus = num_cpus
+        self.mem_gb = mem_gb
+
+
+    def __repr__(self):
+        return "Step(%s, depends_on=%s)" %(self.name, self.depends_on)
+
+
+class StepScheduler:
+    """
+    Schedule steps so that each step runs after the steps it
+    depends on. Steps that are ready run concurrently (in
+    threads) as long as the sum of their CPUs and memory is
+    within the budget; ready steps are started in the order
+    they were added, so with a budget of one CPU the steps run
+    serially in that order.
+
+    A step that needs more than the whole budget is run when
+    no other step is running.
+    """
+    def __init__(self, max_cpus=1, max_mem_gb=None, logger=None):
+        """
+        Kwargs:
+        - max_cpus: number of CPUs that steps can use at once
+        - max_mem_gb: memory (in GB) that steps can use at once
+          (unlimited if None)
+        - logger: logger to log messages to
+        """
+        self.max_cpus = max(1, max_cpus)
+        self.max_mem_gb = max_mem_gb
+        self.logger = logger
+        self.steps = []
+        self.steps_by_name = {}
+        # Mapping from step name to its (start, end) times
+        self.timings = {}
+
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+
+    def add_step(self, name, func, depends_on=[], num_cpus=1, mem_gb=1):
+        """
+        Add a step. Its dependencies must be added before it.
+
+        Args:
+        - name: name of step
+        - func: function to run, called without arguments
+
+        Kwargs:
+        - depends_on: names of steps to run before this one
+        - num_cpus: number of CPUs used by the step
+        - mem_gb: memory (in GB) used by the step
+        """
+        if name in self.steps_by_name:
+            raise Exception, "Step %s was already added." %(name)
+        for dep_name in depends_on:
+            if dep_name not in self.steps_by_name:
+                raise Exception, "Step %s depends on unknown step %s" \
+                      %(name, dep_name)
+        step = Step(name, func, depends_on=depends_on,
+                    num_cpus=num_cpus,
+                    mem_gb=mem_gb)
+        self.steps.append(step)
+        self.steps_by_name[name] = step
+        return step
+
+
+    def fits_budget(self, step, used_cpus, used_mem_gb, num_running):
+        """
+        Return True if step can be started given the resources
+        used by running steps.
+        """
+        if num_running == 0:
+            return True
+        if used_cpus + step.num_cpus > self.max_cpus:
+            return False
+        if (self.max_mem_gb is not None) and \
+           (used_mem_gb + step.mem_gb > self.max_mem_gb):
+            return False
+        return True
+
+
+    def run_step(self, step):
+        """
+        Run step, recording its timing.
+        """
+        self.log("Starting step %s" %(step.name))
+        t1 = time.time()
+        try:
+            step.func()
+        finally:
+            t2 = time.time()
+            self.timings[step.name] = (t1, t2)
+        self.log("Step %s took %.2f minutes." %(step.name, (t2 - t1)/60.))
+
+
+    def run(self):
+        """
+        Run all steps. If a step fails, no more steps are
+        started and the error is raised once the running
+        steps complete.
+        """
+        done = set()
+        running = {}
+        errors = []
+        cond = threading.Condition()
+        def run_in_thread(step):
+            try:
+                self.run_step(step)
+            except:
+                errors.append((step.name, sys.exc_info()))
+            with cond:
+                running.pop(step.name)
+                done.add(step.name)
+                cond.notify()
+        waiting = list(self.steps)
+        with cond:
+            while (len(waiting) > 0 or len(running) > 0):
+                if len(errors) == 0:
+                    used_cpus = sum([s.num_cpus for s in running.values()])
+                    used_mem_gb = sum([s.mem_gb for s in running.values()])
+                    for step in list(waiting):
+                        if not all([d in done for d in step.depends_on]):
+                            continue
+                        if not self.fits_budget(step, used_cpus, used_mem_gb,
+                                                len(running)):
+                            # Start steps in order: don't let later
+                            # steps take the resources of this one
+                            break
+                        waiting.remove(step)
+                        running[step.name] = step
+                        used_cpus += step.num_cpus
+                        used_mem_gb += step.mem_gb
+                        step_thread = threading.Thread(target=run_in_thread,
+                                                       args=(step,))
+                        step_thread.daemon = True
+                        step_thread.start()
+                elif len(running) == 0:
+                    break
+                # Wait for a running step to complete. Wait with
+                # a timeout so that the thread remains interruptible
+                cond.wait(1)
+        if len(errors) > 0:
+            step_name, exc_info = errors[0]
+            self.log("Step %s failed." %(step_name))
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+    def output_timings(self, output_fname):
+        """
+        Output timings of steps that were run, in order they
+        were started.
+        """
+        timed_steps = sorted(self.timings.keys(),
+                             key=lambda name: self.timings[name][0])
+        with open(output_fname, "w") as timings_file:
+            timings_file.write("step\tstart\tend\tsecs\n")
+            for name in timed_steps:
+                t1, t2 = self.timings[name]
+                timings_file.write("%s\t%s\t%s\t%.2f\n" \
+                                   %(name,
+                                     time.strftime("%Y-%m-%d %H:%M:%S",
+                                                   time.localtime(t1)),
+                                     time.strftime("%Y-%m-%d %H:%M:%S",
+                                                   time.localtime(t2)),
+                                     t2 - t1))
+        return output_fname
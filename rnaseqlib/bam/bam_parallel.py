@@ -0,0 +1,160 @@
+##
+## Engine for processing indexed BAM files in parallel.
+##
+## The BAM is split into shards (chromosomes, or regions of
+## chromosomes) and a per-shard function is run on each shard
+## in a pool of processes. The per-shard results are returned
+## in shard order and merged, so that results do not depend
+## on the number of processes used.
+##
+import os
+import sys
+import time
+
+import multiprocessing
+
+import pysam
+
+
+def ensure_bam_index(bam_fname):
+    """
+    Index the BAM file if it's not already indexed.
+    """
+    index_fname = "%s.bai" %(bam_fname)
+    if not os.path.isfile(index_fname):
+        pysam.index(bam_fname)
+    return index_fname
+
+
+def get_bam_shards(bam_fname, region_size=None):
+    """
+    Return the shards of the BAM file as a list of
+    (chrom, start, end) tuples, in the order of the
+    chromosomes in the BAM header.
+
+    Kwargs:
+    - region_size: if given, split each chromosome into
+      regions of at most this many bases. Otherwise, use
+      one shard per chromosome.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    shards = []
+    for chrom, chrom_len in zip(bam_file.references, bam_file.lengths):
+        if region_size is None:
+            shards.append((chrom, 0, chrom_len))
+            continue
+        for start in xrange(0, chrom_len, region_size):
+            shards.append((chrom, start, min(start + region_size,
+                                             chrom_len)))
+    bam_file.close()
+    return shards
+
+
+def fetch_shard_reads(bam_file, shard):
+    """
+    Fetch the reads of the given shard from an open BAM file.
+
+    Only reads whose alignment starts in the shard are returned,
+    so that a read overlapping two neighbouring shards is only
+    processed once. Unmapped reads without a position are not
+    part of any shard.
+    """
+    chrom, start, end = shard
+    for read in bam_file.fetch(chrom, start, end):
+        if read.pos < start:
+            continue
+        yield read
+
+
+def _run_shard(shard_job):
+    """
+    Run shard function on shard. Used by process pool.
+    """
+    shard_func, bam_fname, shard, shard_args = shard_job
+    return shard_func(bam_fname, shard, *shard_args)
+
+
+def map_bam_shards(bam_fname, shard_func,
+                   shard_args=(),
+                   num_processors=1,
+                   shards=None):
+    """
+    Run 'shard_func' on every shard of the BAM file. Returns
+    list of results, one per shard, in shard order.
+
+    Args:
+    - bam_fname: BAM filename (indexed if it's not indexed already)
+    - shard_func: function called as
+      shard_func(bam_fname, shard, *shard_args). Must be defined
+      at the module level so that it can be sent to other processes.
+
+    Kwargs:
+    - shard_args: additional arguments to pass to 'shard_func'
+    - num_processors: number of processes to use
+    - shards: shards to process. By default, one shard per chromosome.
+    """
+    ensure_bam_index(bam_fname)
+    if shards is None:
+        shards = get_bam_shards(bam_fname)
+    shard_jobs = [(shard_func, bam_fname, shard, tuple(shard_args)) \
+                  for shard in shards]
+    if (num_processors is None) or (num_processors <= 1) or \
+       (len(shard_jobs) <= 1):
+        return map(_run_shard, shard_jobs)
+    pool = multiprocessing.Pool(processes=min(num_processors,
+                                              len(shard_jobs)))
+    try:
+        # map returns results in the order of the shards,
+        # regardless of the order in which shards finished
+        shard_results = pool.map(_run_shard, shard_jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return shard_results
+
+
+def map_reduce_bam(bam_fname, shard_func, merge_func,
+                   shard_args=(),
+                   num_processors=1,
+                   shards=None):
+    """
+    Run 'shard_func' on every shard of the BAM file and merge
+    the list of per-shard results with 'merge_func'.
+
+    See 'map_bam_shards' for arguments.
+    """
+    shard_results = map_bam_shards(bam_fname, shard_func,
+                                   shard_args=shard_args,
+                                   num_processors=num_processors,
+                                   shards=shards)
+    return merge_func(shard_results)
+
+
+def add_counts(target, source):
+    """
+    Add the counts in dictionary 'source' to dictionary 'target'.
+    Dictionaries may be nested, in which case nested dictionaries
+    are added recursively.
+    """
+    for key, value in source.iteritems():
+        if isinstance(value, dict):
+            if key in target:
+                add_counts(target[key], value)
+            else:
+                target[key] = value
+        else:
+            target[key] = target.get(key, 0) + value
+    return target
+
+
+def merge_counts(counts_list):
+    """
+    Merge a list of (possibly nested) counts dictionaries
+    by summing them. The first dictionary is added to in place.
+    """
+    if len(counts_list) == 0:
+        return {}
+    merged = counts_list[0]
+    for counts in counts_list[1:]:
+        add_counts(merged, counts)
+    return merged
@@ -5,13 +5,22 @@ import os
 import sys
 import time
 
+import array
+import shutil
+import tempfile
 import subprocess
 
+import numpy as np
 import pysam
 
 import rnaseqlib
+import rnaseqlib.utils as utils
 import rnaseqlib.fastx_utils as fastx_utils
 
+# Number of read ID hashes that a DistinctCounter holds in
+# memory (8 bytes each) before spilling them to disk
+DISTINCT_BUFFER_SIZE = 2000000
+
 
 def parse_tagBam_opt_field(opt_field,
                            interval_label="gff",
@@ -48,6 +57,284 @@ def parse_tagBam_opt_field(opt_field,
     return regions
 
 
+##
+## Utilities for post-processing mapped BAM files
+##
+def is_coord_sorted_bam(bam_file):
+    """
+    Return True if the given (open) BAM file declares itself
+    to be sorted by coordinate in its header.
+    """
+    header = bam_file.header
+    if hasattr(header, "to_dict"):
+        header = header.to_dict()
+    if "HD" not in header:
+        return False
+    return header["HD"].get("SO", None) == "coordinate"
+
+
+def is_unique_read(read):
+    """
+    Return True if read is uniquely mapping, i.e. has an 'NH'
+    tag equal to 1.
+    """
+    return ("NH", 1) in read.tags
+
+
+def get_multi_ribo_read_ids(bam_file, chr_ribo="chrRibo"):
+    """
+    Return the set of hashed read IDs of the multi-mapping reads
+    that have an alignment to the rRNA chromosome.
+
+    Uniquely mapping rRNA reads are not recorded, since their only
+    alignment is on 'chr_ribo' and they can be recognized by their
+    reference alone. Read IDs are kept as integer hashes rather
+    than strings to keep the set compact.
+    """
+    ribo_read_ids = set()
+    if chr_ribo not in bam_file.references:
+        return ribo_read_ids
+    ribo_reads = bam_file.fetch(reference=chr_ribo,
+                                start=None,
+                                end=None,
+                                multiple_iterators=True)
+    for ribo_read in ribo_reads:
+        if is_unique_read(ribo_read):
+            continue
+        ribo_read_ids.add(hash(ribo_read.qname))
+    return ribo_read_ids
+
+
+def split_bam_reads(bam_fname, output_fnames,
+                    chr_ribo="chrRibo",
+                    index_outputs=True):
+    """
+    Split a mapped BAM file into its uniquely mapping reads,
+    its rRNA-subtracted reads and its uniquely mapping
+    rRNA-subtracted reads in a single pass over the BAM.
+
+    Args:
+    - bam_fname: coordinate-sorted, indexed BAM file
+    - output_fnames: dictionary mapping output type ('unique',
+      'ribosub' or 'unique_ribosub') to the BAM filename to write
+      reads of that type to. Types not in the dictionary are not
+      outputted.
+
+    Kwargs:
+    - chr_ribo: name of the rRNA chromosome
+    - index_outputs: if True, index each of the outputted BAMs
+
+    Since the input is coordinate-sorted, the outputs are sorted
+    as well. Returns a dictionary mapping output type to the number
+    of reads written to it.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    if not is_coord_sorted_bam(bam_file):
+        bam_file.close()
+        raise Exception, "BAM %s must be sorted by coordinate." \
+              %(bam_fname)
+    # Only multi-mapping reads can have alignments both on and
+    # off the rRNA chromosome, so only those need to be tracked
+    ribo_read_ids = get_multi_ribo_read_ids(bam_file,
+                                            chr_ribo=chr_ribo)
+    ribo_tid = -1
+    if chr_ribo in bam_file.references:
+        ribo_tid = bam_file.gettid(chr_ribo)
+    output_types = output_fnames.keys()
+    with utils.temp_outputs([output_fnames[output_type] \
+                             for output_type in output_types]) as tmp_fnames:
+        out_files = {}
+        for output_type, tmp_fname in zip(output_types, tmp_fnames):
+            out_files[output_type] = \
+                pysam.Samfile(tmp_fname, "wb",
+                              # Use original file's headers
+                              template=bam_file)
+        unique_out = out_files.get("unique", None)
+        ribosub_out = out_files.get("ribosub", None)
+        unique_ribosub_out = out_files.get("unique_ribosub", None)
+        num_reads = dict([(output_type, 0) for output_type in output_fnames])
+        for read in bam_file.fetch(until_eof=True):
+            is_unique = is_unique_read(read)
+            if read.tid == ribo_tid:
+                is_ribo = True
+            elif is_unique:
+                is_ribo = False
+            else:
+                is_ribo = hash(read.qname) in ribo_read_ids
+            if is_unique and (unique_out is not None):
+                unique_out.write(read)
+                num_reads["unique"] += 1
+            if is_ribo:
+                continue
+            if ribosub_out is not None:
+                ribosub_out.write(read)
+                num_reads["ribosub"] += 1
+            if is_unique and (unique_ribosub_out is not None):
+                unique_ribosub_out.write(read)
+                num_reads["unique_ribosub"] += 1
+        bam_file.close()
+        for output_type in output_types:
+            out_files[output_type].close()
+    if index_outputs:
+        for output_type in output_types:
+            pysam.index(output_fnames[output_type])
+    return num_reads
+
+
+##
+## Utilities for counting reads in BAM files
+##
+class DistinctCounter:
+    """
+    Count the distinct values of a stream of values (e.g. read IDs)
+    in bounded memory.
+
+    Values are kept as 64-bit hashes in a fixed-size buffer. When
+    the buffer is full, its hashes are spilled to disk, split into
+    partitions by hash, so that each partition can be counted
+    separately at the end.
+    """
+    def __init__(self, buffer_size=DISTINCT_BUFFER_SIZE,
+                 num_partitions=16,
+                 tmp_dir=None):
+        self.buffer_size = buffer_size
+        self.num_partitions = num_partitions
+        self.tmp_dir = tmp_dir
+        self.buffer = array.array("l")
+        # Directory of spilled partitions, created on first spill
+        self.spill_dir = None
+
+
+    def add(self, value):
+        self.buffer.append(hash(value))
+        if len(self.buffer) == self.buffer_size:
+            self.spill()
+
+
+    def get_buffered_hashes(self):
+        """
+        Return the distinct buffered hashes and empty the buffer.
+        """
+        hashes = np.unique(np.frombuffer(self.buffer, dtype=np.int64))
+        self.buffer = array.array("l")
+        return hashes
+
+
+    def spill(self):
+        """
+        Write the distinct buffered hashes to the partition files.
+        """
+        hashes = self.get_buffered_hashes()
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        partitions = hashes % self.num_partitions
+        for partition in xrange(self.num_partitions):
+            partition_fname = os.path.join(self.spill_dir,
+                                           "%d.hashes" %(partition))
+            with open(partition_fname, "ab") as partition_file:
+                hashes[partitions == partition].tofile(partition_file)
+
+
+    def count(self):
+        """
+        Return the number of distinct values added and release
+        the spilled partitions.
+        """
+        if self.spill_dir is None:
+            return self.get_buffered_hashes().size
+        self.spill()
+        num_distinct = 0
+        try:
+            for partition in xrange(self.num_partitions):
+                partition_fname = os.path.join(self.spill_dir,
+                                               "%d.hashes" %(partition))
+                if not os.path.isfile(partition_fname):
+                    continue
+                num_distinct += \
+                    np.unique(np.fromfile(partition_fname,
+                                          dtype=np.int64)).size
+        finally:
+            shutil.rmtree(self.spill_dir)
+            self.spill_dir = None
+        return num_distinct
+
+
+def get_num_indexed_mapped(bam_fname):
+    """
+    Return the number of mapped alignments in the BAM file
+    according to its index, or None if the BAM is not indexed.
+    """
+    if not os.path.isfile("%s.bai" %(bam_fname)):
+        return None
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    try:
+        num_mapped = bam_file.mapped
+    except ValueError:
+        num_mapped = None
+    bam_file.close()
+    return num_mapped
+
+
+def count_distinct_reads(bam_in,
+                         all_unique=False,
+                         buffer_size=DISTINCT_BUFFER_SIZE,
+                         tmp_dir=None):
+    """
+    Return the number of distinct reads (read IDs) that have
+    alignments in a BAM file, in bounded memory.
+
+    Args:
+    - bam_in: BAM filename or iterator of BAM reads
+
+    Kwargs:
+    - all_unique: if True, the BAM is known to contain only
+      uniquely mapping reads (e.g. the output of 'split_bam_reads')
+    - buffer_size: maximum number of read IDs hashes to hold in
+      memory before spilling them to disk
+    - tmp_dir: directory for spilled read IDs hashes
+
+    Single-end uniquely mapping reads (with 'NH' tag equal to 1)
+    have one alignment and are counted directly. The IDs of other
+    reads are counted using a DistinctCounter. If 'all_unique' is
+    True and the BAM is indexed, the count is taken from the index
+    without reading the BAM.
+    """
+    bam_reads = bam_in
+    bam_file = None
+    if isinstance(bam_in, basestring):
+        if all_unique:
+            num_mapped = get_num_indexed_mapped(bam_in)
+            if num_mapped is not None:
+                # Check that reads are single-end
+                bam_file = pysam.Samfile(bam_in, "rb")
+                is_paired = False
+                for read in bam_file.fetch(until_eof=True):
+                    is_paired = read.is_paired
+                    break
+                bam_file.close()
+                if not is_paired:
+                    return num_mapped
+        bam_file = pysam.Samfile(bam_in, "rb")
+        bam_reads = bam_file.fetch(until_eof=True)
+    num_unique = 0
+    read_ids = DistinctCounter(buffer_size=buffer_size,
+                               tmp_dir=tmp_dir)
+    for read in bam_reads:
+        if read.is_unmapped:
+            continue
+        if not read.is_paired:
+            try:
+                if read.opt("NH") == 1:
+                    num_unique += 1
+                    continue
+            except KeyError:
+                pass
+        read_ids.add(read.qname)
+    if bam_file is not None:
+        bam_file.close()
+    return num_unique + read_ids.count()
+
+
 ##
 ## Utilities for converting bam to UCSC formats like
 ## bigWig
@@ -65,7 +352,7 @@ def bam_to_bigWig_file(bam_fname, bigWig_fname, genome):
     bam_to_bigwig(bam=bam_fname,
                   genome=genome,
                   output=bigWig_fname)
-    return None
+    return bigWig_fname
 
 
 def bam_to_bed(bam_fname, bed_fname,
@@ -99,6 +386,9 @@ def bam_to_bed(bam_fname, bed_fname,
             fields[1], fields[2] = str(start), str(end)
             processed_line = "%s\n" %("\t".join(fields))
             bed_out.write(processed_line)
+    if bed_proc.wait() != 0:
+        raise Exception, "Could not convert %s to BED: %s" \
+              %(bam_fname, bed_proc.stderr.read())
             
 
 ##
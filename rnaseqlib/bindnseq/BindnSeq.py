@@ -12,8 +12,9 @@ import scipy
 
 import rnaseqlib
 import rnaseqlib.motif.meme_utils as meme_utils
-import rnaseqlib.motif.seq_counter as seq_counter
+import rnaseqlib.bindnseq.KmerScorer as kmer_scorer
 import rnaseqlib.utils as utils
+import rnaseqlib.pandas_utils as pandas_utils
 
 # Fold change filter for BNS analyses (filter for enrichmed
 # kmers)
@@ -142,9 +143,9 @@ class BindnSeq:
             self.logger.criticla("Unknown enrichment method %s" %(method))
             sys.exit(1)
         # Sort resulting DataFrame by rank in descending order
-        ranked_or_df.sort(columns=[rank_col],
-                          inplace=True,
-                          ascending=False)
+        pandas_utils.sort_df(ranked_or_df, [rank_col],
+                             inplace=True,
+                             ascending=False)
         # Ordinal ranking
         ranked_or_df["ordinal_rank"] = \
             ranked_or_df["rank"].rank(ascending=False,
@@ -261,6 +262,9 @@ class BindnSeq:
             raise Exception, "Cannot score enriched motifs since OR data " \
                              "is not loaded."
         print "Scoring enriched motifs for: ", kmer_lens
+        # Scorers of the sequences of each region, loaded once
+        # for all kmer lengths
+        region_scorers = {}
         for kmer_len in kmer_lens:
             if kmer_len not in self.odds_ratios:
                 raise Exception, "Cannot score enriched motifs for k = %d " \
@@ -282,10 +286,16 @@ class BindnSeq:
                 if seq_fname is None:
                     print "Skipping %s" %(region)
                     continue
-                fasta_counter = seq_counter.SeqCounter(seq_fname)
+                if region not in region_scorers:
+                    region_scorers[region] = \
+                        kmer_scorer.load_fasta_scorer(seq_fname)
+                scorer = region_scorers[region]
                 enriched_kmers_to_score = list(enriched_kmers["kmer"])
+                # Count all enriched kmers in all sequences at once
+                kmer_counts = scorer.count_kmers(enriched_kmers_to_score)
                 subseq_densities = \
-                    fasta_counter.get_subseq_densities(enriched_kmers_to_score)
+                    scorer.get_densities_df(enriched_kmers_to_score,
+                                            counts=kmer_counts)
                 # Output enriched kmers ranks (fold change and ordinal)
                 fc_rank_str = \
                   ",".join(map(str, list(enriched_kmers["rank"].values)))
@@ -297,7 +307,13 @@ class BindnSeq:
                 subseq_densities = \
                   self.add_rank_weighted_densities(subseq_densities,
                                                    enriched_kmers["rank"].values,
-                                                   kmer_len)
+                                                   kmer_len,
+                                                   obs_counts=kmer_counts)
+                # Sort in place by density in descending order
+                pandas_utils.sort_df(subseq_densities,
+                                     ["sum_density", "max_density"],
+                                     ascending=False,
+                                     inplace=True)
                 ##
                 ## Output summary file
                 ##
@@ -326,7 +342,8 @@ class BindnSeq:
                                                   enriched_kmer_to_fc,
                                                   kmer_len,
                                                   bed_output_fname,
-                                                  track_desc=curr_track_desc)
+                                                  track_desc=curr_track_desc,
+                                                  scorer=scorer)
 
 
     def output_cds_kmers_per_gene(self, densities_df, output_fname, kmer_len):
@@ -380,7 +397,8 @@ class BindnSeq:
                                      kmer_len,
                                      bed_output_fname,
                                      track_desc="BindnSeq enriched kmers",
-                                     db="mm9"):
+                                     db="mm9",
+                                     scorer=None):
         """
         Output enriched kmers to the given BED filename as BED.
 
@@ -390,100 +408,40 @@ class BindnSeq:
           - enriched_kmers: DataFrame of enriched kmers
           - enriched_kmer_to_fc: dict mapping from enriched kmers to their
             fold change 
+          - scorer: kmer scorer of the sequences (see
+            'KmerScorer.KmerScorer'), loaded from 'seq_fname' if
+            not given
         """
         print "Outputting BED file: %s" %(bed_output_fname)
-        fasta_counter = seq_counter.SeqCounter(seq_fname)
         if os.path.isfile(bed_output_fname):
             print "Found BED file. Skipping..."
             return
+        if scorer is None:
+            scorer = kmer_scorer.load_fasta_scorer(seq_fname)
+        # Enriched kmers to look at
+        enriched_kmers_to_score = list(enriched_kmers["kmer"])
+        # Kmer score is the fold change rescaled assuming a
+        # maximum value for fold change
+        fc_ceiling = 4
+        kmer_fcs = np.array([enriched_kmer_to_fc[kmer] \
+                             for kmer in enriched_kmers_to_score])
+        kmer_scores = \
+          np.minimum(rescale_score(kmer_fcs, 1, fc_ceiling, 1, 1000),
+                     1000).astype(int)
         with open(bed_output_fname, "w") as bed_out:
-            # Enriched kmers to look at
-            enriched_kmers_to_score = list(enriched_kmers["kmer"])
             # Output BED Detail header
             bed_header = \
               "track name=\"%s\" description=\"%s\" useScore=1 " \
               "db=%s visibility=3" %(track_desc, track_desc, db)
             bed_out.write("%s\n" %(bed_header))
-            # Go through all sequences (e.g. these might be 3' UTRs
-            # or other genomic features of interest)
-            for curr_seq in fasta_counter.seqs:
-                seq_name = curr_seq[0][1:]
-                seq_len = len(curr_seq[1])
-                # Get starting positions of all the enriched kmers in
-                # current sequence
-                enriched_kmers_starts = \
-                  fasta_counter.count_subseqs_with_starts(curr_seq[1],
-                                                          enriched_kmers_to_score)
-                # Output each enriched kmer start position
-                # Parse the sequence chromosome, start, end coordinates
-                seq_chrom, seq_coords, seq_strand = \
-                  seq_name.split(";")[0].split(":")
-                seq_start, seq_end = seq_coords.split("-")
-                # Output a BED line for each occurrence of each
-                # enriched kmer in current sequence
-                for curr_kmer in enriched_kmers_starts:
-                    kmer_seq, kmer_starts = curr_kmer
-                    # If this kmer has no occurrences in current sequence,
-                    # continue to next
-                    if len(kmer_starts) == 0:
-                        continue
-                    kmer_len = len(kmer_seq)
-                    for kmer_start in kmer_starts:
-                        # Map start to be 1-based not 0 based
-                        kmer_start += 1
-                        ## BED:
-                        ## 1. chrom
-                        ## 2. chromStart
-                        ## 3. chromEnd
-                        ## 4. name
-                        ## 5. score
-                        ## 6. strand
-                        ## 7. thickStart
-                        ## 8. thickEnd
-                        # Kmer score is defined to be the fold change
-                        # rescaled (multiplied by 100 and < 1000)
-#                        kmer_score = \
-#                          int(min(round(enriched_kmer_to_fc[kmer_seq] * 100.0),
-#                              1000))
-                        # Rescale fold enrichments assuming maximum
-                        # value for fold change
-                        fc_ceiling = 4
-                        kmer_score = \
-                          min(rescale_score(enriched_kmer_to_fc[kmer_seq],
-                                            1, fc_ceiling,
-                                            1, 1000), 1000)
-                        kmer_score = int(kmer_score)
-                        # Kmer color
-                        kmer_color = \
-                          min(rescale_score(enriched_kmer_to_fc[kmer_seq],
-                                            1, fc_ceiling,
-                                            1, 255), 255)
-                        kmer_color = int(kmer_color)
-                        if seq_strand == "-":
-                            # Minus strand: the start has to be calculated
-                            # from the end coordinate
-                            kmer_end_in_seq = int(seq_end) - kmer_start + 1
-                            kmer_start_in_seq = kmer_end_in_seq - kmer_len 
-                        else:
-                            continue
-                            # Plus strand
-                            kmer_start_in_seq = int(seq_start) + kmer_start
-                            kmer_end_in_seq = kmer_start_in_seq + kmer_len - 1
-                        bed_entry = {"chrom": seq_chrom,
-                                     "chromStart": str(kmer_start_in_seq),
-                                     "chromEnd": str(kmer_end_in_seq),
-                                     "name": kmer_seq,
-                                     "score": str(kmer_score),
-                                     "strand": seq_strand,
-                                     "thickStart": str(kmer_start_in_seq),
-                                     "thickEnd": str(kmer_end_in_seq)}
-                        bed_line = \
-                          "%(chrom)s\t%(chromStart)s\t%(chromEnd)s\t" \
-                          "%(name)s\t%(score)s\t%(strand)s\t" \
-                          "%(thickStart)s\t%(thickEnd)s\n" \
-                          % bed_entry
-                        bed_out.write(bed_line)
-        print "Completed BED output."
+            # Output a BED line for each occurrence of each
+            # enriched kmer in all sequences (e.g. these might be
+            # 3' UTRs or other genomic features of interest)
+            num_written = \
+                scorer.write_bed_occurrences(bed_out,
+                                             enriched_kmers_to_score,
+                                             kmer_scores)
+        print "Completed BED output (%d occurrences)." %(num_written)
 
 
     def parse_counts(self, counts):
@@ -496,55 +454,37 @@ class BindnSeq:
     def add_rank_weighted_densities(self, subseq_densities,
                                     fc_rank, kmer_len,
                                     min_density_val=2**(-8),
-                                    min_seq_len=15):
+                                    min_seq_len=15,
+                                    obs_counts=None):
         """
         Add to the given dataframe of kmer densities additional information,
         namely the *weighted* densities of kmers which are the densities
         multiplied by the rank (fold-change) of the kmer.
+
+        'obs_counts' is the array of the observed counts of each kmer
+        in each row; if not given, it is parsed from the 'obs_counts'
+        column.
         """
         fc_rank = np.array(fc_rank)
-        # Record the weighted densities and the maximum
-        # fold enrichment of each kmer
-        weighted_densities = []
-        max_kmer_fcs = []
-        for row_num, row in subseq_densities.iterrows():
-            # Observed number of counts for each kmer
-            obs_counts = self.parse_counts(row["obs_counts"])
-            ##
-            ## If the kmers are less than the threshold filter, consider them 0
-            ##
-            # Indices for observed counts where condition is met
-            counts_met_inds = np.where(fc_rank >= FC_FILTER)[0]
-            counts_not_met_inds = np.where(fc_rank < FC_FILTER)[0]
-            if len(counts_met_inds) == 0:
-                print "WARNING: Unable to find counts where %.2f FC_FILTER " \
-                      "is met" %(FC_FILTER)
-            # Where condition is *NOT* met, set counts to 0
-            # note the tilde (~)
-            obs_counts[counts_not_met_inds] = 0
-            # Normalize each observed counts by sequence length (in KB!)
-            KB = 1000.0
-            len_denom = (float(row["seq_len"]) - kmer_len + 1) / KB
-            norm_density = obs_counts / len_denom
-            # Multiply the observed counts by the fold change
-            # and sum the result
-#            weighted_density = np.sum(norm_density * fc_rank)
-            weighted_density = np.sum(norm_density)
-            weighted_density = max(weighted_density, min_density_val)
-            # Record maximum fold change all kmers present in region
-            nonzero_kmer_inds = np.where(obs_counts >= 1)[0]
-            if len(nonzero_kmer_inds) == 0:
-                # There are no enriched kmers in the region
-                max_kmer_fc = min_density_val
-            else:
-                max_kmer_fc = max(fc_rank[nonzero_kmer_inds])
-            if row["seq_len"] < min_seq_len:
-                # If the length of the region is too short, mark it
-                # as zero
-                weighted_density = min_density_val
-                max_kmer_fc = min_density_val
-            weighted_densities.append(weighted_density)
-            max_kmer_fcs.append(max_kmer_fc)
+        if obs_counts is None:
+            obs_counts = \
+                np.array([self.parse_counts(counts) \
+                          for counts in subseq_densities["obs_counts"]])
+            obs_counts = obs_counts.reshape((len(subseq_densities),
+                                             len(fc_rank)))
+        ##
+        ## If the kmers are less than the threshold filter, consider them 0
+        ##
+        if np.all(fc_rank < FC_FILTER):
+            print "WARNING: Unable to find counts where %.2f FC_FILTER " \
+                  "is met" %(FC_FILTER)
+        seq_lens = subseq_densities["seq_len"].values
+        weighted_densities, max_kmer_fcs = \
+            kmer_scorer.get_rank_weighted_densities(obs_counts, seq_lens,
+                                                    fc_rank, kmer_len,
+                                                    FC_FILTER,
+                                                    min_density_val,
+                                                    min_seq_len)
         # Record log2_weighted_density
         subseq_densities["log2_weighted_density"] = np.log2(weighted_densities)
         subseq_densities["max_kmer_fc"] = max_kmer_fcs
@@ -0,0 +1,327 @@
+##
+## Scoring of kmers in many regions at once
+##
+import os
+import sys
+import time
+
+import pandas
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fasta_utils as fasta_utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+import rnaseqlib.motif.seq_counter as seq_counter
+
+KB = 1000.0
+
+
+def load_fasta_scorer(fasta_fname):
+    """
+    Return kmer scorer of the sequences in FASTA file.
+    """
+    return KmerScorer(list(fasta_utils.read_fasta(fasta_fname)))
+
+
+def parse_region_coords(seq_names):
+    """
+    Parse the chromosome, start, end and strand of regions
+    from sequence names of the form 'chrom:start-end:strand;...'
+    (with 1-based coordinates.) Return arrays of the chromosomes,
+    starts, ends and strands.
+    """
+    chroms, starts, ends, strands = [], [], [], []
+    for seq_name in seq_names:
+        seq_chrom, seq_coords, seq_strand = \
+            seq_name.split(";")[0].split(":")
+        seq_start, seq_end = seq_coords.split("-")
+        chroms.append(seq_chrom)
+        starts.append(int(seq_start))
+        ends.append(int(seq_end))
+        strands.append(seq_strand)
+    return np.array(chroms), np.array(starts, dtype=np.int64), \
+           np.array(ends, dtype=np.int64), np.array(strands)
+
+
+def get_rank_weighted_densities(counts, seq_lens, fc_rank, kmer_len,
+                                fc_filter,
+                                min_density_val=2**(-8),
+                                min_seq_len=15):
+    """
+    Return arrays of the weighted density of enriched kmers
+    in each sequence and of the maximum fold change of the
+    kmers present in each sequence.
+
+    Args:
+    - counts: counts of kmers (columns) in each sequence (rows)
+    - seq_lens: length of each sequence
+    - fc_rank: fold change of each kmer
+    - kmer_len: length of kmers
+    - fc_filter: kmers with a fold change below this are
+      not counted
+
+    Kwargs:
+    - min_density_val: value of densities and fold changes
+      of sequences without enriched kmers
+    - min_seq_len: sequences shorter than this are given
+      'min_density_val'
+    """
+    fc_rank = np.asarray(fc_rank, dtype=float)
+    seq_lens = np.asarray(seq_lens)
+    # Where fold change filter is not met, set counts to 0
+    counts = counts * (fc_rank >= fc_filter)
+    # Normalize observed counts by sequence length (in KB!)
+    len_denoms = (seq_lens - kmer_len + 1) / KB
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weighted_densities = \
+            (counts / len_denoms[:, np.newaxis]).sum(axis=1)
+    weighted_densities = np.maximum(weighted_densities, min_density_val)
+    # Maximum fold change of kmers present in each sequence
+    max_kmer_fcs = np.zeros(len(seq_lens)) + min_density_val
+    if len(fc_rank) > 0:
+        is_present = (counts >= 1)
+        present_fcs = np.where(is_present, fc_rank, -np.inf).max(axis=1)
+        has_kmers = is_present.any(axis=1)
+        max_kmer_fcs[has_kmers] = present_fcs[has_kmers]
+    # Sequences that are too short are marked as zero
+    is_short = (seq_lens < min_seq_len)
+    weighted_densities[is_short] = min_density_val
+    max_kmer_fcs[is_short] = min_density_val
+    return weighted_densities, max_kmer_fcs
+
+
+class KmerScorer:
+    """
+    Score kmers in many sequences (e.g. regions such as 3' UTRs)
+    at once.
+
+    The bases of all sequences are encoded once, and each set of
+    kmers is found in all sequences in one pass over the codes
+    (see 'find_kmers'). Kmers are matched as by 'str.find' in
+    'seq_counter.SeqCounter': overlapping and case-sensitive, and
+    kmers can be of any lengths and bases.
+    """
+    def __init__(self, seqs):
+        """
+        Args:
+        - seqs: list of (FASTA header, sequence) tuples, as read
+          by 'fasta_utils.read_fasta'
+        """
+        # Sequence name is FASTA header minus '>' prefix
+        self.seq_names = [header[1:] for header, seq in seqs]
+        self.num_seqs = len(seqs)
+        self.seq_lens = np.array([len(seq) for header, seq in seqs],
+                                 dtype=np.int64)
+        # Start of each sequence in the codes of all sequences,
+        # which are separated by an invalid base
+        self.seq_starts = np.cumsum(self.seq_lens + 1) - (self.seq_lens + 1)
+        self.all_seqs = "N".join([seq for header, seq in seqs])
+        self.base_codes = \
+            kmer_utils.EXACT_BASE_CODES[np.frombuffer(self.all_seqs,
+                                                      dtype=np.uint8)]
+        # Kmers last found and their occurrences
+        self.found_kmers = None
+
+
+    def find_kmers(self, kmers, chunk_size=2**20):
+        """
+        Find occurrences of kmers in all sequences. Return arrays
+        of the index of the sequence, the start in the sequence
+        (0-based) and the index of the kmer of each occurrence,
+        ordered by sequence, kmer and start.
+
+        Kmers of A, C, G, T are found together (see
+        'kmer_utils.SubseqFinder'), scanning 'chunk_size' positions
+        at a time; other kmers are found one by one. The
+        occurrences of the kmers last found are kept, so that
+        counting and outputting the same kmers scans the sequences
+        once.
+        """
+        if (self.found_kmers is not None) and \
+           (self.found_kmers[0] == list(kmers)):
+            return self.found_kmers[1]
+        subseq_finder = kmer_utils.SubseqFinder(kmers)
+        kmer_lens = np.array([len(kmer) for kmer in subseq_finder.subseqs],
+                             dtype=np.int64)
+        max_coded_len = max([0] + kmer_lens[subseq_finder.is_coded].tolist())
+        all_positions = [np.zeros(0, dtype=np.int64)]
+        all_kmer_inds = [np.zeros(0, dtype=np.int64)]
+        if max_coded_len > 0:
+            num_positions = len(self.base_codes)
+            for chunk_start in xrange(0, num_positions, chunk_size):
+                chunk_end = min(chunk_start + chunk_size, num_positions)
+                chunk_codes = \
+                    self.base_codes[chunk_start:chunk_end + max_coded_len - 1]
+                positions, kmer_inds = \
+                    subseq_finder.find_occurrences(chunk_codes,
+                                                   num_starts=chunk_end - \
+                                                              chunk_start)
+                all_positions.append(positions + chunk_start)
+                all_kmer_inds.append(kmer_inds)
+        # Kmers that cannot be coded are found in the joined
+        # sequences by 'str.find'
+        for kmer_ind in np.nonzero(~subseq_finder.is_coded)[0].tolist():
+            kmer = subseq_finder.subseqs[kmer_ind]
+            num_found, positions = \
+                seq_counter.overlap_count_with_starts(self.all_seqs, kmer)
+            all_positions.append(np.array(positions, dtype=np.int64))
+            all_kmer_inds.append(np.zeros(num_found, dtype=np.int64) + \
+                                 kmer_ind)
+        positions = np.concatenate(all_positions)
+        kmer_inds = np.concatenate(all_kmer_inds)
+        seq_inds = np.searchsorted(self.seq_starts, positions,
+                                   side="right") - 1
+        starts = positions - self.seq_starts[seq_inds]
+        # Occurrences that run into the next sequence
+        is_within = (starts + kmer_lens[kmer_inds] <= self.seq_lens[seq_inds])
+        seq_inds, starts, kmer_inds = \
+            seq_inds[is_within], starts[is_within], kmer_inds[is_within]
+        # Order by sequence, then kmer, then start
+        hits_order = np.lexsort((starts, kmer_inds, seq_inds))
+        hits = (seq_inds[hits_order], starts[hits_order],
+                kmer_inds[hits_order])
+        self.found_kmers = (list(kmers), hits)
+        return hits
+
+
+    def count_kmers(self, kmers):
+        """
+        Return array of the number of occurrences of each kmer
+        (columns) in each sequence (rows).
+        """
+        seq_inds, starts, kmer_inds = self.find_kmers(kmers)
+        num_kmers = len(kmers)
+        counts = np.bincount(seq_inds * num_kmers + kmer_inds,
+                             minlength=self.num_seqs * num_kmers)
+        return counts.reshape((self.num_seqs, num_kmers))
+
+
+    def get_densities(self, counts, kmer_len):
+        """
+        Return array of densities of kmers in each sequence, i.e.
+        the counts of the kmers per kb of possible kmer starts.
+        """
+        density_denoms = (self.seq_lens - kmer_len + 1) / KB
+        with np.errstate(divide="ignore", invalid="ignore"):
+            densities = counts / density_denoms[:, np.newaxis]
+        return densities
+
+
+    def get_densities_df(self, kmers, counts=None):
+        """
+        Return DataFrame of densities of kmers in each sequence,
+        with the columns of 'SeqCounter.get_subseq_densities'
+        (in the order of the sequences.)
+        """
+        if counts is None:
+            counts = self.count_kmers(kmers)
+        kmer_len = len(kmers[0]) if len(kmers) > 0 else 0
+        densities = self.get_densities(counts, kmer_len)
+        if len(kmers) > 0:
+            max_densities = densities.max(axis=1)
+        else:
+            max_densities = np.zeros(self.num_seqs)
+        obs_counts_strs = \
+            [",".join(map(str, seq_counts)) \
+             for seq_counts in counts.tolist()]
+        densities_strs = \
+            [",".join(map(str, seq_densities)) \
+             for seq_densities in densities.tolist()]
+        densities_df = \
+            pandas.DataFrame({"header": self.seq_names,
+                              "sum_density": densities.sum(axis=1),
+                              "max_density": max_densities,
+                              "obs_counts": obs_counts_strs,
+                              "sum_counts": counts.sum(axis=1).astype(float),
+                              "densities": densities_strs,
+                              "seq_len": self.seq_lens,
+                              "seq_len_in_kb": self.seq_lens / KB},
+                             columns=["header",
+                                      "sum_density",
+                                      "max_density",
+                                      "obs_counts",
+                                      "sum_counts",
+                                      "densities",
+                                      "seq_len",
+                                      "seq_len_in_kb"])
+        return densities_df.set_index("header")
+
+
+    def get_occurrence_coords(self, seq_inds, starts, kmer_len):
+        """
+        Return the chromosome, BED start (0-based), BED end and
+        strand of kmer occurrences, given the indices of their
+        sequences, their starts within sequences and the length
+        of their kmers (one length or an array of lengths.) Sequence
+        names give the coordinates of sequences (see
+        'parse_region_coords'); occurrences in minus strand
+        sequences are counted from the sequence end.
+        """
+        chroms, seq_starts, seq_ends, strands = \
+            parse_region_coords(self.seq_names)
+        chroms, seq_starts, seq_ends, strands = \
+            chroms[seq_inds], seq_starts[seq_inds], \
+            seq_ends[seq_inds], strands[seq_inds]
+        is_minus = (strands == "-")
+        bed_starts = np.where(is_minus,
+                              seq_ends - starts - kmer_len,
+                              seq_starts - 1 + starts)
+        bed_ends = bed_starts + kmer_len
+        return chroms, bed_starts, bed_ends, strands
+
+
+    def write_bed_occurrences(self, bed_out, kmers, kmer_scores,
+                              chunk_size=100000):
+        """
+        Write a BED line for each occurrence of each kmer in
+        all sequences, on both strands.
+
+        Args:
+        - bed_out: handle of BED file
+        - kmers: kmers to write
+        - kmer_scores: BED score of each kmer
+
+        Return the number of occurrences written.
+        """
+        seq_inds, starts, kmer_inds = self.find_kmers(kmers)
+        if len(kmers) == 0:
+            return 0
+        kmer_lens = np.array([len(kmer) for kmer in kmers], dtype=np.int64)
+        chroms, bed_starts, bed_ends, strands = \
+            self.get_occurrence_coords(seq_inds, starts,
+                                       kmer_lens[kmer_inds])
+        kmers = np.array(kmers)
+        kmer_scores = np.asarray(kmer_scores, dtype=np.int64)
+        ## BED:
+        ## 1. chrom
+        ## 2. chromStart
+        ## 3. chromEnd
+        ## 4. name
+        ## 5. score
+        ## 6. strand
+        ## 7. thickStart
+        ## 8. thickEnd
+        for chunk_start in xrange(0, len(seq_inds), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            bed_cols = [chroms[chunk], bed_starts[chunk].astype(str),
+                        bed_ends[chunk].astype(str),
+                        kmers[kmer_inds[chunk]],
+                        kmer_scores[kmer_inds[chunk]].astype(str),
+                        strands[chunk]]
+            bed_lines = \
+                ["%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" \
+                 %(chrom, bed_start, bed_end, kmer, score, strand,
+                   bed_start, bed_end) \
+                 for chrom, bed_start, bed_end, kmer, score, strand \
+                 in zip(*[bed_col.tolist() for bed_col in bed_cols])]
+            bed_out.writelines(bed_lines)
+        return len(seq_inds)
+
+
+    def __str__(self):
+        return "KmerScorer(num_seqs=%d)" %(self.num_seqs)
+
+
+    def __repr__(self):
+        return self.__str__()
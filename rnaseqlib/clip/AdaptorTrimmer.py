@@ -0,0 +1,387 @@
+##
+## Trimming of adaptors from reads
+##
+import os
+import sys
+import time
+import itertools
+import functools
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.fastq_scatter as fastq_scatter
+
+# Options of adaptors files (in 'cutadapt' syntax) giving
+# each kind of adaptor
+ADAPTOR_OPTIONS = {"-a": "3prime",
+                   "--adapter": "3prime",
+                   "-g": "5prime",
+                   "--front": "5prime",
+                   "-b": "anywhere",
+                   "--anywhere": "anywhere"}
+
+# Options of adaptors files giving trimming parameters
+PARAM_OPTIONS = {"-e": ("error_rate", float),
+                 "--error-rate": ("error_rate", float),
+                 "-O": ("min_overlap", int),
+                 "--overlap": ("min_overlap", int),
+                 "-q": ("quality_cutoff", int),
+                 "--quality-cutoff": ("quality_cutoff", int),
+                 "-m": ("min_read_len", int),
+                 "--minimum-length": ("min_read_len", int)}
+
+# Base of FASTQ quality scores
+QUAL_BASE = 33
+
+
+def parse_adaptors(adaptors_str):
+    """
+    Parse adaptors given as 'cutadapt' options, e.g.:
+
+      -a TGGAATTCTCGGGTGCCAAGG
+      -g GTTCAGAGTTCTACAGTCCGACGATC -e 0.1
+
+    Options can be given as '-a SEQ', '--adapter SEQ' or
+    '--adapter=SEQ'. Sequences given without an option are
+    taken as 3' adaptors.
+
+    Returns a list of (adaptor kind, adaptor sequence) pairs,
+    where the kind is one of '3prime', '5prime' or 'anywhere',
+    and a dictionary of trimming parameters given.
+    """
+    tokens = []
+    for token in adaptors_str.split():
+        if token.startswith("--") and "=" in token:
+            tokens.extend(token.split("=", 1))
+        else:
+            tokens.append(token)
+    adaptors = []
+    params = {}
+    n = 0
+    while n < len(tokens):
+        token = tokens[n]
+        if not token.startswith("-"):
+            adaptors.append(("3prime", token.upper()))
+            n += 1
+            continue
+        if (token not in ADAPTOR_OPTIONS) and (token not in PARAM_OPTIONS):
+            raise Exception, "Unknown option %s in adaptors." %(token)
+        if n + 1 >= len(tokens):
+            raise Exception, "Missing value for %s in adaptors." %(token)
+        value = tokens[n + 1]
+        if token in ADAPTOR_OPTIONS:
+            adaptors.append((ADAPTOR_OPTIONS[token], value.upper()))
+        else:
+            param_name, param_type = PARAM_OPTIONS[token]
+            params[param_name] = param_type(value)
+        n += 2
+    return adaptors, params
+
+
+def load_adaptors(adaptors_filename):
+    """
+    Load adaptors file (see 'parse_adaptors'.)
+    """
+    with open(adaptors_filename, "r") as adaptors_in:
+        return parse_adaptors(adaptors_in.read())
+
+
+def get_quality_trim_lens(quals_matrix, quality_cutoff):
+    """
+    Return lengths of reads after trimming low quality 3' ends,
+    given a matrix of qualities of reads of the same length.
+
+    Uses the algorithm of BWA (as does 'cutadapt -q'): the read
+    is cut where the sum of (cutoff - quality) from the 3' end
+    is largest, summing until the sum becomes negative.
+    """
+    num_reads, read_len = quals_matrix.shape
+    if read_len == 0:
+        return np.zeros(num_reads, dtype=np.int64)
+    diffs = quality_cutoff - \
+        (quals_matrix[:, ::-1].astype(np.int64) - QUAL_BASE)
+    sums = np.cumsum(diffs, axis=1)
+    # Only sums before the first negative sum count
+    negative = (sums < 0)
+    stops = np.where(negative.any(axis=1), negative.argmax(axis=1), read_len)
+    sums[np.arange(read_len)[np.newaxis, :] >= stops[:, np.newaxis]] = 0
+    max_inds = sums.argmax(axis=1)
+    max_sums = sums[np.arange(num_reads), max_inds]
+    return np.where(max_sums > 0, read_len - (max_inds + 1), read_len)
+
+
+def find_3prime_matches(seqs_matrix, adaptor, wildcards,
+                        error_rate, min_overlap):
+    """
+    Find 3' adaptor in reads of the same length, given as rows
+    of a byte matrix. The adaptor matches where all of it,
+    or a prefix of it running off the 3' end of the read, is
+    aligned to the read with at most 'error_rate' mismatches
+    per aligned base and at least 'min_overlap' aligned bases.
+    Bases in 'wildcards' of the adaptor match any base.
+
+    Returns the start of the leftmost match of each read and
+    the number of aligned bases (0 if there is no match.)
+    """
+    num_reads, read_len = seqs_matrix.shape
+    match_starts = np.zeros(num_reads, dtype=np.int64)
+    match_lens = np.zeros(num_reads, dtype=np.int64)
+    # Go from the 3' end so that the leftmost match is kept
+    for start in xrange(read_len - min_overlap, -1, -1):
+        align_len = min(len(adaptor), read_len - start)
+        mismatches = \
+            (seqs_matrix[:, start:start + align_len] != adaptor[0:align_len])
+        if wildcards is not None:
+            mismatches &= ~wildcards[0:align_len]
+        matched = \
+            (mismatches.sum(axis=1) <= int(error_rate * align_len))
+        match_starts[matched] = start
+        match_lens[matched] = align_len
+    return match_starts, match_lens
+
+
+class AdaptorTrimmer:
+    """
+    Trim adaptors from reads.
+
+    Reads are processed a batch at a time: reads of the same
+    length are searched for each adaptor at once as rows of
+    a byte matrix. Adaptors are matched semi-globally, allowing
+    mismatches (but not indels) up to 'error_rate' per aligned
+    base. 3' adaptors are removed with everything after them,
+    and 5' adaptors with everything before them. If several
+    adaptors match a read, the one with the most aligned bases
+    is removed.
+
+    Before searching for adaptors, low quality 3' ends are
+    trimmed (see 'get_quality_trim_lens'.) Reads shorter than
+    'min_read_len' after trimming are discarded.
+    """
+    def __init__(self, adaptors,
+                 error_rate=0.1,
+                 min_overlap=3,
+                 quality_cutoff=3,
+                 min_read_len=5):
+        """
+        Args:
+        - adaptors: list of (adaptor kind, adaptor sequence)
+          pairs (see 'parse_adaptors')
+
+        Kwargs:
+        - error_rate: maximum mismatches per aligned base
+        - min_overlap: minimum number of aligned bases of
+          partial adaptor matches
+        - quality_cutoff: quality cutoff of 3' end trimming
+          (0 to not trim)
+        - min_read_len: minimum length of trimmed reads
+        """
+        for adaptor_kind, adaptor_seq in adaptors:
+            if adaptor_kind not in ["3prime", "5prime", "anywhere"]:
+                raise Exception, "Unknown adaptor kind %s" %(adaptor_kind)
+        self.adaptors = adaptors
+        self.error_rate = error_rate
+        self.min_overlap = max(1, min_overlap)
+        self.quality_cutoff = quality_cutoff
+        self.min_read_len = min_read_len
+        # Adaptors as byte arrays, with masks of their
+        # wildcard bases
+        self.adaptor_arrays = []
+        for adaptor_kind, adaptor_seq in adaptors:
+            adaptor = np.frombuffer(adaptor_seq, dtype=np.uint8)
+            wildcards = (adaptor == ord("N"))
+            if not wildcards.any():
+                wildcards = None
+            self.adaptor_arrays.append((adaptor, wildcards))
+
+
+    def get_adaptor_matches(self, seqs_matrix, adaptor_num):
+        """
+        Return the start and end of the part of each read that
+        is kept when removing the given adaptor, and the number
+        of aligned bases of the adaptor (0 if it does not match.)
+        """
+        adaptor_kind = self.adaptors[adaptor_num][0]
+        adaptor, wildcards = self.adaptor_arrays[adaptor_num]
+        num_reads, read_len = seqs_matrix.shape
+        keep_starts = np.zeros(num_reads, dtype=np.int64)
+        keep_ends = np.zeros(num_reads, dtype=np.int64) + read_len
+        match_lens = np.zeros(num_reads, dtype=np.int64)
+        if adaptor_kind in ["3prime", "anywhere"]:
+            match_starts, match_lens = \
+                find_3prime_matches(seqs_matrix, adaptor, wildcards,
+                                    self.error_rate, self.min_overlap)
+            matched = (match_lens > 0)
+            keep_ends[matched] = match_starts[matched]
+        if adaptor_kind in ["5prime", "anywhere"]:
+            rev_wildcards = None
+            if wildcards is not None:
+                rev_wildcards = wildcards[::-1]
+            rev_starts, rev_lens = \
+                find_3prime_matches(seqs_matrix[:, ::-1], adaptor[::-1],
+                                    rev_wildcards, self.error_rate,
+                                    self.min_overlap)
+            if adaptor_kind == "anywhere":
+                # Adaptors found anywhere are taken as 5' adaptors
+                # only where a suffix of them starts the read
+                rev_lens[(rev_starts + rev_lens) < read_len] = 0
+                rev_lens[match_lens > 0] = 0
+            matched = (rev_lens > 0)
+            keep_starts[matched] = read_len - rev_starts[matched]
+            match_lens = np.maximum(match_lens, rev_lens)
+        return keep_starts, keep_ends, match_lens
+
+
+    def trim_records(self, records):
+        """
+        Trim list of (header, sequence, header2, quality) records.
+        Return the trimmed records that are long enough and a
+        dictionary of trimming statistics.
+        """
+        stats = self.get_empty_stats()
+        if len(records) == 0:
+            return [], stats
+        headers, seqs, headers2, quals = zip(*records)
+        num_reads = len(seqs)
+        stats["num_reads"] = num_reads
+        seqs = list(seqs)
+        quals = list(quals)
+        # Trim low quality ends
+        if self.quality_cutoff > 0:
+            for read_len, inds, len_quals in \
+                fastq_utils.group_seqs_by_len(quals):
+                if read_len == 0:
+                    continue
+                quals_matrix = np.frombuffer("".join(len_quals),
+                                             dtype=np.uint8)
+                quals_matrix = quals_matrix.reshape((len(len_quals),
+                                                     read_len))
+                trim_lens = get_quality_trim_lens(quals_matrix,
+                                                  self.quality_cutoff)
+                if inds is None:
+                    inds = np.arange(num_reads)
+                trimmed = np.nonzero(trim_lens < read_len)[0]
+                stats["num_quality_trimmed"] += len(trimmed)
+                stats["quality_trimmed_bases"] += \
+                    int((read_len - trim_lens[trimmed]).sum())
+                for i, trim_len in itertools.izip(inds[trimmed].tolist(),
+                                                  trim_lens[trimmed].tolist()):
+                    seqs[i] = seqs[i][0:trim_len]
+                    quals[i] = quals[i][0:trim_len]
+        # Trim adaptors
+        keep_starts = np.zeros(num_reads, dtype=np.int64)
+        keep_ends = np.fromiter(itertools.imap(len, seqs), dtype=np.int64,
+                                count=num_reads)
+        for read_len, inds, len_seqs in fastq_utils.group_seqs_by_len(seqs):
+            if read_len == 0 or len(self.adaptors) == 0:
+                continue
+            seqs_matrix = np.frombuffer("".join(len_seqs).upper(),
+                                        dtype=np.uint8)
+            seqs_matrix = seqs_matrix.reshape((len(len_seqs), read_len))
+            if inds is None:
+                inds = np.arange(num_reads)
+            best_lens = np.zeros(len(len_seqs), dtype=np.int64)
+            for adaptor_num in xrange(len(self.adaptors)):
+                starts, ends, match_lens = \
+                    self.get_adaptor_matches(seqs_matrix, adaptor_num)
+                better = (match_lens > best_lens)
+                best_lens[better] = match_lens[better]
+                keep_starts[inds[better]] = starts[better]
+                keep_ends[inds[better]] = ends[better]
+        # Count reads that adaptors were removed from
+        trimmed_lens = np.maximum(keep_ends - keep_starts, 0)
+        orig_lens = np.fromiter(itertools.imap(len, seqs), dtype=np.int64,
+                                count=num_reads)
+        with_adaptor = (trimmed_lens < orig_lens)
+        stats["num_with_adaptor"] = int(with_adaptor.sum())
+        stats["adaptor_trimmed_bases"] = \
+            int((orig_lens - trimmed_lens)[with_adaptor].sum())
+        to_keep = (trimmed_lens >= self.min_read_len)
+        stats["num_too_short"] = int(num_reads - to_keep.sum())
+        trimmed_records = \
+            [(headers[i], seqs[i][start:end], headers2[i],
+              quals[i][start:end]) \
+             for i, start, end in \
+             itertools.izip(np.nonzero(to_keep)[0].tolist(),
+                            keep_starts[to_keep].tolist(),
+                            keep_ends[to_keep].tolist())]
+        stats["num_written"] = len(trimmed_records)
+        return trimmed_records, stats
+
+
+    def get_empty_stats(self):
+        return {"num_reads": 0,
+                "num_quality_trimmed": 0,
+                "quality_trimmed_bases": 0,
+                "num_with_adaptor": 0,
+                "adaptor_trimmed_bases": 0,
+                "num_too_short": 0,
+                "num_written": 0}
+
+
+def merge_trim_stats(stats1, stats2):
+    """
+    Add two dictionaries of trimming statistics.
+    """
+    return dict([(stat_name, stats1[stat_name] + stats2[stat_name]) \
+                 for stat_name in stats1])
+
+
+def trim_transform(records, trimmer):
+    """
+    Chunk transform (see 'fastq_scatter') that trims adaptors
+    and outputs the trimmed records as FASTQ, along with the
+    trimming statistics.
+    """
+    trimmed_records, stats = trimmer.trim_records(records)
+    return fastq_utils.format_fastq_records(trimmed_records), stats
+
+
+def output_trim_stats(stats, output_filename):
+    """
+    Output trimming statistics as a table of statistic name
+    and value.
+    """
+    with open(output_filename, "w") as stats_file:
+        stats_file.write("stat\tvalue\n")
+        for stat_name in ["num_reads", "num_quality_trimmed",
+                          "quality_trimmed_bases", "num_with_adaptor",
+                          "adaptor_trimmed_bases", "num_too_short",
+                          "num_written"]:
+            stats_file.write("%s\t%d\n" %(stat_name, stats[stat_name]))
+
+
+def trim_fastq(fastq_fname, adaptors_fname, output_fname,
+               num_procs=1,
+               min_read_len=5,
+               quality_cutoff=3,
+               chunk_size=fastq_scatter.CHUNK_SIZE,
+               logger=None):
+    """
+    Trim adaptors given in 'adaptors_fname' (see 'parse_adaptors')
+    from reads of FASTQ file, outputting the trimmed reads to
+    'output_fname'. Trimming parameters given in the adaptors
+    file override the ones given here.
+
+    The reads are split into chunks of about 'chunk_size' bytes
+    trimmed by 'num_procs' processes. Returns a dictionary of
+    trimming statistics.
+    """
+    adaptors, params = load_adaptors(adaptors_fname)
+    trim_params = {"min_read_len": min_read_len,
+                   "quality_cutoff": quality_cutoff}
+    trim_params.update(params)
+    trimmer = AdaptorTrimmer(adaptors, **trim_params)
+    transform = functools.partial(trim_transform, trimmer=trimmer)
+    num_chunks, stats = \
+        fastq_scatter.scatter_gather(fastq_fname, output_fname,
+                                     transform,
+                                     num_procs=num_procs,
+                                     chunk_size=chunk_size,
+                                     merge_stats=merge_trim_stats,
+                                     logger=logger)
+    if stats is None:
+        stats = trimmer.get_empty_stats()
+    return stats
@@ -0,0 +1,248 @@
+##
+## Collapsing of duplicate reads
+##
+import os
+import sys
+import time
+import heapq
+import itertools
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+
+
+class ReadCollapser:
+    """
+    Collapse reads of a FASTQ file with identical sequences
+    into one read, counting the number of reads of each
+    sequence.
+
+    Reads are read a batch at a time as columns of sequences
+    and qualities, and counted in a hash of sequences. Each
+    collapsed read keeps the qualities of the first read with
+    its sequence.
+
+    At most 'max_seqs' distinct sequences are held in memory:
+    beyond that, the sequences are spilled to disk as a run
+    sorted by sequence, and the runs are merged at the end.
+    Collapsed reads are output sorted by sequence, so that the
+    output does not depend on whether runs were spilled.
+    """
+    def __init__(self, tmp_dir,
+                 max_seqs=5000000,
+                 logger=None):
+        """
+        Args:
+        - tmp_dir: directory to spill runs to
+
+        Kwargs:
+        - max_seqs: maximum number of distinct sequences held
+          in memory
+        - logger: logger to log messages to
+        """
+        self.tmp_dir = tmp_dir
+        self.max_seqs = max(1, max_seqs)
+        self.logger = logger
+        # Mapping from sequence to number of reads and to
+        # qualities of first read
+        self.counts = {}
+        self.quals = {}
+        self.run_fnames = []
+        self.num_reads = 0
+
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print msg
+
+
+    def add_records(self, records):
+        """
+        Add list of (header, sequence, header2, quality) records.
+        """
+        if len(records) == 0:
+            return
+        headers, seqs, headers2, quals = zip(*records)
+        self.add_reads(seqs, quals)
+
+
+    def add_reads(self, seqs, quals):
+        """
+        Add reads given as lists of sequences and qualities.
+        """
+        self.num_reads += len(seqs)
+        counts = self.counts
+        for seq, qual in itertools.izip(seqs, quals):
+            if seq in counts:
+                counts[seq] += 1
+                continue
+            if len(counts) >= self.max_seqs:
+                self.spill()
+                counts = self.counts
+            counts[seq] = 1
+            self.quals[seq] = qual
+
+
+    def add_fastq(self, fastq_fname, batch_size=100000):
+        for headers, seqs, headers2, quals in \
+            fastq_utils.read_fastq_columns(fastq_fname,
+                                           batch_size=batch_size):
+            self.add_reads(seqs, quals)
+
+
+    def get_sorted_seqs(self):
+        """
+        Return (sequence, count, qualities) of sequences held in
+        memory, sorted by sequence.
+        """
+        return [(seq, self.counts[seq], self.quals[seq]) \
+                for seq in sorted(self.counts.iterkeys())]
+
+
+    def spill(self):
+        """
+        Write sequences held in memory to a run file.
+        """
+        utils.make_dir(self.tmp_dir)
+        run_fname = os.path.join(self.tmp_dir,
+                                 "collapse_run.%d.%d.txt" \
+                                 %(os.getpid(), len(self.run_fnames)))
+        with open(run_fname, "w") as run_file:
+            run_file.write("".join(["%s\t%d\t%s\n" %(seq_entry) \
+                                    for seq_entry in self.get_sorted_seqs()]))
+        self.run_fnames.append(run_fname)
+        self.log("Spilled %d sequences to %s" %(len(self.counts), run_fname))
+        self.counts = {}
+        self.quals = {}
+
+
+    def iter_run(self, run_fname, run_num):
+        with open(run_fname) as run_file:
+            for line in run_file:
+                seq, count, qual = line[:-1].split("\t")
+                yield seq, run_num, int(count), qual
+
+
+    def iter_collapsed(self):
+        """
+        Yield (sequence, count, qualities) of distinct sequences,
+        sorted by sequence. Spilled runs are merged, keeping the
+        qualities from the earliest run.
+        """
+        if len(self.run_fnames) == 0:
+            for seq_entry in self.get_sorted_seqs():
+                yield seq_entry
+            return
+        if len(self.counts) > 0:
+            self.spill()
+        # Runs are merged by sequence, then by run number
+        runs = [self.iter_run(run_fname, run_num) \
+                for run_num, run_fname in enumerate(self.run_fnames)]
+        prev_seq, prev_count, prev_qual = None, 0, None
+        for seq, run_num, count, qual in heapq.merge(*runs):
+            if seq == prev_seq:
+                prev_count += count
+                continue
+            if prev_seq is not None:
+                yield prev_seq, prev_count, prev_qual
+            prev_seq, prev_count, prev_qual = seq, count, qual
+        if prev_seq is not None:
+            yield prev_seq, prev_count, prev_qual
+
+
+    def output_collapsed(self, output_fname, counts_fname,
+                         batch_size=100000):
+        """
+        Output collapsed reads as FASTQ, with read IDs of the
+        form <read number>-<number of reads>. Output a table of
+        the number of reads of each collapsed read's sequence
+        to 'counts_fname'.
+
+        Returns a dictionary of duplication statistics.
+        """
+        num_seqs = 0
+        num_duplicated = 0
+        max_count = 0
+        with fastq_utils.FastqWriter(output_fname) as writer:
+            with open(counts_fname, "w") as counts_file:
+                counts_file.write("read_id\tsequence\tnum_reads\n")
+                collapsed = self.iter_collapsed()
+                while True:
+                    seq_entries = list(itertools.islice(collapsed,
+                                                        batch_size))
+                    if len(seq_entries) == 0:
+                        break
+                    read_ids = ["%d-%d" %(num_seqs + n + 1, count) \
+                                for n, (seq, count, qual) \
+                                in enumerate(seq_entries)]
+                    writer.write_records([(read_id, seq, "+", qual) \
+                                          for read_id, (seq, count, qual) \
+                                          in itertools.izip(read_ids,
+                                                            seq_entries)])
+                    counts_file.write("".join(["%s\t%s\t%d\n" \
+                                               %(read_id, seq, count) \
+                                               for read_id, (seq, count, qual) \
+                                               in itertools.izip(read_ids,
+                                                                 seq_entries)]))
+                    num_seqs += len(seq_entries)
+                    for seq, count, qual in seq_entries:
+                        if count > 1:
+                            num_duplicated += 1
+                        max_count = max(max_count, count)
+        self.remove_runs()
+        stats = {"num_reads": self.num_reads,
+                 "num_seqs": num_seqs,
+                 "num_duplicated_seqs": num_duplicated,
+                 "max_reads_per_seq": max_count}
+        return stats
+
+
+    def remove_runs(self):
+        for run_fname in self.run_fnames:
+            if os.path.isfile(run_fname):
+                os.remove(run_fname)
+        self.run_fnames = []
+
+
+def collapse_fastq(fastq_fname, output_dir,
+                   max_seqs=5000000,
+                   logger=None):
+    """
+    Collapse reads of FASTQ file. Outputs the collapsed reads
+    to <output_dir>/<basename>.collapsed.fastq.gz and the number
+    of reads of each collapsed read to
+    <output_dir>/<basename>.collapsed.counts.txt
+
+    Returns the collapsed reads filename.
+    """
+    output_basename = utils.trim_fastq_ext(os.path.basename(fastq_fname))
+    collapsed_fname = os.path.join(output_dir,
+                                   "%s.collapsed.fastq.gz" \
+                                   %(output_basename))
+    counts_fname = os.path.join(output_dir,
+                                "%s.collapsed.counts.txt" %(output_basename))
+    if os.path.isfile(collapsed_fname) and os.path.isfile(counts_fname):
+        return collapsed_fname
+    utils.make_dir(output_dir)
+    collapser = ReadCollapser(output_dir, max_seqs=max_seqs, logger=logger)
+    collapser.add_fastq(fastq_fname)
+    with utils.temp_outputs([counts_fname, collapsed_fname]) \
+         as [tmp_counts_fname, tmp_collapsed_fname]:
+        stats = collapser.output_collapsed(tmp_collapsed_fname,
+                                           tmp_counts_fname)
+    frac_duplicate = 0
+    if stats["num_reads"] > 0:
+        frac_duplicate = \
+            1 - (stats["num_seqs"] / float(stats["num_reads"]))
+    msg = "Collapsed %d reads into %d sequences (%.2f%% duplicate reads, " \
+          "%d sequences with duplicates, at most %d reads per sequence)" \
+          %(stats["num_reads"], stats["num_seqs"], frac_duplicate * 100,
+            stats["num_duplicated_seqs"], stats["max_reads_per_seq"])
+    if logger is not None:
+        logger.info(msg)
+    else:
+        print msg
+    return collapsed_fname
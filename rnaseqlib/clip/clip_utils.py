@@ -11,6 +11,8 @@ import pybedtools
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.fastx_utils as fastx_utils
+import rnaseqlib.clip.ReadCollapser as read_collapser
+import rnaseqlib.clip.AdaptorTrimmer as adaptor_trimmer
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
 
 
@@ -18,16 +20,13 @@ def trim_clip_adaptors(fastq_filename,
                        adaptors_filename,
                        output_dir,
                        logger,
-                       min_read_len=5):
+                       min_read_len=5,
+                       num_procs=1):
     """
-    Trim CLIP adaptors using 'cutadapt'.
+    Trim CLIP adaptors (see 'AdaptorTrimmer'.) Trimming
+    statistics are output alongside the trimmed reads.
     """
     logger.info("Trimming CLIP adaptors from: %s" %(fastq_filename))
-    cutadapt_path = utils.which("cutadapt")
-    if cutadapt_path is None:
-        logger.critical("Could not find \'cutadapt\' on the path. " \
-                        "Please install \'cutadapt\' or make the installed " \
-                        "version available on path.")
     output_basename = \
         utils.trim_fastq_ext(os.path.basename(fastq_filename))
     output_filename = os.path.join(output_dir,
@@ -39,24 +38,24 @@ def trim_clip_adaptors(fastq_filename,
         return output_filename
     logger.info("  - Outputting trimmed sequences to: %s" \
                 %(output_filename))
-    # Load adaptors to pass to 'cutadapt'
     if not os.path.isfile(adaptors_filename):
         logger.critical("Could not find adaptors file %s" \
                         %(adaptors_filename))
         sys.exit(1)
-    adaptors_in = open(adaptors_filename, "r")
-    # Substitute newlines with spaces
-    adaptors = adaptors_in.read().strip().replace("\n", " ")
-    adaptors_in.close()
-    cutadapt_cmd = "%s %s %s -o %s -m %d -q 3 > %s.log" %(cutadapt_path,
-                                                          adaptors,
-                                                          fastq_filename,
-                                                          output_filename,
-                                                          min_read_len,
-                                                          output_filename)
-    logger.info("Executing: %s" %(cutadapt_cmd))
     t1 = time.time()
-    os.system(cutadapt_cmd)
+    with utils.temp_outputs([output_filename]) as [tmp_output_filename]:
+        stats = adaptor_trimmer.trim_fastq(fastq_filename,
+                                           adaptors_filename,
+                                           tmp_output_filename,
+                                           num_procs=num_procs,
+                                           min_read_len=min_read_len,
+                                           logger=logger)
+        stats_filename = "%s.log" %(output_filename)
+        adaptor_trimmer.output_trim_stats(stats, stats_filename)
+    logger.info("Trimmed adaptors from %d of %d reads, %d reads too short " \
+                "after trimming." %(stats["num_with_adaptor"],
+                                    stats["num_reads"],
+                                    stats["num_too_short"]))
     t2 = time.time()
     logger.info("Trimming took %.2f mins." %((t2 - t1)/60.))
     return output_filename
@@ -64,25 +63,22 @@ def trim_clip_adaptors(fastq_filename,
 
 def collapse_clip_reads(sample, output_dir, logger):
     """
-    Collapse CLIP reads. Uses fastx_collapser.
+    Collapse CLIP reads with identical sequences (see
+    'ReadCollapser'.)
     """
     logger.info("Collapsing CLIP reads for %s" %(sample.label))
     t1 = time.time()
     collapsed_seq_filename = \
-        fastx_utils.fastx_collapse_fastq(sample.rawdata.reads_filename,
-                                         output_dir,
-                                         logger)
-    if collapsed_seq_filename is None:
-        logger.critical("Collapsing of CLIP reads failed.")
-        sys.exit(1)
+        read_collapser.collapse_fastq(sample.rawdata.reads_filename,
+                                      output_dir,
+                                      logger=logger)
     t2 = time.time()
     logger.info("Collapsing took %.2f minutes." %((t2 - t1)/60.))
     return collapsed_seq_filename
 
 
 def check_clip_utils(logger,
-                     required_utils=["cutadapt",
-                                     "fastx_collapser"]):
+                     required_utils=[]):
     """
     Check that necessary utilities are available.
     """
@@ -96,6 +92,27 @@ def check_clip_utils(logger,
     logger.info("Found CLIP utilities.")
 
 
+def get_filtered_clusters_fname(clusters_bed_fname, output_dir,
+                                num_reads=5,
+                                depth=5,
+                                min_size=20,
+                                max_size=500):
+    """
+    Return filename of clusters filtered by 'filter_clusters'.
+    """
+    bed_basename = \
+        os.path.basename(clusters_bed_fname).rsplit(".bed", 1)[0]
+    filtered_clusters_fname = \
+        os.path.join(output_dir,
+                     "%s.num_reads_%d.depth_%d.mins_%d_maxs_%d.bed" \
+                     %(bed_basename,
+                       num_reads,
+                       depth,
+                       min_size,
+                       max_size))
+    return filtered_clusters_fname
+
+
 def filter_clusters(logger, clusters_bed_fname, output_dir,
                     num_reads=5,
                     depth=5,
@@ -110,16 +127,12 @@ def filter_clusters(logger, clusters_bed_fname, output_dir,
         logger.critical("Error: clusters filename %s must end in .bed" \
                         %(clusters_bed_fname))
         sys.exit(1)
-    bed_basename = \
-        os.path.basename(clusters_bed_fname).rsplit(".bed", 1)[0]
     filtered_clusters_fname = \
-        os.path.join(output_dir,
-                     "%s.num_reads_%d.depth_%d.mins_%d_maxs_%d.bed" \
-                     %(bed_basename,
-                       num_reads,
-                       depth,
-                       min_size,
-                       max_size))
+        get_filtered_clusters_fname(clusters_bed_fname, output_dir,
+                                    num_reads=num_reads,
+                                    depth=depth,
+                                    min_size=min_size,
+                                    max_size=max_size)
     num_passing_filter = 0
     with open(filtered_clusters_fname, "w") as clusters_out:
         with open(clusters_bed_fname, "r") as clusters_in:
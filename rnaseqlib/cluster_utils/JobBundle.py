@@ -0,0 +1,168 @@
+##
+## Bundles of small commands run as a single cluster job
+##
+import os
+import sys
+import time
+import json
+import threading
+import subprocess
+from optparse import OptionParser
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.cluster_utils.JobTracker as job_tracker
+
+
+class JobBundle:
+    """
+    A set of commands run by one job, at most 'num_parallel'
+    at a time. The commands are written to a bundle file
+    that the job reads (see 'run_bundle'). Each command writes
+    its exit code to its own status file, so that commands
+    are reported on individually.
+    """
+    def __init__(self, bundle_name, jobs, bundle_dir, num_parallel=1):
+        """
+        Args:
+        - bundle_name: name of bundle (used as the job's name)
+        - jobs: list of (cmd, job_name) commands
+        - bundle_dir: directory to write bundle, status and
+          log files to
+
+        Kwargs:
+        - num_parallel: number of commands to run at once
+        """
+        self.bundle_name = bundle_name
+        self.bundle_dir = os.path.abspath(bundle_dir)
+        self.num_parallel = max(1, num_parallel)
+        self.job_id = None
+        self.commands = []
+        for cmd, job_name in jobs:
+            prefix = os.path.join(self.bundle_dir,
+                                  "%s.%s" %(bundle_name, job_name))
+            self.commands.append({"cmd": cmd,
+                                  "job_name": job_name,
+                                  "status_fname": "%s.done" %(prefix),
+                                  "log_fname": "%s.out" %(prefix)})
+        self.bundle_fname = os.path.join(self.bundle_dir,
+                                         "%s.bundle.json" %(bundle_name))
+
+
+    def write(self):
+        """
+        Write bundle file, clearing the statuses of its commands.
+        """
+        utils.make_dir(self.bundle_dir)
+        for command in self.commands:
+            if os.path.isfile(command["status_fname"]):
+                os.remove(command["status_fname"])
+        with open(self.bundle_fname, "w") as bundle_file:
+            json.dump({"num_parallel": self.num_parallel,
+                       "commands": self.commands},
+                      bundle_file, indent=1)
+        return self.bundle_fname
+
+
+    def get_cmd(self):
+        """
+        Return command that runs the bundle.
+        """
+        return "%s -m rnaseqlib.cluster_utils.JobBundle --run %s" \
+            %(sys.executable, self.bundle_fname)
+
+
+    def get_statuses(self):
+        """
+        Return mapping from job name of each command to its exit
+        code (None if the command is not done.)
+        """
+        return dict([(command["job_name"],
+                      job_tracker.read_sentinel(command["status_fname"])) \
+                     for command in self.commands])
+
+
+    def __repr__(self):
+        return "JobBundle(%s, %d commands, job_id=%s)" \
+            %(self.bundle_name, len(self.commands), str(self.job_id))
+
+
+def make_bundles(jobs, bundle_size, bundle_dir,
+                 bundle_label="bundle",
+                 num_parallel=1):
+    """
+    Pack list of (cmd, job_name) jobs into bundles of at most
+    'bundle_size' commands. Return list of JobBundle objects.
+    """
+    bundle_size = max(1, bundle_size)
+    bundles = []
+    for start in range(0, len(jobs), bundle_size):
+        bundle_name = "%s_%d" %(bundle_label, len(bundles))
+        bundles.append(JobBundle(bundle_name,
+                                 jobs[start:start + bundle_size],
+                                 bundle_dir,
+                                 num_parallel=num_parallel))
+    return bundles
+
+
+def run_command(command):
+    """
+    Run a command of a bundle, writing its output to its log
+    file and then its exit code to its status file.
+    """
+    with open(command["log_fname"], "w") as log_file:
+        exit_code = subprocess.call(command["cmd"], shell=True,
+                                    stdout=log_file,
+                                    stderr=subprocess.STDOUT)
+    tmp_fname = "%s.tmp" %(command["status_fname"])
+    with open(tmp_fname, "w") as status_file:
+        status_file.write("%d\n" %(exit_code))
+    os.rename(tmp_fname, command["status_fname"])
+    return exit_code
+
+
+def run_bundle(bundle_fname):
+    """
+    Run the commands of a bundle, at most 'num_parallel' at a
+    time, in order. Return the number of commands that failed.
+    """
+    with open(bundle_fname) as bundle_file:
+        bundle = json.load(bundle_file)
+    commands = list(bundle["commands"])
+    exit_codes = []
+    lock = threading.Lock()
+    def run_commands():
+        while True:
+            with lock:
+                if len(commands) == 0:
+                    return
+                command = commands.pop(0)
+            print "Running %s: %s" %(command["job_name"], command["cmd"])
+            exit_code = run_command(command)
+            print "  - %s exited with code %d" %(command["job_name"],
+                                                 exit_code)
+            with lock:
+                exit_codes.append(exit_code)
+    threads = [threading.Thread(target=run_commands) \
+               for n in range(min(bundle["num_parallel"], len(commands)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len([c for c in exit_codes if c != 0])
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--run", dest="run", nargs=1, default=None,
+                      help="Run the commands of a bundle file.")
+    (options, args) = parser.parse_args()
+    if options.run is None:
+        parser.error("Need bundle file to run.")
+    num_failed = run_bundle(os.path.abspath(options.run))
+    if num_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
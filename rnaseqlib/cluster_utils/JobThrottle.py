@@ -0,0 +1,224 @@
+##
+## Throttling of job submissions to a maximum number of
+## jobs in flight
+##
+import os
+import sys
+import time
+
+import rnaseqlib
+
+
+class JobThrottle:
+    """
+    Submit jobs through a Cluster object so that at most
+    'max_in_flight' submitted jobs are not done at any time.
+    A job is submitted as soon as a slot frees up: while all
+    slots are taken, completion of jobs is polled with an
+    interval that starts at 'min_poll' and grows by 'backoff'
+    up to 'max_poll', and is reset when a job completes.
+
+    If given a state file, the jobs submitted and the exit
+    codes of completed jobs are recorded in it, so that a
+    partially submitted batch can be resumed: jobs that
+    completed successfully are not submitted again, nor are
+    jobs still running on a cluster (jobs run locally die with
+    the process that ran them, so they are submitted again.)
+
+    The number of jobs in flight and left to submit is logged
+    whenever it changes, and written to 'depth_fname' if given.
+    """
+    def __init__(self, my_cluster, max_in_flight,
+                 state_fname=None,
+                 resume=False,
+                 depth_fname=None,
+                 min_poll=1,
+                 max_poll=30,
+                 backoff=1.5,
+                 logger=None):
+        """
+        Args:
+        - my_cluster: Cluster object to submit jobs through
+        - max_in_flight: maximum number of jobs in flight
+
+        Kwargs:
+        - state_fname: file to record state of jobs in
+        - resume: if True, resume the batch of jobs recorded
+          in the state file; otherwise start a new batch
+        - depth_fname: file to record number of jobs in flight in
+        - min_poll, max_poll, backoff: poll interval settings
+        - logger: logger to log messages to
+        """
+        self.my_cluster = my_cluster
+        self.max_in_flight = max(1, max_in_flight)
+        self.state_fname = state_fname
+        self.depth_fname = depth_fname
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.logger = logger
+        # Mapping from job ID to job name for jobs in flight
+        self.in_flight = {}
+        # Mapping from job name to exit code of completed jobs
+        self.exit_codes = {}
+        # Number of jobs left to submit, if known
+        self.num_pending = None
+        # List of (time, jobs in flight, jobs pending)
+        self.depths = []
+        if (not resume) and (self.state_fname is not None) and \
+           os.path.isfile(self.state_fname):
+            os.remove(self.state_fname)
+        self.prev_states = self.load_state()
+
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print msg
+
+
+    def load_state(self):
+        """
+        Load state of jobs from a previous run: mapping from job
+        name to 'submitted' or exit code.
+        """
+        prev_states = {}
+        if (self.state_fname is None) or \
+           (not os.path.isfile(self.state_fname)):
+            return prev_states
+        with open(self.state_fname) as state_file:
+            for line in state_file:
+                fields = line.strip().split("\t")
+                if len(fields) != 2:
+                    # Partially written line
+                    continue
+                job_name, job_state = fields
+                if job_state != "submitted":
+                    job_state = int(job_state) if job_state != "NA" else None
+                prev_states[job_name] = job_state
+        return prev_states
+
+
+    def record_state(self, job_name, job_state):
+        if self.state_fname is None:
+            return
+        if job_state is None:
+            job_state = "NA"
+        with open(self.state_fname, "a") as state_file:
+            state_file.write("%s\t%s\n" %(job_name, str(job_state)))
+
+
+    def is_done_before(self, job_name):
+        """
+        Return True if job was submitted in a previous run and
+        need not be submitted again.
+        """
+        if job_name not in self.prev_states:
+            return False
+        job_state = self.prev_states[job_name]
+        if job_state == "submitted":
+            # Jobs submitted to a cluster outlive their submitter
+            return self.my_cluster.cluster_type in ["bsub", "qsub"]
+        return job_state in [0, None]
+
+
+    def record_depth(self):
+        depth = (len(self.in_flight), self.num_pending)
+        if (len(self.depths) > 0) and (self.depths[-1][1:] == depth):
+            return
+        self.depths.append((time.time(),) + depth)
+        pending_str = "NA" if self.num_pending is None \
+                      else str(self.num_pending)
+        self.log("Jobs in flight: %d, left to submit: %s" \
+                 %(len(self.in_flight), pending_str))
+        if self.depth_fname is not None:
+            write_header = not os.path.isfile(self.depth_fname)
+            with open(self.depth_fname, "a") as depth_file:
+                if write_header:
+                    depth_file.write("time\tin_flight\tpending\n")
+                depth_file.write("%s\t%d\t%s\n" \
+                                 %(time.strftime("%Y-%m-%d %H:%M:%S"),
+                                   len(self.in_flight),
+                                   pending_str))
+
+
+    def update(self):
+        """
+        Record jobs in flight that completed. Return the number
+        of completed jobs.
+        """
+        if len(self.in_flight) == 0:
+            return 0
+        done_jobs = self.my_cluster.get_done_jobs(self.in_flight.keys())
+        for job_id in done_jobs:
+            job_name = self.in_flight.pop(job_id)
+            exit_code = self.my_cluster.get_exit_code(job_id)
+            self.exit_codes[job_name] = exit_code
+            self.record_state(job_name, exit_code)
+        if len(done_jobs) > 0:
+            self.record_depth()
+        return len(done_jobs)
+
+
+    def wait_for_slots(self, max_in_flight):
+        """
+        Wait until at most 'max_in_flight' jobs are in flight.
+        """
+        poll_interval = self.min_poll
+        self.update()
+        while len(self.in_flight) > max_in_flight:
+            time.sleep(poll_interval)
+            if self.update() > 0:
+                poll_interval = self.min_poll
+            else:
+                poll_interval = min(poll_interval * self.backoff,
+                                    self.max_poll)
+
+
+    def submit(self, cmd, job_name, **launch_kwargs):
+        """
+        Submit job once a slot is free, unless it was done in
+        a previous run. Return the job's ID (None if it was
+        not submitted.)
+
+        Keyword arguments are passed to 'Cluster.launch_job'.
+        """
+        job_id = None
+        if self.is_done_before(job_name):
+            self.log("Job %s was submitted before, skipping.." %(job_name))
+        else:
+            self.wait_for_slots(self.max_in_flight - 1)
+            job_id = self.my_cluster.launch_job(cmd, job_name,
+                                                **launch_kwargs)
+            if job_id is not None:
+                self.in_flight[job_id] = job_name
+                self.record_state(job_name, "submitted")
+        if self.num_pending is not None:
+            self.num_pending = max(0, self.num_pending - 1)
+        self.record_depth()
+        return job_id
+
+
+    def submit_all(self, jobs, **launch_kwargs):
+        """
+        Submit list of (cmd, job_name) jobs. Return mapping from
+        job name to job ID for submitted jobs.
+        """
+        self.num_pending = len(jobs)
+        job_ids = {}
+        for cmd, job_name in jobs:
+            job_id = self.submit(cmd, job_name, **launch_kwargs)
+            if job_id is not None:
+                job_ids[job_name] = job_id
+        return job_ids
+
+
+    def finish(self, wait=False):
+        """
+        Finish submitting jobs. Jobs run locally are waited on;
+        jobs submitted to a cluster are waited on only if 'wait'
+        is True.
+        """
+        if wait or (self.my_cluster.cluster_type in ["local", "none"]):
+            self.wait_for_slots(0)
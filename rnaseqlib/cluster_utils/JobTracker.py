@@ -0,0 +1,167 @@
+##
+## Tracking of the completion of cluster jobs through
+## sentinel files and batched scheduler status queries
+##
+import os
+import sys
+import time
+
+import rnaseqlib
+
+
+def add_sentinel_to_cmd(cmd, sentinel_fname):
+    """
+    Return command that writes its exit code to the sentinel
+    file when it completes, and exits with the same code (so
+    that the scheduler sees failed jobs as failed.)
+    """
+    return "%s; ret=$?; echo $ret > %s; exit $ret" %(cmd, sentinel_fname)
+
+
+def read_sentinel(sentinel_fname):
+    """
+    Return exit code written to sentinel file, or None if
+    the file does not exist (or is still being written.)
+    """
+    try:
+        with open(sentinel_fname) as sentinel_file:
+            exit_code = sentinel_file.read().strip()
+    except IOError:
+        return None
+    if exit_code == "":
+        return None
+    return int(exit_code)
+
+
+class JobTracker:
+    """
+    Wait on a set of jobs at once.
+
+    A job is done when its sentinel file appears (see
+    'add_sentinel_to_cmd') or when the scheduler no longer
+    reports it as running. Sentinel files are checked for all
+    outstanding jobs at each poll, and the scheduler is queried
+    about all of them at once, at most every 'query_interval'
+    seconds (a query covers jobs that were killed before they
+    could write their sentinel.) The interval between polls
+    starts at 'min_poll' and grows by 'backoff' up to
+    'max_poll' while no job completes; it is reset when one
+    does.
+    """
+    def __init__(self, status_func=None,
+                 min_poll=1,
+                 max_poll=30,
+                 backoff=1.5,
+                 query_interval=60):
+        """
+        Kwargs:
+        - status_func: function taking a list of job IDs and
+          returning the set of those that are done according to
+          the scheduler (e.g. 'Mybsub.get_done_jobs')
+        - min_poll: initial seconds between polls
+        - max_poll: maximum seconds between polls
+        - backoff: factor to increase poll interval by
+        - query_interval: minimum seconds between scheduler queries
+        """
+        self.status_func = status_func
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.query_interval = query_interval
+        # Mapping from job ID to sentinel filename
+        self.sentinels = {}
+        # Mapping from job ID to exit code for completed jobs
+        # (None if the job's exit code is unknown)
+        self.exit_codes = {}
+        self.num_queries = 0
+        # Time of last scheduler query
+        self.last_query = time.time()
+
+
+    def add_job(self, job_id, sentinel_fname=None):
+        """
+        Track job with the given sentinel file.
+        """
+        self.sentinels[job_id] = sentinel_fname
+
+
+    def is_done(self, job_id):
+        return job_id in self.exit_codes
+
+
+    def get_outstanding(self, job_ids):
+        return [job_id for job_id in job_ids if not self.is_done(job_id)]
+
+
+    def check_sentinels(self, job_ids):
+        """
+        Record jobs whose sentinel files exist as done. Return
+        the number of jobs found to be done.
+        """
+        num_done = 0
+        for job_id in job_ids:
+            sentinel_fname = self.sentinels.get(job_id)
+            if sentinel_fname is None:
+                continue
+            exit_code = read_sentinel(sentinel_fname)
+            if exit_code is not None:
+                self.exit_codes[job_id] = exit_code
+                num_done += 1
+        return num_done
+
+
+    def query_scheduler(self, job_ids):
+        """
+        Query the scheduler about all the jobs at once, recording
+        the jobs it reports as done. Return the number of jobs
+        found to be done.
+        """
+        if (self.status_func is None) or (len(job_ids) == 0):
+            return 0
+        self.num_queries += 1
+        done_jobs = self.status_func(job_ids)
+        num_done = 0
+        for job_id in job_ids:
+            if job_id not in done_jobs:
+                continue
+            # The job may have written its sentinel since it
+            # was last checked
+            if self.check_sentinels([job_id]) == 0:
+                self.exit_codes[job_id] = None
+            num_done += 1
+        return num_done
+
+
+    def poll(self, job_ids):
+        """
+        Check which of the jobs are done, without waiting: check
+        their sentinels, and query the scheduler if it was not
+        queried in the last 'query_interval' seconds. Return the
+        number of jobs found to be done.
+        """
+        outstanding = self.get_outstanding(job_ids)
+        num_done = self.check_sentinels(outstanding)
+        outstanding = self.get_outstanding(outstanding)
+        if (len(outstanding) > 0) and \
+           (time.time() - self.last_query >= self.query_interval):
+            num_done += self.query_scheduler(outstanding)
+            self.last_query = time.time()
+        return num_done
+
+
+    def wait_on_jobs(self, job_ids):
+        """
+        Wait until all the jobs are done. Return mapping from
+        job ID to exit code (None if it is unknown.)
+        """
+        poll_interval = self.min_poll
+        while True:
+            num_done = self.poll(job_ids)
+            if len(self.get_outstanding(job_ids)) == 0:
+                break
+            if num_done > 0:
+                poll_interval = self.min_poll
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * self.backoff, self.max_poll)
+        return dict([(job_id, self.exit_codes[job_id]) \
+                     for job_id in job_ids])
@@ -0,0 +1,228 @@
+##
+## Queue of jobs run as processes on the local machine,
+## with a limit on the number of jobs, CPUs and memory
+## used at once
+##
+import os
+import sys
+import time
+import threading
+import subprocess
+import multiprocessing
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+
+class LocalJob:
+    """
+    A shell command run as a local job.
+    """
+    def __init__(self, job_id, cmd, job_name,
+                 num_cpus=1,
+                 mem_gb=0,
+                 num_retries=0,
+                 log_fname=None):
+        self.job_id = job_id
+        self.cmd = cmd
+        self.job_name = job_name
+        self.num_cpus = num_cpus
+        self.mem_gb = mem_gb
+        self.num_retries = num_retries
+        self.log_fname = log_fname
+        # Number of times the job was started
+        self.num_attempts = 0
+        # One of 'queued', 'running' or 'done'
+        self.status = "queued"
+        # Exit codes of each attempt of the job
+        self.exit_codes = []
+        self.proc = None
+
+
+    @property
+    def exit_code(self):
+        if len(self.exit_codes) == 0:
+            return None
+        return self.exit_codes[-1]
+
+
+    def __repr__(self):
+        return "LocalJob(%d, %s, status=%s, exit_codes=%s)" \
+            %(self.job_id, self.job_name, self.status, self.exit_codes)
+
+
+class LocalQueue:
+    """
+    Run jobs as local processes in the order they were
+    submitted, so that at most 'max_jobs' jobs run at once and
+    the CPUs and memory reserved by the running jobs are within
+    'max_cpus' and 'max_mem_gb'. A job that reserves more than
+    the limits is run when no other job is running.
+
+    Jobs that exit with a nonzero code are retried up to their
+    number of retries. Each job's output is appended to its log
+    file (if one is given.)
+    """
+    def __init__(self, max_jobs=None,
+                 max_cpus=None,
+                 max_mem_gb=None,
+                 logger=None):
+        """
+        Kwargs:
+        - max_jobs: jobs to run at once (by default, the number
+          of CPUs of the machine)
+        - max_cpus: CPUs that the jobs can reserve at once (by
+          default, the number of CPUs of the machine)
+        - max_mem_gb: memory (in GB) that the jobs can reserve
+          at once (unlimited if None)
+        - logger: logger to log messages to
+        """
+        num_machine_cpus = multiprocessing.cpu_count()
+        if max_jobs is None:
+            max_jobs = num_machine_cpus
+        if max_cpus is None:
+            max_cpus = num_machine_cpus
+        self.max_jobs = max(1, max_jobs)
+        self.max_cpus = max(1, max_cpus)
+        self.max_mem_gb = max_mem_gb
+        self.logger = logger
+        self.jobs = {}
+        self.queued = []
+        self.running = {}
+        self.cond = threading.Condition()
+
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+
+    def submit(self, cmd, job_name,
+               num_cpus=1,
+               mem_gb=0,
+               num_retries=0,
+               log_fname=None):
+        """
+        Add job to the queue and return its ID.
+
+        Args:
+        - cmd: shell command to run
+        - job_name: name of job
+
+        Kwargs:
+        - num_cpus: CPUs reserved by the job
+        - mem_gb: memory (in GB) reserved by the job
+        - num_retries: number of times to rerun job if it fails
+        - log_fname: file to append job's output to
+        """
+        with self.cond:
+            job_id = len(self.jobs)
+            job = LocalJob(job_id, cmd, job_name,
+                           num_cpus=num_cpus,
+                           mem_gb=mem_gb,
+                           num_retries=num_retries,
+                           log_fname=log_fname)
+            self.jobs[job_id] = job
+            self.queued.append(job)
+            self.start_jobs()
+        return job_id
+
+
+    def fits_limits(self, job):
+        """
+        Return True if job can be started along with the
+        running jobs.
+        """
+        if len(self.running) == 0:
+            return True
+        if len(self.running) >= self.max_jobs:
+            return False
+        used_cpus = sum([j.num_cpus for j in self.running.values()])
+        if used_cpus + job.num_cpus > self.max_cpus:
+            return False
+        if self.max_mem_gb is not None:
+            used_mem_gb = sum([j.mem_gb for j in self.running.values()])
+            if used_mem_gb + job.mem_gb > self.max_mem_gb:
+                return False
+        return True
+
+
+    def start_jobs(self):
+        """
+        Start queued jobs, in order, while they fit the limits.
+        Must be called with the queue's lock held.
+        """
+        while (len(self.queued) > 0) and self.fits_limits(self.queued[0]):
+            job = self.queued.pop(0)
+            self.start_job(job)
+
+
+    def start_job(self, job):
+        job.num_attempts += 1
+        job.status = "running"
+        self.running[job.job_id] = job
+        self.log("Starting local job %d (%s), attempt %d: %s" \
+                 %(job.job_id, job.job_name, job.num_attempts, job.cmd))
+        output_file = None
+        if job.log_fname is not None:
+            utils.make_dir(os.path.dirname(job.log_fname))
+            output_file = open(job.log_fname, "a")
+        try:
+            job.proc = subprocess.Popen(job.cmd, shell=True,
+                                        stdout=output_file,
+                                        stderr=subprocess.STDOUT \
+                                               if output_file else None)
+        finally:
+            if output_file is not None:
+                output_file.close()
+        # Wait on the job's process in a thread so that the
+        # next job is started as soon as this one exits
+        waiter = threading.Thread(target=self.wait_on_proc, args=(job,))
+        waiter.daemon = True
+        waiter.start()
+
+
+    def wait_on_proc(self, job):
+        exit_code = job.proc.wait()
+        with self.cond:
+            job.exit_codes.append(exit_code)
+            self.running.pop(job.job_id)
+            if (exit_code != 0) and (job.num_attempts <= job.num_retries):
+                self.log("Local job %d (%s) failed with exit code %d, " \
+                         "retrying.." %(job.job_id, job.job_name, exit_code))
+                job.status = "queued"
+                self.queued.insert(0, job)
+            else:
+                job.status = "done"
+            self.start_jobs()
+            self.cond.notify_all()
+
+
+    def wait(self, job_id):
+        """
+        Wait until job is done and return its exit code.
+        """
+        job = self.jobs[job_id]
+        with self.cond:
+            while job.status != "done":
+                # Wait with a timeout so that the waiting thread
+                # remains interruptible
+                self.cond.wait(1)
+        return job.exit_code
+
+
+    def wait_all(self):
+        """
+        Wait until all jobs are done. Return mapping from job
+        ID to exit code.
+        """
+        for job_id in sorted(self.jobs.keys()):
+            self.wait(job_id)
+        return dict([(job_id, job.exit_code) \
+                     for job_id, job in self.jobs.iteritems()])
+
+
+    def __repr__(self):
+        return "LocalQueue(max_jobs=%d, max_cpus=%d, max_mem_gb=%s, " \
+               "%d jobs)" %(self.max_jobs, self.max_cpus, self.max_mem_gb,
+                            len(self.jobs))
@@ -1,28 +1,40 @@
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.cluster_utils.JobTracker as job_tracker
 
 import os, os.path, subprocess, sys, time, getpass
 from optparse import OptionParser
 
 
+def get_done_jobs(jobIDs):
+    """
+    Return the set of job IDs that are done, querying bjobs
+    about all jobs at once. Jobs that bjobs does not know
+    about are done.
+    """
+    output = subprocess.Popen("bjobs %s" %(" ".join(map(str, jobIDs))),
+                              shell=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).communicate()
+    done_jobs = set(jobIDs)
+    for line in output[0].splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 3 or not fields[0].isdigit():
+            continue
+        if fields[2] not in ["DONE", "EXIT"]:
+            done_jobs.discard(int(fields[0]))
+    return done_jobs
+
+
 def waitUntilDone(jobID, sleep=60):
     """
     Waits until a job ID is no longer found in the bjobs output.
     """
-    while True:
-        output = subprocess.Popen("bjobs %i"%jobID,
-                                  shell=True,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE).communicate()
-        if len(output[0]) > 0:
-            status = output[0].split()[10]
-            if status == "DONE":
-                break
-        else:
-            # No jobs available
-            break
-        time.sleep(sleep)
-    time.sleep(sleep)
+    tracker = job_tracker.JobTracker(status_func=get_done_jobs,
+                                     min_poll=sleep,
+                                     max_poll=sleep,
+                                     query_interval=0)
+    tracker.wait_on_jobs([jobID])
 
     
 def launchJob(cmd, job_name,
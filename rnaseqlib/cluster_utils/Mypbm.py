@@ -1,24 +1,41 @@
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.cluster_utils.JobTracker as job_tracker
 
 import os, subprocess, sys, time, getpass
 from optparse import OptionParser
 
+def get_done_jobs(jobIDs):
+    """
+    Return the set of job IDs that are done, querying qstat
+    about all jobs at once. Jobs that qstat does not know
+    about (Unknown Job Id) or reports as completed are done.
+    """
+    output = \
+        subprocess.Popen("qstat %s" %(" ".join(map(str, jobIDs))),
+                         shell=True,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+    done_jobs = set(jobIDs)
+    for line in output[0].splitlines():
+        fields = line.split()
+        if len(fields) < 5 or not fields[0].split(".")[0].isdigit():
+            continue
+        if fields[4] != "C":
+            done_jobs.discard(int(fields[0].split(".")[0]))
+    return done_jobs
+
+
 def waitUntilDone(jobID,
                   sleep=60):
     """
     Waits until a job ID is no longer found in the qstat output
     """
-    while True:
-        output = \
-            subprocess.Popen("qstat %i" %(jobID),
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE).communicate()
-        if "Unknown Job" in output[1]:
-            break
-        time.sleep(sleep)
-    time.sleep(sleep)
+    tracker = job_tracker.JobTracker(status_func=get_done_jobs,
+                                     min_poll=sleep,
+                                     max_poll=sleep,
+                                     query_interval=0)
+    tracker.wait_on_jobs([jobID])
 
         
 def launchJob(cmd, job_name, scriptOptions,
@@ -7,27 +7,60 @@ import sys
 import time
 
 import rnaseqlib
+import rnaseqlib.utils as utils
 from rnaseqlib.cluster_utils import Mybsub, Mypbm, Mysge
+import rnaseqlib.cluster_utils.LocalQueue as local_queue
+import rnaseqlib.cluster_utils.JobTracker as job_tracker
+import rnaseqlib.cluster_utils.JobBundle as job_bundle
 
 class Cluster:
     """
     Cluster submission.
+
+    Cluster type 'local' runs jobs on the local machine through
+    a queue (see 'LocalQueue') that limits the jobs, CPUs and
+    memory used at once, retrying jobs that fail.
+
+    Jobs submitted to bsub/qsub write a sentinel file when they
+    complete, and are waited on together (see 'JobTracker'.)
+
+    Many small commands can be packed into fewer jobs with
+    'launch_bundles' (see 'JobBundle'.)
     """
     def __init__(self,
                  cluster_type,
                  output_dir,
                  logger,
-                 supported_types=["bsub", "qsub", "none"],
+                 supported_types=["bsub", "qsub", "local", "none"],
                  cluster_queue=None,
-                 cluster_memory=None):
+                 cluster_memory=None,
+                 max_jobs=None,
+                 max_cpus=None,
+                 max_mem_gb=None,
+                 num_retries=0):
         self.logger = logger
         self.cluster_type = cluster_type.lower()
         self.cluster_queue = cluster_queue
         self.cluster_memory = cluster_memory
         self.output_dir = output_dir
+        # Number of times to rerun failed local jobs
+        self.num_retries = num_retries
 
         self._curjobid = 0
         self.jobs = {}
+        self.local_queue = None
+        self.job_tracker = None
+        if self.cluster_type == "bsub":
+            self.job_tracker = \
+                job_tracker.JobTracker(status_func=Mybsub.get_done_jobs)
+        elif self.cluster_type == "qsub":
+            self.job_tracker = \
+                job_tracker.JobTracker(status_func=Mypbm.get_done_jobs)
+        elif self.cluster_type == "local":
+            self.local_queue = local_queue.LocalQueue(max_jobs=max_jobs,
+                                                      max_cpus=max_cpus,
+                                                      max_mem_gb=max_mem_gb,
+                                                      logger=self.logger)
         
         if self.cluster_type not in supported_types:
             self.logger.critical("Unsupported cluster type: %s" \
@@ -39,10 +72,11 @@ class Cluster:
 
     def launch_and_wait(self, cmd, job_name,
                         unless_exists=None,
-                        extra_sleep=20,
+                        extra_sleep=0,
                         ppn=1):
         """
-        Launch job and wait until it's done.
+        Launch job and wait until it's done, sleeping for
+        'extra_sleep' seconds after.
         """
         job_id = self.launch_job(cmd, job_name,
                                  unless_exists=unless_exists,
@@ -54,19 +88,24 @@ class Cluster:
             # Job is submitted (assigned an ID) so now
             # wait for it to finish
             self.wait_on_job(job_id)
-        time.sleep(extra_sleep)
+        if extra_sleep > 0:
+            time.sleep(extra_sleep)
     
 
     def launch_job(self, cmd, job_name,
                    ppn=1,
-                   unless_exists=None):
+                   unless_exists=None,
+                   mem_gb=0):
         """
         Launch job on cluster and return a job id.
 
         if unless_exists flag is given, do not execute command
         if the given filename path exists.
+
+        mem_gb is the memory (in GB) reserved by the job
+        when running locally.
         
-        Wrapper to Mysge/Mypbm/Mybsub.
+        Wrapper to Mysge/Mypbm/Mybsub/LocalQueue.
         """
         job_id = None
         script_options = {}
@@ -75,6 +114,22 @@ class Cluster:
             print "launch_job: SKIPPING %s since %s exists." \
                 %(cmd, unless_exists)
             return job_id
+        sentinel_fname = None
+        if self.job_tracker is not None:
+            # Have job write its exit code to a sentinel file
+            sentinels_dir = os.path.join(self.output_dir,
+                                         "cluster_scripts",
+                                         "sentinels")
+            utils.make_dir(sentinels_dir)
+            sentinel_fname = \
+                os.path.abspath(os.path.join(sentinels_dir,
+                                             "%s.%d.%d.done" \
+                                             %(job_name, os.getpid(),
+                                               self._curjobid)))
+            self._curjobid += 1
+            if os.path.isfile(sentinel_fname):
+                os.remove(sentinel_fname)
+            cmd = job_tracker.add_sentinel_to_cmd(cmd, sentinel_fname)
         if self.cluster_type == "bsub":
             # Use bsub for submission
             job_id = Mybsub.launchJob(cmd, job_name,
@@ -90,6 +145,16 @@ class Cluster:
                                      self.output_dir,
                                      queue_type="long",
                                      ppn=ppn)
+        elif self.cluster_type == "local":
+            # Queue job on the local machine
+            log_fname = os.path.join(self.output_dir,
+                                     "cluster_scripts",
+                                     "%s.%d.out" %(job_name, os.getpid()))
+            job_id = self.local_queue.submit(cmd, job_name,
+                                             num_cpus=int(ppn),
+                                             mem_gb=mem_gb,
+                                             num_retries=self.num_retries,
+                                             log_fname=log_fname)
         elif self.cluster_type == "none":
             # Use local machine (multi-cores)
             p = subprocess.Popen(cmd, shell=True)
@@ -98,23 +163,82 @@ class Cluster:
             self._curjobid += 1
         if job_id is None:
             print "WARNING: Job %s not submitted." %(job_name)
+        elif self.job_tracker is not None:
+            self.job_tracker.add_job(job_id, sentinel_fname)
         return job_id
         
 
+    def get_bundles(self, jobs, bundle_size,
+                    num_parallel=1,
+                    bundle_label="bundle"):
+        """
+        Pack list of (cmd, job_name) jobs into bundles of at most
+        'bundle_size' commands, each run by one job with at most
+        'num_parallel' commands at a time. Return list of
+        JobBundle objects whose files are written.
+        """
+        bundle_dir = os.path.join(self.output_dir,
+                                  "cluster_scripts",
+                                  "bundles")
+        bundles = job_bundle.make_bundles(jobs, bundle_size, bundle_dir,
+                                          bundle_label=bundle_label,
+                                          num_parallel=num_parallel)
+        for bundle in bundles:
+            bundle.write()
+        return bundles
+
+
+    def launch_bundles(self, jobs, bundle_size,
+                       num_parallel=1,
+                       bundle_label="bundle",
+                       ppn=None):
+        """
+        Launch list of (cmd, job_name) jobs packed into bundles
+        (see 'get_bundles'.) Return list of JobBundle objects
+        with their job IDs.
+
+        Each bundle's job reserves 'ppn' processors (by default,
+        one per command run at once.)
+        """
+        if ppn is None:
+            ppn = num_parallel
+        bundles = self.get_bundles(jobs, bundle_size,
+                                   num_parallel=num_parallel,
+                                   bundle_label=bundle_label)
+        for bundle in bundles:
+            bundle.job_id = self.launch_job(bundle.get_cmd(),
+                                            bundle.bundle_name,
+                                            ppn=ppn)
+        return bundles
+
+
+    def wait_on_bundles(self, bundles):
+        """
+        Wait on bundles. Return mapping from job name of each
+        command in the bundles to its exit code (None if the
+        command did not complete.)
+        """
+        self.wait_on_jobs([bundle.job_id for bundle in bundles \
+                           if bundle.job_id is not None])
+        statuses = {}
+        for bundle in bundles:
+            statuses.update(bundle.get_statuses())
+        return statuses
+
+
     def wait_on_job(self, job_id):
-        if self.cluster_type == "bsub":
+        if self.cluster_type in ["bsub", "qsub"]:
             print "Waiting on %s.. (started wait @ %s)" \
                 %(job_id,
                   time.strftime("%x, %X"))
-            Mybsub.waitUntilDone(job_id)
+            self.job_tracker.wait_on_jobs([job_id])
             print "  - Completed at %s" %(time.strftime("%x, %X"))
             return True
-        elif self.cluster_type == "qsub":
-            print "Waiting on %s.. (started wait @ %s)" \
-                %(job_id,
-                  time.strftime("%x, %X"))
-            Mypbm.waitUntilDone(job_id)
-            print "  - Completed at %s" %(time.strftime("%x, %X"))
+        elif self.cluster_type == "local":
+            exit_code = self.local_queue.wait(job_id)
+            if exit_code != 0:
+                print "WARNING: Local job %d exited with code %d." \
+                    %(job_id, exit_code)
             return True
         elif self.cluster_type == "none":
             self.jobs[job_id].wait()
@@ -126,9 +250,55 @@ class Cluster:
         num_jobs = len(job_ids)
         print "Starting to wait on a collection of %d jobs" \
             %(num_jobs)
+        if self.job_tracker is not None:
+            # Wait on all jobs at once
+            self.job_tracker.wait_on_jobs(job_ids)
+            print "All jobs completed."
+            return
         jobs_completed = {}
         for job_id in job_ids:
             if job_id in jobs_completed: continue
             if self.wait_on_job(job_id):
                 jobs_completed[job_id] = True
         print "All jobs completed."
+
+
+    def get_done_jobs(self, job_ids):
+        """
+        Return the set of the given jobs that are done, without
+        waiting on them.
+        """
+        if self.job_tracker is not None:
+            self.job_tracker.poll(job_ids)
+            return set([job_id for job_id in job_ids \
+                        if self.job_tracker.is_done(job_id)])
+        elif self.cluster_type == "local":
+            return set([job_id for job_id in job_ids \
+                        if self.local_queue.jobs[job_id].status == "done"])
+        elif self.cluster_type == "none":
+            return set([job_id for job_id in job_ids \
+                        if self.jobs[job_id].poll() is not None])
+        raise Exception, "Not implemented yet."
+
+
+    def get_exit_code(self, job_id):
+        """
+        Return exit code of a completed job (None if it is
+        not known.)
+        """
+        if self.job_tracker is not None:
+            return self.job_tracker.exit_codes.get(job_id)
+        elif self.cluster_type == "local":
+            return self.local_queue.jobs[job_id].exit_code
+        elif self.cluster_type == "none":
+            return self.jobs[job_id].returncode
+        return None
+
+
+    def wait_on_local_jobs(self):
+        """
+        Wait until all jobs queued on the local machine are
+        done. Jobs submitted to a cluster are not waited on.
+        """
+        if self.cluster_type == "local":
+            self.local_queue.wait_all()
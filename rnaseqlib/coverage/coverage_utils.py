@@ -4,6 +4,7 @@
 import os
 import sys
 import time
+import array
 
 import numpy as np
 import scipy
@@ -15,10 +16,19 @@ import pybedtools
 import rnaseqlib
 import rnaseqlib.stats.stats_utils as stats_utils
 import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.bam_parallel as bam_parallel
 import rnaseqlib.utils as utils
 
 from collections import defaultdict, OrderedDict
 
+# Cigar operations of bases aligned to the reference (M, =, X)
+ALIGNED_CIGAR_OPS = [0, 7, 8]
+# Cigar operations that skip over the reference (D, N)
+REF_CIGAR_OPS = [2, 3]
+# Bytes taken by the bookkeeping of each exon of an
+# ExonsCoverage (its key, info tuple and dict slot)
+EXON_INFO_BYTES = 500
+
 
 # def output_bam_coverage_per_base(bam_fname, gff_fname, output_dir,
 #                                  num_coverage_fields=11):
@@ -181,9 +191,336 @@ def coverage_dist_from_uniform(obs_reads_per_base):
     return sqrt_jsd_dist
 
 
+def get_cigar_blocks(bam_read):
+    """
+    Return the blocks of the reference that the read's bases are
+    aligned to (cigar M, = and X operations), as (start, end)
+    pairs in 1-based, end-exclusive coordinates.
+    """
+    blocks = []
+    ref_pos = bam_read.pos + 1
+    for cigar_type, cigar_len in bam_read.cigar:
+        if cigar_type in ALIGNED_CIGAR_OPS:
+            blocks.append((ref_pos, ref_pos + cigar_len))
+            ref_pos += cigar_len
+        elif cigar_type in REF_CIGAR_OPS:
+            # Deletions and skipped regions (junctions) advance
+            # along the reference without covering it
+            ref_pos += cigar_len
+    return blocks
+
+
+def estimate_exons_coverage_bytes(gff_fname):
+    """
+    Return an estimate of the memory (in bytes) that an
+    ExonsCoverage of all the exons of a GFF file takes.
+    """
+    num_exons = 0
+    total_len = 0
+    with open(gff_fname) as gff_in:
+        for line in gff_in:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields) < 5 or fields[2] != "exon":
+                continue
+            num_exons += 1
+            total_len += (int(fields[4]) - int(fields[3]) + 1) + 1
+    # One 8-byte coverage slot per exon base (plus one per exon)
+    return (8 * total_len) + (EXON_INFO_BYTES * num_exons)
+
+
+class ExonsCoverage:
+    """
+    Per-base read coverage of a set of exons.
+
+    The coverage of all exons is kept in a single flat array,
+    where each exon has an offset and one slot per base (plus
+    one extra slot, so that exons don't share slots.) The array
+    holds differences of coverage between consecutive bases:
+    each block of a read adds 1 at the block's start and -1 past
+    its end, and the coverage is the cumulative sum. Block starts
+    and ends are buffered and applied to the array in batches.
+    """
+    def __init__(self, flush_size=1000000):
+        # Exons in order of their offsets
+        self.exons = []
+        # Mapping from exon to its (offset, start, end)
+        self.exon_info = {}
+        self.total_len = 0
+        self.coverage_diffs = np.zeros(1024, dtype=np.int64)
+        self.flush_size = flush_size
+        self.block_starts = array.array("l")
+        self.block_ends = array.array("l")
+        # Number of times a read had no base in an exon it
+        # was mapped to
+        self.num_unmatched = 0
+
+
+    def add_exon(self, exon):
+        """
+        Add exon, given as string in GFF coordinates
+        (e.g. 'chr13:21281961-21281993:+').
+        """
+        chrom, start, end, strand = utils.parse_dash_coords(exon)
+        # Check that start < end
+        assert (start <= end), \
+          "Start (%d) must be less than end (%d): %s" %(start, end, exon)
+        # Check strand
+        if not (strand == "+" or strand == "-"):
+            raise Exception, "Unknown strand symbol %s" %(str(strand))
+        offset = self.total_len
+        self.total_len += (end - start + 1) + 1
+        if self.total_len > len(self.coverage_diffs):
+            new_len = max(2 * len(self.coverage_diffs), self.total_len)
+            new_diffs = np.zeros(new_len, dtype=np.int64)
+            new_diffs[0:len(self.coverage_diffs)] = self.coverage_diffs
+            self.coverage_diffs = new_diffs
+        self.exons.append(exon)
+        self.exon_info[exon] = (offset, start, end)
+        return self.exon_info[exon]
+
+
+    def add_read(self, bam_read, exons):
+        """
+        Add coverage of read to the exons it was mapped to.
+        """
+        blocks = get_cigar_blocks(bam_read)
+        for exon in exons:
+            exon_info = self.exon_info.get(exon, None)
+            if exon_info is None:
+                exon_info = self.add_exon(exon)
+            offset, start, end = exon_info
+            read_matched_to_exon = False
+            for block_start, block_end in blocks:
+                # Part of block that lands in exon
+                block_start = max(block_start, start)
+                block_end = min(block_end, end + 1)
+                if block_start >= block_end:
+                    continue
+                self.block_starts.append(offset + block_start - start)
+                self.block_ends.append(offset + block_end - start)
+                read_matched_to_exon = True
+            if not read_matched_to_exon:
+                self.num_unmatched += 1
+        if len(self.block_starts) >= self.flush_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Apply buffered block starts and ends to the coverage array.
+        """
+        for positions, value in [(self.block_starts, 1),
+                                 (self.block_ends, -1)]:
+            if len(positions) == 0:
+                continue
+            positions = np.frombuffer(positions, dtype=np.int64)
+            unique_positions, counts = np.unique(positions,
+                                                 return_counts=True)
+            self.coverage_diffs[unique_positions] += value * counts
+        self.block_starts = array.array("l")
+        self.block_ends = array.array("l")
+
+
+    def merge(self, other):
+        """
+        Add the coverage of another ExonsCoverage object.
+        """
+        other.flush()
+        for exon in other.exons:
+            exon_info = self.exon_info.get(exon, None)
+            if exon_info is None:
+                exon_info = self.add_exon(exon)
+            offset, start, end = exon_info
+            other_offset = other.exon_info[exon][0]
+            exon_slots = end - start + 2
+            self.coverage_diffs[offset:offset + exon_slots] += \
+                other.coverage_diffs[other_offset:other_offset + exon_slots]
+        self.num_unmatched += other.num_unmatched
+        return self
+
+
+    def get_coverage(self):
+        """
+        Return the flat array of coverage of all exons, and the
+        offsets and lengths of the exons in it.
+        """
+        self.flush()
+        # The differences of each exon sum to zero, so the
+        # cumulative sum can be taken over all exons at once
+        coverage = np.cumsum(self.coverage_diffs[0:self.total_len])
+        offsets = np.array([self.exon_info[exon][0] for exon in self.exons],
+                           dtype=np.int64)
+        lens = np.array([self.exon_info[exon][2] - \
+                         self.exon_info[exon][1] + 1 for exon in self.exons],
+                        dtype=np.int64)
+        return coverage, offsets, lens
+
+
+    def get_exon_coverage(self, exon):
+        """
+        Return array of coverage of each base of exon.
+        """
+        coverage, offsets, lens = self.get_coverage()
+        offset, start, end = self.exon_info[exon]
+        return coverage[offset:offset + (end - start + 1)]
+
+
+    def get_stats(self, chunk_size=1000000):
+        """
+        Calculate coverage statistics of each exon. Returns mapping
+        from an exon to its coverage statistics.
+
+        Kwargs:
+        - chunk_size: approximate number of bases to compute
+        statistics for at a time, which bounds the memory used
+        by temporary arrays
+        """
+        exon_stats_dict = {}
+        if len(self.exons) == 0:
+            return exon_stats_dict
+        coverage, offsets, lens = self.get_coverage()
+        # Split exons into chunks of about 'chunk_size' bases
+        chunk_ends = np.searchsorted(np.cumsum(lens),
+                                     np.arange(chunk_size, lens.sum(),
+                                               chunk_size),
+                                     side="right")
+        chunk_ends = np.unique(np.r_[chunk_ends, len(self.exons)])
+        chunk_start = 0
+        for chunk_end in chunk_ends:
+            if chunk_end <= chunk_start:
+                continue
+            stats = \
+              get_segments_coverage_stats(coverage,
+                                          offsets[chunk_start:chunk_end],
+                                          lens[chunk_start:chunk_end])
+            for exon_num in range(chunk_start, chunk_end):
+                exon = self.exons[exon_num]
+                entry = {"exon": exon}
+                for stat in stats:
+                    entry[stat] = stats[stat][exon_num - chunk_start]
+                exon_stats_dict[exon] = entry
+            chunk_start = chunk_end
+        return exon_stats_dict
+
+
+def get_segments_coverage_stats(coverage, offsets, lens):
+    """
+    Calculate coverage statistics (mean, std, min, max, kurtosis,
+    cv and sqrt_jsd) of each segment of the coverage array, given
+    the segments' offsets and lengths.
+
+    Statistics match those computed one segment at a time with
+    numpy/scipy (np.std, scipy.stats.kurtosis with fisher=False,
+    'coverage_dist_from_uniform'.)
+
+    Returns mapping from statistic to array of its values.
+    """
+    # Drop the extra slot between segments so that segments are
+    # contiguous and can be reduced with reduceat
+    starts = np.r_[0, np.cumsum(lens)[:-1]]
+    positions = np.repeat(offsets - starts, lens) + np.arange(lens.sum())
+    counts = coverage[positions]
+    values = counts.astype(np.float64)
+    old_settings = np.seterr(divide="ignore", invalid="ignore")
+    try:
+        sums = np.add.reduceat(values, starts)
+        means = sums / lens
+        centered = values - np.repeat(means, lens)
+        m2 = np.add.reduceat(centered ** 2, starts) / lens
+        m4 = np.add.reduceat(centered ** 4, starts) / lens
+        stds = np.sqrt(m2)
+        kurtosis = np.where(m2 == 0, 0, m4 / m2 ** 2.0)
+        cvs = stds / means
+        # sqrt of Jensen-Shannon divergence between observed
+        # distribution of reads per base and a uniform one
+        obs_dist = values / np.repeat(sums, lens)
+        uniform_dist = np.repeat(1. / lens, lens)
+        mixed_dist = obs_dist + uniform_dist
+        d1 = obs_dist * np.log2(2 * obs_dist / mixed_dist)
+        d2 = uniform_dist * np.log2(2 * uniform_dist / mixed_dist)
+        d1[np.isnan(d1)] = 0
+        d2[np.isnan(d2)] = 0
+        sqrt_jsd = np.sqrt(0.5 * np.add.reduceat(d1 + d2, starts))
+    finally:
+        np.seterr(**old_settings)
+    stats = {"mean": means,
+             "std": stds,
+             "max": np.maximum.reduceat(counts, starts),
+             "min": np.minimum.reduceat(counts, starts),
+             "kurtosis": kurtosis,
+             "cv": cvs,
+             "sqrt_jsd": sqrt_jsd}
+    return stats
+
+
+def count_exons_coverage_in_shard(bam_fname, shard,
+                                  interval_label="gff",
+                                  gff_coords=True):
+    """
+    Count coverage of each base of each exon in a shard of a
+    BAM file produced by tagBam.
+
+    Returns an ExonsCoverage object.
+    """
+    exons_coverage = ExonsCoverage()
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        gff_aligned_regions = bam_read.opt("YB")
+        # Get GFF regions that read aligns to
+        parsed_regions = \
+          bam_utils.parse_tagBam_opt_field(gff_aligned_regions,
+                                           interval_label=interval_label,
+                                           gff_coords=gff_coords)
+        exons_coverage.add_read(bam_read, parsed_regions)
+    bam_file.close()
+    exons_coverage.flush()
+    return exons_coverage
+
+
+def count_exons_coverage_in_bam_shard(bam_fname, shard, exons_index):
+    """
+    Count coverage of each base of each exon in a shard of
+    a BAM file, using an index of the exons (see
+    IntervalIndex.add_gff_file). As with tagBam -f 1, reads
+    are mapped to the exons that contain them.
+
+    Returns an ExonsCoverage object.
+    """
+    exons_coverage = ExonsCoverage()
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    chrom = shard[0]
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        if bam_read.is_unmapped:
+            continue
+        matches = exons_index.find(chrom, bam_read.pos, bam_read.aend,
+                                   contained=True)
+        if len(matches) == 0:
+            continue
+        # Regions in GFF coordinates
+        regions = ["%s:%d-%d:%s" %(chrom, start + 1, end, strand) \
+                   for start, end, label, name, strand in matches]
+        exons_coverage.add_read(bam_read, regions)
+    bam_file.close()
+    exons_coverage.flush()
+    return exons_coverage
+
+
+def merge_exons_coverage(shard_results):
+    """
+    Merge the ExonsCoverage objects of shards.
+    """
+    exons_coverage = ExonsCoverage()
+    for shard_coverage in shard_results:
+        exons_coverage.merge(shard_coverage)
+    return exons_coverage
+
+
 def get_exons_coverage_from_tagBam(bam_fname,
                                    interval_label="gff",
-                                   gff_coords=True):
+                                   gff_coords=True,
+                                   num_processors=1):
     """
     Count exons coverage from BAM file produced by tagBam.
     Returns mapping from an exon to its coverage statistics.
@@ -199,73 +536,42 @@ def get_exons_coverage_from_tagBam(bam_fname,
     from BED format (0-based) to GFF based by adding 1 to the start
     coordinate. Note that tagBam produces intervals in BED format
     always.
+    - num_processors: number of processes to use. The BAM is
+    processed one chromosome at a time.
     """
-    # Mapping from exons to start positions counts, i.e.
-    #  exon1 -> genomic start_pos1 -> # at genomic start position 1
-    #        -> genomic start_pos4 -> # at genomic start position 4
-    #  exon2 -> ...
-    exons_to_start_pos_counts = {}
-    bam_file = pysam.Samfile(bam_fname, "rb")
-    num_unmatched = 0
-    for bam_read in bam_file:
-        gff_aligned_regions = bam_read.opt("YB")
-        # Get GFF regions that read aligns to
-        parsed_regions = \
-          bam_utils.parse_tagBam_opt_field(gff_aligned_regions,
-                                           gff_coords=gff_coords)
-        # Get read start position
-        read_start_pos = bam_read.pos + 1
-        for region in parsed_regions:
-            # If we've seen this exon region before, use its dictionary
-            if region in exons_to_start_pos_counts:
-                curr_region_starts = exons_to_start_pos_counts[region]
-            else:
-                curr_region_starts = init_region_start_pos(region)
-                exons_to_start_pos_counts[region] = curr_region_starts
-            # Add +1 to each read position that the read overlaps
-            # Have a simple read position counter that starts with
-            # read start and counts the bases covered by a Match
-            # according to the cigar string
-            read_counter = read_start_pos
-            read_matched_to_interval = False
-            for cigar_type, cigar_len in bam_read.cigar:
-                # Skip the non-matches (denoted as 0 in pysam)
-                # but increment the read_counter
-                if cigar_type != 0:
-                    read_counter += cigar_len
-                    continue
-                # It's a match, so record the bases covered
-                for match_pos in range(read_counter,
-                                       read_counter + cigar_len + 1):
-                    # This match portion of read does not land in region
-                    if match_pos not in curr_region_starts:
-                        # Advance counter
-                        read_counter += 1
-                        continue
-                    curr_region_starts[match_pos] += 1
-                    # Record that the read was matched to this interval
-                    read_matched_to_interval = True
-            if not read_matched_to_interval:
-                num_unmatched += 1
+    exons_coverage = \
+      bam_parallel.map_reduce_bam(bam_fname,
+                                  count_exons_coverage_in_shard,
+                                  merge_exons_coverage,
+                                  shard_args=(interval_label, gff_coords),
+                                  num_processors=num_processors)
     # Calculate statistics and return as dictionary
     # indexed by exons
-    exon_stats_dict = {}
-    for exon in exons_to_start_pos_counts:
-        exon_info = exons_to_start_pos_counts[exon]
-        exon_counts = exon_info.values()
-        # Calculate sqrt JSD-based coverage metric
-        sqrt_jsd_val = coverage_dist_from_uniform(exon_counts)
-        entry = {"exon": exon,
-                 "mean": np.mean(exon_counts),
-                 "std": np.std(exon_counts),
-                 "max": np.max(exon_counts),
-                 "min": np.min(exon_counts),
-                 "kurtosis": scipy.stats.kurtosis(exon_counts,
-                                                  fisher=False),
-                 "cv": stats_utils.coeff_var(exon_counts),
-                 "sqrt_jsd": sqrt_jsd_val}
-        exon_stats_dict[exon] = entry
-    return exon_stats_dict
+    return exons_coverage.get_stats()
+
+
+def get_exons_coverage_from_bam(bam_fname, exons_index,
+                                num_processors=1):
+    """
+    Count exons coverage from a BAM file, using an index of
+    the exons instead of a BAM produced by tagBam. Returns
+    mapping from an exon to its coverage statistics.
+
+    Args:
+    - bam_fname: BAM filename
+    - exons_index: IntervalIndex of exons
+
+    Kwargs:
+    - num_processors: number of processes to use. The BAM is
+    processed one chromosome at a time.
+    """
+    exons_coverage = \
+      bam_parallel.map_reduce_bam(bam_fname,
+                                  count_exons_coverage_in_bam_shard,
+                                  merge_exons_coverage,
+                                  shard_args=(exons_index,),
+                                  num_processors=num_processors)
+    return exons_coverage.get_stats()
 
     # DEBUGGING
     # print "PRINTING VALUES FOR EXONS: "
@@ -103,6 +103,23 @@ def set_default_settings(settings_info):
         settings_info["mapping"]["cluster_queue"] = None
     if "cluster_memory" not in settings_info["mapping"]:
         settings_info["mapping"]["cluster_memory"] = None
+    if "num_processors" not in settings_info["mapping"]:
+        # Number of processes to use for processing BAM files
+        settings_info["mapping"]["num_processors"] = 1
+    if "max_cpus" not in settings_info["pipeline"]:
+        # Number of CPUs that the steps of a sample can use
+        # at once
+        settings_info["pipeline"]["max_cpus"] = \
+            settings_info["mapping"]["num_processors"]
+    if "samples_per_job" not in settings_info["pipeline"]:
+        # Number of samples to run in each job
+        settings_info["pipeline"]["samples_per_job"] = 1
+    if "max_mem_gb" not in settings_info["pipeline"]:
+        # Memory (in GB) that the steps of a sample can use at
+        # once, against the estimates of the memory each step
+        # takes (see Pipeline.get_steps_mem_gb): unlimited by
+        # default
+        settings_info["pipeline"]["max_mem_gb"] = None
     if "paired" not in settings_info["mapping"]:
         # Not paired-end by default, only if no setting was given
         settings_info["mapping"]["paired"] = False
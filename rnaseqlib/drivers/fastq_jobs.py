@@ -0,0 +1,96 @@
+##
+## Driver for converting the FASTQ files of a settings file
+## to FASTA, a cluster job per file
+##
+import os
+import sys
+import time
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.settings as settings
+import rnaseqlib.cluster_utils.cluster as cluster
+
+def fastq2fasta(settings_filename,
+                output_dir,
+                fieldname="sequence_files",
+                cluster_type="none",
+                num_procs=1):
+    """
+    Convert FASTQ to FASTA. Each FASTQ file is converted by
+    a job that splits it into chunks converted by 'num_procs'
+    processes (see 'fastq_scatter'.)
+    """
+    output_dir = os.path.join(output_dir, "fasta")
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    settings_info, parsed_settings = \
+                   settings.load_settings(settings_filename)
+
+    # Sequence files are given as (filename, sample label) pairs
+    # relative to the input directory
+    fastq_filenames = settings_info["data"][fieldname]
+    input_dir = utils.pathify(settings_info["data"].get("indir", ""))
+
+    my_cluster = cluster.Cluster(cluster_type, output_dir, None,
+                                 cluster_queue="quick")
+    job_ids = []
+    for fastq in fastq_filenames:
+        fastq_filename, sample_id = fastq
+        fastq_filename = os.path.join(input_dir, fastq_filename)
+        print "Converting %s to FASTA" %(sample_id)
+        print "  FASTQ: %s" %(fastq_filename)
+        job_id = "fastq2fasta_%s" %(sample_id)
+        fastq_basename = os.path.basename(fastq_filename)
+        output_filename = os.path.join(output_dir,
+                                       "%s.fa" %(fastq_basename))
+
+        if os.path.isfile(output_filename):
+            print "WARNING: %s exists. Aborting..." \
+                  %(output_filename)
+            continue
+        fastq2fasta_cmd = "%s -m rnaseqlib.fastq_scatter --to-fasta %s %s " \
+                          "--num-procs %d" %(sys.executable,
+                                             fastq_filename,
+                                             output_filename,
+                                             num_procs)
+        print "Running: %s" %(fastq2fasta_cmd)
+        job_ids.append(my_cluster.launch_job(fastq2fasta_cmd, job_id,
+                                             ppn=num_procs))
+    my_cluster.wait_on_jobs([job_id for job_id in job_ids \
+                             if job_id is not None])
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--fastq2fasta", dest="fastq2fasta", nargs=1,
+                      help="Convert FASTQ to FASTA. Takes settings file with "
+                      "FASTQ filenames.")
+    parser.add_option("--fastq-fieldname", dest="fastq_fieldname", default="sequence_files",
+                      type="str", nargs=1)
+    parser.add_option("--cluster-type", dest="cluster_type", default="none",
+                      type="str", nargs=1,
+                      help="Cluster type to run --fastq2fasta jobs on.")
+    parser.add_option("--num-procs", dest="num_procs", default=1,
+                      type="int", nargs=1,
+                      help="Number of processes to convert each FASTQ with.")
+    parser.add_option("--output-dir", dest="output_dir", nargs=1, default=None,
+                      help="Output directory.")
+    (options, args) = parser.parse_args()
+
+    if options.output_dir == None:
+        print "Error: need --output-dir"
+        return
+
+    output_dir = os.path.abspath(os.path.expanduser(options.output_dir))
+
+    if options.fastq2fasta != None:
+        settings_filename = os.path.abspath(os.path.expanduser(options.fastq2fasta))
+        fastq2fasta(settings_filename, output_dir, fieldname=options.fastq_fieldname,
+                    cluster_type=options.cluster_type,
+                    num_procs=options.num_procs)
+
+if __name__ == '__main__':
+    main()
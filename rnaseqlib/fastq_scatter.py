@@ -0,0 +1,661 @@
+##
+## Scatter/gather processing of FASTQ files: a file is split
+## into chunks on record boundaries, each chunk is transformed
+## by a pool of workers and the results are concatenated in
+## the order of the chunks
+##
+import os
+import sys
+import time
+import zlib
+import bisect
+import struct
+import collections
+import functools
+import multiprocessing
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.fastq_utils as fastq_utils
+
+# Size of chunks (in uncompressed bytes)
+CHUNK_SIZE = 64 * 1024 * 1024
+# Size of window read to find the first record of a chunk
+WINDOW_SIZE = 64 * 1024
+
+
+class FastqChunk:
+    """
+    Chunk of FASTQ file: the records between uncompressed
+    offsets 'start' and 'end' (None for the end of the file.)
+
+    Chunks of gzipped files are read starting from the gzip
+    member at compressed offset 'access_offset', whose data
+    starts at uncompressed offset 'access_start'. Chunks
+    cut out of a stream carry their data instead.
+    """
+    def __init__(self, fastq_fname, chunk_num, start, end,
+                 access_offset=None,
+                 access_start=0,
+                 data=None):
+        self.fastq_fname = fastq_fname
+        self.chunk_num = chunk_num
+        self.start = start
+        self.end = end
+        self.access_offset = access_offset
+        self.access_start = access_start
+        self.data = data
+
+
+    def read(self):
+        """
+        Return the records of the chunk as a string.
+        """
+        if self.data is not None:
+            return self.data
+        num_bytes = -1 if self.end is None else (self.end - self.start)
+        if self.access_offset is None:
+            with open(self.fastq_fname, "rb") as fastq_file:
+                fastq_file.seek(self.start)
+                return fastq_file.read(num_bytes)
+        with open(self.fastq_fname, "rb") as fastq_file:
+            return read_gzip_range(fastq_file, self.access_offset,
+                                   self.start - self.access_start,
+                                   num_bytes)
+
+
+    def __repr__(self):
+        return "FastqChunk(%s, %d, start=%d, end=%s)" \
+            %(os.path.basename(self.fastq_fname), self.chunk_num,
+              self.start, str(self.end))
+
+
+##
+## Reading of gzipped files from gzip member boundaries
+##
+def iter_gzip_members(gz_file, offset=0, block_size=1024*1024):
+    """
+    Decompress gzip file starting from the member at compressed
+    offset 'offset', through the members that follow it. Yields
+    (member offset, data) pairs, where 'member offset' is the
+    compressed offset of the member that 'data' comes from.
+    """
+    gz_file.seek(offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_offset = offset
+    # Compressed offset of the start of 'compressed'
+    compressed_offset = offset
+    compressed = gz_file.read(block_size)
+    while compressed:
+        data = decompressor.decompress(compressed)
+        if decompressor.unused_data:
+            # Member ended; the rest of the data starts
+            # the next member
+            rest = decompressor.unused_data
+            if data:
+                yield member_offset, data
+            if rest.strip("\0") == "":
+                # Padding after last member
+                break
+            compressed_offset += len(compressed) - len(rest)
+            member_offset = compressed_offset
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            compressed = rest
+            continue
+        if data:
+            yield member_offset, data
+        compressed_offset += len(compressed)
+        compressed = gz_file.read(block_size)
+    data = decompressor.flush()
+    if data:
+        yield member_offset, data
+
+
+def read_gzip_range(gz_file, offset, skip, num_bytes):
+    """
+    Return 'num_bytes' bytes (all if -1) of uncompressed data
+    of gzip file, after skipping 'skip' bytes of the data that
+    starts at the member at compressed offset 'offset'.
+    """
+    blocks = []
+    num_read = 0
+    for member_offset, data in iter_gzip_members(gz_file, offset):
+        if skip >= len(data):
+            skip -= len(data)
+            continue
+        data = data[skip:]
+        skip = 0
+        if num_bytes >= 0:
+            data = data[0:num_bytes - num_read]
+        blocks.append(data)
+        num_read += len(data)
+        if (num_bytes >= 0) and (num_read >= num_bytes):
+            break
+    return "".join(blocks)
+
+
+##
+## Index of BGZF files (gzip files made of blocks, as written
+## by 'bgzip'): the compressed and uncompressed offsets of
+## their blocks
+##
+# Size of the fixed part of gzip member header
+GZIP_HEADER_SIZE = 12
+
+
+def get_gzip_index_fname(gz_fname):
+    """
+    Return sidecar filename where index of gzipped file is
+    cached.
+    """
+    return "%s.gzindex" %(gz_fname)
+
+
+def read_bgzf_block_size(gz_file, offset):
+    """
+    Return the total size (in compressed bytes) of the BGZF
+    block at 'offset', read from the 'BC' subfield of its
+    header. Returns 0 at the end of the file and None if the
+    data at 'offset' is not a BGZF block.
+    """
+    gz_file.seek(offset)
+    header = gz_file.read(GZIP_HEADER_SIZE)
+    if len(header) == 0:
+        return 0
+    if len(header) < GZIP_HEADER_SIZE:
+        return None
+    magic1, magic2, method, flags, mtime, xfl, os_type, extra_len = \
+        struct.unpack("<BBBBIBBH", header)
+    if (magic1, magic2, method) != (31, 139, 8) or not (flags & 4):
+        return None
+    extra = gz_file.read(extra_len)
+    pos = 0
+    while pos + 4 <= len(extra):
+        sub_id = extra[pos:pos + 2]
+        sub_len = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+        if (sub_id == "BC") and (sub_len == 2) and \
+           (pos + 6 <= len(extra)):
+            return struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + sub_len
+    return None
+
+
+def is_bgzf(gz_fname):
+    """
+    Return True if gzipped file is in BGZF format, judging by
+    the header of its first block.
+    """
+    with open(gz_fname, "rb") as gz_file:
+        return bool(read_bgzf_block_size(gz_file, 0))
+
+
+def build_gzip_index(gz_fname):
+    """
+    Return list of (compressed offset, uncompressed offset)
+    pairs for the blocks of a BGZF file, or None if the file
+    is not in BGZF format.
+
+    Blocks are walked by the sizes in their headers and the
+    uncompressed sizes in their trailers, without decompressing
+    them. Empty blocks (like the end-of-file marker) are left
+    out.
+    """
+    index = []
+    offset = 0
+    uncompressed_offset = 0
+    with open(gz_fname, "rb") as gz_file:
+        while True:
+            block_size = read_bgzf_block_size(gz_file, offset)
+            if block_size == 0:
+                break
+            if block_size is None:
+                if offset == 0:
+                    return None
+                raise Exception, "Malformed BGZF block at offset %d of %s" \
+                      %(offset, gz_fname)
+            # Uncompressed size is the last field of the block
+            gz_file.seek(offset + block_size - 4)
+            trailer = gz_file.read(4)
+            if len(trailer) < 4:
+                raise Exception, "Truncated BGZF block at offset %d of %s" \
+                      %(offset, gz_fname)
+            data_size = struct.unpack("<I", trailer)[0]
+            if data_size > 0:
+                index.append((offset, uncompressed_offset))
+            uncompressed_offset += data_size
+            offset += block_size
+    return index
+
+
+def load_gzip_index(gz_fname):
+    """
+    Return the cached index of gzipped file, or None if there's
+    no cached index or the file has changed since it was cached.
+    """
+    index_fname = get_gzip_index_fname(gz_fname)
+    if not os.path.isfile(index_fname):
+        return None
+    try:
+        with open(index_fname) as index_file:
+            fingerprint = index_file.readline().strip()
+            index = [tuple(map(int, line.split("\t"))) \
+                     for line in index_file]
+    except (IOError, ValueError):
+        return None
+    if fingerprint != utils.get_files_fingerprint([gz_fname]):
+        return None
+    return index
+
+
+def save_gzip_index(gz_fname, index):
+    """
+    Cache index of gzipped file in its sidecar file, keyed by
+    the file's size and modification time. Does nothing if
+    the sidecar file cannot be written.
+    """
+    index_fname = get_gzip_index_fname(gz_fname)
+    tmp_index_fname = "%s.tmp.%d" %(index_fname, os.getpid())
+    try:
+        with open(tmp_index_fname, "w") as index_file:
+            index_file.write("%s\n" \
+                             %(utils.get_files_fingerprint([gz_fname])))
+            for member_offset, uncompressed_offset in index:
+                index_file.write("%d\t%d\n" %(member_offset,
+                                              uncompressed_offset))
+        os.rename(tmp_index_fname, index_fname)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_index_fname):
+            os.remove(tmp_index_fname)
+
+
+def get_gzip_index(gz_fname, use_cache=True):
+    """
+    Return index of BGZF file (see 'build_gzip_index'), or None
+    if the file is not in BGZF format.
+    """
+    if not is_bgzf(gz_fname):
+        return None
+    index = None
+    if use_cache:
+        index = load_gzip_index(gz_fname)
+    if index is None:
+        index = build_gzip_index(gz_fname)
+        if use_cache:
+            save_gzip_index(gz_fname, index)
+    return index
+
+
+##
+## Splitting of FASTQ files on record boundaries
+##
+def find_record_start(data, pos=0, at_eof=False):
+    """
+    Return the offset of the first FASTQ record in 'data' that
+    starts at or after 'pos', which must be the start of a
+    line. A record starts with a line starting with '@' whose
+    second non-blank line after it starts with '+' (quality
+    lines can start with '@', but are followed by a sequence
+    line.)
+
+    Returns None if there is no record, or if more data is
+    needed to tell unless 'at_eof' is True.
+    """
+    window_size = WINDOW_SIZE
+    while True:
+        window = data[pos:pos + window_size]
+        is_last_window = (pos + window_size >= len(data))
+        lines = window.split("\n")
+        if not (is_last_window and at_eof):
+            # Last line might be incomplete
+            lines.pop()
+        line_start = pos
+        for n in xrange(len(lines)):
+            if lines[n].startswith("@"):
+                next_lines = []
+                for line in lines[n + 1:]:
+                    if line:
+                        next_lines.append(line)
+                        if len(next_lines) == 2:
+                            break
+                if len(next_lines) < 2:
+                    # Record continues past the window
+                    break
+                if next_lines[1].startswith("+"):
+                    return line_start
+            line_start += len(lines[n]) + 1
+        if is_last_window:
+            return None
+        if line_start == pos:
+            # No complete record candidate in the window
+            window_size *= 2
+        pos = line_start
+
+
+def find_chunk_start(read_window, offset):
+    """
+    Return the offset of the first record starting at or after
+    'offset', where 'read_window(offset, num_bytes)' returns
+    the data at an offset (less data only at the end of the
+    file.) Returns None if there is no such record.
+    """
+    window_size = WINDOW_SIZE
+    while True:
+        # Start from the beginning of the line after 'offset'
+        data = read_window(offset - 1, window_size + 1)
+        at_eof = (len(data) < window_size + 1)
+        line_start = data.find("\n")
+        if line_start != -1:
+            record_start = find_record_start(data, line_start + 1,
+                                             at_eof=at_eof)
+            if record_start is not None:
+                return offset - 1 + record_start
+        if at_eof:
+            return None
+        window_size *= 2
+
+
+def get_plain_chunks(fastq_fname, chunk_size):
+    """
+    Return chunks of an uncompressed FASTQ file.
+    """
+    file_size = os.path.getsize(fastq_fname)
+    starts = [0]
+    with open(fastq_fname, "rb") as fastq_file:
+        def read_window(offset, num_bytes):
+            fastq_file.seek(offset)
+            return fastq_file.read(num_bytes)
+        while starts[-1] + chunk_size < file_size:
+            start = find_chunk_start(read_window, starts[-1] + chunk_size)
+            if start is None:
+                break
+            starts.append(start)
+    ends = starts[1:] + [None]
+    return [FastqChunk(fastq_fname, n, starts[n], ends[n]) \
+            for n in range(len(starts))]
+
+
+def get_indexed_chunks(fastq_fname, chunk_size, index):
+    """
+    Return chunks of a BGZF FASTQ file, given the file's
+    index. Each chunk is read
+    starting from the member its first record is in.
+    """
+    uncompressed_offsets = [point[1] for point in index]
+    def get_member(offset):
+        return index[max(0, bisect.bisect_right(uncompressed_offsets,
+                                                offset) - 1)]
+    chunks = [FastqChunk(fastq_fname, 0, 0, None,
+                         access_offset=index[0][0],
+                         access_start=index[0][1])]
+    with open(fastq_fname, "rb") as fastq_file:
+        def read_window(offset, num_bytes):
+            member_offset, uncompressed_offset = get_member(offset)
+            return read_gzip_range(fastq_file, member_offset,
+                                   offset - uncompressed_offset,
+                                   num_bytes)
+        for member_offset, uncompressed_offset in index[1:]:
+            if uncompressed_offset - chunks[-1].start < chunk_size:
+                continue
+            start = find_chunk_start(read_window, uncompressed_offset)
+            if start is None:
+                break
+            if start <= chunks[-1].start:
+                continue
+            member_offset, uncompressed_offset = get_member(start)
+            chunks[-1].end = start
+            chunks.append(FastqChunk(fastq_fname, len(chunks), start, None,
+                                     access_offset=member_offset,
+                                     access_start=uncompressed_offset))
+    return chunks
+
+
+def iter_stream_chunks(fastq_fname, chunk_size):
+    """
+    Yield chunks of a FASTQ file (gzipped or not) read as
+    a stream, each carrying its data.
+    """
+    reader = fastq_utils.BlockReader(fastq_fname)
+    blocks = []
+    num_bytes = 0
+    start = 0
+    chunk_num = 0
+    try:
+        while True:
+            block = reader.read()
+            blocks.append(block)
+            num_bytes += len(block)
+            if block and (num_bytes <= chunk_size):
+                continue
+            data = "".join(blocks)
+            while len(data) > 0:
+                # Cut at first record starting after the chunk
+                # size, or at the end of the file
+                end = None
+                pos = data.find("\n", chunk_size - 1)
+                if pos != -1:
+                    end = find_record_start(data, pos + 1,
+                                            at_eof=(not block))
+                if end is None:
+                    if block:
+                        # Need more data
+                        break
+                    end = len(data)
+                yield FastqChunk(fastq_fname, chunk_num, start,
+                                 start + end, data=data[0:end])
+                chunk_num += 1
+                start += end
+                data = data[end:]
+            blocks = [data]
+            num_bytes = len(data)
+            if not block:
+                break
+    finally:
+        reader.close()
+
+
+def get_fastq_chunks(fastq_fname, chunk_size=CHUNK_SIZE,
+                     use_index=True):
+    """
+    Split FASTQ file into chunks of about 'chunk_size' bytes
+    of uncompressed data, on record boundaries. Returns an
+    iterator of FastqChunk objects.
+
+    Uncompressed files are split by byte offsets. BGZF files
+    (as written by 'bgzip') are split on blocks using the
+    file's index, if they have enough data to be split; other
+    gzipped files are cut into chunks as they are read.
+    """
+    if not fastq_fname.endswith(".gz"):
+        return iter(get_plain_chunks(fastq_fname, chunk_size))
+    if use_index:
+        index = get_gzip_index(fastq_fname)
+        if (index is not None) and (len(index) > 1) and \
+           (index[-1][1] - index[0][1] >= chunk_size):
+            return iter(get_indexed_chunks(fastq_fname, chunk_size,
+                                           index))
+    return iter_stream_chunks(fastq_fname, chunk_size)
+
+
+##
+## Transforms of chunks: functions that take a list of
+## (header, sequence, header2, quality) records and return
+## a string
+##
+def fastq_transform(records):
+    """
+    Output records as FASTQ.
+    """
+    return fastq_utils.format_fastq_records(records)
+
+
+def fasta_transform(records):
+    """
+    Output records as FASTA.
+    """
+    return "".join([">%s\n%s\n" %(rec[0], rec[1]) for rec in records])
+
+
+def filter_transform(records, min_read_len=0, max_read_len=None,
+                     output_func=fastq_transform):
+    """
+    Output records whose sequence length is between
+    'min_read_len' and 'max_read_len'.
+    """
+    if max_read_len is None:
+        max_read_len = sys.maxint
+    return output_func([rec for rec in records \
+                        if min_read_len <= len(rec[1]) <= max_read_len])
+
+
+def run_transform(chunk, transform):
+    """
+    Transform records of chunk. Return the transformed data.
+    """
+    records = fastq_utils.parse_fastq_data(chunk.read())
+    return transform(records)
+
+
+def scatter_gather(fastq_fname, output_fname, transform,
+                   num_procs=1,
+                   chunk_size=CHUNK_SIZE,
+                   use_index=True,
+                   merge_stats=None,
+                   logger=None):
+    """
+    Split FASTQ file into chunks, transform each chunk using
+    a pool of 'num_procs' processes and write the transformed
+    chunks to 'output_fname' (gzipped if ending in '.gz'), in
+    order. Returns the number of chunks.
+
+    'transform' must be a picklable function of a list of
+    records (e.g. a module function or a functools.partial of
+    one) that returns a string.
+
+    If 'merge_stats' is given, 'transform' returns a (string,
+    stats) pair instead, where stats of chunks are merged by
+    'merge_stats(stats1, stats2)'. Returns the number of chunks
+    and the merged stats.
+    """
+    t1 = time.time()
+    chunks = get_fastq_chunks(fastq_fname, chunk_size=chunk_size,
+                              use_index=use_index)
+    num_chunks = 0
+    stats = []
+    def write_result(writer, result):
+        if merge_stats is None:
+            writer.write_data(result)
+            return
+        data, chunk_stats = result
+        writer.write_data(data)
+        if len(stats) == 0:
+            stats.append(chunk_stats)
+        else:
+            stats[0] = merge_stats(stats[0], chunk_stats)
+    with fastq_utils.FastqWriter(output_fname) as writer:
+        if num_procs <= 1:
+            for chunk in chunks:
+                write_result(writer, run_transform(chunk, transform))
+                num_chunks += 1
+        else:
+            pool = multiprocessing.Pool(num_procs)
+            try:
+                # Results of chunks being transformed, in order. At
+                # most two chunks per process are pending, so that
+                # chunks read as a stream are not all held at once
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(run_transform,
+                                                    (chunk, transform)))
+                    if len(pending) >= 2 * num_procs:
+                        write_result(writer, pending.popleft().get())
+                    num_chunks += 1
+                while len(pending) > 0:
+                    write_result(writer, pending.popleft().get())
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    t2 = time.time()
+    msg = "Transformed %s in %d chunks (%.2f secs)" \
+        %(fastq_fname, num_chunks, t2 - t1)
+    if logger is not None:
+        logger.info(msg)
+    else:
+        print msg
+    if merge_stats is not None:
+        return num_chunks, (stats[0] if len(stats) > 0 else None)
+    return num_chunks
+
+
+def fastq_to_fasta(fastq_fname, fasta_fname,
+                   num_procs=1,
+                   chunk_size=CHUNK_SIZE):
+    """
+    Convert FASTQ to FASTA.
+    """
+    return scatter_gather(fastq_fname, fasta_fname, fasta_transform,
+                          num_procs=num_procs,
+                          chunk_size=chunk_size)
+
+
+def filter_fastq(fastq_fname, output_fname,
+                 min_read_len=0,
+                 max_read_len=None,
+                 num_procs=1,
+                 chunk_size=CHUNK_SIZE):
+    """
+    Filter FASTQ by read length.
+    """
+    transform = functools.partial(filter_transform,
+                                  min_read_len=min_read_len,
+                                  max_read_len=max_read_len)
+    return scatter_gather(fastq_fname, output_fname, transform,
+                          num_procs=num_procs,
+                          chunk_size=chunk_size)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--to-fasta", dest="to_fasta", nargs=2, default=None,
+                      help="Convert FASTQ to FASTA. Takes FASTQ filename "
+                      "and FASTA filename to output.")
+    parser.add_option("--filter", dest="filter", nargs=2, default=None,
+                      help="Filter FASTQ by read length. Takes FASTQ "
+                      "filename and FASTQ filename to output. Use with "
+                      "--min-read-len/--max-read-len.")
+    parser.add_option("--min-read-len", dest="min_read_len", default=0,
+                      type="int", nargs=1)
+    parser.add_option("--max-read-len", dest="max_read_len", default=None,
+                      type="int", nargs=1)
+    parser.add_option("--num-procs", dest="num_procs", default=1,
+                      type="int", nargs=1,
+                      help="Number of processes to transform chunks with.")
+    parser.add_option("--chunk-mb", dest="chunk_mb", default=64,
+                      type="int", nargs=1,
+                      help="Size of chunks (in Megabytes of uncompressed "
+                      "data.)")
+    (options, args) = parser.parse_args()
+
+    chunk_size = options.chunk_mb * 1024 * 1024
+    if options.to_fasta != None:
+        fastq_fname, fasta_fname = \
+            [utils.pathify(f) for f in options.to_fasta]
+        fastq_to_fasta(fastq_fname, fasta_fname,
+                       num_procs=options.num_procs,
+                       chunk_size=chunk_size)
+    elif options.filter != None:
+        fastq_fname, output_fname = \
+            [utils.pathify(f) for f in options.filter]
+        filter_fastq(fastq_fname, output_fname,
+                     min_read_len=options.min_read_len,
+                     max_read_len=options.max_read_len,
+                     num_procs=options.num_procs,
+                     chunk_size=chunk_size)
+    else:
+        parser.error("Need --to-fasta or --filter.")
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,25 @@
 
 import os
 import time
+import Queue
+import threading
+import subprocess
+import itertools
 from itertools import ifilter, islice
 
 import gzip
 
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+# Size of blocks (in bytes) that FASTQ files are read and
+# written in
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+# Number of records per batch of FASTQ records
+FASTQ_BATCH_SIZE = 10000
+
 def read_open_fastq(fastq_filename):
     fastq_file = None
     if fastq_filename.endswith(".gz"):
@@ -36,43 +51,9 @@ def read_fastq(fastq_in):
     parse a fastq-formatted file, yielding a
     (header, sequence, header2, quality) tuple
     """
-    fastqfile = None
-    if type(fastq_in) == str:
-        # Parse as filename
-        fastqfile = read_open_fastq(fastq_in)
-    else:
-        # Otherwise assume it's a file handle
-        fastqfile = fastq_in
-    fastqiter = (l.strip('\n') for l in fastqfile)  # strip trailing newlines
-    fastqiter = ifilter(lambda l: l, fastqiter)  # skip blank lines
-    line_num = 0
-    while True:
-        fqlines = list(islice(fastqiter, 4))
-        if len(fqlines) == 4:
-            header1,seq,header2,qual = fqlines
-            # If the header is binary, convert it to plain text
-            if "\0" in header1:
-                print "Removing binary from header: %s" %(header1)
-                header1 = header1.replace("\0", "")
-            # Allow header1 to have '@' somewhere in it, not just in the
-            # first line, mainly to header FASTQ files with odd headers
-            if (header1.startswith('@') or ("@" in header1)) and \
-                header2.startswith('+'):
-                yield header1[1:], seq, header2, qual
-            else:
-                print "Problem with formatting of FASTQ file detected."
-                print "header1: ", header1, " header2: ", header2
-                raise ValueError("Invalid header lines in FASTQ: %s and %s (line %d)" \
-                                 %(header1, header2, line_num))
-        elif len(fqlines) == 0:
-            raise StopIteration
-        else:
-            print "Length of FASTQ unit: %d" %(len(fqlines))
-            print header1, ",", seq, ",", header2, ",", qual
-            print "Problematic line no: %d" %(line_num)
-            # Do not raise error
-            #raise EOFError("Failed to parse four lines from fastq file!")
-        line_num += 1
+    for records in read_fastq_chunks(fastq_in):
+        for record in records:
+            yield record
 
 
 def write_fastq(fastq_file, fastq_rec):
@@ -83,8 +64,405 @@ def write_fastq(fastq_file, fastq_rec):
     fastq_file.write("%s\n" %(seq))
     fastq_file.write("%s\n" %(header2))
     fastq_file.write("%s\n" %(quality))
-    
-                                                                                
+
+
+##
+## Batched FASTQ I/O
+##
+class BlockReader:
+    """
+    Read a FASTQ file in blocks of 'block_size' bytes from a
+    helper thread, so that reading (and decompressing) the file
+    overlaps with parsing it. Gzipped files are decompressed by
+    a 'gzip' process when the binary is on the path, and by the
+    gzip module in the helper thread otherwise.
+    """
+    def __init__(self, fastq_in,
+                 block_size=FASTQ_BLOCK_SIZE,
+                 max_blocks=4,
+                 use_gzip_binary=True):
+        """
+        Args:
+        - fastq_in: FASTQ filename or file handle
+
+        Kwargs:
+        - block_size: size of blocks to read (in bytes)
+        - max_blocks: maximum number of blocks read ahead
+        - use_gzip_binary: if True, decompress gzipped files
+          with the 'gzip' binary if available
+        """
+        self.block_size = block_size
+        self.proc = None
+        self.close_file = False
+        if isinstance(fastq_in, basestring):
+            if fastq_in.endswith(".gz") and use_gzip_binary and \
+               (utils.which("gzip") is not None):
+                self.proc = subprocess.Popen(["gzip", "-dc", fastq_in],
+                                             stdout=subprocess.PIPE,
+                                             bufsize=block_size)
+                self.fastq_file = self.proc.stdout
+            else:
+                self.fastq_file = read_open_fastq(fastq_in)
+            self.close_file = True
+        else:
+            self.fastq_file = fastq_in
+        self.blocks = Queue.Queue(maxsize=max_blocks)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.read_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def read_blocks(self):
+        """
+        Read blocks into the queue until the end of the file
+        (marked by an empty block.)
+        """
+        try:
+            while not self.closed:
+                block = self.fastq_file.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except Exception, e:
+            self.error = e
+            self.blocks.put("")
+
+
+    def read(self):
+        """
+        Return next block, or an empty string at the end of
+        the file.
+        """
+        block = self.blocks.get()
+        if self.error is not None:
+            raise IOError("Error reading FASTQ: %s" %(str(self.error)))
+        return block
+
+
+    def close(self):
+        self.closed = True
+        # Unblock the helper thread if it waits on a full queue
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self.close_file:
+            self.fastq_file.close()
+        if self.proc is not None:
+            self.proc.wait()
+
+
+def check_fastq_headers(headers, headers2, first_rec_num):
+    """
+    Check the header lines of FASTQ records, as done by
+    'read_fastq'. Headers are checked together, and one at a
+    time only if some header does not start with '@' (or
+    second header with '+'.) Return the headers without
+    their '@'.
+    """
+    headers_str = "\n" + "\n".join(headers)
+    if (headers_str.count("\n@") == len(headers)) and \
+       (("\n" + "\n".join(headers2)).count("\n+") == len(headers2)) and \
+       ("\0" not in headers_str):
+        return headers_str[2:].split("\n@") if len(headers) > 0 else []
+    checked_headers = []
+    for n in xrange(len(headers)):
+        header1, header2 = headers[n], headers2[n]
+        # If the header is binary, convert it to plain text
+        if "\0" in header1:
+            print "Removing binary from header: %s" %(header1)
+            header1 = header1.replace("\0", "")
+        # Allow header1 to have '@' somewhere in it, not just in the
+        # first line, mainly to header FASTQ files with odd headers
+        if (header1.startswith('@') or ("@" in header1)) and \
+            header2.startswith('+'):
+            checked_headers.append(header1[1:])
+        else:
+            print "Problem with formatting of FASTQ file detected."
+            print "header1: ", header1, " header2: ", header2
+            raise ValueError("Invalid header lines in FASTQ: %s and %s " \
+                             "(record %d)" %(header1, header2,
+                                             first_rec_num + n))
+    return checked_headers
+
+
+def parse_fastq_data(data, first_rec_num=0):
+    """
+    Parse string of FASTQ records into a list of (header,
+    sequence, header2, quality) tuples, as done by 'read_fastq'.
+    """
+    lines = data.split("\n")
+    if "" in lines:
+        lines = [l for l in lines if l]
+    end = 4 * (len(lines) / 4)
+    if end != len(lines):
+        print "Length of FASTQ unit: %d" %(len(lines) - end)
+        print ",".join(lines[end:])
+        print "Problematic record no: %d" %(first_rec_num + end / 4)
+    headers = check_fastq_headers(lines[0:end:4],
+                                  lines[2:end:4],
+                                  first_rec_num)
+    return zip(headers,
+               lines[1:end:4],
+               lines[2:end:4],
+               lines[3:end:4])
+
+
+def group_seqs_by_len(seqs):
+    """
+    Group sequences by length, yielding (length, indices,
+    sequences) for each length, where 'indices' are the
+    indices of the sequences of that length (None if all
+    sequences have the same length.)
+
+    Sequences of a length can then be viewed at once as
+    a byte matrix or a fixed-length string array.
+    """
+    seq_lens = np.fromiter(itertools.imap(len, seqs), dtype=np.int64,
+                           count=len(seqs))
+    unique_lens = np.unique(seq_lens)
+    if len(unique_lens) == 1:
+        yield int(unique_lens[0]), None, seqs
+        return
+    for seq_len in unique_lens:
+        inds = np.nonzero(seq_lens == seq_len)[0]
+        yield int(seq_len), inds, [seqs[i] for i in inds]
+
+
+def format_fastq_records(records):
+    """
+    Return string of (header, sequence, header2, quality)
+    records formatted as by 'write_fastq'.
+    """
+    return "".join(["%s\n%s\n%s\n%s\n" %(rec) if rec[0].startswith("@") \
+                    else "@%s\n%s\n%s\n%s\n" %(rec) for rec in records])
+
+
+def read_fastq_chunks(fastq_in,
+                      batch_size=FASTQ_BATCH_SIZE,
+                      block_size=FASTQ_BLOCK_SIZE,
+                      use_gzip_binary=True):
+    """
+    Read FASTQ file in batches of up to 'batch_size' records,
+    yielding a list of (header, sequence, header2, quality)
+    tuples per batch, parsed as by 'read_fastq'.
+
+    Takes either filename or file handle.
+    """
+    for columns in read_fastq_columns(fastq_in,
+                                      batch_size=batch_size,
+                                      block_size=block_size,
+                                      use_gzip_binary=use_gzip_binary):
+        yield zip(*columns)
+
+
+def read_fastq_columns(fastq_in,
+                       batch_size=FASTQ_BATCH_SIZE,
+                       block_size=FASTQ_BLOCK_SIZE,
+                       use_gzip_binary=True):
+    """
+    Read FASTQ file in batches of up to 'batch_size' records,
+    yielding (headers, sequences, headers2, qualities) lists
+    per batch, parsed as by 'read_fastq'. The file is read in
+    large blocks by a helper thread (see BlockReader) and each
+    block is split into lines at once.
+
+    Takes either filename or file handle.
+    """
+    reader = BlockReader(fastq_in, block_size=block_size,
+                         use_gzip_binary=use_gzip_binary)
+    # Lines not yet parsed into records
+    lines = []
+    # Partial line at the end of the last block read
+    remainder = ""
+    num_records = 0
+    try:
+        while True:
+            block = reader.read()
+            if block:
+                new_lines = (remainder + block).split("\n")
+                remainder = new_lines.pop()
+            else:
+                # Last line might have no newline
+                new_lines = [remainder]
+                remainder = ""
+            # Skip blank lines
+            if "" in new_lines:
+                new_lines = [l for l in new_lines if l]
+            lines = lines + new_lines if lines else new_lines
+            # Parse complete records into batches, leaving the
+            # lines of the last partial batch for the next block
+            # unless the file ended
+            start = 0
+            while (len(lines) - start >= 4 * batch_size) or \
+                  ((not block) and (len(lines) - start >= 4)):
+                end = start + 4 * min(batch_size, (len(lines) - start) / 4)
+                headers = check_fastq_headers(lines[start:end:4],
+                                              lines[start+2:end:4],
+                                              num_records)
+                yield (headers,
+                       lines[start+1:end:4],
+                       lines[start+2:end:4],
+                       lines[start+3:end:4])
+                num_records += (end - start) / 4
+                start = end
+            lines = lines[start:]
+            if not block:
+                break
+        if len(lines) > 0:
+            print "Length of FASTQ unit: %d" %(len(lines))
+            print ",".join(lines)
+            print "Problematic record no: %d" %(num_records)
+            # Do not raise error
+            #raise EOFError("Failed to parse four lines from fastq file!")
+    finally:
+        reader.close()
+
+
+class FastqWriter:
+    """
+    Write FASTQ records in large blocks. Records are formatted
+    as by 'write_fastq' and buffered into blocks of about
+    'block_size' bytes, which a helper thread writes out.
+    Gzipped files are compressed by a 'gzip' process when the
+    binary is on the path, and by the gzip module in the
+    helper thread otherwise.
+    """
+    def __init__(self, fastq_out,
+                 block_size=FASTQ_BLOCK_SIZE,
+                 max_blocks=4,
+                 compress_level=6,
+                 use_gzip_binary=True):
+        """
+        Args:
+        - fastq_out: FASTQ filename or file handle. Gzipped
+          if filename ends in '.gz'
+
+        Kwargs:
+        - block_size: size of blocks to write (in bytes)
+        - max_blocks: maximum number of blocks waiting to be
+          written
+        - compress_level: gzip compression level
+        - use_gzip_binary: if True, compress gzipped files with
+          the 'gzip' binary if available
+        """
+        self.block_size = block_size
+        self.proc = None
+        self.output_file = None
+        self.close_file = False
+        if isinstance(fastq_out, basestring):
+            if fastq_out.endswith(".gz") and use_gzip_binary and \
+               (utils.which("gzip") is not None):
+                self.output_file = open(fastq_out, "wb")
+                self.proc = subprocess.Popen(["gzip", "-c",
+                                              "-%d" %(compress_level)],
+                                             stdin=subprocess.PIPE,
+                                             stdout=self.output_file,
+                                             bufsize=block_size)
+                self.fastq_file = self.proc.stdin
+            elif fastq_out.endswith(".gz"):
+                self.fastq_file = gzip.open(fastq_out, "wb",
+                                            compress_level)
+            else:
+                self.fastq_file = open(fastq_out, "w")
+            self.close_file = True
+        else:
+            self.fastq_file = fastq_out
+        self.buffer = []
+        self.buffer_len = 0
+        self.blocks = Queue.Queue(maxsize=max_blocks)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.write_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def write_blocks(self):
+        """
+        Write blocks from the queue until getting None.
+        """
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is not None:
+                # Discard blocks after an error
+                continue
+            try:
+                self.fastq_file.write(block)
+            except Exception, e:
+                self.error = e
+
+
+    def check_error(self):
+        if self.error is not None:
+            raise IOError("Error writing FASTQ: %s" %(str(self.error)))
+
+
+    def write_records(self, records):
+        """
+        Write list of (header, sequence, header2, quality) records.
+        """
+        self.write_data(format_fastq_records(records))
+
+
+    def write_data(self, data):
+        """
+        Write string of formatted records.
+        """
+        self.check_error()
+        self.buffer.append(data)
+        self.buffer_len += len(data)
+        if self.buffer_len >= self.block_size:
+            self.flush()
+
+
+    def write(self, record):
+        """
+        Write a (header, sequence, header2, quality) record.
+        """
+        self.write_records([record])
+
+
+    def flush(self):
+        """
+        Pass buffered records to the helper thread.
+        """
+        if self.buffer_len > 0:
+            self.blocks.put("".join(self.buffer))
+        self.buffer = []
+        self.buffer_len = 0
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.blocks.put(None)
+        self.thread.join()
+        if self.close_file:
+            self.fastq_file.close()
+        if self.proc is not None:
+            if self.proc.wait() != 0:
+                self.error = IOError("gzip exited with code %d" \
+                                     %(self.proc.returncode))
+            self.output_file.close()
+        self.check_error()
+
+
 def fastq_get_rec_id(line):
     if line.startswith("@"):
         return line[1:]
@@ -92,44 +470,6 @@ def fastq_get_rec_id(line):
         return line
 
 
-def fastq2fasta(settings_filename,
-                output_dir,
-                fieldname="fastq_filenames"):
-    """
-    Convert FASTQ to FASTA.
-    """
-    output_dir = os.path.join(output_dir, "fasta")
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-
-    settings_info, parsed_settings = \
-                   settings.load_settings(settings_filename)
-
-    fastq_filenames = settings_info["data"][fieldname]
-
-    queue_name = "quick"
-
-    for fastq in fastq_filenames:
-        sample_id, fastq_filename = fastq
-        print "Converting %s to FASTA" %(sample_id)
-        print "  FASTQ: %s" %(fastq_filename)
-        job_id = "fastq2fasta_%s" %(sample_id)
-        fastq_basename = os.path.basename(fastq_filename)
-        output_filename = os.path.join(output_dir,
-                                       "%s.fa" %(fastq_basename))
-
-        if os.path.isfile(output_filename):
-            print "WARNING: %s exists. Aborting..." \
-                  %(output_filename)
-            continue
-        fastq2fasta_cmd = "perl %s fq2fa %s > %s" %(FQCONVERT,
-                                                    fastq_filename,
-                                                    output_filename)
-        print "Running: %s" %(fastq2fasta_cmd)
-        cluster.run_on_cluster(fastq2fasta_cmd, job_id, output_dir,
-                               queue_name=queue_name,
-                               other_args="-l nodes=1:E5620")
-
 def file_type(input):
     """given an input file, determine the type and return both type and record delimiter (> or @)"""
     name, extension = os.path.splitext(os.path.basename(input))
@@ -243,11 +583,6 @@ def chunk_fasta(fasta_filename, output_dir,
 def main():
     from optparse import OptionParser
     parser = OptionParser()
-    parser.add_option("--fastq2fasta", dest="fastq2fasta", nargs=1,
-                      help="Convert FASTQ to FASTA. Takes settings file with "
-                      "FASTQ filenames.")
-    parser.add_option("--fastq-fieldname", dest="fastq_fieldname", default="fastq_files",
-                      type="str", nargs=1)
     parser.add_option("--chunk-fasta", dest="chunk_fasta", nargs=2, default=None,
                       help="Chunk FASTA filename. Takes FASTA file and size (in Megabytes) to "
                       "chunk to.")
@@ -261,10 +596,7 @@ def main():
 
     output_dir = os.path.abspath(os.path.expanduser(options.output_dir))
 
-    if options.fastq2fasta != None:
-        settings_filename = os.path.abspath(os.path.expanduser(options.fastq2fasta))
-        fastq2fasta(settings_filename, output_dir, fieldname=options.fastq_fieldname)
-    elif options.chunk_fasta != None:
+    if options.chunk_fasta != None:
         fasta_filename = os.path.abspath(os.path.expanduser(options.chunk_fasta[0]))
         chunk_size = int(options.chunk_fasta[1])
         chunk_fasta(fasta_filename, output_dir,
@@ -13,6 +13,9 @@ import rnaseqlib.fastq_utils as fastq_utils
 
 import gzip
 
+import numpy as np
+
+
 def write_open_fastx(fastx_filename):
     """
     Write FASTQ/FASTA file for writing, optionally
@@ -115,6 +118,128 @@ def get_fastx_entries(fastx_filename,
     return entries
 
 
+##
+## Utilities for counting FASTQ/FASTA entries
+##
+def count_fastx_lines(fastx_file, chunk_size=4*1024*1024):
+    """
+    Return the number of non-empty lines and the number of lines
+    starting with '>' in an open FASTQ/FASTA file, reading it in
+    chunks of 'chunk_size' bytes.
+    """
+    num_lines = 0
+    num_headers = 0
+    # Whether the previous byte read was a newline (the start
+    # of the file counts as one)
+    prev_newline = True
+    last_byte = None
+    while True:
+        chunk = fastx_file.read(chunk_size)
+        if not chunk:
+            break
+        chunk_bytes = np.frombuffer(chunk, dtype=np.uint8)
+        newlines = (chunk_bytes == 10)
+        headers = (chunk_bytes == 62)
+        # Empty lines are newlines that follow a newline
+        num_empty = np.count_nonzero(newlines[1:] & newlines[:-1])
+        if prev_newline and newlines[0]:
+            num_empty += 1
+        num_lines += np.count_nonzero(newlines) - num_empty
+        num_headers += np.count_nonzero(headers[1:] & newlines[:-1])
+        if prev_newline and headers[0]:
+            num_headers += 1
+        prev_newline = bool(newlines[-1])
+        last_byte = chunk[-1]
+    if (last_byte is not None) and (not prev_newline):
+        # Last line has no newline
+        num_lines += 1
+    return num_lines, num_headers
+
+
+def get_fastx_counts_fname(fastx_filename):
+    """
+    Return sidecar filename where number of entries in
+    FASTQ/FASTA file is cached.
+    """
+    return "%s.counts" %(fastx_filename)
+
+
+def load_fastx_count(fastx_filename):
+    """
+    Return the cached number of entries in FASTQ/FASTA file,
+    or None if there's no cached number or the file has changed
+    (in size or modification time) since it was cached.
+    """
+    counts_fname = get_fastx_counts_fname(fastx_filename)
+    if not os.path.isfile(counts_fname):
+        return None
+    fastx_stat = os.stat(fastx_filename)
+    try:
+        with open(counts_fname) as counts_file:
+            fields = counts_file.readline().strip().split("\t")
+        file_size, file_mtime, num_entries = \
+            int(fields[0]), float(fields[1]), int(fields[2])
+    except (IOError, ValueError, IndexError):
+        return None
+    if (file_size != fastx_stat.st_size) or \
+       (file_mtime != float(fastx_stat.st_mtime)):
+        return None
+    return num_entries
+
+
+def save_fastx_count(fastx_filename, num_entries):
+    """
+    Cache number of entries in FASTQ/FASTA file in its sidecar file,
+    keyed by the file's size and modification time. Does nothing if
+    the sidecar file cannot be written.
+    """
+    counts_fname = get_fastx_counts_fname(fastx_filename)
+    fastx_stat = os.stat(fastx_filename)
+    tmp_counts_fname = "%s.tmp.%d" %(counts_fname, os.getpid())
+    try:
+        with open(tmp_counts_fname, "w") as counts_file:
+            counts_file.write("%d\t%r\t%d\n" %(fastx_stat.st_size,
+                                                 float(fastx_stat.st_mtime),
+                                                 num_entries))
+        os.rename(tmp_counts_fname, counts_fname)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_counts_fname):
+            os.remove(tmp_counts_fname)
+
+
+def count_fastx_entries(fastx_filename, use_cache=True):
+    """
+    Return number of entries in FASTQ/FASTA file (optionally
+    gzipped), counting them in constant memory without parsing
+    the entries.
+
+    Kwargs:
+    - use_cache: if True, use the number of entries cached by
+      a previous call if the file has not changed since, and
+      cache the number of entries otherwise.
+    """
+    if use_cache:
+        num_entries = load_fastx_count(fastx_filename)
+        if num_entries is not None:
+            return num_entries
+    if fastx_filename.endswith(".gz"):
+        fastx_file = gzip.open(fastx_filename, "rb")
+    else:
+        fastx_file = open(fastx_filename, "rb")
+    try:
+        num_lines, num_headers = count_fastx_lines(fastx_file)
+    finally:
+        fastx_file.close()
+    if get_fastx_type(fastx_filename) == "fasta":
+        num_entries = num_headers
+    else:
+        # Only complete four-line FASTQ entries are read
+        num_entries = num_lines / 4
+    if use_cache:
+        save_fastx_count(fastx_filename, num_entries)
+    return num_entries
+
+
 def fastx_collapse_fastq(fastq_filename, output_dir, logger):
     """
     FASTX collapse FASTQ. Return 
@@ -0,0 +1,208 @@
+##
+## IntervalIndex: sorted index of genomic intervals for
+## finding the intervals that contain or overlap a read
+##
+import os
+import sys
+import time
+import bisect
+
+from collections import defaultdict
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+
+class IntervalIndex:
+    """
+    Index of labeled genomic intervals. Intervals are in 0-based,
+    end-exclusive (BED) coordinates.
+
+    Intervals of each chromosome are binned by length, with
+    lengths of each bin within a factor of two (as in the UCSC
+    binning scheme), and kept sorted by start within each bin.
+    A query only looks at the intervals of each bin that start
+    late enough to reach the query interval given the longest
+    interval of the bin, so that long intervals do not slow down
+    queries that are far from them.
+    """
+    def __init__(self):
+        # Intervals added but not yet indexed
+        self.unindexed = defaultdict(list)
+        # Mapping from chromosome to arrays of starts and ends,
+        # sorted by length bin and then by start
+        self.starts = {}
+        self.ends = {}
+        # Mapping from chromosome to list of (max length, first
+        # index, last index) of each length bin
+        self.bins = {}
+        # Mapping from chromosome to list of (label, name, strand)
+        # of each interval, in order of the starts
+        self.info = {}
+        # Interval labels, e.g. 'introns'
+        self.labels = []
+        self.num_intervals = 0
+        # Lists versions of arrays, created on first query
+        self._lists = {}
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Do not send cached lists when pickling
+        state["_lists"] = {}
+        return state
+
+
+    def add_interval(self, chrom, start, end,
+                     label=None,
+                     name=None,
+                     strand=None):
+        """
+        Add interval to index. Takes effect once 'build' is called.
+        """
+        if start > end:
+            start, end = end, start
+        if label not in self.labels:
+            self.labels.append(label)
+        self.unindexed[chrom].append((start, end, label, name, strand))
+
+
+    def add_bed_file(self, bed_fname, label):
+        """
+        Add all intervals from BED file under the given label.
+        """
+        with open(bed_fname) as bed_file:
+            for line in bed_file:
+                if line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.strip().split("\t")
+                if len(fields) < 3:
+                    continue
+                name, strand = None, None
+                if len(fields) > 3:
+                    name = fields[3]
+                if len(fields) > 5:
+                    strand = fields[5]
+                self.add_interval(fields[0], int(fields[1]), int(fields[2]),
+                                  label=label,
+                                  name=name,
+                                  strand=strand)
+
+
+    def add_gff_file(self, gff_fname, label):
+        """
+        Add all records from GFF file under the given label. GFF
+        coordinates are converted to BED coordinates, and the name
+        of each interval is the record's feature type.
+        """
+        with open(gff_fname) as gff_file:
+            for line in gff_file:
+                if line.startswith("#"):
+                    continue
+                fields = line.strip().split("\t")
+                if len(fields) < 7:
+                    continue
+                self.add_interval(fields[0], int(fields[3]) - 1, int(fields[4]),
+                                  label=label,
+                                  name=fields[2],
+                                  strand=fields[6])
+
+
+    def build(self):
+        """
+        Index all the intervals added so far.
+        """
+        for chrom in self.unindexed:
+            chrom_intervals = self.unindexed[chrom]
+            if chrom in self.starts:
+                # Merge with previously indexed intervals
+                chrom_intervals.extend([(start, end) + info for start, end, info \
+                                        in zip(self.starts[chrom].tolist(),
+                                               self.ends[chrom].tolist(),
+                                               self.info[chrom])])
+            chrom_intervals.sort(key=lambda interval: \
+                                 (get_length_bin(interval[1] - interval[0]),
+                                  interval[0], interval[1]))
+            self.starts[chrom] = \
+                np.array([i[0] for i in chrom_intervals], dtype=np.int64)
+            self.ends[chrom] = \
+                np.array([i[1] for i in chrom_intervals], dtype=np.int64)
+            self.info[chrom] = [i[2:] for i in chrom_intervals]
+            # Index ranges of the length bins
+            lens = self.ends[chrom] - self.starts[chrom]
+            len_bins = np.array([get_length_bin(l) for l in lens.tolist()],
+                                dtype=np.int64)
+            bin_firsts = \
+                np.nonzero(np.concatenate([[True],
+                                           len_bins[1:] != len_bins[:-1]]))[0]
+            bin_lasts = np.concatenate([bin_firsts[1:], [len(lens)]])
+            self.bins[chrom] = \
+                [(int(lens[first:last].max()), int(first), int(last)) \
+                 for first, last in zip(bin_firsts, bin_lasts)]
+        self.unindexed = defaultdict(list)
+        self._lists = {}
+        self.num_intervals = sum([len(self.starts[c]) for c in self.starts])
+        return self
+
+
+    def _get_lists(self, chrom):
+        """
+        Return the chromosome's starts and ends as lists, which
+        are faster than arrays for single queries.
+        """
+        if chrom not in self._lists:
+            if chrom not in self.starts:
+                self._lists[chrom] = None
+            else:
+                self._lists[chrom] = (self.starts[chrom].tolist(),
+                                      self.ends[chrom].tolist())
+        return self._lists[chrom]
+
+
+    def find(self, chrom, start, end, contained=True):
+        """
+        Find intervals on 'chrom' that contain the query interval
+        [start, end) if 'contained' is True, or that overlap it
+        otherwise.
+
+        Returns list of (start, end, label, name, strand) of
+        matching intervals, in order of their starts.
+        """
+        chrom_lists = self._get_lists(chrom)
+        if chrom_lists is None:
+            return []
+        starts, ends = chrom_lists
+        chrom_info = self.info[chrom]
+        # Intervals containing the query must start at or before its
+        # start. Overlapping intervals must start before its end.
+        if contained:
+            max_start = start
+            min_end = end
+        else:
+            max_start = end - 1
+            min_end = start + 1
+        matches = []
+        for max_len, bin_first, bin_last in self.bins[chrom]:
+            # Intervals of the bin that can reach 'min_end'
+            n = bisect.bisect_left(starts, min_end - max_len,
+                                   bin_first, bin_last)
+            last_index = bisect.bisect_right(starts, max_start, n, bin_last)
+            while n < last_index:
+                if ends[n] >= min_end:
+                    matches.append((starts[n], ends[n]) + chrom_info[n])
+                n += 1
+        if len(self.bins[chrom]) > 1:
+            matches.sort(key=lambda match: match[0:2])
+        return matches
+
+
+def get_length_bin(length):
+    """
+    Return bin of interval length: intervals of bin k have
+    lengths in (2^(k-1), 2^k].
+    """
+    if length <= 1:
+        return 0
+    return int(length - 1).bit_length()
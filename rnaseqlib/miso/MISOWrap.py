@@ -295,10 +295,19 @@ class MISOWrap:
         Load cluster submission object for the particular
         pipeline settings we were given.
         """
+        cluster_settings = self.settings_info["settings"]
+        # Limits on jobs run on the local machine
+        max_mem_gb = None
+        if "local_max_mem_gb" in cluster_settings:
+            max_mem_gb = float(cluster_settings["local_max_mem_gb"])
         self.my_cluster = \
           cluster.Cluster(self.cluster_type,
                           self.output_dir,
-                          self.logger)
+                          self.logger,
+                          max_jobs=cluster_settings.get("local_max_jobs"),
+                          max_cpus=cluster_settings.get("local_max_cpus"),
+                          max_mem_gb=max_mem_gb,
+                          num_retries=cluster_settings.get("job_retries", 0))
 
 
     def __repr__(self):
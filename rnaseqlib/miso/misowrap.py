@@ -19,6 +19,7 @@ import rnaseqlib.miso.PsiTable as pt
 import rnaseqlib.miso.MISOWrap as mw
 import rnaseqlib.miso.miso_utils as miso_utils
 import rnaseqlib.cluster_utils.cluster as cluster
+import rnaseqlib.cluster_utils.JobThrottle as job_throttle
 import rnaseqlib.pandas_utils as pandas_utils
 
 import argh
@@ -77,15 +78,27 @@ def summarize(settings,
             else:
                 if not dry_run:
                     os.system(summary_cmd)
+    if misowrap_obj.use_cluster:
+        # Jobs run locally need this process to run
+        misowrap_obj.my_cluster.wait_on_local_jobs()
             
 
 @arg("settings", help="misowrap settings filename.")
 @arg("logs-outdir", help="Directory where to place logs.")
-@arg("--delay", help="Delay between execution of cluster jobs")
+@arg("--max-in-flight",
+     help="Maximum number of cluster jobs submitted and not done.")
+@arg("--resume", help="Resume a partially submitted set of jobs.")
+@arg("--bundle-size",
+     help="Number of comparisons to run in each cluster job.")
+@arg("--bundle-parallel",
+     help="Number of comparisons to run at once in each cluster job.")
 @arg("--dry-run", help="Dry run: do not submit or execute jobs.")
 def compare(settings,
             logs_outdir,
-            delay=5,
+            max_in_flight=100,
+            resume=False,
+            bundle_size=1,
+            bundle_parallel=1,
             dry_run=False):
     """
     Run a MISO samples comparison between all pairs of samples.
@@ -103,6 +116,12 @@ def compare(settings,
     comparisons_dir = misowrap_obj.comparisons_dir
     utils.make_dir(comparisons_dir)
     misowrap_obj.logger.info("Running MISO comparisons...")
+    throttle = None
+    if misowrap_obj.use_cluster and (not dry_run):
+        throttle = get_job_throttle(misowrap_obj, "compare",
+                                    max_in_flight, resume)
+    # Comparison jobs to submit to cluster
+    compare_jobs = []
     ##
     ## Compute comparisons between all pairs
     ## in a sample group
@@ -162,14 +181,44 @@ def compare(settings,
                       sample2)
                 misowrap_obj.logger.info("Executing: %s" %(compare_cmd))
                 if misowrap_obj.use_cluster:
-                    if not dry_run:
-                        misowrap_obj.my_cluster.launch_job(compare_cmd,
-                                                           job_name,
-                                                           ppn=1)
-                        time.sleep(delay)
+                    compare_jobs.append((compare_cmd, job_name))
                 else:
                     if not dry_run:
                         os.system(compare_cmd)
+    if throttle is not None:
+        bundle_size = int(bundle_size)
+        if bundle_size > 1:
+            # Pack comparisons into fewer jobs
+            bundles = \
+                misowrap_obj.my_cluster.get_bundles(compare_jobs,
+                                                    bundle_size,
+                                                    num_parallel=int(bundle_parallel),
+                                                    bundle_label="compare")
+            misowrap_obj.logger.info("Running %d comparisons in %d jobs" \
+                                     %(len(compare_jobs), len(bundles)))
+            compare_jobs = [(bundle.get_cmd(), bundle.bundle_name) \
+                            for bundle in bundles]
+        throttle.submit_all(compare_jobs, ppn=int(bundle_parallel))
+        throttle.finish()
+
+
+def get_job_throttle(misowrap_obj, label, max_in_flight, resume):
+    """
+    Return throttle for submitting the jobs of a misowrap
+    command. The jobs' state and the number of jobs in flight
+    are recorded in the logs directory.
+    """
+    state_fname = os.path.join(misowrap_obj.logs_outdir,
+                               "%s.jobs.txt" %(label))
+    depth_fname = os.path.join(misowrap_obj.logs_outdir,
+                               "%s.queue_depth.txt" %(label))
+    throttle = job_throttle.JobThrottle(misowrap_obj.my_cluster,
+                                        int(max_in_flight),
+                                        state_fname=state_fname,
+                                        resume=resume,
+                                        depth_fname=depth_fname,
+                                        logger=misowrap_obj.logger)
+    return throttle
 
 
 def get_read_len(sample_label, readlen_val):
@@ -191,19 +240,15 @@ def get_read_len(sample_label, readlen_val):
 @arg("settings", help="misowrap settings filename.")
 @arg("logs-outdir", help="Directory where to place logs.")
 @arg("--use-cluster", help="Use cluster to submit jobs.")
-@arg("--base-delay", help="Base delay to use (in seconds).")
-@arg("--batch-delay",
-     help="Delay to use between batches of jobs (in seconds).")
-@arg("--delay-every-n-jobs",
-     help="Number of jobs after which a delay is imposed.")
+@arg("--max-in-flight",
+     help="Maximum number of cluster jobs submitted and not done.")
+@arg("--resume", help="Resume a partially submitted set of jobs.")
 @arg("--dry-run", help="Dry run: do not submit or execute jobs.")
 @arg("--samples", help="Samples to run on.", nargs='+', type=str)
 def run(settings, logs_outdir,
         use_cluster=True,
-        base_delay=10,
-        # Batch delay (20 mins by default)
-        batch_delay=60*20,
-        delay_every_n_jobs=30,
+        max_in_flight=100,
+        resume=False,
         dry_run=False,
         event_types=None,
         samples=[]):
@@ -236,7 +281,12 @@ def run(settings, logs_outdir,
     event_types_dirs = \
         miso_utils.get_event_types_dirs(misowrap_obj.settings_info)
     miso_settings_filename = misowrap_obj.miso_settings_filename
-    n = 0
+    throttle = None
+    if use_cluster and (not dry_run):
+        throttle = get_job_throttle(misowrap_obj, "run",
+                                    max_in_flight, resume)
+    # MISO jobs to submit to cluster
+    run_jobs = []
     for bam_input in bam_files:
         bam_filename, sample_label = bam_input
         # If asked to run on certain samples only,
@@ -294,21 +344,13 @@ def run(settings, logs_outdir,
             misowrap_obj.logger.info("Executing: %s" %(miso_cmd))
             job_name = "%s_%s" %(sample_label, event_type)
             if use_cluster:
-                if not dry_run:
-                    misowrap_obj.my_cluster.launch_job(miso_cmd,
-                                                       job_name,
-                                                       ppn=1)
-                if n == delay_every_n_jobs:
-                    # Larger delay everytime we've submitted n jobs
-                    misowrap_obj.logger.info("Submitted %d jobs, now waiting %.2f mins." \
-                                             %(n, batch_delay / 60.))
-                    time.sleep(batch_delay)
-                    n = 0
-                time.sleep(base_delay)
+                run_jobs.append((miso_cmd, job_name))
             else:
                 if not dry_run:
                     os.system(miso_cmd)
-            n += 1
+    if throttle is not None:
+        throttle.submit_all(run_jobs, ppn=1)
+        throttle.finish()
 
 
 @arg("settings", help="misowrap settings filename.")
@@ -370,6 +412,8 @@ def compute_insert_lens(settings,
                                                ppn=1)
         else:
             os.system(insert_len_cmd)
+    if use_cluster and misowrap_obj.use_cluster:
+        misowrap_obj.my_cluster.wait_on_local_jobs()
 
 
 @arg("settings", help="misowrap settings filename.")
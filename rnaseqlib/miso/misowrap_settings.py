@@ -70,6 +70,10 @@ def load_misowrap_settings(config_filename,
                            # Integer parameters
                            INT_PARAMS=["overhanglen",
                                        "chunk_jobs",
+                                       # Local jobs settings
+                                       "local_max_jobs",
+                                       "local_max_cpus",
+                                       "job_retries",
                                        # Filters for events
                                        "atleast_inc",
                                        "atleast_exc",
@@ -1,5 +1,6 @@
 ##
-## Wrapper for dinucleotide usage of pycogent
+## Dinucleotide frequencies and Markov-1 (dinucleotide)
+## models of sequences
 ##
 ## Yarden Katz
 ##
@@ -11,15 +12,147 @@ from collections import defaultdict
 
 import numpy as np
 
-import cogent
-from cogent.core.usage import DinucUsage
-
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+# Bases in the order of their codes (see 'kmer_utils.BASE_CODES')
+CODED_BASES = "ACGT"
+
+
+def get_kmer_dinucs(kmers):
+    """
+    Return the dinucleotides of kmers (of any lengths) as:
+
+      - array of the code of the first base of each kmer
+      - array of the number of times each dinucleotide (by
+        code, 4 * first base + second base) occurs in each kmer
+      - array of whether each kmer is valid (non-empty and of
+        A, C, G, T/U only)
+    """
+    num_kmers = len(kmers)
+    kmer_lens = np.array([len(kmer) for kmer in kmers], dtype=np.int64)
+    base_codes = \
+        kmer_utils.BASE_CODES[np.frombuffer("".join(kmers),
+                                            dtype=np.uint8)].astype(np.int64)
+    kmer_ids = np.repeat(np.arange(num_kmers), kmer_lens)
+    kmer_starts = np.cumsum(kmer_lens) - kmer_lens
+    is_valid = \
+        (kmer_lens > 0) & \
+        (np.bincount(kmer_ids[base_codes == 4], minlength=num_kmers) == 0)
+    first_codes = np.zeros(num_kmers, dtype=np.int64)
+    first_codes[is_valid] = base_codes[kmer_starts[is_valid]]
+    # Dinucleotides within kmers
+    in_kmer = (kmer_ids[:-1] == kmer_ids[1:]) & \
+              (base_codes[:-1] < 4) & (base_codes[1:] < 4)
+    dinuc_codes = (base_codes[:-1] * 4 + base_codes[1:])[in_kmer]
+    kmer_dinucs = \
+        np.bincount(kmer_ids[:-1][in_kmer] * 16 + dinuc_codes,
+                    minlength=num_kmers * 16).reshape((num_kmers, 16))
+    return first_codes, kmer_dinucs, is_valid
+
+
+class DinucModel:
+    """
+    Markov-1 (dinucleotide) model of each of many sequences,
+    computed for all sequences at once.
+
+    Under the model of a sequence, the probability of a kmer is
+    the frequency of its first base in the sequence times the
+    probabilities of its transitions between bases (the count of
+    each dinucleotide in the sequence over the count of the
+    dinucleotides starting with the same base.)
+
+    Bases are case-insensitive and U is read as T.
+    """
+    def __init__(self, seqs, overlapping=True):
+        self.overlapping = overlapping
+        self.num_seqs = len(seqs)
+        self.seq_lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        # Codes of the bases of all sequences, separated by
+        # invalid bases, and the index of the sequence of each base
+        base_codes = kmer_utils.encode_seqs(seqs).astype(np.int64)
+        seq_ids = np.repeat(np.arange(self.num_seqs),
+                            self.seq_lens + 1)[0:len(base_codes)]
+        # Counts of bases in each sequence
+        is_base = (base_codes < 4)
+        self.base_counts = \
+            np.bincount(seq_ids[is_base] * 4 + base_codes[is_base],
+                        minlength=self.num_seqs * 4).reshape((self.num_seqs,
+                                                              4))
+        # Counts of dinucleotides in each sequence
+        is_dinuc = is_base[:-1] & is_base[1:]
+        if not overlapping:
+            # Only dinucleotides starting at even positions
+            seq_starts = np.cumsum(self.seq_lens + 1) - (self.seq_lens + 1)
+            seq_positions = \
+                np.arange(len(base_codes) - 1) - seq_starts[seq_ids[:-1]]
+            is_dinuc &= (seq_positions % 2 == 0)
+        dinuc_codes = (base_codes[:-1] * 4 + base_codes[1:])[is_dinuc]
+        self.dinuc_counts = \
+            np.bincount(seq_ids[:-1][is_dinuc] * 16 + dinuc_codes,
+                        minlength=self.num_seqs * 16)
+        self.dinuc_counts = self.dinuc_counts.reshape((self.num_seqs, 4, 4))
+        # Frequencies of bases over the length of each sequence
+        seq_lens = np.maximum(self.seq_lens, 1).astype(float)
+        self.base_freqs = self.base_counts / seq_lens[:, np.newaxis]
+        # Transition matrix of each sequence (transitions from
+        # bases with no dinucleotides have probability 0)
+        dinucs_from = self.dinuc_counts.sum(axis=2)[:, :, np.newaxis]
+        self.trans_probs = \
+            self.dinuc_counts / np.maximum(dinucs_from, 1).astype(float)
+
+
+    def get_kmer_probs(self, kmers):
+        """
+        Return array of the probability of each kmer (columns)
+        under the model of each sequence (rows).
+
+        Kmers are scored for all sequences at once as a product
+        of the log transition matrices and the dinucleotide
+        counts of the kmers. Kmers that are not of A, C, G, T/U
+        have probability 0.
+        """
+        first_codes, kmer_dinucs, is_valid = get_kmer_dinucs(kmers)
+        trans_probs = self.trans_probs.reshape((self.num_seqs, 16))
+        kmer_dinucs = kmer_dinucs.T.astype(float)
+        is_zero_trans = (trans_probs == 0)
+        log_trans_probs = np.log(np.where(is_zero_trans, 1, trans_probs))
+        first_freqs = self.base_freqs[:, first_codes]
+        log_probs = np.log(np.where(first_freqs == 0, 1, first_freqs)) + \
+                    np.dot(log_trans_probs, kmer_dinucs)
+        probs = np.exp(log_probs)
+        # Kmers with unseen first bases or transitions
+        probs[(first_freqs == 0) | \
+              (np.dot(is_zero_trans.astype(float), kmer_dinucs) > 0)] = 0
+        probs[:, ~is_valid] = 0
+        return probs
+
+
+    def get_expected_counts(self, kmers):
+        """
+        Return array of the expected number of occurrences of
+        each kmer (columns) in each sequence (rows): the
+        probability of the kmer times the number of positions
+        of the kmer in the sequence.
+        """
+        kmer_lens = np.array([len(kmer) for kmer in kmers], dtype=np.int64)
+        num_positions = \
+            np.maximum(self.seq_lens[:, np.newaxis] - kmer_lens + 1, 0)
+        return self.get_kmer_probs(kmers) * num_positions
+
+
+    def __str__(self):
+        return "DinucModel(num_seqs=%d)" %(self.num_seqs)
+
+
+    def __repr__(self):
+        return self.__str__()
+
 
 class DinucFreqs:
     """
-    Dinucleotide frequencies. Wrapper for pycogent class.
+    Dinucleotide frequencies of a sequence.
     """
     def __init__(self, seq,
                  overlapping=True,
@@ -29,26 +162,23 @@ class DinucFreqs:
         self.normalize = normalize
         # Sequence length
         self.len = len(seq)
+        # Model of the sequence
+        self.model = DinucModel([self.seq], overlapping=overlapping)
         # Calculate dinuc. frequencies
-        self.du = DinucUsage(seq, Overlapping=overlapping)
+        dinuc_counts = self.model.dinuc_counts[0].ravel()
         if normalize:
-            self.du.normalize()
+            dinuc_counts = dinuc_counts / float(max(dinuc_counts.sum(), 1))
+        self.dinuc_freqs = {}
+        for first_code, first_base in enumerate(CODED_BASES):
+            for second_code, second_base in enumerate(CODED_BASES):
+                self.dinuc_freqs[first_base + second_base] = \
+                    dinuc_counts[first_code * 4 + second_code]
         # Calculate frequencies for individual bases
-        A_base = "A"
-        T_base = "T"
-        U_base = "U"
-        G_base = "G"
-        C_base = "C"
-        self.bases = (A_base, T_base, G_base, C_base)
+        # (T and U are the same base)
         self.base_freqs = defaultdict(int)
-        for curr_base in self.bases:
-            self.base_freqs[curr_base] = \
-                (self.seq.count(curr_base) / float(self.len))
-        # Equalize T/U -- pick the greater of the two frequencies
-        # and then set them as equal
-        self.base_freqs[T_base] = max((self.base_freqs["T"],
-                                       self.base_freqs["U"]))
-        self.base_freqs[U_base] = self.base_freqs[T_base]
+        for base_code, curr_base in enumerate(CODED_BASES):
+            self.base_freqs[curr_base] = self.model.base_freqs[0, base_code]
+        self.base_freqs["U"] = self.base_freqs["T"]
 
 
     def get_dinuc_freqs_from(self, base, all_bases="ATGC"):
@@ -60,28 +190,16 @@ class DinucFreqs:
         base -> T
         ...
         """
-        return [self.du["%s%s" %(base, possible_base)] \
-                for possible_base in all_bases]
+        base = base.replace("U", "T")
+        return [self.dinuc_freqs["%s%s" %(base, possible_base)] \
+                for possible_base in all_bases.replace("U", "T")]
+
 
-            
     def prob_score(self, subseq):
         """
         Score probability of subseq in sequence.
         """
-        if len(subseq) == 0:
-            return 0
-        # Score first base
-        total_logscore = np.log(self.base_freqs[subseq[0]])
-        for prev_base, next_base in utils.iter_by_pair(subseq, 1):
-            # Score current dinucleotide
-            curr_dinuc = "%s%s" %(prev_base, next_base)
-            # Divide by sum of all other transitions from the previous base
-            curr_dinuc_freq = self.du[curr_dinuc]
-            denom_dinuc_freqs = np.sum(self.get_dinuc_freqs_from(prev_base))
-            total_logscore += (np.log(curr_dinuc_freq) - \
-                               np.log(denom_dinuc_freqs))
-        total_score = np.exp(total_logscore)
-        return total_score
+        return self.model.get_kmer_probs([subseq])[0, 0]
 
 
     def get_expected_num(self, subseq):
@@ -89,16 +207,7 @@ class DinucFreqs:
         Calculcate the number of expected occurrences of subseq
         based on dinucleotide frequencies.
         """
-        subseq_len = len(subseq)
-        # Calculcate score of sequence (its probability)
-        subseq_score = self.prob_score(subseq)
-        # Calculate the number of possible positions for the subseq
-        # to occur within the larger sequence
-        num_positions = self.len - subseq_len + 1
-        # Expected number is the score times the number of possible
-        # positions
-        exp_num = num_positions * subseq_score
-        return exp_num
+        return self.model.get_expected_counts([subseq])[0, 0]
 
 
     def __str__(self):
@@ -108,6 +217,3 @@ class DinucFreqs:
 
     def __repr__(self):
         return self.__str__()
-
-    
-        
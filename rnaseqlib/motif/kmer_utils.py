@@ -4,11 +4,13 @@
 import os
 import sys
 import time
+import multiprocessing
 
 import numpy as np
 import pandas
 
 import operator
+import itertools
 
 import rnaseqlib
 import rnaseqlib.utils as utils
@@ -17,6 +19,7 @@ import rnaseqlib.fasta_utils as fasta_utils
 import rnaseqlib.motif.altschulEriksonDinuclShuffle as dinuc_shuffle
 import rnaseqlib.motif.jellyfish_utils as jf_utils
 
+from string import maketrans
 from collections import defaultdict
 
 try:
@@ -24,6 +27,33 @@ try:
 except:
     print "WARNING: khmer not found!"
 
+# Largest kmer length counted into a dense array of the
+# counts of all kmers (4^12 counts); kmers that are longer
+# are counted as a sorted array of the kmers found
+MAX_DENSE_KMER_LEN = 12
+
+# Largest kmer length whose codes fit in 64-bit integers
+MAX_KMER_LEN = 31
+# Largest length of subsequences found by looking up the
+# codes of kmers in a table of all kmers (4^10 entries); longer
+# subsequences are looked up in their sorted codes
+MAX_TABLE_KMER_LEN = 10
+
+REVCOMP_TABLE = maketrans("ACGT", "TGCA")
+
+# Codes of bases: A, C, G, T (or U) as 0-3 and any other
+# character as 4
+BASE_CODES = np.zeros(256, dtype=np.uint8) + 4
+for base_code, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = base_code
+
+# Codes of bases matching bases exactly, as when finding
+# subsequences: only uppercase A, C, G, T are valid
+EXACT_BASE_CODES = np.zeros(256, dtype=np.uint8) + 4
+for base_code, base in enumerate("ACGT"):
+    EXACT_BASE_CODES[ord(base)] = base_code
+
 
 class ShuffledFasta:
     """
@@ -69,14 +99,341 @@ class ShuffledFasta:
         return self.shuffled_fasta_fnames
 
 
+class KmerCounts:
+    """
+    Counts of kmers of a given length.
+
+    Kmers are counted by their integer codes (see
+    'get_kmer_codes'.) Counts of kmers of up to
+    MAX_DENSE_KMER_LEN bases are held as a dense array
+    indexed by kmer code; counts of longer kmers are held
+    as a sorted array of the codes of the kmers found and
+    an array of their counts.
+    """
+    def __init__(self, kmer_len):
+        if kmer_len > MAX_KMER_LEN:
+            raise Exception, "Cannot count kmers longer than %d." \
+                             %(MAX_KMER_LEN)
+        self.kmer_len = kmer_len
+        self.is_dense = (kmer_len <= MAX_DENSE_KMER_LEN)
+        if self.is_dense:
+            self.codes = None
+            self.counts = np.zeros(4**kmer_len, dtype=np.int64)
+        else:
+            self.codes = np.zeros(0, dtype=np.int64)
+            self.counts = np.zeros(0, dtype=np.int64)
+        # Codes and counts of kmers added but not yet merged
+        # into the sorted codes
+        self.pending = []
+        self.num_pending = 0
+
+
+    def add_codes(self, kmer_codes, kmer_counts=None):
+        """
+        Add kmers given by their codes, each counted once or
+        'kmer_counts' times.
+        """
+        if self.is_dense:
+            added_counts = np.bincount(kmer_codes, weights=kmer_counts,
+                                       minlength=len(self.counts))
+            self.counts += added_counts.astype(np.int64)
+            return
+        if kmer_counts is None:
+            kmer_counts = np.ones(len(kmer_codes), dtype=np.int64)
+        self.pending.append((kmer_codes, kmer_counts))
+        self.num_pending += len(kmer_codes)
+        # Merge once as many kmers are pending as are held, so
+        # that merging takes time linear in the kmers added
+        if self.num_pending >= max(len(self.codes), 2**22):
+            self.merge_pending()
+
+
+    def merge_pending(self):
+        """
+        Merge pending kmers into the sorted kmer codes.
+        """
+        if len(self.pending) == 0:
+            return
+        pending_codes, pending_counts = zip(*self.pending)
+        codes = np.concatenate(pending_codes)
+        counts = np.concatenate(pending_counts)
+        self.pending = []
+        self.num_pending = 0
+        if len(codes) == 0:
+            return
+        # Sort the pending kmers and sum the counts of each kmer
+        if (counts == 1).all():
+            codes = np.sort(codes)
+        else:
+            order = np.argsort(codes)
+            codes = codes[order]
+            counts = counts[order]
+        run_starts = np.concatenate([[True], codes[1:] != codes[:-1]])
+        run_starts = np.nonzero(run_starts)[0]
+        counts = np.add.reduceat(counts, run_starts)
+        codes = codes[run_starts]
+        if len(self.codes) == 0:
+            self.codes, self.counts = codes, counts
+            return
+        # Add counts of kmers held and insert the other kmers
+        # where they go in the sorted codes
+        code_inds = np.searchsorted(self.codes, codes)
+        held_inds = np.minimum(code_inds, len(self.codes) - 1)
+        held = (self.codes[held_inds] == codes)
+        self.counts[held_inds[held]] += counts[held]
+        self.codes = np.insert(self.codes, code_inds[~held], codes[~held])
+        self.counts = np.insert(self.counts, code_inds[~held], counts[~held])
+
+
+    def add_seqs(self, seqs, both_strands=False):
+        """
+        Count kmers of sequences. Kmers with bases other than
+        A, C, G, T are skipped. If 'both_strands' is True, also
+        count the kmers of the reverse complement of sequences.
+        """
+        self.add_base_codes(encode_seqs(seqs), both_strands=both_strands)
+
+
+    def add_base_codes(self, base_codes, both_strands=False):
+        """
+        Count kmers of sequences given as an array of base codes
+        (see 'encode_seqs'.)
+        """
+        kmer_codes = get_kmer_codes(base_codes, self.kmer_len)
+        if both_strands:
+            kmer_codes = \
+                np.concatenate([kmer_codes,
+                                get_revcomp_codes(kmer_codes,
+                                                  self.kmer_len)])
+        self.add_codes(kmer_codes)
+
+
+    def add_counts(self, kmer_counts):
+        """
+        Add counts given as a mapping from kmers to counts.
+        """
+        kmers = kmer_counts.keys()
+        kmer_codes = kmers_to_codes(kmers, self.kmer_len)
+        valid = (kmer_codes >= 0)
+        self.add_codes(kmer_codes[valid],
+                       np.array([kmer_counts[kmer] for kmer in kmers],
+                                dtype=np.int64)[valid])
+
+
+    def get_counts(self, kmers):
+        """
+        Return array of counts of list of kmers.
+        """
+        return self.get_code_counts(kmers_to_codes(kmers, self.kmer_len))
+
+
+    def get_code_counts(self, kmer_codes):
+        """
+        Return array of counts of kmers given by their codes
+        (0 for codes of -1.)
+        """
+        valid = (kmer_codes >= 0)
+        counts = np.zeros(len(kmer_codes), dtype=np.int64)
+        if self.is_dense:
+            counts[valid] = self.counts[kmer_codes[valid]]
+            return counts
+        self.merge_pending()
+        if len(self.codes) == 0:
+            return counts
+        code_inds = np.minimum(np.searchsorted(self.codes, kmer_codes),
+                               len(self.codes) - 1)
+        found = valid & (self.codes[code_inds] == kmer_codes)
+        counts[found] = self.counts[code_inds[found]]
+        return counts
+
+
+    def get_nonzero(self):
+        """
+        Return codes of kmers found and their counts.
+        """
+        if self.is_dense:
+            kmer_codes = np.nonzero(self.counts)[0]
+            return kmer_codes, self.counts[kmer_codes]
+        self.merge_pending()
+        return self.codes, self.counts
+
+
+    def iteritems(self):
+        """
+        Iterate over (kmer, count) of kmers found.
+        """
+        kmer_codes, counts = self.get_nonzero()
+        return itertools.izip(codes_to_kmers(kmer_codes, self.kmer_len),
+                              counts.tolist())
+
+
+    def __iter__(self):
+        kmer_codes, counts = self.get_nonzero()
+        return iter(codes_to_kmers(kmer_codes, self.kmer_len))
+
+
+    def __len__(self):
+        return len(self.get_nonzero()[0])
+
+
+    def __getitem__(self, kmer):
+        return int(self.get_counts([kmer])[0])
+
+
+class SubseqFinder:
+    """
+    Find occurrences of many subsequences in sequences at once.
+
+    Subsequences of each length are matched against the codes
+    of the kmers at every position of a sequence (see
+    'get_kmer_codes_by_pos'), looking up all subsequences at
+    once in a table of all kmers (up to MAX_TABLE_KMER_LEN bases)
+    or in their sorted codes. Occurrences are found as by
+    'str.find', overlapping and case-sensitive.
+
+    Only subsequences of uppercase A, C, G, T of up to
+    MAX_KMER_LEN bases can be coded: occurrences of other
+    subsequences are not found ('is_coded' is False for them.)
+    """
+    def __init__(self, subseqs):
+        self.subseqs = list(subseqs)
+        self.is_coded = \
+            np.array([(0 < len(subseq) <= MAX_KMER_LEN) and \
+                      (subseq.strip("ACGT") == "") \
+                      for subseq in self.subseqs], dtype=bool)
+        # For each length of subsequences: the indices of the
+        # subsequences, their distinct codes sorted, and the index
+        # of the code of each subsequence
+        self.len_groups = []
+        # For lengths of up to MAX_TABLE_KMER_LEN: table of the
+        # index in the sorted codes of each kmer's code (-1 for
+        # other kmers), with a last entry of -1 for positions
+        # with no kmer (code -1)
+        self.code_tables = {}
+        subseq_lens = np.array([len(subseq) for subseq in self.subseqs],
+                               dtype=np.int64)
+        for subseq_len in np.unique(subseq_lens[self.is_coded]).tolist():
+            subseq_inds = \
+                np.nonzero(self.is_coded & (subseq_lens == subseq_len))[0]
+            subseq_codes = \
+                kmers_to_codes([self.subseqs[i] for i in subseq_inds],
+                               subseq_len)
+            unique_codes, code_inds = np.unique(subseq_codes,
+                                                return_inverse=True)
+            self.len_groups.append((subseq_len, subseq_inds,
+                                    unique_codes, code_inds))
+            if subseq_len <= MAX_TABLE_KMER_LEN:
+                code_table = np.zeros(4**subseq_len + 1, dtype=np.int64) - 1
+                code_table[unique_codes] = np.arange(len(unique_codes))
+                self.code_tables[subseq_len] = code_table
+
+
+    def find_codes(self, base_codes, subseq_len, unique_codes):
+        """
+        Return the index in 'unique_codes' of the code of the
+        kmer at each position, and whether it is one of them.
+        """
+        kmer_codes = get_kmer_codes_by_pos(base_codes, subseq_len)
+        if subseq_len in self.code_tables:
+            found_inds = self.code_tables[subseq_len][kmer_codes]
+            return found_inds, (found_inds >= 0)
+        found_inds = np.minimum(np.searchsorted(unique_codes, kmer_codes),
+                                len(unique_codes) - 1)
+        found = (unique_codes[found_inds] == kmer_codes)
+        return found_inds, found
+
+
+    def count(self, seq):
+        """
+        Return array of the number of occurrences of each
+        subsequence in sequence.
+        """
+        counts = np.zeros(len(self.subseqs), dtype=np.int64)
+        base_codes = EXACT_BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+        for subseq_len, subseq_inds, unique_codes, code_inds in \
+            self.len_groups:
+            found_inds, found = self.find_codes(base_codes, subseq_len,
+                                                unique_codes)
+            code_counts = np.bincount(found_inds[found],
+                                      minlength=len(unique_codes))
+            counts[subseq_inds] = code_counts[code_inds]
+        return counts
+
+
+    def find_starts(self, seq):
+        """
+        Return list of the starts (0-based) of the occurrences
+        of each subsequence in sequence, or None for subsequences
+        that are not coded.
+        """
+        starts = [None] * len(self.subseqs)
+        base_codes = EXACT_BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+        for subseq_len, subseq_inds, unique_codes, code_inds in \
+            self.len_groups:
+            found_inds, found = self.find_codes(base_codes, subseq_len,
+                                                unique_codes)
+            found_starts = np.nonzero(found)[0]
+            found_inds = found_inds[found_starts]
+            # Group the starts by code, keeping them in order
+            order = np.argsort(found_inds, kind="mergesort")
+            code_counts = np.bincount(found_inds,
+                                      minlength=len(unique_codes))
+            code_starts = np.split(found_starts[order],
+                                   np.cumsum(code_counts)[:-1])
+            for subseq_ind, code_ind in itertools.izip(subseq_inds.tolist(),
+                                                       code_inds.tolist()):
+                starts[subseq_ind] = code_starts[code_ind].tolist()
+        return starts
+
+
+    def find_occurrences(self, base_codes, num_starts=None):
+        """
+        Return arrays of the start of each occurrence of the
+        coded subsequences in an array of base codes and of the
+        index of the subsequence that occurs there. Repeated
+        subsequences each have their own occurrences.
+
+        Kwargs:
+        - num_starts: only find occurrences starting in the first
+          'num_starts' positions (all positions if None)
+        """
+        if num_starts is None:
+            num_starts = len(base_codes)
+        all_starts = [np.zeros(0, dtype=np.int64)]
+        all_subseq_inds = [np.zeros(0, dtype=np.int64)]
+        for subseq_len, subseq_inds, unique_codes, code_inds in \
+            self.len_groups:
+            found_inds, found = \
+                self.find_codes(base_codes[0:num_starts + subseq_len - 1],
+                                subseq_len, unique_codes)
+            found_starts = np.nonzero(found)[0]
+            found_inds = found_inds[found_starts]
+            # Subsequences of each code, and the number of
+            # subsequences found at each start
+            order = np.argsort(code_inds, kind="mergesort")
+            code_counts = np.bincount(code_inds, minlength=len(unique_codes))
+            code_offsets = np.cumsum(code_counts) - code_counts
+            num_found = code_counts[found_inds]
+            found_offsets = \
+                np.repeat(code_offsets[found_inds] - \
+                          (np.cumsum(num_found) - num_found), num_found) + \
+                np.arange(num_found.sum())
+            all_starts.append(np.repeat(found_starts, num_found))
+            all_subseq_inds.append(subseq_inds[order][found_offsets])
+        return np.concatenate(all_starts), np.concatenate(all_subseq_inds)
+
+
 class Kmers:
     """
     Representation of a set of kmers a FASTA file.
     """
     def __init__(self, kmer_len,
                  fasta_fname=None,
-                 shuffled_fasta=None):
+                 shuffled_fasta=None,
+                 both_strands=False):
         self.kmer_len = kmer_len
+        # Whether to count kmers on both strands
+        self.both_strands = both_strands
         # FASTA file attached to kmers
         self.fasta_fname = fasta_fname
         # Shuffled FASTA filenames
@@ -87,42 +444,46 @@ class Kmers:
         # Mapping from kmers to their counts for each
         # dinucleotide shuffled version of the FASTA file
         self.shuffled_kmer_counts = []
-        # Get the set of kmers
-        self.kmers = enumerate_kmers(kmer_len)
+        # Set of kmers, listed when needed (see 'get_kmers')
+        self.kmers = None
         # Counts file for jf
         self.jf_counts_fname = None
 
 
 
+    def get_kmers(self):
+        """
+        Return list of all kmers, or None for kmers not counted
+        densely (they are too many to list.)
+        """
+        if self.kmers is None and self.kmer_len <= MAX_DENSE_KMER_LEN:
+            self.kmers = enumerate_kmers(self.kmer_len)
+        return self.kmers
+
+
     def output_enriched_kmers(self, result_counts, output_fname):
         """
         Output Kmers that are enriched relative to dinucleotide shuffles
         of the sequences.
         """
-        kmer_entries = []
+        kmers = result_counts["kmers"]
+        # Counts of kmers in the target FASTA file and in
+        # each of the shuffled runs
+        counts = result_counts["counts"].get_counts(kmers)
         shuffled_counts = result_counts["shuffled_counts"]
-        for kmer in self.kmers:
-            # kmer name and its counts in the target FASTA file
-            kmer_entry = {"kmer": kmer,
-                          "counts": result_counts["counts"][kmer]}
-            # Include counts from each of the shuffled runs
-            shuffled_cols = []
-            shuffled_vals = []
-            for shuffle_num in range(len(shuffled_counts)):
-                shuffled_count = shuffled_counts[shuffle_num][kmer]
-                # Record as one based
-                shuffled_col = "shuffled_counts_%d" %(shuffle_num + 1)
-                shuffled_cols.append(shuffled_col)
-                shuffled_vals.append(shuffled_count)
-                kmer_entry.update({shuffled_col: shuffled_count})
-            # Take mean of shuffled values
-            kmer_entry.update({"shuffled_mean": np.mean(shuffled_vals)})
-            # Take ratio of target count to mean of shuffled values
-            target_to_shuffled_ratio = \
-                kmer_entry["counts"] / kmer_entry["shuffled_mean"]
-            kmer_entry.update({"target_to_shuffled":
-                               target_to_shuffled_ratio})
-            kmer_entries.append(kmer_entry)
+        kmer_entries = {"kmer": kmers,
+                        "counts": counts}
+        shuffled_cols = []
+        for shuffle_num in range(len(shuffled_counts)):
+            # Record as one based
+            shuffled_col = "shuffled_counts_%d" %(shuffle_num + 1)
+            shuffled_cols.append(shuffled_col)
+            kmer_entries[shuffled_col] = shuffled_counts[shuffle_num]
+        # Take mean of shuffled values
+        kmer_entries["shuffled_mean"] = shuffled_counts.mean(axis=0)
+        # Take ratio of target count to mean of shuffled values
+        kmer_entries["target_to_shuffled"] = \
+            counts / kmer_entries["shuffled_mean"]
         kmer_df = pandas.DataFrame(kmer_entries)
         print "Outputting kmer counts to: %s" %(output_fname)
         column_order = \
@@ -139,22 +500,53 @@ class Kmers:
         return kmer_df
             
 
-    def get_enriched_kmers(self, output_dir, num_shuffles=1):
+    def get_enriched_kmers(self, output_dir,
+                           num_shuffles=1,
+                           num_procs=1,
+                           seed=0):
         """
         Get kmers that are enriched in FASTA relative to its nucleotide
         shuffled version.
+
+        If the kmers have shuffled FASTA files, the kmers are counted
+        in each of them. Otherwise, the FASTA file is shuffled
+        'num_shuffles' times in process (see 'count_shuffled_kmers'.)
+
+        Returns the kmers (all kmers, or only the ones found in
+        the FASTA file for kmers not counted densely), their counts
+        and a matrix of their counts in each shuffle.
         """
-        # Make the shuffled FASTA files
-        shuffled_fasta_fnames = self.shuffled_fasta.shuffled_fasta_fnames
         # First count the kmers in the target FASTA file
         kmer_counts = self.count_kmers(self.fasta_fname, output_dir)
-        all_shuffled_counts = []
-        for shuffled_fname in shuffled_fasta_fnames:
-            shuffled_counts = self.count_kmers(shuffled_fname,
-                                               output_dir)
-            all_shuffled_counts.append(shuffled_counts)
-        result_counts = {"counts": kmer_counts,
-                         "shuffled_counts": all_shuffled_counts}
+        kmers = self.get_kmers()
+        if kmers is None:
+            kmers = [kmer for kmer in kmer_counts]
+        if self.shuffled_fasta is not None:
+            shuffled_fasta_fnames = self.shuffled_fasta.shuffled_fasta_fnames
+            shuffled_counts = \
+                np.zeros((len(shuffled_fasta_fnames), len(kmers)),
+                         dtype=np.int64)
+            for shuffle_num, shuffled_fname in \
+                enumerate(shuffled_fasta_fnames):
+                shuffled_counts[shuffle_num] = \
+                    self.count_kmers(shuffled_fname,
+                                     output_dir).get_counts(kmers)
+        else:
+            # All kmers are counted in the order of 'get_kmers' by
+            # default
+            count_kmers = None
+            if self.kmer_len > MAX_DENSE_KMER_LEN:
+                count_kmers = kmers
+            shuffled_counts = \
+                count_shuffled_kmers(self.fasta_fname, self.kmer_len,
+                                     num_shuffles,
+                                     kmers=count_kmers,
+                                     num_procs=num_procs,
+                                     seed=seed,
+                                     both_strands=self.both_strands)
+        result_counts = {"kmers": kmers,
+                         "counts": kmer_counts,
+                         "shuffled_counts": shuffled_counts}
         return result_counts
         
 
@@ -175,15 +567,30 @@ class Kmers:
         return shuffled_kmer_counts
 
 
-    def count_kmers(self, fasta_fname, output_dir, method="jf"):
-        # Load up fasta file
+    def count_kmers(self, fasta_fname, output_dir, method="numpy"):
+        """
+        Count kmers in FASTA file. Returns a 'KmerCounts' object.
+
+        'method' is one of 'numpy' (count in process, see
+        'count_kmers_numpy'), 'jf' (count with jellyfish) or
+        'naive' (count one kmer at a time.)
+        """
         kmer_counts = None
-        if method == "jf":
+        if method == "numpy":
+            kmer_counts = self.count_kmers_numpy(fasta_fname)
+        elif method == "jf":
+            if self.both_strands:
+                raise Exception, "Counting kmers on both strands not " \
+                                 "supported with jf."
             self.jf_counts_fname = self.count_kmers_jellyfish(fasta_fname,
                                                               output_dir)
             # Parse jf results
-            kmer_counts = \
-                jf_utils.jf_counts_to_dict(self.jf_counts_fname)
+            kmer_counts = KmerCounts(self.kmer_len)
+            kmer_counts.add_counts(\
+                jf_utils.jf_counts_to_dict(self.jf_counts_fname))
+        elif method == "naive":
+            kmer_counts = KmerCounts(self.kmer_len)
+            kmer_counts.add_counts(self.count_kmers_naive(fasta_fname))
         else:
             raise Exception, "Do not support %s" %(method)
         return kmer_counts
@@ -221,8 +628,43 @@ class Kmers:
     ##
     ## Methods for counting kmers.
     ## 
-    def count_kmers_naive(self):
-        pass
+    def count_kmers_naive(self, fasta_fname):
+        """
+        Count kmers one at a time, skipping kmers with bases
+        other than A, C, G, T.
+        """
+        # Reset counts
+        self.kmer_counts = defaultdict(int)
+        for fastx_name, fastx_seq in \
+            fastx_utils.get_fastx_entries(fasta_fname, fasta=True):
+            seqs = [fastx_seq.upper().replace("U", "T")]
+            if self.both_strands:
+                seqs.append(seqs[0].translate(REVCOMP_TABLE)[::-1])
+            for seq in seqs:
+                for n in xrange(len(seq) - self.kmer_len + 1):
+                    kmer = seq[n:n + self.kmer_len]
+                    if kmer.strip("ACGT") != "":
+                        continue
+                    self.kmer_counts[kmer] += 1
+        return self.kmer_counts
+
+
+    def count_kmers_numpy(self, fasta_fname, batch_size=10000):
+        """
+        Count kmers in process: sequences are read in batches
+        of 'batch_size', and the kmers of a batch are encoded
+        as integer codes and counted at once (see 'KmerCounts'.)
+        """
+        kmer_counts = KmerCounts(self.kmer_len)
+        fasta_entries = fastx_utils.get_fastx_entries(fasta_fname,
+                                                      fasta=True)
+        while True:
+            seqs = [fastx_seq for fastx_name, fastx_seq in \
+                    itertools.islice(fasta_entries, batch_size)]
+            if len(seqs) == 0:
+                break
+            kmer_counts.add_seqs(seqs, both_strands=self.both_strands)
+        return kmer_counts
 
 
     def count_kmers_jellyfish(self, fasta_fname, output_dir):
@@ -274,12 +716,101 @@ def counts_to_df(counts, label=None):
 
 def enumerate_kmers(kmer_len):
     """
-    Return all kmers as strings.
+    Return all kmers as strings, ordered by kmer code
+    (i.e. lexicographically.)
     """
-    ktable = khmer.new_ktable(kmer_len)
-    kmers = [ktable.reverse_hash(n) \
-             for n in range(ktable.n_entries())]
-    return kmers
+    return codes_to_kmers(np.arange(4**kmer_len, dtype=np.int64),
+                          kmer_len)
+
+
+def encode_seqs(seqs):
+    """
+    Return array of codes of the bases of list of sequences
+    (see 'BASE_CODES'), with an invalid base between sequences
+    so that no kmer spans two sequences.
+    """
+    return BASE_CODES[np.frombuffer("N".join(seqs), dtype=np.uint8)]
+
+
+def get_kmer_codes(base_codes, kmer_len):
+    """
+    Return array of the codes of the kmers in an array of base
+    codes, skipping kmers with bases other than A, C, G, T.
+    The code of a kmer has the codes of its bases as digits
+    in base 4, so kmer codes are ordered as the kmers are.
+    """
+    kmer_codes = get_kmer_codes_by_pos(base_codes, kmer_len)
+    return kmer_codes[kmer_codes >= 0]
+
+
+def get_kmer_codes_by_pos(base_codes, kmer_len):
+    """
+    Return array of the codes of the kmers starting at each
+    position of an array of base codes (-1 for kmers with bases
+    other than A, C, G, T.)
+    """
+    num_kmers = len(base_codes) - kmer_len + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # Roll over the bases of all kmers at once
+    kmer_codes = np.zeros(num_kmers, dtype=np.int64)
+    for n in xrange(kmer_len):
+        kmer_codes <<= 2
+        kmer_codes |= (base_codes[n:n + num_kmers] & 3)
+    # Mark kmers with invalid bases
+    num_invalid = np.concatenate([[0], np.cumsum(base_codes == 4)])
+    invalid = \
+        (num_invalid[kmer_len:] - num_invalid[0:num_kmers]) > 0
+    kmer_codes[invalid] = -1
+    return kmer_codes
+
+
+def get_revcomp_codes(kmer_codes, kmer_len):
+    """
+    Return codes of the reverse complements of kmers given
+    by their codes.
+    """
+    revcomp_codes = np.zeros(len(kmer_codes), dtype=np.int64)
+    for n in xrange(kmer_len):
+        revcomp_codes <<= 2
+        revcomp_codes |= 3 - ((kmer_codes >> (2 * n)) & 3)
+    return revcomp_codes
+
+
+def kmers_to_codes(kmers, kmer_len):
+    """
+    Return codes of list of kmers (-1 for kmers with bases
+    other than A, C, G, T or not of length 'kmer_len'.)
+    """
+    kmer_codes = np.zeros(len(kmers), dtype=np.int64) - 1
+    is_len = np.array([len(kmer) == kmer_len for kmer in kmers],
+                      dtype=bool)
+    if not is_len.any():
+        return kmer_codes
+    len_kmers = [kmer for kmer in kmers if len(kmer) == kmer_len]
+    base_codes = encode_seqs(["".join(len_kmers)])
+    base_codes = base_codes.reshape((len(len_kmers), kmer_len))
+    len_codes = np.zeros(len(len_kmers), dtype=np.int64)
+    for n in xrange(kmer_len):
+        len_codes <<= 2
+        len_codes |= (base_codes[:, n] & 3)
+    len_codes[(base_codes == 4).any(axis=1)] = -1
+    kmer_codes[is_len] = len_codes
+    return kmer_codes
+
+
+def codes_to_kmers(kmer_codes, kmer_len):
+    """
+    Return list of kmers given by their codes.
+    """
+    if kmer_len == 0:
+        return [""] * len(kmer_codes)
+    letters = np.frombuffer("ACGT", dtype=np.uint8)
+    kmers_matrix = np.zeros((len(kmer_codes), kmer_len), dtype=np.uint8)
+    for n in xrange(kmer_len):
+        kmers_matrix[:, kmer_len - n - 1] = \
+            letters[(kmer_codes >> (2 * n)) & 3]
+    return kmers_matrix.view("S%d" %(kmer_len)).ravel().tolist()
     
 
 def get_dinuc_shuffles(seq, num_shuffles=1):
@@ -292,6 +823,159 @@ def get_dinuc_shuffles(seq, num_shuffles=1):
     return shuffles
 
 
+def dinuc_shuffle_codes(base_codes, rand):
+    """
+    Return dinucleotide shuffle of an array of base codes (see
+    'encode_seqs'), drawn with 'rand' (a numpy RandomState.)
+    Uses the algorithm of Altschul and Erikson, as does
+    'altschulEriksonDinuclShuffle'.
+
+    Invalid bases (e.g. Ns, or the bases between sequences)
+    are kept in place, and the stretches of bases between them
+    are shuffled separately.
+    """
+    shuffled_codes = base_codes.tolist()
+    invalid_inds = np.nonzero(base_codes == 4)[0].tolist()
+    starts = [0] + [ind + 1 for ind in invalid_inds]
+    ends = invalid_inds + [len(base_codes)]
+    for start, end in itertools.izip(starts, ends):
+        if end - start > 2:
+            shuffled_codes[start:end] = \
+                dinuc_shuffle_stretch(shuffled_codes[start:end], rand)
+    return np.array(shuffled_codes, dtype=np.uint8)
+
+
+def dinuc_shuffle_stretch(codes, rand):
+    """
+    Return dinucleotide shuffle of list of codes of valid bases.
+
+    The sequence is a walk through the graph of its dinucleotides
+    (as edges between bases.) A last edge out of each base is
+    drawn such that the last edges lead to the last base, the
+    other edges out of each base are shuffled, and the walk
+    through the edges in their new order gives the shuffle.
+    """
+    last_code = codes[-1]
+    # Edges out of each base, in sequence order
+    edges = [[], [], [], []]
+    for code, next_code in itertools.izip(codes, codes[1:]):
+        edges[code].append(next_code)
+    from_codes = [code for code in xrange(4) \
+                  if code != last_code and len(edges[code]) > 0]
+    # Draw last edges until every base leads to the last base
+    while True:
+        last_edges = [None] * 4
+        for code in from_codes:
+            last_edges[code] = rand.randint(len(edges[code]))
+        connected = True
+        for code in from_codes:
+            num_steps = 0
+            while code != last_code and num_steps <= 4:
+                code = edges[code][last_edges[code]]
+                num_steps += 1
+            if code != last_code:
+                connected = False
+                break
+        if connected:
+            break
+    for code in xrange(4):
+        code_edges = edges[code]
+        if last_edges[code] is not None:
+            last_edge = code_edges.pop(last_edges[code])
+            rand.shuffle(code_edges)
+            code_edges.append(last_edge)
+        else:
+            rand.shuffle(code_edges)
+    # Walk through the edges
+    shuffled_codes = [codes[0]]
+    edge_inds = [0, 0, 0, 0]
+    code = codes[0]
+    for n in xrange(len(codes) - 1):
+        next_code = edges[code][edge_inds[code]]
+        edge_inds[code] += 1
+        shuffled_codes.append(next_code)
+        code = next_code
+    return shuffled_codes
+
+
+def dinuc_shuffle_seq(seq, rand):
+    """
+    Return dinucleotide shuffle of sequence (see
+    'dinuc_shuffle_codes'.) The shuffle is in uppercase DNA
+    letters, with invalid bases as 'N'.
+    """
+    shuffled_codes = dinuc_shuffle_codes(encode_seqs([seq]), rand)
+    return np.frombuffer("ACGTN", dtype=np.uint8)[shuffled_codes].tostring()
+
+
+def _count_shuffled_kmers(shuffle_job):
+    """
+    Count kmers in dinucleotide shuffles of FASTA file.
+    Used by process pool.
+    """
+    fasta_fname, kmer_len, kmer_codes, shuffle_nums, seed, both_strands = \
+        shuffle_job
+    base_codes = \
+        encode_seqs([fastx_seq for fastx_name, fastx_seq in \
+                     fastx_utils.get_fastx_entries(fasta_fname, fasta=True)])
+    shuffled_counts = np.zeros((len(shuffle_nums), len(kmer_codes)),
+                               dtype=np.int64)
+    for n, shuffle_num in enumerate(shuffle_nums):
+        # Each shuffle has its own seed, so that shuffles do not
+        # depend on which process makes them
+        rand = np.random.RandomState(seed + shuffle_num)
+        kmer_counts = KmerCounts(kmer_len)
+        kmer_counts.add_base_codes(dinuc_shuffle_codes(base_codes, rand),
+                                   both_strands=both_strands)
+        shuffled_counts[n] = kmer_counts.get_code_counts(kmer_codes)
+    return shuffled_counts
+
+
+def count_shuffled_kmers(fasta_fname, kmer_len, num_shuffles,
+                         kmers=None,
+                         num_procs=1,
+                         seed=0,
+                         both_strands=False):
+    """
+    Count kmers in 'num_shuffles' dinucleotide shuffles of FASTA
+    file. Shuffles are counted as they are made, without being
+    written out, by 'num_procs' processes. Shuffle n is drawn
+    with seed 'seed' + n.
+
+    Returns a matrix of the counts of each kmer (columns) in
+    each shuffle (rows.) Kmers are all kmers by default (see
+    'enumerate_kmers'.)
+    """
+    if kmers is None:
+        if kmer_len > MAX_DENSE_KMER_LEN:
+            raise Exception, "Need kmers to count for kmers longer " \
+                             "than %d." %(MAX_DENSE_KMER_LEN)
+        kmer_codes = np.arange(4**kmer_len, dtype=np.int64)
+    else:
+        kmer_codes = kmers_to_codes(kmers, kmer_len)
+    # Split shuffles into a few jobs per process
+    num_jobs = max(1, min(num_shuffles, 4 * num_procs))
+    shuffle_jobs = \
+        [(fasta_fname, kmer_len, kmer_codes,
+          range(num_shuffles)[job_num::num_jobs], seed, both_strands) \
+         for job_num in xrange(num_jobs)]
+    if num_procs <= 1:
+        job_counts = map(_count_shuffled_kmers, shuffle_jobs)
+    else:
+        pool = multiprocessing.Pool(processes=min(num_procs, num_jobs))
+        try:
+            job_counts = pool.map(_count_shuffled_kmers, shuffle_jobs,
+                                  chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    shuffled_counts = np.zeros((num_shuffles, len(kmer_codes)),
+                               dtype=np.int64)
+    for job_num in xrange(num_jobs):
+        shuffled_counts[job_num::num_jobs] = job_counts[job_num]
+    return shuffled_counts
+
+
 def output_dinuc_shuffled_fasta(fasta_fname, shuffled_fasta_fname,
                                 num_shuffles=1):
     """
@@ -337,23 +1021,19 @@ def output_dinuc_enriched_kmers(logger,
                                 fasta_fname,
                                 output_dir,
                                 kmer_lens,
-                                num_shuffles=100):
+                                num_shuffles=100,
+                                num_procs=1):
     """
     Output enriched kmers in a FASTA file relative to
-    a dinucleotide shuffled version of it.
+    dinucleotide shuffled versions of it.
     """
     logger.info("Output dinucleotide enriched Kmers..")
     logger.info("  - Input FASTA: %s" %(fasta_fname))
     logger.info("  - Output dir: %s" %(output_dir))
     utils.make_dir(output_dir)
-    # Shuffle the FASTA
-    shuffled_dir = os.path.join(output_dir, "shuffled_fasta")
-    utils.make_dir(shuffled_dir)
-    shuffled_fasta = ShuffledFasta(fasta_fname, shuffled_dir)
     for kmer_len in kmer_lens:
         kmers = Kmers(kmer_len,
-                      fasta_fname=fasta_fname,
-                      shuffled_fasta=shuffled_fasta)
+                      fasta_fname=fasta_fname)
         output_basename = \
             "%s.%d_kmers.counts" %(os.path.basename(fasta_fname),
                                    kmer_len)
@@ -362,7 +1042,8 @@ def output_dinuc_enriched_kmers(logger,
         if not os.path.isfile(enrichment_fname):
             # Get the enriched kmers
             results = kmers.get_enriched_kmers(output_dir,
-                                               num_shuffles=num_shuffles)
+                                               num_shuffles=num_shuffles,
+                                               num_procs=num_procs)
             # Output enrichment result
             kmers.output_enriched_kmers(results, enrichment_fname)
         else:
@@ -1,20 +1,20 @@
 ##
-## Cogent-based sequence counter
+## Sequence counter
 ##
 import os
 import sys
 import time
+import itertools
 
 import pandas
 
 import numpy as np
 
-import cogent
-from cogent.core.usage import DinucUsage
-
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.pandas_utils as pandas_utils
 import rnaseqlib.motif.dinuc_freq as dinuc_freq
+import rnaseqlib.motif.kmer_utils as kmer_utils
 import rnaseqlib.fasta_utils as fasta_utils
 
 
@@ -57,6 +57,19 @@ class SeqCounter:
     def __init__(self, fasta_fname):
         self.fasta_fname = fasta_fname
         self.seqs = fasta_utils.read_fasta(self.fasta_fname)
+        # Finder of the subsequences last counted
+        self.subseq_finder = None
+
+
+    def get_subseq_finder(self, subseqs):
+        """
+        Return finder of subsequences (see 'kmer_utils.SubseqFinder'),
+        reusing the finder of the subsequences last counted.
+        """
+        if (self.subseq_finder is None) or \
+           (self.subseq_finder.subseqs != list(subseqs)):
+            self.subseq_finder = kmer_utils.SubseqFinder(subseqs)
+        return self.subseq_finder
 
 
     def count(self, subseq):
@@ -75,27 +88,28 @@ class SeqCounter:
         return the observed number of occurrences of all subseqs
         in curr_seq,        
         """
-        dinuc_freq_obj = dinuc_freq.DinucFreqs(seq)
-        obs_counts = []
-        exp_counts = []
-        for subseq in subseqs:
-            # Observed count of subsequence
-            obs_count = overlap_count(seq, subseq)
-            obs_counts.append(float(obs_count))
-            # Expected count of subsequence
-            exp_count = dinuc_freq_obj.get_expected_num(subseq)
-            exp_counts.append(exp_count)
-        return np.array(obs_counts), np.array(exp_counts)
+        dinuc_model = dinuc_freq.DinucModel([seq])
+        # Observed counts of subsequences
+        obs_counts = self.count_subseqs(seq, subseqs)
+        # Expected counts of subsequences
+        exp_counts = dinuc_model.get_expected_counts(subseqs)[0]
+        return obs_counts, exp_counts
 
 
     def count_subseqs(self, seq, subseqs):
         """
         Count occurrences of subseqs in seq.
+
+        All subseqs are counted in one pass over seq (see
+        'kmer_utils.SubseqFinder'), except for subseqs that
+        are not of A, C, G, T, which are counted one by one.
         """
-        obs_counts = \
-            [float(overlap_count(seq, subseq)) \
-             for subseq in subseqs]
-        return np.array(obs_counts)
+        subseq_finder = self.get_subseq_finder(subseqs)
+        obs_counts = subseq_finder.count(seq).astype(float)
+        for subseq_ind in np.nonzero(~subseq_finder.is_coded)[0]:
+            obs_counts[subseq_ind] = \
+                overlap_count(seq, subseq_finder.subseqs[subseq_ind])
+        return obs_counts
 
 
     def count_subseqs_with_starts(self, seq, subseqs):
@@ -104,9 +118,13 @@ class SeqCounter:
         return a tuple of the subseq and a list of its starting positions
         in seq.
         """
+        subseq_finder = self.get_subseq_finder(subseqs)
+        all_starts = subseq_finder.find_starts(seq)
         start_positions = []
-        for subseq in subseqs:
-            counts, starts = overlap_count_with_starts(seq, subseq)
+        for subseq, starts in itertools.izip(subseq_finder.subseqs,
+                                             all_starts):
+            if starts is None:
+                counts, starts = overlap_count_with_starts(seq, subseq)
             start_positions.append((subseq, starts))
         return start_positions
 
@@ -161,13 +179,38 @@ class SeqCounter:
         entries = pandas.DataFrame(entries,
                                    columns=col_names).set_index("header")
         # Sort in place by mean density in descending order
-        entries.sort(column=["sum_density", "max_density"],
-                     ascending=False,
-                     inplace=True)
+        pandas_utils.sort_df(entries, ["sum_density", "max_density"],
+                             ascending=False,
+                             inplace=True)
         return entries
 
     
-    def obs_over_exp_counts_dinuc(self, subseqs):
+    def iter_obs_exp_counts_dinuc(self, subseqs, batch_size=1000):
+        """
+        Iterate over the observed and expected counts of
+        subsequences in each sequence. Yields tuples of the
+        sequence name, observed counts and expected counts.
+
+        Expected counts are computed for 'batch_size' sequences
+        at a time (see 'dinuc_freq.DinucModel'.)
+        """
+        subseqs = list(subseqs)
+        seqs = iter(self.seqs)
+        while True:
+            seq_batch = list(itertools.islice(seqs, batch_size))
+            if len(seq_batch) == 0:
+                break
+            dinuc_model = \
+                dinuc_freq.DinucModel([seq for name, seq in seq_batch])
+            all_exp_counts = dinuc_model.get_expected_counts(subseqs)
+            for (name, seq), exp_counts in itertools.izip(seq_batch,
+                                                          all_exp_counts):
+                # Sequence name is FASTA header without leading '>'
+                obs_counts = self.count_subseqs(seq, subseqs)
+                yield name[1:], obs_counts, exp_counts
+
+
+    def obs_over_exp_counts_dinuc(self, subseqs, batch_size=1000):
         """
         Get observed over expected ratio of counts (non-log!) of
         subsequences in all sequences.
@@ -175,12 +218,8 @@ class SeqCounter:
         entries = []
         t1 = time.time()
         num_seqs = 0
-        for curr_seq in self.seqs:
-            # Sequence name is FASTA header without leading '>'
-            seq_name = curr_seq[0][1:]
-            # Get observed and expected counts for all subseqs
-            # in the current sequence
-            obs_counts, exp_counts = self.count_subseqs(curr_seq[1], subseqs)
+        for seq_name, obs_counts, exp_counts in \
+            self.iter_obs_exp_counts_dinuc(subseqs, batch_size=batch_size):
             # Calculate ratios
             ratios = obs_counts / exp_counts
             # All ratios
@@ -200,22 +239,18 @@ class SeqCounter:
                             exp_counts_str,
                             ratios_str])
             num_seqs += 1
-            if num_seqs == 100:
-                print "Quitting early!"
-                print "=" * 10
-                break
         t2 = time.time()
         print "Counting occurrences in %d sequences took %.2f seconds" \
               %(num_seqs, (t2 - t1))
         col_names = ["header", "max_ratio", "max_ratio_obs_count",
                      "obs_counts", "exp_counts", "ratios"]
         entries = \
-            pandas.DataFrame(np.array(entries),
+            pandas.DataFrame(entries,
                              columns=col_names).set_index("header")
         # Sort in descending order
-        entries.sort(column=["max_ratio"],
-                     ascending=False,
-                     inplace=True)
+        pandas_utils.sort_df(entries, ["max_ratio"],
+                             ascending=False,
+                             inplace=True)
         return entries
             
 
@@ -227,6 +227,21 @@ def select_df_rows(df, cond,
     return result, result_ind
 
 
+def sort_df(df, columns, ascending=True, inplace=False):
+    """
+    Sort DataFrame by the given column (or list of columns.)
+    Works with both old versions of pandas ('DataFrame.sort')
+    and new ones ('DataFrame.sort_values').
+
+    Returns the sorted DataFrame, or None if 'inplace' is True.
+    """
+    if hasattr(df, "sort_values"):
+        return df.sort_values(by=columns, ascending=ascending,
+                              inplace=inplace)
+    return df.sort(columns=columns, ascending=ascending,
+                   inplace=inplace)
+
+
 if __name__ == "__main__":
     from numpy import *
     from scipy import *
@@ -9,7 +9,7 @@ import utils
 from numpy import *
 
 import rnaseqlib
-from rnaseqlib.QualityControl import QualityControl
+from rnaseqlib.QualityControl import QualityControl, compute_cycle_profile
 
 def compute_qc_metrics(settings_filename, output_dir, settings):
     """
@@ -21,10 +21,15 @@ def compute_qc_metrics(settings_filename, output_dir, settings):
 
 
 def get_cycle_profile(fastq_filename):
-    qc_obj = QualityControl(None)
-    percent_n = qc_obj.get_seq_cycle_profile(fastq_filename,
-                                             first_n_seqs=1000000)
+    profile = compute_cycle_profile(fastq_filename,
+                                    num_seqs=1000000)
+    percent_n = profile.get_percent_n()
+    mean_quals = profile.get_mean_quals()
     print "Percent n for %s" %(fastq_filename)
+    print "cycle\tpercent_n\tmean_qual"
+    for cycle in range(len(percent_n)):
+        print "%d\t%.4f\t%.2f" %(cycle + 1, percent_n[cycle],
+                                   mean_quals[cycle])
 
     
 
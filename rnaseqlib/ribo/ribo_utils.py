@@ -4,11 +4,15 @@
 import os
 import sys
 import time
+import itertools
+import functools
 
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.fastq_scatter as fastq_scatter
 
+import numpy as np
 import scipy
 from scipy.stats.stats import zscore
 
@@ -63,13 +67,117 @@ def compute_te(ribo_rpkms, rna_rpkms,
     return te
     
 
+def get_polyA_lens(seqs):
+    """
+    Return array with the length of the trailing stretch of As
+    of each sequence. Sequences of each length are compared
+    at once as rows of a byte matrix.
+    """
+    polyA_lens = np.zeros(len(seqs), dtype=np.int64)
+    for seq_len, inds, len_seqs in fastq_utils.group_seqs_by_len(seqs):
+        if seq_len == 0:
+            continue
+        seqs_matrix = np.frombuffer("".join(len_seqs), dtype=np.uint8)
+        seqs_matrix = seqs_matrix.reshape((len(len_seqs), seq_len))
+        # Position of the last base that is not an A, counting
+        # from the end of the sequence
+        not_A = (seqs_matrix[:, ::-1] != ord("A"))
+        len_polyA_lens = np.where(not_A.any(axis=1),
+                                  not_A.argmax(axis=1),
+                                  seq_len)
+        if inds is None:
+            polyA_lens = len_polyA_lens
+        else:
+            polyA_lens[inds] = len_polyA_lens
+    return polyA_lens
+
+
+def trim_polyA_records(records,
+                       min_polyA_len=3,
+                       min_read_len=22):
+    """
+    Trim polyA ends from list of FASTQ records. Return the
+    trimmed records and an array of their lengths, skipping
+    records that do not end with at least 'min_polyA_len' As
+    (and at least one A) or that are shorter than
+    'min_read_len' after trimming.
+
+    Qualities are cut to the length of the trimmed sequence.
+    """
+    if len(records) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    headers, seqs, headers2, quals = zip(*records)
+    polyA_lens = get_polyA_lens(seqs)
+    trimmed_lens = \
+        np.fromiter(itertools.imap(len, seqs), dtype=np.int64,
+                    count=len(seqs)) - polyA_lens
+    to_keep = (polyA_lens >= max(min_polyA_len, 1)) & \
+              (trimmed_lens >= min_read_len)
+    inds = np.nonzero(to_keep)[0]
+    trimmed_lens = trimmed_lens[inds]
+    trimmed_records = \
+        [(headers[i], seqs[i][0:trimmed_len], headers2[i],
+          quals[i][0:trimmed_len]) \
+         for i, trimmed_len in itertools.izip(inds.tolist(),
+                                              trimmed_lens.tolist())]
+    return trimmed_records, trimmed_lens
+
+
+def trim_polyA_transform(records, **trim_kwargs):
+    """
+    Chunk transform (see 'fastq_scatter') that trims polyA
+    ends and outputs the trimmed records as FASTQ, along
+    with a histogram of their lengths.
+    """
+    trimmed_records, trimmed_lens = trim_polyA_records(records,
+                                                       **trim_kwargs)
+    return (fastq_utils.format_fastq_records(trimmed_records),
+            np.bincount(trimmed_lens))
+
+
+def merge_hists(hist1, hist2):
+    """
+    Add two histograms (arrays of counts) of possibly different
+    lengths.
+    """
+    if len(hist1) < len(hist2):
+        hist1, hist2 = hist2, hist1
+    merged_hist = hist1.copy()
+    merged_hist[0:len(hist2)] += hist2
+    return merged_hist
+
+
+def output_trimmed_lens_hist(hist, output_filename):
+    """
+    Output histogram of lengths of trimmed reads, as a table
+    of read length and number of reads.
+    """
+    with open(output_filename, "w") as hist_file:
+        hist_file.write("read_len\tnum_reads\n")
+        for read_len in np.nonzero(hist)[0]:
+            hist_file.write("%d\t%d\n" %(read_len, hist[read_len]))
+
+
+def get_trimmed_lens_filename(trimmed_filename):
+    """
+    Return filename of histogram of read lengths of trimmed
+    FASTQ file.
+    """
+    return "%s.trimmed_lens.txt" %(utils.trim_fastq_ext(trimmed_filename))
+
+
 def trim_polyA_ends(fastq_filename,
                     output_dir,
                     compressed=False,
                     min_polyA_len=3,
-                    min_read_len=22):
+                    min_read_len=22,
+                    num_procs=1):
     """
     Trim polyA ends from reads.
+
+    The reads are split into chunks trimmed by 'num_procs'
+    processes. A histogram of the lengths of trimmed reads is
+    output alongside the trimmed reads.
     """
     print "Trimming polyA trails from: %s" %(fastq_filename)
     # Strip the trailing extension
@@ -82,30 +190,23 @@ def trim_polyA_ends(fastq_filename,
         print "SKIPPING: %s already exists!" %(output_filename)
         return output_filename
     print "  - Outputting trimmed sequences to: %s" %(output_filename)
-    input_file = fastq_utils.read_open_fastq(fastq_filename)
-    output_file = fastq_utils.write_open_fastq(output_filename)
     t1 = time.time()
-    for line in fastq_utils.read_fastq(input_file):
-        header, seq, header2, qual = line
-        if seq.endswith("A"):
-            # Skip sequences that do not end with at least N
-            # many As
-            if seq[-min_polyA_len:] != ("A" * min_polyA_len):
-                continue
-            # Get sequence stripped of contiguous strech of polyAs
-            stripped_seq = rstrip_stretch(seq, "A")
-            if len(stripped_seq) < min_read_len:
-                # Skip altogether reads that are shorter than
-                # the required length after trimming
-                continue
-            # Strip the quality scores to match trimmed sequence
-            new_qual = qual[0:len(stripped_seq)]
-            new_rec = (header, stripped_seq, header2, new_qual)
-            # Write the record with trimmed sequence back out to file
-            fastq_utils.write_fastq(output_file, new_rec)
+    transform = functools.partial(trim_polyA_transform,
+                                  min_polyA_len=min_polyA_len,
+                                  min_read_len=min_read_len)
+    with utils.temp_outputs([output_filename]) as [tmp_output_filename]:
+        num_chunks, hist = \
+            fastq_scatter.scatter_gather(fastq_filename, tmp_output_filename,
+                                         transform,
+                                         num_procs=num_procs,
+                                         merge_stats=merge_hists)
+        if hist is None:
+            hist = np.zeros(0, dtype=np.int64)
+        hist_filename = get_trimmed_lens_filename(output_filename)
+        print "  - Outputting trimmed read lengths to: %s" %(hist_filename)
+        output_trimmed_lens_hist(hist, hist_filename)
     t2 = time.time()
     print "Trimming took %.2f mins." %((t2 - t1)/60.)
-    output_file.close()
     return output_filename
             
 
@@ -0,0 +1,215 @@
+##
+## ExpressionStore: columnar on-disk store of expression
+## matrices (e.g. counts and RPKMs) across samples
+##
+import os
+import sys
+import time
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+
+class ExpressionStore:
+    """
+    Store of rows (e.g. genes) x samples matrices in a directory.
+
+    Each matrix (e.g. 'rpkm') is a raw file of float64 values in
+    column-major order, so that the values of a sample are
+    contiguous on disk: reading a sample is a single read of a
+    memory-mapped column, and adding a sample appends to the end
+    of each matrix file. The directory contains:
+
+      - rows.txt: row IDs in the first column, followed by
+        optional annotation columns (e.g. exons of each gene)
+      - matrices.txt: names of the matrices, one per line
+      - <matrix>.dat: values of each matrix
+      - samples.txt: sample labels in order of columns
+
+    A sample is recorded in samples.txt only after its values
+    were written to all matrices, so a sample whose writing was
+    interrupted is not part of the store and gets overwritten
+    when the next sample is added.
+    """
+    def __init__(self, store_dir, rows=None, matrix_names=None):
+        """
+        Open the store in 'store_dir', or create it if it does
+        not exist.
+
+        Kwargs (required to create a store):
+        - rows: DataFrame whose first column has the row IDs, with
+          optional annotation columns
+        - matrix_names: names of matrices in the store
+        """
+        self.store_dir = os.path.abspath(os.path.expanduser(store_dir))
+        self.rows_fname = os.path.join(self.store_dir, "rows.txt")
+        self.matrices_fname = os.path.join(self.store_dir, "matrices.txt")
+        self.samples_fname = os.path.join(self.store_dir, "samples.txt")
+        if not os.path.isfile(self.matrices_fname):
+            if (rows is None) or (matrix_names is None):
+                raise Exception, "No expression store in %s; rows and " \
+                      "matrix names are needed to create one." \
+                      %(self.store_dir)
+            self.create(rows, matrix_names)
+        self.rows = pandas.read_csv(self.rows_fname, sep="\t",
+                                    dtype=str,
+                                    keep_default_na=False)
+        self.row_ids = list(self.rows[self.rows.columns[0]].astype(str))
+        self.num_rows = len(self.row_ids)
+        with open(self.matrices_fname) as matrices_file:
+            self.matrix_names = [l.strip() for l in matrices_file \
+                                 if l.strip() != ""]
+        self.samples = []
+        if os.path.isfile(self.samples_fname):
+            with open(self.samples_fname) as samples_file:
+                self.samples = [l.strip() for l in samples_file \
+                                if l.strip() != ""]
+        # Positions of rows and samples
+        self.row_nums = dict([(row_id, n) \
+                              for n, row_id in enumerate(self.row_ids)])
+        self.sample_nums = dict([(sample, n) \
+                                 for n, sample in enumerate(self.samples)])
+
+
+    def create(self, rows, matrix_names):
+        """
+        Create empty store.
+        """
+        utils.make_dir(self.store_dir)
+        rows.to_csv(self.rows_fname, sep="\t", index=False)
+        for matrix_name in matrix_names:
+            open(self.get_matrix_fname(matrix_name), "w").close()
+        with open(self.samples_fname, "w") as samples_file:
+            pass
+        # Write matrix names last: their presence marks the
+        # store as created
+        tmp_fname = "%s.tmp" %(self.matrices_fname)
+        with open(tmp_fname, "w") as matrices_file:
+            for matrix_name in matrix_names:
+                matrices_file.write("%s\n" %(matrix_name))
+        os.rename(tmp_fname, self.matrices_fname)
+
+
+    def get_matrix_fname(self, matrix_name):
+        return os.path.join(self.store_dir, "%s.dat" %(matrix_name))
+
+
+    def has_sample(self, sample):
+        return sample in self.sample_nums
+
+
+    def add_sample(self, sample, values):
+        """
+        Add a sample's values to the store. If the sample is
+        already in the store, its values are replaced.
+
+        Args:
+        - sample: sample label
+        - values: mapping from matrix name to the sample's values,
+          either as pandas Series indexed by row IDs (rows missing
+          from the Series get NaN values) or as arrays in order of
+          the store's rows. Matrices without values get NaN values.
+        """
+        columns = {}
+        for matrix_name in self.matrix_names:
+            column = np.empty(self.num_rows, dtype=np.float64)
+            column.fill(np.nan)
+            if matrix_name in values:
+                matrix_values = values[matrix_name]
+                if isinstance(matrix_values, pandas.Series):
+                    matrix_values = \
+                        matrix_values.reindex(self.row_ids).values
+                column[:] = np.asarray(matrix_values, dtype=np.float64)
+            columns[matrix_name] = column
+        if self.has_sample(sample):
+            # Overwrite the sample's column in place
+            sample_num = self.sample_nums[sample]
+            for matrix_name in self.matrix_names:
+                matrix = np.memmap(self.get_matrix_fname(matrix_name),
+                                   dtype=np.float64,
+                                   mode="r+",
+                                   shape=(self.num_rows, len(self.samples)),
+                                   order="F")
+                matrix[:, sample_num] = columns[matrix_name]
+                matrix.flush()
+                del matrix
+            return
+        # Append the column to the end of each matrix, dropping
+        # any values left by an interrupted write
+        matrix_size = self.num_rows * len(self.samples) * 8
+        for matrix_name in self.matrix_names:
+            with open(self.get_matrix_fname(matrix_name), "r+b") as matrix_file:
+                matrix_file.truncate(matrix_size)
+                matrix_file.seek(matrix_size)
+                matrix_file.write(columns[matrix_name].tostring())
+                matrix_file.flush()
+                os.fsync(matrix_file.fileno())
+        with open(self.samples_fname, "a") as samples_file:
+            samples_file.write("%s\n" %(sample))
+        self.sample_nums[sample] = len(self.samples)
+        self.samples.append(sample)
+
+
+    def get_matrix(self, matrix_name):
+        """
+        Return memory-mapped rows x samples matrix. Values are
+        read from disk only as they are accessed.
+        """
+        if matrix_name not in self.matrix_names:
+            raise Exception, "No matrix %s in expression store %s" \
+                  %(matrix_name, self.store_dir)
+        if len(self.samples) == 0 or self.num_rows == 0:
+            return np.zeros((self.num_rows, len(self.samples)),
+                            dtype=np.float64)
+        return np.memmap(self.get_matrix_fname(matrix_name),
+                         dtype=np.float64,
+                         mode="r",
+                         shape=(self.num_rows, len(self.samples)),
+                         order="F")
+
+
+    def get_column(self, matrix_name, sample):
+        """
+        Return the values of a sample as an array (in order of
+        the store's rows.)
+        """
+        if not self.has_sample(sample):
+            raise Exception, "No sample %s in expression store %s" \
+                  %(sample, self.store_dir)
+        matrix = self.get_matrix(matrix_name)
+        return np.array(matrix[:, self.sample_nums[sample]])
+
+
+    def get_table(self, matrix_name, samples=None, prefix=None):
+        """
+        Return DataFrame of the matrix indexed by row IDs, with
+        a column for each of the given samples (all samples by
+        default.) Only the columns of the given samples are read.
+
+        Kwargs:
+        - samples: samples to load
+        - prefix: prefix to add to sample column names,
+          e.g. 'rpkm_'
+        """
+        if samples is None:
+            samples = self.samples
+        matrix = self.get_matrix(matrix_name)
+        columns = [self.sample_nums[sample] for sample in samples]
+        values = np.empty((self.num_rows, len(columns)), dtype=np.float64)
+        for n, column in enumerate(columns):
+            values[:, n] = matrix[:, column]
+        col_names = list(samples)
+        if prefix is not None:
+            col_names = ["%s%s" %(prefix, sample) for sample in samples]
+        return pandas.DataFrame(values,
+                                index=pandas.Index(self.row_ids,
+                                                   name=self.rows.columns[0]),
+                                columns=col_names)
+
+
+    def __repr__(self):
+        return "ExpressionStore(%s, %d rows, %d samples)" \
+            %(self.store_dir, self.num_rows, len(self.samples))
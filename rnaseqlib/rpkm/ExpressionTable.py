@@ -18,6 +18,7 @@ from scipy.stats.stats import zscore
 
 import rnaseqlib
 import rnaseqlib.ribo.ribo_utils as ribo_utils
+import rnaseqlib.rpkm.ExpressionStore as expression_store
 
 
 def compute_fold_changes_table(table,
@@ -291,7 +292,9 @@ class ExpressionTable:
                  from_file=None,
                  delimiter='\t',
                  counts_dir=None,
-                 index_col=None):
+                 index_col=None,
+                 from_store=None,
+                 store_samples=None):
         self.label = label
         self.header_fields = header_fields
         self.from_file = from_file
@@ -299,6 +302,9 @@ class ExpressionTable:
         self.index_col = index_col
         self.counts_dir = counts_dir
         self.counts_panel = {}
+        # Columnar store of expression matrices, if loading
+        # from a store
+        self.store = None
         self.indexed_data = None
         # Label to use when plotting
         self.plot_label = label
@@ -312,6 +318,8 @@ class ExpressionTable:
             # Load counts information if given
             if self.counts_dir != None:
                 self.load_counts_dir(counts_dir)
+        elif from_store is not None:
+            self.load_store(from_store, samples=store_samples)
         self.index_data()
 
 
@@ -373,7 +381,7 @@ class ExpressionTable:
         ## Apply counts filters
         ##
         # Get dataframe containing only counts column for each sample
-        counts_by_samples = self.counts_panel.minor_xs("counts")
+        counts_by_samples = self.get_counts_table()
         for counts_filter in thresholds["counts"]:
             counts_threshold = counts_filter["cutoff"]
             # Apply threshold disjunctively in any sample
@@ -443,3 +451,31 @@ class ExpressionTable:
             
         # Cast to DataFrame
         self.counts_panel = pandas.Panel(counts)
+
+
+    def load_store(self, store_dir, samples=None):
+        """
+        Load RPKMs from an expression store (see ExpressionStore.)
+        Only the RPKM columns of the given samples (all samples
+        by default) are read; counts are read when needed.
+        """
+        print "Loading expression store from: %s" %(store_dir)
+        self.store = expression_store.ExpressionStore(store_dir)
+        rpkm_table = self.store.get_table("rpkm", samples=samples,
+                                          prefix="rpkm_")
+        self.data = rpkm_table.reset_index()
+        if self.index_col is None:
+            self.index_col = self.data.columns[0]
+
+
+    def get_counts_table(self, samples=None):
+        """
+        Return DataFrame of read counts with a column for
+        each sample.
+        """
+        if self.store is not None:
+            return self.store.get_table("counts", samples=samples)
+        counts_by_samples = self.counts_panel.minor_xs("counts")
+        if samples is not None:
+            counts_by_samples = counts_by_samples[samples]
+        return counts_by_samples
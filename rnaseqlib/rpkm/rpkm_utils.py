@@ -12,6 +12,11 @@ import subprocess
 import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.bam.bam_parallel as bam_parallel
+import rnaseqlib.mapping.IntervalIndex as interval_index
+import rnaseqlib.rpkm.ExpressionStore as expression_store
+
+import numpy as np
 
 import pandas
 
@@ -55,6 +60,198 @@ def load_sample_rpkms(sample,
     return rpkm_tables
     
 
+# Matrices of RPKM and exons coverage stores
+RPKM_STORE_MATRICES = ["rpkm", "counts"]
+COVERAGE_STORE_MATRICES = ["kurtosis", "min", "max", "mean",
+                           "std", "cv", "sqrt_jsd"]
+
+
+def get_rpkm_store_dirs(rpkm_dir, table_name):
+    """
+    Return the directories of the RPKM store (genes x samples)
+    and the exons coverage store (exons x samples) of a table.
+    """
+    rpkm_store_dir = os.path.join(rpkm_dir, "%s.store" %(table_name))
+    coverage_store_dir = os.path.join(rpkm_dir,
+                                      "%s.exons_coverage.store" %(table_name))
+    return rpkm_store_dir, coverage_store_dir
+
+
+def add_sample_to_rpkm_store(store_dir, sample_label, rpkm_filename,
+                             na_val="NA"):
+    """
+    Add a sample's RPKM table (as output by 'write_rpkm_tables')
+    to the RPKM store, creating the store if needed. Genes of the
+    store are those of the first sample added.
+
+    Returns the store.
+    """
+    rpkm_df = pandas.read_csv(rpkm_filename, sep="\t",
+                              na_values=[na_val])
+    rpkm_df["gene_id"] = rpkm_df["gene_id"].astype(str)
+    store = \
+      expression_store.ExpressionStore(store_dir,
+                                       rows=rpkm_df[["gene_id", "exons"]],
+                                       matrix_names=RPKM_STORE_MATRICES)
+    rpkm_df = rpkm_df.set_index("gene_id")
+    store.add_sample(sample_label,
+                     dict([(matrix_name, rpkm_df[matrix_name]) \
+                           for matrix_name in RPKM_STORE_MATRICES]))
+    return store
+
+
+def parse_exons_coverage_table(coverage_filename, na_val="NA"):
+    """
+    Parse RPKM table with exons coverage columns (as output by
+    'write_rpkm_tables') into a DataFrame indexed by exon, with
+    a column for each coverage statistic.
+    """
+    coverage_df = pandas.read_csv(coverage_filename, sep="\t",
+                                  dtype=str)
+    exons = []
+    exon_stats = dict([(stat, []) for stat in COVERAGE_STORE_MATRICES])
+    seen_exons = {}
+    for gene_num in range(len(coverage_df)):
+        gene_exons = coverage_df["exons"].iat[gene_num].split(",")
+        gene_stats = \
+          [coverage_df[stat].iat[gene_num].split(",") \
+           for stat in COVERAGE_STORE_MATRICES]
+        for exon_num, exon in enumerate(gene_exons):
+            # Remove "cds." prefix for exons if found
+            if exon.startswith("cds."):
+                exon = exon.split("cds.")[1]
+            if exon in seen_exons:
+                continue
+            seen_exons[exon] = True
+            exons.append(exon)
+            for stat, stat_values in zip(COVERAGE_STORE_MATRICES,
+                                         gene_stats):
+                value = stat_values[exon_num]
+                if value == na_val or value == "nan":
+                    value = np.nan
+                exon_stats[stat].append(float(value))
+    return pandas.DataFrame(exon_stats,
+                            index=pandas.Index(exons, name="exon"),
+                            columns=COVERAGE_STORE_MATRICES)
+
+
+def add_sample_to_coverage_store(store_dir, sample_label,
+                                 coverage_filename,
+                                 na_val="NA"):
+    """
+    Add a sample's exons coverage statistics to the exons
+    coverage store, creating the store if needed.
+
+    Returns the store.
+    """
+    exons_df = parse_exons_coverage_table(coverage_filename, na_val=na_val)
+    rows = pandas.DataFrame({"exon": list(exons_df.index)})
+    store = \
+      expression_store.ExpressionStore(store_dir,
+                                       rows=rows,
+                                       matrix_names=COVERAGE_STORE_MATRICES)
+    store.add_sample(sample_label,
+                     dict([(stat, exons_df[stat]) \
+                           for stat in COVERAGE_STORE_MATRICES]))
+    return store
+
+
+def update_rpkm_stores(samples, rpkm_dir, table_name,
+                       na_val="NA"):
+    """
+    Add samples' RPKMs and exons coverage for the given table
+    to the table's stores. Samples already in the stores are
+    only read again if their RPKM output changed since they were
+    added (according to the fingerprints saved in the stores.)
+
+    Returns the RPKM store, or None if none of the samples
+    have RPKMs for the table.
+    """
+    rpkm_store_dir, coverage_store_dir = \
+      get_rpkm_store_dirs(rpkm_dir, table_name)
+    rpkm_store = None
+    if os.path.isdir(rpkm_store_dir):
+        rpkm_store = expression_store.ExpressionStore(rpkm_store_dir)
+    coverage_store = None
+    if os.path.isdir(coverage_store_dir):
+        coverage_store = expression_store.ExpressionStore(coverage_store_dir)
+    rpkm_fingerprints_fname = os.path.join(rpkm_store_dir,
+                                           "fingerprints.txt")
+    coverage_fingerprints_fname = os.path.join(coverage_store_dir,
+                                               "fingerprints.txt")
+    rpkm_fingerprints = utils.load_fingerprints(rpkm_fingerprints_fname)
+    coverage_fingerprints = \
+      utils.load_fingerprints(coverage_fingerprints_fname)
+    for sample in samples:
+        rpkm_filename = os.path.join(sample.rpkm_dir,
+                                     "%s.rpkm" %(table_name))
+        if not os.path.isfile(rpkm_filename):
+            print "WARNING: Cannot find RPKM filename %s" %(rpkm_filename)
+            continue
+        fingerprint = utils.get_files_fingerprint([rpkm_filename])
+        if (rpkm_store is None) or \
+           (not rpkm_store.has_sample(sample.label)) or \
+           (rpkm_fingerprints.get(sample.label) != fingerprint):
+            print "Adding %s to RPKM store %s" %(sample.label, rpkm_store_dir)
+            rpkm_store = add_sample_to_rpkm_store(rpkm_store_dir,
+                                                  sample.label,
+                                                  rpkm_filename,
+                                                  na_val=na_val)
+            rpkm_fingerprints[sample.label] = fingerprint
+            utils.save_fingerprints(rpkm_fingerprints_fname,
+                                    rpkm_fingerprints)
+        coverage_filename = os.path.join(sample.rpkm_dir,
+                                         "%s.coverage.txt" %(table_name))
+        if not os.path.isfile(coverage_filename):
+            continue
+        fingerprint = utils.get_files_fingerprint([coverage_filename])
+        if (coverage_store is None) or \
+           (not coverage_store.has_sample(sample.label)) or \
+           (coverage_fingerprints.get(sample.label) != fingerprint):
+            coverage_store = \
+              add_sample_to_coverage_store(coverage_store_dir,
+                                           sample.label,
+                                           coverage_filename,
+                                           na_val=na_val)
+            coverage_fingerprints[sample.label] = fingerprint
+            utils.save_fingerprints(coverage_fingerprints_fname,
+                                    coverage_fingerprints)
+    return rpkm_store
+
+
+def get_rpkm_table_from_store(rpkm_store, samples, gene_table=None):
+    """
+    Return combined RPKM table for the given samples (sample
+    labels) from the RPKM store, with 'gene_id', 'gene_symbol',
+    'rpkm_<sample>', 'counts_<sample>', 'gene_desc' and 'exons'
+    columns.
+
+    Kwargs:
+    - gene_table: gene table to get gene symbols and descriptions from
+    """
+    rpkm_table = rpkm_store.rows.copy()
+    rpkm_table.index = rpkm_store.row_ids
+    for matrix_name in RPKM_STORE_MATRICES:
+        matrix_table = rpkm_store.get_table(matrix_name,
+                                            samples=samples,
+                                            prefix="%s_" %(matrix_name))
+        for col in matrix_table.columns:
+            values = matrix_table[col].values
+            if matrix_name == "counts" and not np.isnan(values).any():
+                values = values.astype(np.int64)
+            rpkm_table[col] = values
+    gene_symbols = None
+    gene_descs = None
+    if gene_table is not None:
+        gene_symbols = [gene_table.genes_to_names[gid] \
+                        for gid in rpkm_store.row_ids]
+        gene_descs = [gene_table.genes_to_desc[gid] \
+                      for gid in rpkm_store.row_ids]
+    rpkm_table["gene_symbol"] = gene_symbols
+    rpkm_table["gene_desc"] = gene_descs
+    return rpkm_table.reset_index(drop=True)
+
+
 def output_rpkm(sample,
                 output_dir,
                 settings_info,
@@ -82,35 +279,58 @@ def output_rpkm(sample,
             logger.info("  - Skipping RPKM output, found %s" \
                         %(rpkm_output_filename))
             continue
-        # Directory where BAM containing mapping to constitutive
-        # exons be stored
-        bam2gff_outdir = os.path.join(output_dir,
-                                      "bam2gff_const_exons")
-        utils.make_dir(bam2gff_outdir)
-        # Map reads to GFF of constitutive exons
-        # Use the rRNA subtracted BAM file
-        logger.info("Mapping BAM to GFF %s" %(const_exons.gff_filename))
-        exons_bam_fname = map_bam2gff_subproc(logger,
-                                              sample.ribosub_bam_filename,
-                                              const_exons.gff_filename,
-                                              bam2gff_outdir)
-        # Compute RPKMs for sample: use number of ribosub mapped reads
-        num_mapped = int(sample.qc.qc_results["num_ribosub_mapped"])
-        if num_mapped == 0:
-            logger.critical("Cannot compute RPKMs since sample %s has 0 " \
-                            "mapped reads." %(sample.label))
-            sys.exit(1)
-        logger.info("Sample %s has %s mapped reads" %(sample.label, num_mapped))
-        read_len = settings_info["readlen"]
-        logger.info("Outputting RPKM from GFF aligned BAM (table %s)" \
-                    %(table_name))
-        output_rpkm_from_gff_aligned_bam(exons_bam_fname,
-                                         num_mapped,
-                                         read_len,
-                                         const_exons,
-                                         rpkm_output_filename)
+        output_table_rpkm(sample,
+                          table_name,
+                          const_exons,
+                          rpkm_output_filename,
+                          settings_info,
+                          logger)
     logger.info("Finished outputting RPKM for %s to %s" %(sample.label,
-                                                          rpkm_output_filename))
+                                                          output_dir))
+    return rpkm_tables
+
+
+def output_table_rpkm(sample,
+                      table_name,
+                      const_exons,
+                      rpkm_output_filename,
+                      settings_info,
+                      logger):
+    """
+    Output RPKM table of the sample for a table of constitutive
+    exons, along with the table with exons coverage
+    (see 'write_rpkm_tables').
+
+    Takes as input:
+
+    - sample: a sample object (with QC results)
+    - table_name: name of table, e.g. 'ensGene'
+    - const_exons: constitutive exons object of table
+    - rpkm_output_filename: RPKM output filename
+    - settings_info: settings information
+    """
+    # Count reads in constitutive exons directly from
+    # the rRNA subtracted BAM file
+    logger.info("Indexing GFF %s" %(const_exons.gff_filename))
+    exons_index = load_gff_regions_index(const_exons.gff_filename)
+    # Compute RPKMs for sample: use number of ribosub mapped reads
+    num_mapped = int(sample.qc.qc_results["num_ribosub_mapped"])
+    if num_mapped == 0:
+        logger.critical("Cannot compute RPKMs since sample %s has 0 " \
+                        "mapped reads." %(sample.label))
+        sys.exit(1)
+    logger.info("Sample %s has %s mapped reads" %(sample.label, num_mapped))
+    read_len = settings_info["mapping"]["readlen"]
+    num_processors = settings_info["mapping"]["num_processors"]
+    logger.info("Outputting RPKM from BAM (table %s)" \
+                %(table_name))
+    output_rpkm_from_bam(sample.ribosub_bam_filename,
+                         exons_index,
+                         num_mapped,
+                         read_len,
+                         const_exons,
+                         rpkm_output_filename,
+                         num_processors=num_processors)
     return rpkm_output_filename
     
 
@@ -229,7 +449,8 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
                                                   "exons"],
                                      na_val="NA",
                                      interval_label="gff",
-                                     with_exon_cov_stats=True):
+                                     with_exon_cov_stats=True,
+                                     num_processors=1):
     """
     Given a BAM file aligned by bedtools (with 'gff' field),
     compute RPKM for each region, incorporating relevant
@@ -247,65 +468,162 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
     - na_val: NA value to use
     - with_exon_cov_stats: if True, output exon coverage
     statistics
+    - num_processors: number of processes to use
     """
-    bam_file = pysam.Samfile(bam_filename, "rb")
     print "Computing RPKM from BAM aligned to GFF..."
     print "  - BAM: %s" %(bam_filename)
     print "  - Output filename: %s" %(output_filename)
     # Map of gff region to read counts
-    region_to_count = defaultdict(int)    
-    for bam_read in bam_file:
-        # Read aligns to region of interest
-        gff_aligned_regions = None
-        try:
-            gff_aligned_regions = bam_read.opt("YB")
-        except KeyError:
-            continue
-        parsed_regions = gff_aligned_regions.split("gff:")[1:]
-        # Compile region counts and lengths
-        for region in parsed_regions:
-            region_chrom, coord_field = region.split(",")[0].split(":")[0:2]
-            # Region internally converted to 0-based start, so we must add 1
-            # to get it back
-            region_start, region_end = map(int, coord_field.split("-"))
-            region_start += 1
-            region_str = "%s:%s-%s" %(region_chrom,
-                                      str(region_start),
-                                      str(region_end))
-            # Count reads in region
-            region_to_count[region_str] += 1
-    # For each gene, find its exons. Sum their counts
-    # and length to compute RPKM
-    rpkm_table = []
+    region_to_count = get_gff_region_counts(bam_filename,
+                                            interval_label=interval_label,
+                                            num_processors=num_processors)
+    rpkm_df = compute_gene_rpkms(region_to_count, num_mapped, const_exons,
+                                 na_val=na_val)
+    exon_stats_dict = None
+    if with_exon_cov_stats:
+        exon_stats_dict = \
+          coverage_utils.get_exons_coverage_from_tagBam(bam_filename,
+                                                        interval_label=interval_label,
+                                                        gff_coords=True,
+                                                        num_processors=num_processors)
+    write_rpkm_tables(rpkm_df, output_filename,
+                      exon_stats_dict=exon_stats_dict,
+                      rpkm_header=rpkm_header,
+                      na_val=na_val)
+    return output_filename
+
+
+def output_rpkm_from_bam(bam_filename,
+                         exons_index,
+                         num_mapped,
+                         read_len,
+                         const_exons,
+                         output_filename,
+                         rpkm_header=["gene_id",
+                                      "rpkm",
+                                      "counts",
+                                      "exons"],
+                         na_val="NA",
+                         with_exon_cov_stats=True,
+                         num_processors=1):
+    """
+    Compute RPKM for each gene from a BAM file, mapping reads
+    to the constitutive exons using an index of the exons
+    rather than a BAM produced by tagBam.
+
+    Args:
+    - bam_filename: the BAM file
+    - exons_index: IntervalIndex of the constitutive exons GFF
+      (see 'load_gff_regions_index')
+    - num_mapped: number of mapped reads to normalize to
+    - read_len: read length
+    - const_exons: Constitutive exons object
+    - output_filename: output filename
+
+    Kwargs:
+    - rpkm_header: header for output RPKM file
+    - na_val: NA value to use
+    - with_exon_cov_stats: if True, output exon coverage
+    statistics
+    - num_processors: number of processes to use
+    """
+    print "Computing RPKM from BAM..."
+    print "  - BAM: %s" %(bam_filename)
+    print "  - Output filename: %s" %(output_filename)
+    region_to_count = \
+        get_gff_region_counts_from_bam(bam_filename, exons_index,
+                                       num_processors=num_processors)
+    rpkm_df = compute_gene_rpkms(region_to_count, num_mapped, const_exons,
+                                 na_val=na_val)
+    exon_stats_dict = None
+    if with_exon_cov_stats:
+        exon_stats_dict = \
+          coverage_utils.get_exons_coverage_from_bam(bam_filename,
+                                                     exons_index,
+                                                     num_processors=num_processors)
+    write_rpkm_tables(rpkm_df, output_filename,
+                      exon_stats_dict=exon_stats_dict,
+                      rpkm_header=rpkm_header,
+                      na_val=na_val)
+    return output_filename
+
+
+def get_region_key(exon):
+    """
+    Return the key of a constitutive exon (e.g. 'cds.chr1:10-20:+')
+    in the region counts, i.e. its coordinates without strand or
+    prefix (e.g. 'chr1:10-20').
+    """
+    # Strip the strand of the exon
+    curr_exon = exon[0:-2]
+    if "." in curr_exon:
+        # Strip off dot prefix if any is there
+        curr_exon = curr_exon.split(".")[1]
+    return curr_exon
+
+
+def compute_gene_rpkms(region_to_count, num_mapped, const_exons,
+                       na_val="NA"):
+    """
+    Compute RPKM for each gene from the counts of reads in
+    its constitutive exons.
+
+    Args:
+    - region_to_count: mapping from region (in GFF coordinates,
+      e.g. 'chr1:10-20') to read counts
+    - num_mapped: number of mapped reads to normalize to
+    - const_exons: Constitutive exons object
+
+    Returns a DataFrame with the RPKM, counts and exons of
+    each gene that has constitutive exons.
+    """
+    gene_ids = []
+    gene_exons = []
+    # Gene number of each exon, and the exon's counts and length
+    exon_genes = []
+    exon_counts = []
+    exon_lens = []
     for gene_info in const_exons.genes_to_exons:
-        gene_id = gene_info["gene_id"]
         exons = gene_info["exons"]
         if exons == na_val:
             continue
-        parsed_exons = exons.split(",")
-        # Strip the strand of the exons
-        strandless_exons = []
-        for parsed_exon in parsed_exons:
-            curr_exon = parsed_exon[0:-2]
-            if "." in curr_exon:
-                # Strip off dot prefix if any is there
-                curr_exon = curr_exon.split(".")[1]
-            strandless_exons.append(curr_exon)
-        curr_counts = [region_to_count[s_exon] for s_exon in strandless_exons]
-        sum_counts = sum(curr_counts)
-        curr_lens = [const_exons.exon_lens[exon] for exon in parsed_exons]
-        sum_lens = sum(curr_lens)
-        assert(len(curr_counts) == len(curr_lens)), \
-            "Error: sum_counts != sum_lens in RPKM computation."
-        gene_rpkm = compute_rpkm(sum_counts, sum_lens, num_mapped)
-        # RPKM entry for gene
-        rpkm_entry = {"rpkm": gene_rpkm,
-                      "gene_id": gene_id,
-                      "counts": sum_counts,
-                      "exons": exons}
-        rpkm_table.append(rpkm_entry)
-    rpkm_df = pandas.DataFrame(rpkm_table)
-    if with_exon_cov_stats:
+        gene_num = len(gene_ids)
+        gene_ids.append(gene_info["gene_id"])
+        gene_exons.append(exons)
+        for exon in exons.split(","):
+            exon_genes.append(gene_num)
+            exon_counts.append(region_to_count.get(get_region_key(exon), 0))
+            exon_lens.append(const_exons.exon_lens[exon])
+    num_genes = len(gene_ids)
+    # Sum counts and lengths of each gene's exons
+    exon_genes = np.array(exon_genes, dtype=np.int64)
+    sum_counts = np.bincount(exon_genes,
+                             weights=np.array(exon_counts, dtype=np.float64),
+                             minlength=num_genes).astype(np.int64)
+    sum_lens = np.bincount(exon_genes,
+                           weights=np.array(exon_lens, dtype=np.float64),
+                           minlength=num_genes)
+    gene_rpkms = compute_rpkm(sum_counts, sum_lens, num_mapped)
+    rpkm_df = pandas.DataFrame({"rpkm": gene_rpkms,
+                                "gene_id": gene_ids,
+                                "counts": sum_counts,
+                                "exons": gene_exons})
+    return rpkm_df
+
+
+def write_rpkm_tables(rpkm_df, output_filename,
+                      exon_stats_dict=None,
+                      rpkm_header=["gene_id",
+                                   "rpkm",
+                                   "counts",
+                                   "exons"],
+                      na_val="NA"):
+    """
+    Output RPKM table. If exon coverage statistics are given,
+    also output a version of the table with coverage columns
+    for exons.
+    """
+    if exon_stats_dict is not None:
         # Output version of RPKM table with coverage columns
         # for exons
         # Strip filename extension and add a .coverage
@@ -313,9 +631,8 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
         output_fname_with_cov += ".coverage.txt" 
         # If asked, output a table with RPKM coverage
         rpkm_df_with_cov, coverage_cols = \
-          add_exons_coverage_from_bam_to_rpkm_df(rpkm_df,
-                                                 bam_filename,
-                                                 interval_label=interval_label)
+          add_exons_coverage_to_rpkm_df(rpkm_df, exon_stats_dict,
+                                        na_val=na_val)
         rpkm_header_with_cols = rpkm_header + coverage_cols
         rpkm_df_with_cov.to_csv(output_fname_with_cov,
                                 cols=rpkm_header_with_cols,
@@ -333,6 +650,108 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
     return output_filename
 
 
+def count_gff_regions_in_shard(bam_filename, shard,
+                               interval_label="gff"):
+    """
+    Count reads in each GFF region in a shard of a BAM file
+    aligned by bedtools (with 'gff' field). Returns mapping
+    from region (in GFF coordinates) to read counts.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    region_to_count = defaultdict(int)
+    label_with_delim = "%s:" %(interval_label)
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        # Read aligns to region of interest
+        gff_aligned_regions = None
+        try:
+            gff_aligned_regions = bam_read.opt("YB")
+        except KeyError:
+            continue
+        parsed_regions = gff_aligned_regions.split(label_with_delim)[1:]
+        # Compile region counts and lengths
+        for region in parsed_regions:
+            region_chrom, coord_field = region.split(",")[0].split(":")[0:2]
+            # Region internally converted to 0-based start, so we must add 1
+            # to get it back
+            region_start, region_end = map(int, coord_field.split("-"))
+            region_start += 1
+            region_str = "%s:%s-%s" %(region_chrom,
+                                      str(region_start),
+                                      str(region_end))
+            # Count reads in region
+            region_to_count[region_str] += 1
+    bam_file.close()
+    return region_to_count
+
+
+def get_gff_region_counts(bam_filename,
+                          interval_label="gff",
+                          num_processors=1):
+    """
+    Count reads in each GFF region of a BAM file aligned by
+    bedtools (with 'gff' field), processing the BAM one
+    chromosome at a time using 'num_processors' processes.
+
+    Returns mapping from region (in GFF coordinates) to read counts.
+    """
+    shard_counts = \
+        bam_parallel.map_bam_shards(bam_filename,
+                                    count_gff_regions_in_shard,
+                                    shard_args=(interval_label,),
+                                    num_processors=num_processors)
+    return bam_parallel.merge_counts([defaultdict(int)] + shard_counts)
+
+
+def load_gff_regions_index(gff_filename, interval_label="gff"):
+    """
+    Load GFF file into an interval index.
+    """
+    regions_index = interval_index.IntervalIndex()
+    regions_index.add_gff_file(gff_filename, interval_label)
+    return regions_index.build()
+
+
+def count_gff_regions_in_bam_shard(bam_filename, shard, regions_index):
+    """
+    Count reads in each GFF region in a shard of a BAM file,
+    using an index of the GFF regions. As with tagBam -f 1,
+    reads are counted in the regions that contain them.
+
+    Returns mapping from region (in GFF coordinates) to read counts.
+    """
+    bam_file = pysam.Samfile(bam_filename, "rb")
+    chrom = shard[0]
+    region_to_count = defaultdict(int)
+    for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        if bam_read.is_unmapped:
+            continue
+        matches = regions_index.find(chrom, bam_read.pos, bam_read.aend,
+                                     contained=True)
+        for match in matches:
+            # Index has BED coordinates, so add 1 to start
+            region_to_count[(match[0], match[1])] += 1
+    bam_file.close()
+    # Format regions once rather than once per read
+    return dict([("%s:%d-%d" %(chrom, start + 1, end), count) \
+                 for (start, end), count in region_to_count.iteritems()])
+
+
+def get_gff_region_counts_from_bam(bam_filename, regions_index,
+                                   num_processors=1):
+    """
+    Count reads in each GFF region of a BAM file, using an index
+    of the GFF regions instead of a BAM produced by tagBam.
+
+    Returns mapping from region (in GFF coordinates) to read counts.
+    """
+    shard_counts = \
+        bam_parallel.map_bam_shards(bam_filename,
+                                    count_gff_regions_in_bam_shard,
+                                    shard_args=(regions_index,),
+                                    num_processors=num_processors)
+    return bam_parallel.merge_counts([defaultdict(int)] + shard_counts)
+
+
 def parse_tagBam_opt_field(opt_field,
                            interval_label="gff",
                            gff_coords=True):
@@ -372,6 +791,7 @@ def add_exons_coverage_from_bam_to_rpkm_df(rpkm_df,
                                            bam_fname,
                                            interval_label="gff",
                                            na_val="NA",
+                                           num_processors=1,
                                            coverage_cols=["kurtosis",
                                                           "min",
                                                           "max",
@@ -390,11 +810,38 @@ def add_exons_coverage_from_bam_to_rpkm_df(rpkm_df,
     Kwargs:
     - interval_label: Interval label from BAM filename
     - na_val: NA value to use
+    - num_processors: number of processes to use
     """
     exon_stats_dict = \
       coverage_utils.get_exons_coverage_from_tagBam(bam_fname,
                                                     interval_label=interval_label,
-                                                    gff_coords=True)
+                                                    gff_coords=True,
+                                                    num_processors=num_processors)
+    return add_exons_coverage_to_rpkm_df(rpkm_df, exon_stats_dict,
+                                         na_val=na_val,
+                                         coverage_cols=coverage_cols)
+
+
+def add_exons_coverage_to_rpkm_df(rpkm_df,
+                                  exon_stats_dict,
+                                  na_val="NA",
+                                  coverage_cols=["kurtosis",
+                                                 "min",
+                                                 "max",
+                                                 "mean",
+                                                 "std",
+                                                 "cv",
+                                                 "sqrt_jsd"]):
+    """
+    Add exons coverage to RPKM dataframe.
+
+    Args:
+    - rpkm_df: RPKM dataframe
+    - exon_stats_dict: mapping from exon to its coverage statistics
+
+    Kwargs:
+    - na_val: NA value to use
+    """
     gene_entries = []
     # Add exon coverage statistics to RPKM table
     for rpkm_row, curr_entry in rpkm_df.iterrows():
@@ -5,11 +5,17 @@ import default_settings
 
 def load_settings(config_filename,
                   # Float parameters
-                  FLOAT_PARAMS=[],
+                  FLOAT_PARAMS=["max_mem_gb",
+                                "local_max_mem_gb"],
                   # Integer parameters
                   INT_PARAMS=["readlen",
                               "overhanglen",
                               "num_processors",
+                              "max_cpus",
+                              "local_max_jobs",
+                              "local_max_cpus",
+                              "job_retries",
+                              "samples_per_job",
                               "paired_end_frag"],
                   # Boolean parameters
                   BOOL_PARAMS=["paired",
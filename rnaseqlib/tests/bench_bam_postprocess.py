@@ -0,0 +1,98 @@
+##
+## Benchmark of BAM post-processing after mapping: single-pass
+## splitting of BAM versus separate unique/rRNA-subtraction passes
+##
+## Usage: python -m rnaseqlib.tests.bench_bam_postprocess [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.bam.bam_utils as bam_utils
+
+
+def separate_passes(bam_fname, output_dir, chr_ribo="chrRibo"):
+    """
+    Post-process BAM as done prior to single-pass splitting:
+    one pass for unique reads, an rRNA read IDs dictionary
+    followed by a pass for rRNA-subtracted reads, then sorting
+    and indexing of each output.
+    """
+    unique_fname = os.path.join(output_dir, "sep.unique.bam")
+    ribosub_fname = os.path.join(output_dir, "sep.ribosub.bam")
+    # Unique reads
+    mapped_reads = pysam.Samfile(bam_fname, "rb")
+    unique_reads = pysam.Samfile(unique_fname, "wb",
+                                 template=mapped_reads)
+    for read in mapped_reads:
+        if ("NH", 1) in read.tags:
+            unique_reads.write(read)
+    unique_reads.close()
+    mapped_reads.close()
+    # rRNA-subtracted reads
+    mapped_reads = pysam.Samfile(bam_fname, "rb")
+    ribo_read_ids = {}
+    for ribo_read in mapped_reads.fetch(reference=chr_ribo,
+                                        multiple_iterators=True):
+        ribo_read_ids[ribo_read.qname] = True
+    ribosub_bam = pysam.Samfile(ribosub_fname, "wb",
+                                template=mapped_reads)
+    for read in mapped_reads:
+        if read.qname in ribo_read_ids:
+            continue
+        ribosub_bam.write(read)
+    ribosub_bam.close()
+    mapped_reads.close()
+    # Sort and index outputs
+    for fname in [unique_fname, ribosub_fname]:
+        sorted_fname = fname.replace(".bam", ".sorted.bam")
+        pysam.sort("-o", sorted_fname, fname)
+        pysam.index(sorted_fname)
+    return None
+
+
+def single_pass(bam_fname, output_dir, chr_ribo="chrRibo"):
+    """
+    Post-process BAM using single-pass splitting.
+    """
+    output_fnames = {}
+    for output_type in ["unique", "ribosub", "unique_ribosub"]:
+        output_fnames[output_type] = \
+            os.path.join(output_dir, "single.%s.sorted.bam" %(output_type))
+    return bam_utils.split_bam_reads(bam_fname, output_fnames,
+                                     chr_ribo=chr_ribo)
+
+
+def main():
+    num_reads = 1000000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "synthetic.sorted.bam")
+        print "Generating synthetic BAM with %d reads.." %(num_reads)
+        # Generate in a separate process so that the memory used
+        # for generation does not count towards the benchmarks
+        bench_utils.measure(test_utils.make_synthetic_bam,
+                            bam_fname, num_reads)
+        secs, peak_rss, result = \
+            bench_utils.measure(separate_passes, bam_fname, output_dir)
+        bench_utils.print_results("separate passes", secs, peak_rss,
+                                  num_items=num_reads)
+        secs, peak_rss, result = \
+            bench_utils.measure(single_pass, bam_fname, output_dir)
+        bench_utils.print_results("single pass", secs, peak_rss,
+                                  num_items=num_reads)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+##
+## Benchmark of sequencing cycle profile computation: per-base
+## loop versus batches of reads as byte matrices
+##
+## Usage: python -m rnaseqlib.tests.bench_cycle_profile [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from collections import defaultdict
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.QualityControl as qc
+
+
+def per_base_profile(fastq_fname):
+    """
+    Compute percent of N bases at each cycle as done prior to
+    the vectorized cycle profile, one base at a time.
+    """
+    num_n_bases = defaultdict(int)
+    num_reads = defaultdict(int)
+    for entry in fastq_utils.read_fastq(fastq_fname):
+        header1, seq, header2, qual = entry
+        for n in range(len(seq)):
+            if seq[n] == "N":
+                num_n_bases[n] += 1
+            num_reads[n] += 1
+    return [float(num_n_bases[n]) / num_reads[n] \
+            for n in range(len(num_reads))]
+
+
+def vectorized_profile(fastq_fname, num_seqs=None, sampling="first"):
+    profile = qc.compute_cycle_profile(fastq_fname,
+                                       num_seqs=num_seqs,
+                                       sampling=sampling,
+                                       seed=1)
+    return list(profile.get_percent_n())
+
+
+def main():
+    num_reads = 2000000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        fastq_fname = os.path.join(output_dir, "synthetic.fastq")
+        print "Generating synthetic FASTQ with %d reads.." %(num_reads)
+        bench_utils.measure(test_utils.make_synthetic_fastq,
+                            fastq_fname, num_reads, read_len=50)
+        secs, peak_rss, per_base = \
+            bench_utils.measure(per_base_profile, fastq_fname)
+        bench_utils.print_results("per-base loop", secs, peak_rss,
+                                  num_items=num_reads)
+        secs, peak_rss, vectorized = \
+            bench_utils.measure(vectorized_profile, fastq_fname)
+        bench_utils.print_results("byte matrix batches", secs, peak_rss,
+                                  num_items=num_reads)
+        if max([abs(x - y) for x, y in zip(per_base, vectorized)]) > 1e-9:
+            print "Warning: profiles differ."
+        num_seqs = num_reads / 10
+        for sampling in ["first", "random"]:
+            secs, peak_rss, result = \
+                bench_utils.measure(vectorized_profile, fastq_fname,
+                                    num_seqs=num_seqs,
+                                    sampling=sampling)
+            bench_utils.print_results("%s %d reads" %(sampling, num_seqs),
+                                      secs, peak_rss)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+##
+## Benchmark of expected counts of kmers under dinucleotide
+## models of sequences: all sequences and kmers at once versus
+## scoring each kmer in each sequence one base at a time
+##
+## Usage: python -m rnaseqlib.tests.bench_dinuc_model [num_seqs]
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.tests.bench_subseq_count as bench_subseq_count
+import rnaseqlib.motif.kmer_utils as kmer_utils
+import rnaseqlib.motif.dinuc_freq as dinuc_freq
+
+
+def get_expected_counts_by_base(seqs, kmers):
+    """
+    Score each kmer in each sequence one base at a time,
+    looking up the dinucleotide frequencies from each base
+    on every transition, as done prior to 'DinucModel'.
+    Expected counts are summed over sequences.
+    """
+    all_exp_counts = []
+    for seq in seqs:
+        dinuc_freqs = {}
+        for first_base in "ACGT":
+            for second_base in "ACGT":
+                dinuc = first_base + second_base
+                dinuc_freqs[dinuc] = \
+                    sum(1 for n in xrange(len(seq) - 1) \
+                        if seq[n:n + 2] == dinuc)
+        exp_counts = []
+        for kmer in kmers:
+            log_score = np.log(seq.count(kmer[0]) / float(len(seq)))
+            for prev_base, next_base in zip(kmer, kmer[1:]):
+                denom = np.sum([dinuc_freqs[prev_base + base] \
+                                for base in "ACGT"])
+                log_score += np.log(dinuc_freqs[prev_base + next_base]) - \
+                             np.log(denom)
+            exp_counts.append((len(seq) - len(kmer) + 1) * np.exp(log_score))
+        all_exp_counts.append(exp_counts)
+    return np.sum(all_exp_counts, axis=0)
+
+
+def get_expected_counts(seqs, kmers, batch_size=1000):
+    """
+    Score kmers in 'batch_size' sequences at a time. Expected
+    counts are summed over sequences, as the expected counts of
+    each sequence are used and dropped when streaming.
+    """
+    total_exp_counts = np.zeros(len(kmers))
+    for start in xrange(0, len(seqs), batch_size):
+        dinuc_model = dinuc_freq.DinucModel(seqs[start:start + batch_size])
+        total_exp_counts += dinuc_model.get_expected_counts(kmers).sum(axis=0)
+    return total_exp_counts
+
+
+def main():
+    num_seqs = 20000
+    if len(sys.argv) > 1:
+        num_seqs = int(sys.argv[1])
+    kmers = kmer_utils.enumerate_kmers(6)
+    seqs = bench_subseq_count.make_random_seqs(num_seqs * 1000)
+    print "Scoring %d kmers in %d sequences of 1 kb.." %(len(kmers),
+                                                        len(seqs))
+    # Scoring one base at a time is only run on a few sequences
+    part_seqs = seqs[0:10]
+    secs, peak_rss, by_base_counts = \
+        bench_utils.measure(get_expected_counts_by_base, part_seqs, kmers)
+    bench_utils.print_results("one base at a time", secs, peak_rss,
+                              num_items=len(part_seqs),
+                              items_label="seqs")
+    if not np.allclose(by_base_counts, get_expected_counts(part_seqs, kmers)):
+        print "Warning: expected counts differ."
+    secs, peak_rss, exp_counts = \
+        bench_utils.measure(get_expected_counts, seqs, kmers)
+    bench_utils.print_results("transition matrices", secs, peak_rss,
+                              num_items=len(seqs), items_label="seqs")
+
+
+if __name__ == "__main__":
+    main()
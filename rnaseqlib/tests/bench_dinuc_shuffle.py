@@ -0,0 +1,78 @@
+##
+## Benchmark of kmer counts of dinucleotide shuffles: writing
+## shuffled FASTA files and counting each of them versus
+## counting shuffles as they are made, in a process pool
+##
+## Usage: python -m rnaseqlib.tests.bench_dinuc_shuffle [num_bases]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.tests.bench_kmer_count as bench_kmer_count
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+
+def count_shuffled_files(fasta_fname, kmer_len, num_shuffles, output_dir):
+    """
+    Write shuffled FASTA files and count kmers in each of them,
+    as done prior to counting shuffles in process.
+    """
+    shuffled_dir = os.path.join(output_dir, "shuffled_%d" %(num_shuffles))
+    shuffled_fasta = kmer_utils.ShuffledFasta(fasta_fname, shuffled_dir,
+                                              num_shuffles=num_shuffles)
+    kmers = kmer_utils.Kmers(kmer_len, fasta_fname=fasta_fname,
+                             shuffled_fasta=shuffled_fasta)
+    results = kmers.get_enriched_kmers(output_dir)
+    shutil.rmtree(shuffled_dir)
+    return results["shuffled_counts"]
+
+
+def main():
+    num_bases = 50000
+    if len(sys.argv) > 1:
+        num_bases = int(sys.argv[1])
+    kmer_len = 6
+    num_procs = multiprocessing.cpu_count()
+    output_dir = tempfile.mkdtemp()
+    try:
+        fasta_fname = os.path.join(output_dir, "seqs.fa")
+        num_bases = bench_kmer_count.make_random_fasta(fasta_fname, num_bases,
+                                                       seq_len=200)
+        print "Counting %d-mers in shuffles of %d bases (%d processors).." \
+              %(kmer_len, num_bases, num_procs)
+        for num_shuffles in [10, 100, 1000]:
+            secs, peak_rss, file_counts = \
+                bench_utils.measure(count_shuffled_files, fasta_fname,
+                                    kmer_len, num_shuffles, output_dir)
+            bench_utils.print_results("%d shuffles, files" %(num_shuffles),
+                                      secs, peak_rss,
+                                      num_items=num_shuffles,
+                                      items_label="shuffles")
+            for procs in sorted(set([1, num_procs])):
+                secs, peak_rss, shuffled_counts = \
+                    bench_utils.measure(kmer_utils.count_shuffled_kmers,
+                                        fasta_fname, kmer_len, num_shuffles,
+                                        num_procs=procs)
+                bench_utils.print_results("%d shuffles, in process (%d)" \
+                                          %(num_shuffles, procs),
+                                          secs, peak_rss,
+                                          num_items=num_shuffles,
+                                          items_label="shuffles")
+            # Shuffles differ, but keep the number of kmers
+            if not np.array_equal(file_counts.sum(axis=1),
+                                  shuffled_counts.sum(axis=1)):
+                print "Warning: numbers of kmers in shuffles differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
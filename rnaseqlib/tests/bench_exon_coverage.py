@@ -0,0 +1,125 @@
+##
+## Benchmark of exons coverage: per-base dictionaries of
+## counts for each exon versus the flat coverage array of
+## ExonsCoverage with vectorized statistics
+##
+## Usage: python -m rnaseqlib.tests.bench_exon_coverage [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.tests.test_rpkm as test_rpkm
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.bam.bam_parallel as bam_parallel
+
+
+def make_inputs(bam_fname, output_dir, num_reads, num_exons):
+    """
+    Make synthetic BAM and constitutive exons.
+    """
+    test_utils.make_synthetic_bam(bam_fname, num_reads)
+    regions = \
+        test_utils.make_synthetic_regions(num_exons,
+                                          chroms=test_utils.SYNTHETIC_CHROMS[:2],
+                                          max_len=1000)
+    const_exons = test_rpkm.make_const_exons(output_dir, "ensGene", regions)
+    return const_exons.gff_filename
+
+
+def get_read_exons(bam_fname, exons_index):
+    """
+    Yield each read with the exons that contain it.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    for shard in bam_parallel.get_bam_shards(bam_fname):
+        chrom = shard[0]
+        for bam_read in bam_parallel.fetch_shard_reads(bam_file, shard):
+            if bam_read.is_unmapped:
+                continue
+            matches = exons_index.find(chrom, bam_read.pos, bam_read.aend,
+                                       contained=True)
+            if len(matches) == 0:
+                continue
+            yield bam_read, ["%s:%d-%d:%s" %(chrom, start + 1, end, strand) \
+                             for start, end, label, name, strand in matches]
+    bam_file.close()
+
+
+def per_base_coverage(bam_fname, gff_fname):
+    """
+    Compute exons coverage statistics as done prior to the
+    coverage array, with a dictionary of per-base counts for
+    each exon and statistics computed one exon at a time.
+    """
+    exons_index = rpkm_utils.load_gff_regions_index(gff_fname)
+    exons_to_start_pos_counts = {}
+    for bam_read, exons in get_read_exons(bam_fname, exons_index):
+        blocks = coverage_utils.get_cigar_blocks(bam_read)
+        for exon in exons:
+            if exon not in exons_to_start_pos_counts:
+                exons_to_start_pos_counts[exon] = \
+                    coverage_utils.init_region_start_pos(exon)
+            exon_counts = exons_to_start_pos_counts[exon]
+            for block_start, block_end in blocks:
+                for pos in range(block_start, block_end):
+                    if pos in exon_counts:
+                        exon_counts[pos] += 1
+    exon_stats = {}
+    for exon in exons_to_start_pos_counts:
+        counts = exons_to_start_pos_counts[exon].values()
+        exon_stats[exon] = (np.mean(counts), np.std(counts))
+    return exon_stats
+
+
+def array_coverage(bam_fname, gff_fname):
+    exons_index = rpkm_utils.load_gff_regions_index(gff_fname)
+    exons_coverage = coverage_utils.ExonsCoverage()
+    for bam_read, exons in get_read_exons(bam_fname, exons_index):
+        exons_coverage.add_read(bam_read, exons)
+    stats = exons_coverage.get_stats()
+    return dict([(exon, (stats[exon]["mean"], stats[exon]["std"])) \
+                 for exon in stats])
+
+
+def main():
+    num_reads = 1000000
+    num_exons = 20000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "synthetic.sorted.bam")
+        print "Generating synthetic BAM with %d reads and %d exons.." \
+            %(num_reads, num_exons)
+        secs, peak_rss, gff_fname = \
+            bench_utils.measure(make_inputs, bam_fname, output_dir,
+                                num_reads, num_exons)
+        secs, peak_rss, per_base_stats = \
+            bench_utils.measure(per_base_coverage, bam_fname, gff_fname)
+        bench_utils.print_results("per-base dictionaries", secs, peak_rss,
+                                  num_items=num_reads)
+        secs, peak_rss, array_stats = \
+            bench_utils.measure(array_coverage, bam_fname, gff_fname)
+        bench_utils.print_results("coverage array", secs, peak_rss,
+                                  num_items=num_reads)
+        if sorted(per_base_stats.keys()) != sorted(array_stats.keys()) or \
+           not all([np.allclose(per_base_stats[e], array_stats[e]) \
+                    for e in per_base_stats]):
+            print "Warning: coverage statistics differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
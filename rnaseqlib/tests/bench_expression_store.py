@@ -0,0 +1,123 @@
+##
+## Benchmark of loading multi-sample expression tables:
+## reading every per-sample RPKM table and stacking them into
+## a pandas Panel, versus reading the columnar expression store
+##
+## Usage: python -m rnaseqlib.tests.bench_expression_store [num_samples]
+##
+import os
+import sys
+import time
+import glob
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.rpkm.ExpressionStore as expression_store
+import rnaseqlib.rpkm.ExpressionTable as expression_table
+
+
+def make_rpkm_files(output_dir, num_samples, num_genes):
+    """
+    Write per-sample RPKM tables in the format output by
+    'rpkm_utils.write_rpkm_tables'.
+    """
+    gene_ids = ["ENSG%011d" %(n) for n in range(num_genes)]
+    exons = ["chr1:%d-%d:+" %(n * 1000 + 1, n * 1000 + 200) \
+             for n in range(num_genes)]
+    rand = np.random.RandomState(1)
+    for sample_num in range(num_samples):
+        counts = rand.poisson(50, size=num_genes)
+        rpkms = counts / 0.2 / 10.
+        rpkm_fname = os.path.join(output_dir, "sample%d.rpkm" %(sample_num))
+        with open(rpkm_fname, "w") as rpkm_file:
+            rpkm_file.write("gene_id\trpkm\tcounts\texons\n")
+            rpkm_file.write("".join(["%s\t%s\t%d\t%s\n" \
+                                     %(gene_id, repr(rpkm), count, exon) \
+                                     for gene_id, rpkm, count, exon \
+                                     in zip(gene_ids, rpkms, counts, exons)]))
+
+
+def get_rpkm_fnames(output_dir):
+    return sorted(glob.glob(os.path.join(output_dir, "*.rpkm")),
+                  key=lambda f: int(os.path.basename(f)[6:-5]))
+
+
+def load_panel(output_dir):
+    """
+    Load per-sample RPKM tables into a Panel, as done by
+    'ExpressionTable.load_counts_dir'.
+    """
+    counts = {}
+    for rpkm_fname in get_rpkm_fnames(output_dir):
+        sample = os.path.basename(rpkm_fname).split(".")[0]
+        counts[sample] = pandas.read_csv(rpkm_fname, sep="\t")
+        counts[sample] = counts[sample].set_index("gene_id")
+    counts_panel = pandas.Panel(counts)
+    rpkms = counts_panel.minor_xs("rpkm")
+    return rpkms.shape
+
+
+def build_store(output_dir, store_dir):
+    for rpkm_fname in get_rpkm_fnames(output_dir):
+        sample = os.path.basename(rpkm_fname).split(".")[0]
+        rpkm_utils.add_sample_to_rpkm_store(store_dir, sample, rpkm_fname)
+
+
+def load_store(store_dir):
+    expr_table = expression_table.ExpressionTable(from_store=store_dir)
+    return expr_table.data.shape
+
+
+def load_store_column(store_dir, sample):
+    store = expression_store.ExpressionStore(store_dir)
+    return store.get_column("counts", sample).sum()
+
+
+def main():
+    num_samples = 500
+    num_genes = 60000
+    if len(sys.argv) > 1:
+        num_samples = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        store_dir = os.path.join(output_dir, "ensGene.store")
+        print "Generating %d RPKM tables with %d genes.." \
+            %(num_samples, num_genes)
+        bench_utils.measure(make_rpkm_files, output_dir, num_samples,
+                            num_genes)
+        secs, peak_rss, panel_shape = \
+            bench_utils.measure(load_panel, output_dir)
+        bench_utils.print_results("per-sample tables into Panel", secs,
+                                  peak_rss, num_items=num_samples,
+                                  items_label="samples")
+        secs, peak_rss, result = \
+            bench_utils.measure(build_store, output_dir, store_dir)
+        bench_utils.print_results("appending samples to store", secs,
+                                  peak_rss, num_items=num_samples,
+                                  items_label="samples")
+        secs, peak_rss, store_shape = \
+            bench_utils.measure(load_store, store_dir)
+        bench_utils.print_results("all RPKMs from store", secs, peak_rss,
+                                  num_items=num_samples,
+                                  items_label="samples")
+        secs, peak_rss, result = \
+            bench_utils.measure(load_store_column, store_dir,
+                                "sample%d" %(num_samples / 2))
+        bench_utils.print_results("one sample's counts from store", secs,
+                                  peak_rss)
+        # Store table has an additional gene ID column
+        if (panel_shape is not None) and \
+           (panel_shape != (store_shape[0], store_shape[1] - 1)):
+            print "Warning: table shapes differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
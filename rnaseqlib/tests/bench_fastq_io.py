@@ -0,0 +1,113 @@
+##
+## Benchmark of FASTQ reading and writing: record at a time
+## generator versus batched parsing with a helper thread
+##
+## Usage: python -m rnaseqlib.tests.bench_fastq_io [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from itertools import ifilter, islice
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.fastq_utils as fastq_utils
+
+
+def iter_fastq_serially(fastq_fname):
+    """
+    Parse FASTQ file four lines at a time, as done by
+    'read_fastq' prior to batched parsing.
+    """
+    fastqfile = fastq_utils.read_open_fastq(fastq_fname)
+    fastqiter = (l.strip('\n') for l in fastqfile)
+    fastqiter = ifilter(lambda l: l, fastqiter)
+    while True:
+        fqlines = list(islice(fastqiter, 4))
+        if len(fqlines) != 4:
+            break
+        header1, seq, header2, qual = fqlines
+        if not ((header1.startswith('@') or ("@" in header1)) and \
+                header2.startswith('+')):
+            raise ValueError("Invalid header lines in FASTQ")
+        yield header1[1:], seq, header2, qual
+
+
+def read_fastq_serially(fastq_fname):
+    num_records = 0
+    for record in iter_fastq_serially(fastq_fname):
+        num_records += 1
+    return num_records
+
+
+def read_fastq_chunks(fastq_fname, use_gzip_binary=True):
+    num_records = 0
+    for records in \
+        fastq_utils.read_fastq_chunks(fastq_fname,
+                                      use_gzip_binary=use_gzip_binary):
+        num_records += len(records)
+    return num_records
+
+
+def copy_fastq_serially(fastq_fname, output_fname):
+    output_file = fastq_utils.write_open_fastq(output_fname)
+    for record in iter_fastq_serially(fastq_fname):
+        fastq_utils.write_fastq(output_file, record)
+    output_file.close()
+
+
+def copy_fastq_chunks(fastq_fname, output_fname):
+    with fastq_utils.FastqWriter(output_fname) as writer:
+        for records in fastq_utils.read_fastq_chunks(fastq_fname):
+            writer.write_records(records)
+
+
+def main():
+    num_reads = 2000000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        for ext in ["fastq", "fastq.gz"]:
+            fastq_fname = os.path.join(output_dir, "synthetic.%s" %(ext))
+            print "Generating synthetic %s with %d reads.." %(ext, num_reads)
+            bench_utils.measure(test_utils.make_synthetic_fastq,
+                                fastq_fname, num_reads, read_len=50)
+            secs, peak_rss, num_serial = \
+                bench_utils.measure(read_fastq_serially, fastq_fname)
+            bench_utils.print_results("%s: read serially" %(ext),
+                                      secs, peak_rss, num_items=num_reads)
+            secs, peak_rss, num_batched = \
+                bench_utils.measure(read_fastq_chunks, fastq_fname)
+            bench_utils.print_results("%s: read in batches" %(ext),
+                                      secs, peak_rss, num_items=num_reads)
+            if ext.endswith(".gz"):
+                secs, peak_rss, num_batched = \
+                    bench_utils.measure(read_fastq_chunks, fastq_fname,
+                                        use_gzip_binary=False)
+                bench_utils.print_results("%s: batches, gzip module" %(ext),
+                                          secs, peak_rss,
+                                          num_items=num_reads)
+            if num_serial != num_batched:
+                print "Warning: number of records differs."
+            output_fname = os.path.join(output_dir, "copy.%s" %(ext))
+            secs, peak_rss, result = \
+                bench_utils.measure(copy_fastq_serially, fastq_fname,
+                                    output_fname)
+            bench_utils.print_results("%s: copy serially" %(ext),
+                                      secs, peak_rss, num_items=num_reads)
+            secs, peak_rss, result = \
+                bench_utils.measure(copy_fastq_chunks, fastq_fname,
+                                    output_fname)
+            bench_utils.print_results("%s: copy in batches" %(ext),
+                                      secs, peak_rss, num_items=num_reads)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+##
+## Benchmark of interval index queries with exon-sized intervals
+## and a long interval (e.g. a long intron): binning intervals by
+## length versus walking back over a running maximum of ends
+##
+## Usage: python -m rnaseqlib.tests.bench_interval_index [num_intervals]
+##
+import os
+import sys
+import time
+import bisect
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.mapping.IntervalIndex as interval_index
+
+
+def make_intervals(num_intervals, seed=1):
+    """
+    Return intervals of 50 to 500 bases on one chromosome, with
+    one interval spanning the chromosome.
+    """
+    rand = np.random.RandomState(seed)
+    chrom_len = num_intervals * 500
+    starts = np.sort(rand.randint(0, chrom_len, size=num_intervals))
+    ends = starts + rand.randint(50, 500, size=num_intervals)
+    intervals = zip(starts.tolist(), ends.tolist())
+    intervals.append((0, chrom_len + 500))
+    return intervals, chrom_len
+
+
+def find_by_max_ends(intervals, queries):
+    """
+    Find intervals containing each query by walking back over
+    intervals sorted by start until the running maximum of their
+    ends is before the query end, as done prior to length bins.
+    """
+    intervals = sorted(intervals)
+    starts = [start for start, end in intervals]
+    ends = [end for start, end in intervals]
+    max_ends = np.maximum.accumulate(ends).tolist()
+    num_matches = 0
+    for start, end in queries:
+        n = bisect.bisect_right(starts, start) - 1
+        while (n >= 0) and (max_ends[n] >= end):
+            if ends[n] >= end:
+                num_matches += 1
+            n -= 1
+    return num_matches
+
+
+def build_index(intervals):
+    index = interval_index.IntervalIndex()
+    for start, end in intervals:
+        index.add_interval("chr1", start, end, label="exons")
+    return index.build()
+
+
+def find_indexed(index, queries):
+    num_matches = 0
+    for start, end in queries:
+        num_matches += len(index.find("chr1", start, end))
+    return num_matches
+
+
+def main():
+    num_intervals = 200000
+    if len(sys.argv) > 1:
+        num_intervals = int(sys.argv[1])
+    intervals, chrom_len = make_intervals(num_intervals)
+    rand = np.random.RandomState(2)
+    query_starts = rand.randint(0, chrom_len, size=2000)
+    queries = zip(query_starts.tolist(), (query_starts + 50).tolist())
+    print "Finding %d reads in %d intervals (one of them long).." \
+          %(len(queries), len(intervals))
+    secs, peak_rss, index = bench_utils.measure(build_index, intervals)
+    bench_utils.print_results("length bins, build", secs, peak_rss,
+                              num_items=len(intervals),
+                              items_label="intervals")
+    secs, peak_rss, indexed_matches = \
+        bench_utils.measure(find_indexed, index, queries)
+    bench_utils.print_results("length bins, queries", secs, peak_rss,
+                              num_items=len(queries))
+    secs, peak_rss, max_ends_matches = \
+        bench_utils.measure(find_by_max_ends, intervals, queries)
+    bench_utils.print_results("running max of ends, queries", secs, peak_rss,
+                              num_items=len(queries))
+    if indexed_matches != max_ends_matches:
+        print "Warning: numbers of matches differ."
+
+
+if __name__ == "__main__":
+    main()
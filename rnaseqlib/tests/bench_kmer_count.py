@@ -0,0 +1,87 @@
+##
+## Benchmark of kmer counting: in process with integer kmer
+## codes versus jellyfish (if available on the path) and
+## versus counting one kmer at a time
+##
+## Usage: python -m rnaseqlib.tests.bench_kmer_count [num_bases]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+
+def make_random_fasta(fasta_fname, num_bases, seq_len=500, seed=1):
+    """
+    Write FASTA file of random sequences of 'seq_len' bases
+    with about 'num_bases' bases in total.
+    """
+    rand = np.random.RandomState(seed)
+    letters = np.frombuffer("ACGT", dtype=np.uint8)
+    num_seqs = max(1, num_bases / seq_len)
+    with open(fasta_fname, "w") as fasta_out:
+        for seq_num in xrange(num_seqs):
+            seq = letters[rand.randint(0, 4, size=seq_len)].tostring()
+            fasta_out.write(">seq%d\n%s\n" %(seq_num, seq))
+    return num_seqs * seq_len
+
+
+def count_kmers(kmer_len, fasta_fname, output_dir, method):
+    kmers = kmer_utils.Kmers(kmer_len, fasta_fname=fasta_fname)
+    return kmers.count_kmers(fasta_fname, output_dir, method=method)
+
+
+def main():
+    num_bases = 20000000
+    if len(sys.argv) > 1:
+        num_bases = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        fasta_fname = os.path.join(output_dir, "seqs.fa")
+        print "Generating synthetic FASTA with %d bases.." %(num_bases)
+        num_bases = make_random_fasta(fasta_fname, num_bases)
+        methods = ["numpy", "naive"]
+        if utils.which("jellyfish") is not None:
+            methods.append("jf")
+        else:
+            print "jellyfish not found, skipping it."
+        for kmer_len in [6, 12, 16]:
+            all_counts = []
+            for method in methods:
+                # Counting one kmer at a time is only run on
+                # part of the sequences
+                method_fname = fasta_fname
+                method_bases = num_bases
+                if method == "naive":
+                    method_fname = os.path.join(output_dir, "part.fa")
+                    method_bases = \
+                        make_random_fasta(method_fname, num_bases / 10)
+                secs, peak_rss, kmer_counts = \
+                    bench_utils.measure(count_kmers, kmer_len, method_fname,
+                                        output_dir, method)
+                bench_utils.print_results("%d-mers, %s" %(kmer_len, method),
+                                          secs, peak_rss,
+                                          num_items=method_bases,
+                                          items_label="bases")
+                if method != "naive":
+                    all_counts.append(kmer_counts)
+            if len(all_counts) > 1:
+                kmer_codes, counts = all_counts[0].get_nonzero()
+                other_codes, other_counts = all_counts[1].get_nonzero()
+                if not (np.array_equal(kmer_codes, other_codes) and \
+                        np.array_equal(counts, other_counts)):
+                    print "Warning: kmer counts differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+##
+## Benchmark of scoring enriched kmers in regions: all regions
+## at once versus counting and scoring one region at a time
+##
+## Usage: python -m rnaseqlib.tests.bench_kmer_scoring [num_regions]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+import rnaseqlib.bindnseq.BindnSeq as bindnseq
+import rnaseqlib.bindnseq.KmerScorer as kmer_scorer
+
+
+def make_regions(num_regions, seed=1):
+    """
+    Return FASTA records of random regions of 50 to 1000 bases.
+    """
+    rand = np.random.RandomState(seed)
+    letters = np.frombuffer("ACGT", dtype=np.uint8)
+    fasta_recs = []
+    for region_num in xrange(num_regions):
+        seq_len = rand.randint(50, 1000)
+        seq = letters[rand.randint(0, 4, size=seq_len)].tostring()
+        start = rand.randint(1, 10000000)
+        header = ">chr1:%d-%d:%s;region%d" \
+                 %(start, start + seq_len - 1, "+-"[region_num % 2],
+                   region_num)
+        fasta_recs.append((header, seq))
+    return fasta_recs
+
+
+def score_by_region(fasta_recs, kmers, fc_rank, kmer_len):
+    """
+    Count kmers in each region in turn and compute weighted
+    densities row by row, as done prior to 'KmerScorer'.
+    """
+    entries = []
+    for header, seq in fasta_recs:
+        counts = []
+        for kmer in kmers:
+            count = 0
+            start = seq.find(kmer)
+            while start != -1:
+                count += 1
+                start = seq.find(kmer, start + 1)
+            counts.append(count)
+        entries.append([header[1:], ",".join(map(str, counts)), len(seq)])
+    densities_df = pandas.DataFrame(entries,
+                                    columns=["header", "obs_counts",
+                                             "seq_len"]).set_index("header")
+    fc_rank = np.array(fc_rank)
+    weighted_densities = []
+    for row_num, row in densities_df.iterrows():
+        obs_counts = np.array(map(int, row["obs_counts"].split(",")))
+        obs_counts[fc_rank < bindnseq.FC_FILTER] = 0
+        len_denom = (float(row["seq_len"]) - kmer_len + 1) / 1000.0
+        weighted_densities.append(max(np.sum(obs_counts / len_denom),
+                                      2**(-8)))
+    densities_df["log2_weighted_density"] = np.log2(weighted_densities)
+    return densities_df
+
+
+def score_all_regions(fasta_recs, kmers, fc_rank, kmer_len, bed_fname):
+    scorer = kmer_scorer.KmerScorer(fasta_recs)
+    counts = scorer.count_kmers(kmers)
+    densities_df = scorer.get_densities_df(kmers, counts=counts)
+    weighted_densities, max_kmer_fcs = \
+        kmer_scorer.get_rank_weighted_densities(counts, scorer.seq_lens,
+                                                fc_rank, kmer_len,
+                                                bindnseq.FC_FILTER)
+    densities_df["log2_weighted_density"] = np.log2(weighted_densities)
+    with open(bed_fname, "w") as bed_out:
+        scorer.write_bed_occurrences(bed_out, kmers,
+                                     np.zeros(len(kmers), dtype=int))
+    return densities_df
+
+
+def main():
+    num_regions = 100000
+    if len(sys.argv) > 1:
+        num_regions = int(sys.argv[1])
+    kmer_len = 6
+    # Top 2% of kmers, as selected by 'get_fc_cutoff'
+    rand = np.random.RandomState(2)
+    all_kmers = kmer_utils.enumerate_kmers(kmer_len)
+    kmers = list(rand.choice(all_kmers, len(all_kmers) / 50, replace=False))
+    fc_rank = rand.uniform(1, 4, size=len(kmers))
+    fasta_recs = make_regions(num_regions)
+    num_bases = sum(len(seq) for header, seq in fasta_recs)
+    print "Scoring %d %d-mers in %d regions (%d bases).." \
+          %(len(kmers), kmer_len, num_regions, num_bases)
+    output_dir = tempfile.mkdtemp()
+    try:
+        # Scoring one region at a time is only run on part
+        # of the regions
+        part_recs = fasta_recs[0:max(1, num_regions / 10)]
+        secs, peak_rss, by_region_df = \
+            bench_utils.measure(score_by_region, part_recs, kmers, fc_rank,
+                                kmer_len)
+        bench_utils.print_results("one region at a time", secs, peak_rss,
+                                  num_items=len(part_recs),
+                                  items_label="regions")
+        bed_fname = os.path.join(output_dir, "kmers.bed")
+        secs, peak_rss, densities_df = \
+            bench_utils.measure(score_all_regions, fasta_recs, kmers,
+                                fc_rank, kmer_len, bed_fname)
+        bench_utils.print_results("all regions, with BED", secs, peak_rss,
+                                  num_items=num_regions,
+                                  items_label="regions")
+        part_densities = \
+            densities_df["log2_weighted_density"].values[0:len(part_recs)]
+        if not np.allclose(by_region_df["log2_weighted_density"].values,
+                           part_densities):
+            print "Warning: weighted densities differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
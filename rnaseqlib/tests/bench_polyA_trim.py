@@ -0,0 +1,99 @@
+##
+## Benchmark of polyA trimming: one read at a time versus
+## batches of reads as byte matrices
+##
+## Usage: python -m rnaseqlib.tests.bench_polyA_trim [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.ribo.ribo_utils as ribo_utils
+
+
+def trim_serially(fastq_fname, output_fname,
+                  min_polyA_len=3,
+                  min_read_len=22):
+    """
+    Trim polyA ends one read at a time, writing one record at
+    a time, as done prior to batch trimming. Returns the
+    trimmed read lengths.
+    """
+    trimmed_lens = []
+    output_file = fastq_utils.write_open_fastq(output_fname)
+    for header, seq, header2, qual in fastq_utils.read_fastq(fastq_fname):
+        if seq.endswith("A"):
+            if seq[-min_polyA_len:] != ("A" * min_polyA_len):
+                continue
+            stripped_seq = ribo_utils.rstrip_stretch(seq, "A")
+            if len(stripped_seq) < min_read_len:
+                continue
+            new_qual = qual[0:len(stripped_seq)]
+            fastq_utils.write_fastq(output_file,
+                                    (header, stripped_seq, header2, new_qual))
+            trimmed_lens.append(len(stripped_seq))
+    output_file.close()
+    return np.array(trimmed_lens)
+
+
+def trim_batches(fastq_fname, output_fname,
+                 min_polyA_len=3,
+                 min_read_len=22):
+    trimmed_lens = []
+    with fastq_utils.FastqWriter(output_fname) as writer:
+        for records in fastq_utils.read_fastq_chunks(fastq_fname):
+            trimmed_records, batch_lens = \
+                ribo_utils.trim_polyA_records(records,
+                                              min_polyA_len=min_polyA_len,
+                                              min_read_len=min_read_len)
+            writer.write_records(trimmed_records)
+            trimmed_lens.append(batch_lens)
+    return np.concatenate(trimmed_lens)
+
+
+def main():
+    num_reads = 2000000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        fastq_fname = os.path.join(output_dir, "synthetic.fastq")
+        print "Generating synthetic FASTQ with %d reads with polyA " \
+              "tails.." %(num_reads)
+        secs, peak_rss, polyA_lens = \
+            bench_utils.measure(test_utils.make_polyA_fastq,
+                                fastq_fname, num_reads, read_len=50,
+                                max_polyA_len=30)
+        # Reads with known tails that should be kept
+        expected_lens = 50 - polyA_lens
+        expected_lens = expected_lens[(polyA_lens >= 3) & \
+                                      (expected_lens >= 22)]
+        serial_fname = os.path.join(output_dir, "serial.fastq")
+        secs, peak_rss, serial_lens = \
+            bench_utils.measure(trim_serially, fastq_fname, serial_fname)
+        bench_utils.print_results("per-read trimming", secs, peak_rss,
+                                  num_items=num_reads)
+        batch_fname = os.path.join(output_dir, "batches.fastq")
+        secs, peak_rss, batch_lens = \
+            bench_utils.measure(trim_batches, fastq_fname, batch_fname)
+        bench_utils.print_results("batch trimming", secs, peak_rss,
+                                  num_items=num_reads)
+        if not (np.array_equal(serial_lens, expected_lens) and \
+                np.array_equal(batch_lens, expected_lens)):
+            print "Warning: trimmed lengths differ from known tails."
+        if open(serial_fname).read() != open(batch_fname).read():
+            print "Warning: trimmed reads differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
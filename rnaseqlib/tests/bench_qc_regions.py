@@ -0,0 +1,103 @@
+##
+## Benchmark of counting reads in QC regions: parsing the BAM
+## produced by tagBam versus classifying reads against an
+## interval index of the regions
+##
+## The time taken by tagBam itself is not included in the
+## tagBam timing, which only covers parsing of its output.
+##
+## Usage: python -m rnaseqlib.tests.bench_qc_regions [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.tests.test_interval_index as test_interval_index
+import rnaseqlib.QualityControl as qc
+
+
+def make_inputs(bam_fname, tagged_bam_fname, output_dir,
+                num_reads, num_regions):
+    """
+    Make synthetic BAM, QC regions BED files and BAM tagged
+    with the QC regions that contain each read.
+    """
+    test_utils.make_synthetic_bam(bam_fname, num_reads)
+    # Regions on the genome's chromosomes but not on chrRibo
+    regions = \
+        test_utils.make_synthetic_regions(num_regions,
+                                          chroms=test_utils.SYNTHETIC_CHROMS[:2],
+                                          max_len=5000)
+    region_filenames = []
+    for label in test_interval_index.QC_REGION_LABELS:
+        bed_fname = os.path.join(output_dir, "%s.bed" %(label))
+        with open(bed_fname, "w") as bed_file:
+            for region in regions:
+                if test_interval_index.get_region_label(region) != label:
+                    continue
+                bed_file.write("%s\t%d\t%d\t%s\t.\t%s\n" \
+                               %(region[0], region[1], region[2],
+                                 test_interval_index.get_region_transcripts(region),
+                                 region[3]))
+        region_filenames.append(bed_fname)
+    test_utils.make_synthetic_tagged_bam(bam_fname, tagged_bam_fname, regions,
+                                         test_interval_index.format_qc_tag,
+                                         contained=True)
+    return region_filenames
+
+
+def count_tagged(tagged_bam_fname):
+    region_counts, by_transcript = qc.count_qc_regions(tagged_bam_fname)
+    return dict(region_counts)
+
+
+def count_indexed(bam_fname, region_filenames, num_processors=1):
+    regions_index = \
+        qc.load_qc_regions_index(region_filenames,
+                                 test_interval_index.QC_REGION_LABELS)
+    region_counts, by_transcript = \
+        qc.count_qc_regions_in_bam(bam_fname, regions_index,
+                                   num_processors=num_processors)
+    return dict(region_counts)
+
+
+def main():
+    num_reads = 1000000
+    num_regions = 50000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "synthetic.sorted.bam")
+        tagged_bam_fname = os.path.join(output_dir, "qc_regions.bam")
+        print "Generating synthetic BAM with %d reads and %d regions.." \
+            %(num_reads, num_regions)
+        secs, peak_rss, region_filenames = \
+            bench_utils.measure(make_inputs, bam_fname, tagged_bam_fname,
+                                output_dir, num_reads, num_regions)
+        secs, peak_rss, tagged_counts = \
+            bench_utils.measure(count_tagged, tagged_bam_fname)
+        bench_utils.print_results("tagBam output parsing", secs, peak_rss,
+                                  num_items=num_reads)
+        for num_processors in [1, 4]:
+            secs, peak_rss, indexed_counts = \
+                bench_utils.measure(count_indexed, bam_fname,
+                                    region_filenames,
+                                    num_processors=num_processors)
+            bench_utils.print_results("interval index (%d procs)" \
+                                      %(num_processors),
+                                      secs, peak_rss,
+                                      num_items=num_reads)
+            if indexed_counts != tagged_counts:
+                print "Warning: counts differ from tagBam output counts."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
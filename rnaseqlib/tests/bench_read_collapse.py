@@ -0,0 +1,122 @@
+##
+## Benchmark of collapsing duplicate reads: counting reads one
+## record at a time (no output) versus collapsing reads read as
+## columns to FASTQ and a counts table, in memory and with runs
+## spilled to disk
+##
+## Usage: python -m rnaseqlib.tests.bench_read_collapse [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.clip.ReadCollapser as read_collapser
+
+
+def make_duplicated_fastq(fastq_fname, num_reads,
+                          num_distinct=1000000,
+                          batch_size=100000,
+                          seed=1):
+    """
+    Write FASTQ file of CLIP-like reads (15 to 40 bases long)
+    drawn with a heavy-tailed distribution from 'num_distinct'
+    sequences, so that a few sequences have many reads.
+    """
+    rand = np.random.RandomState(seed)
+    bases = np.array([ord(b) for b in "ACGT"], dtype=np.uint8)
+    max_len = 40
+    pool = bases[rand.randint(0, 4, size=(num_distinct, max_len))]
+    pool_lens = rand.randint(15, max_len + 1, size=num_distinct)
+    with fastq_utils.FastqWriter(fastq_fname) as writer:
+        for batch_start in xrange(0, num_reads, batch_size):
+            num_batch = min(batch_size, num_reads - batch_start)
+            inds = np.minimum(rand.zipf(1.3, size=num_batch) - 1,
+                              num_distinct - 1)
+            seqs_str = pool[inds].tostring()
+            lens = pool_lens[inds].tolist()
+            quals_str = (33 + rand.randint(2, 42, size=(num_batch, max_len)))
+            quals_str = quals_str.astype(np.uint8).tostring()
+            records = []
+            for n in xrange(num_batch):
+                start = n * max_len
+                end = start + lens[n]
+                records.append(("read%d" %(batch_start + n),
+                                seqs_str[start:end], "+",
+                                quals_str[start:end]))
+            writer.write_records(records)
+
+
+def collapse_serially(fastq_fname):
+    """
+    Count reads of each sequence one record at a time, without
+    writing any output.
+    """
+    counts = {}
+    for header, seq, header2, qual in fastq_utils.read_fastq(fastq_fname):
+        if seq in counts:
+            counts[seq] += 1
+        else:
+            counts[seq] = 1
+    return len(counts)
+
+
+def collapse_reads(fastq_fname, output_dir, max_seqs):
+    """
+    Collapse reads holding at most 'max_seqs' distinct sequences
+    in memory. Return the number of distinct sequences and the
+    number of runs spilled to disk.
+    """
+    collapser = read_collapser.ReadCollapser(output_dir, max_seqs=max_seqs)
+    collapser.add_fastq(fastq_fname)
+    num_runs = len(collapser.run_fnames)
+    stats = collapser.output_collapsed(os.path.join(output_dir,
+                                                    "collapsed.fastq.gz"),
+                                       os.path.join(output_dir,
+                                                    "counts.txt"))
+    return stats["num_seqs"], num_runs
+
+
+def main():
+    num_reads = 50000000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        fastq_fname = os.path.join(output_dir, "reads.fastq.gz")
+        print "Generating synthetic FASTQ with %d reads.." %(num_reads)
+        bench_utils.measure(make_duplicated_fastq, fastq_fname, num_reads)
+        secs, peak_rss, num_serial = \
+            bench_utils.measure(collapse_serially, fastq_fname)
+        bench_utils.print_results("count per record, no output", secs, peak_rss,
+                                  num_items=num_reads)
+        print "  %d distinct sequences" %(num_serial)
+        secs, peak_rss, (num_batched, num_runs) = \
+            bench_utils.measure(collapse_reads, fastq_fname, output_dir,
+                                10**8)
+        bench_utils.print_results("collapse in memory", secs, peak_rss,
+                                  num_items=num_reads)
+        # Hold an eighth of the distinct sequences: sequences
+        # keep appearing throughout the file, so more than 8
+        # runs are spilled
+        max_seqs = max(1, num_serial / 8)
+        secs, peak_rss, (num_spilled, num_runs) = \
+            bench_utils.measure(collapse_reads, fastq_fname, output_dir,
+                                max_seqs)
+        bench_utils.print_results("collapse, spilled", secs, peak_rss,
+                                  num_items=num_reads)
+        print "  %d runs of at most %d sequences" %(num_runs, max_seqs)
+        if not (num_serial == num_batched == num_spilled):
+            print "Warning: number of distinct sequences differs."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+##
+## Benchmark of RPKM computation: counting reads in the BAM
+## produced by tagBam and summing genes one at a time, versus
+## counting reads with an index of the constitutive exons and
+## summing genes with numpy
+##
+## The time taken by tagBam and samtools to write the
+## intermediate BAM is not included in the tagBam timing.
+##
+## Usage: python -m rnaseqlib.tests.bench_rpkm [num_reads]
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.tests.test_rpkm as test_rpkm
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+
+
+def make_inputs(bam_fname, tagged_bam_fname, output_dir,
+                num_reads, num_exons):
+    """
+    Make synthetic BAM, constitutive exons and BAM tagged
+    with the exons that contain each read.
+    """
+    test_utils.make_synthetic_bam(bam_fname, num_reads)
+    regions = \
+        test_utils.make_synthetic_regions(num_exons,
+                                          chroms=test_utils.SYNTHETIC_CHROMS[:2],
+                                          max_len=1000)
+    test_rpkm.make_const_exons(output_dir, "ensGene", regions)
+    test_utils.make_synthetic_tagged_bam(bam_fname, tagged_bam_fname, regions,
+                                         test_rpkm.format_gff_tag,
+                                         contained=True)
+
+
+def rpkms_from_tagged_bam(tagged_bam_fname, output_dir, num_mapped):
+    """
+    Compute RPKMs as done prior to counting with an index of
+    the exons, from the BAM produced by tagBam.
+    """
+    import rnaseqlib.tables as tables
+    const_exons = tables.ConstExons("ensGene", from_dir=output_dir)
+    region_to_count = rpkm_utils.get_gff_region_counts(tagged_bam_fname)
+    rpkms = {}
+    for gene_info in const_exons.genes_to_exons:
+        exons = gene_info["exons"]
+        if exons == "NA":
+            continue
+        parsed_exons = exons.split(",")
+        strandless_exons = []
+        for parsed_exon in parsed_exons:
+            curr_exon = parsed_exon[0:-2]
+            if "." in curr_exon:
+                curr_exon = curr_exon.split(".")[1]
+            strandless_exons.append(curr_exon)
+        sum_counts = sum([region_to_count[e] for e in strandless_exons])
+        sum_lens = sum([const_exons.exon_lens[e] for e in parsed_exons])
+        rpkms[gene_info["gene_id"]] = \
+            rpkm_utils.compute_rpkm(sum_counts, sum_lens, num_mapped)
+    return rpkms
+
+
+def rpkms_from_bam(bam_fname, output_dir, num_mapped):
+    """
+    Compute RPKMs from the BAM using an index of the exons.
+    """
+    import rnaseqlib.tables as tables
+    const_exons = tables.ConstExons("ensGene", from_dir=output_dir)
+    exons_index = rpkm_utils.load_gff_regions_index(const_exons.gff_filename)
+    region_to_count = rpkm_utils.get_gff_region_counts_from_bam(bam_fname,
+                                                                exons_index)
+    rpkm_df = rpkm_utils.compute_gene_rpkms(region_to_count, num_mapped,
+                                            const_exons)
+    return dict(zip(rpkm_df["gene_id"], rpkm_df["rpkm"]))
+
+
+def main():
+    num_reads = 1000000
+    num_exons = 100000
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "synthetic.sorted.bam")
+        tagged_bam_fname = os.path.join(output_dir, "bam2gff.bam")
+        print "Generating synthetic BAM with %d reads and %d exons.." \
+            %(num_reads, num_exons)
+        bench_utils.measure(make_inputs, bam_fname, tagged_bam_fname,
+                            output_dir, num_reads, num_exons)
+        secs, peak_rss, tagged_rpkms = \
+            bench_utils.measure(rpkms_from_tagged_bam, tagged_bam_fname,
+                                output_dir, num_reads)
+        bench_utils.print_results("tagBam output, per gene", secs, peak_rss,
+                                  num_items=num_reads)
+        secs, peak_rss, rpkms = \
+            bench_utils.measure(rpkms_from_bam, bam_fname, output_dir,
+                                num_reads)
+        bench_utils.print_results("exons index, numpy", secs, peak_rss,
+                                  num_items=num_reads)
+        if rpkms != tagged_rpkms:
+            print "Warning: RPKMs differ."
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+##
+## Benchmark of counting many subsequences: in one pass per
+## sequence with kmer codes versus finding each subsequence
+## in each sequence in turn
+##
+## Usage: python -m rnaseqlib.tests.bench_subseq_count [num_bases]
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.bench_utils as bench_utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+
+def make_random_seqs(num_bases, seq_len=1000, seed=1):
+    """
+    Return list of random sequences of 'seq_len' bases
+    with about 'num_bases' bases in total.
+    """
+    rand = np.random.RandomState(seed)
+    letters = np.frombuffer("ACGT", dtype=np.uint8)
+    num_seqs = max(1, num_bases / seq_len)
+    return [letters[rand.randint(0, 4, size=seq_len)].tostring() \
+            for seq_num in xrange(num_seqs)]
+
+
+def count_subseqs_find(seqs, subseqs):
+    """
+    Count overlapping occurrences of each subsequence in each
+    sequence in turn, as done by 'seq_counter.overlap_count'.
+    """
+    counts = np.zeros(len(subseqs), dtype=np.int64)
+    for seq in seqs:
+        for subseq_ind, subseq in enumerate(subseqs):
+            start = seq.find(subseq)
+            while start != -1:
+                counts[subseq_ind] += 1
+                start = seq.find(subseq, start + 1)
+    return counts
+
+
+def count_subseqs_finder(seqs, subseqs):
+    subseq_finder = kmer_utils.SubseqFinder(subseqs)
+    counts = np.zeros(len(subseqs), dtype=np.int64)
+    for seq in seqs:
+        counts += subseq_finder.count(seq)
+    return counts
+
+
+def main():
+    num_bases = 50000000
+    if len(sys.argv) > 1:
+        num_bases = int(sys.argv[1])
+    subseqs = kmer_utils.enumerate_kmers(6)
+    print "Generating %d random bases.." %(num_bases)
+    seqs = make_random_seqs(num_bases)
+    num_bases = sum(len(seq) for seq in seqs)
+    # Finding each subsequence in turn is only run on part
+    # of the sequences
+    part_seqs = seqs[0:max(1, len(seqs) / 1000)]
+    part_bases = sum(len(seq) for seq in part_seqs)
+    print "Counting %d subsequences.." %(len(subseqs))
+    secs, peak_rss, find_counts = \
+        bench_utils.measure(count_subseqs_find, part_seqs, subseqs)
+    bench_utils.print_results("str.find per subsequence", secs, peak_rss,
+                              num_items=part_bases, items_label="bases")
+    secs, peak_rss, part_counts = \
+        bench_utils.measure(count_subseqs_finder, part_seqs, subseqs)
+    if not np.array_equal(find_counts, part_counts):
+        print "Warning: subsequence counts differ."
+    secs, peak_rss, counts = \
+        bench_utils.measure(count_subseqs_finder, seqs, subseqs)
+    bench_utils.print_results("kmer codes, one pass", secs, peak_rss,
+                              num_items=num_bases, items_label="bases")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+##
+## Utilities for benchmarking
+##
+import os
+import sys
+import time
+import Queue
+import resource
+import multiprocessing
+
+
+def _run_measured(func, args, kwargs, results_queue):
+    """
+    Run function and put its running time, peak memory
+    and return value on the queue.
+    """
+    t1 = time.time()
+    result = func(*args, **kwargs)
+    t2 = time.time()
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results_queue.put((t2 - t1, peak_rss / 1024., result))
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run function in a fresh process and return the wall-clock
+    time (in seconds) and the peak RSS (in MB) it took, as well
+    as the function's return value.
+
+    Running in a separate process ensures that the peak memory
+    of one benchmarked function does not carry over to the next.
+
+    If the process dies (e.g. killed for running out of memory),
+    returns None for all values.
+    """
+    results_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_measured,
+                                   args=(func, args, kwargs,
+                                         results_queue))
+    proc.start()
+    while True:
+        try:
+            secs, peak_rss, result = results_queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not proc.is_alive():
+                print "Process running %s exited with code %s" \
+                    %(func.__name__, str(proc.exitcode))
+                return None, None, None
+    proc.join()
+    return secs, peak_rss, result
+
+
+def print_results(label, secs, peak_rss, num_items=None,
+                  items_label="reads"):
+    """
+    Print benchmark results.
+    """
+    if secs is None:
+        print "%-30s failed" %(label)
+        return
+    results_str = "%-30s %8.2f secs  %8.1f MB peak RSS" \
+        %(label, secs, peak_rss)
+    if (num_items is not None) and (secs > 0):
+        results_str += "  %10.0f %s/sec" %(num_items / secs,
+                                          items_label)
+    print results_str
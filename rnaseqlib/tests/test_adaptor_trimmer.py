@@ -0,0 +1,144 @@
+##
+## Unit testing for trimming of adaptors
+##
+import os
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.clip.AdaptorTrimmer as adaptor_trimmer
+
+ADAPTOR_3PRIME = "TGGAATTCTCGGGTGCCAAGG"
+ADAPTOR_5PRIME = "GTTCAGAGTTCTACAGTCCGACGATC"
+
+
+def make_adaptor_reads(num_reads, read_len=40, seed=1):
+    """
+    Return FASTQ records of inserts followed by the 3' adaptor,
+    with a mismatch in some of the adaptors, and the expected
+    trimmed records (with the default trimming parameters.)
+    """
+    rand = np.random.RandomState(seed)
+    records = []
+    expected = []
+    for read_num in xrange(num_reads):
+        insert_len = rand.randint(0, read_len + 1)
+        insert = "".join(rand.choice(list("ACGT"), insert_len))
+        # Inserts must not end with a partial adaptor
+        while insert_len > 0 and insert[-1] == ADAPTOR_3PRIME[0]:
+            insert = insert[0:-1] + "C"
+        adaptor = ADAPTOR_3PRIME
+        # A mismatch is allowed in adaptors with at least 10
+        # aligned bases
+        if (read_num % 3 == 0) and (read_len - insert_len >= 10):
+            adaptor = adaptor[0:5] + "A" + adaptor[6:]
+        seq = (insert + adaptor)[0:read_len]
+        # High qualities, so that no bases are quality trimmed
+        qual = "".join(rand.choice(list("@IJ"), read_len))
+        record = ("read%d" %(read_num), seq, "+", qual)
+        records.append(record)
+        # Partial adaptors shorter than the minimum overlap
+        # are kept
+        if read_len - insert_len < 3:
+            expected.append(record)
+        elif insert_len >= 5:
+            expected.append(("read%d" %(read_num), insert, "+",
+                             qual[0:insert_len]))
+    return records, expected
+
+
+class TestAdaptorTrimmer:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_parse_adaptors(self):
+        adaptors, params = \
+            adaptor_trimmer.parse_adaptors("-a %s\n--front=%s\n-e 0.2\n" \
+                                           "acgtacgt -m 18\n" \
+                                           %(ADAPTOR_3PRIME,
+                                             ADAPTOR_5PRIME))
+        assert (adaptors == [("3prime", ADAPTOR_3PRIME),
+                             ("5prime", ADAPTOR_5PRIME),
+                             ("3prime", "ACGTACGT")])
+        assert (params == {"error_rate": 0.2, "min_read_len": 18})
+
+
+    def test_quality_trim(self):
+        # Qualities 40, 40, 2, 40, 2, 2 with cutoff 3: sums from
+        # the 3' end are 1, 2, -35, so the last two bases are cut
+        quals = np.frombuffer("II#I##", dtype=np.uint8).reshape((1, 6))
+        assert (adaptor_trimmer.get_quality_trim_lens(quals, 3)[0] == 4)
+        quals = np.frombuffer("IIIIII", dtype=np.uint8).reshape((1, 6))
+        assert (adaptor_trimmer.get_quality_trim_lens(quals, 3)[0] == 6)
+        quals = np.frombuffer("######", dtype=np.uint8).reshape((1, 6))
+        assert (adaptor_trimmer.get_quality_trim_lens(quals, 3)[0] == 0)
+
+
+    def test_trim_3prime(self):
+        records, expected = make_adaptor_reads(500)
+        trimmer = adaptor_trimmer.AdaptorTrimmer([("3prime", ADAPTOR_3PRIME)])
+        trimmed_records, stats = trimmer.trim_records(records)
+        assert (trimmed_records == expected)
+        assert (stats["num_reads"] == len(records))
+        assert (stats["num_written"] == len(expected))
+        assert (stats["num_quality_trimmed"] == 0)
+
+
+    def test_trim_5prime(self):
+        trimmer = adaptor_trimmer.AdaptorTrimmer([("5prime", ADAPTOR_5PRIME),
+                                                  ("anywhere",
+                                                   ADAPTOR_3PRIME)],
+                                                 min_read_len=1)
+        insert = "CATCATCATCAT"
+        records = [("r1", ADAPTOR_5PRIME + insert, "+", "I" * 38),
+                   # Suffix of the 5' adaptor starting the read
+                   ("r2", ADAPTOR_5PRIME[-8:] + insert, "+", "I" * 20),
+                   # Adaptor found anywhere: suffix starting the
+                   # read and prefix ending the read
+                   ("r3", ADAPTOR_3PRIME[-6:] + insert, "+", "I" * 18),
+                   ("r4", insert + ADAPTOR_3PRIME[0:6], "+", "I" * 18),
+                   # Too many mismatches
+                   ("r5", "GTACAGTG" + insert, "+", "I" * 20)]
+        trimmed_records, stats = trimmer.trim_records(records)
+        assert ([rec[1] for rec in trimmed_records] == \
+                [insert] * 4 + ["GTACAGTG" + insert])
+        assert (stats["num_with_adaptor"] == 4)
+
+
+    def test_trim_fastq(self):
+        """
+        Test that trimming with several processes matches
+        trimming in one process.
+        """
+        records, expected = make_adaptor_reads(2000)
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq.gz")
+        with fastq_utils.FastqWriter(fastq_fname) as writer:
+            writer.write_records(records)
+        adaptors_fname = os.path.join(self.output_dir, "adaptors.txt")
+        with open(adaptors_fname, "w") as adaptors_file:
+            adaptors_file.write("-a %s\n" %(ADAPTOR_3PRIME))
+        all_stats = []
+        for num_procs in [1, 2]:
+            output_fname = os.path.join(self.output_dir,
+                                        "trimmed%d.fastq.gz" %(num_procs))
+            all_stats.append(adaptor_trimmer.trim_fastq(fastq_fname,
+                                                        adaptors_fname,
+                                                        output_fname,
+                                                        num_procs=num_procs,
+                                                        chunk_size=20000))
+            trimmed_records = list(fastq_utils.read_fastq(output_fname))
+            assert ([rec[1] for rec in trimmed_records] == \
+                    [rec[1] for rec in expected])
+        assert (all_stats[0] == all_stats[1])
+        assert (all_stats[0]["num_written"] == len(expected))
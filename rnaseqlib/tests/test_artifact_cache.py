@@ -0,0 +1,169 @@
+##
+## Unit testing for the artifact cache of pipeline steps
+##
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import multiprocessing
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.ArtifactCache as artifact_cache
+
+
+def write_file(fname, text):
+    with open(fname, "w") as output_file:
+        output_file.write(text)
+
+
+def read_file(fname):
+    with open(fname) as input_file:
+        return input_file.read()
+
+
+class TestArtifactCache:
+    """
+    Test that steps are rerun only when their inputs, settings
+    or outputs change, and after being interrupted.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.manifest_fname = os.path.join(self.output_dir, "manifests",
+                                           "sample.manifest.json")
+        self.input_fname = os.path.join(self.output_dir, "reads.txt")
+        write_file(self.input_fname, "ACGT\nTTTT\n")
+        self.outputs = [os.path.join(self.output_dir, "out", "counts.txt"),
+                        os.path.join(self.output_dir, "out", "lens.txt")]
+        self.num_runs = 0
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def count_reads(self, tmp_outputs):
+        self.num_runs += 1
+        lines = read_file(self.input_fname).split()
+        write_file(tmp_outputs[0], "%d\n" %(len(lines)))
+        write_file(tmp_outputs[1], ",".join([str(len(l)) for l in lines]))
+
+
+    def run_step(self, settings=None):
+        cache = artifact_cache.ArtifactCache(self.manifest_fname)
+        return cache.run_step("count_reads", [self.input_fname],
+                              self.outputs, self.count_reads,
+                              settings=settings)
+
+
+    def test_rerun(self):
+        assert self.run_step()
+        assert (read_file(self.outputs[0]) == "2\n")
+        # Nothing changed
+        assert not self.run_step()
+        # Input touched but with the same contents
+        os.utime(self.input_fname, (1000, 1000))
+        assert not self.run_step()
+        # Input contents changed
+        write_file(self.input_fname, "ACGT\nTTTT\nGG\n")
+        assert self.run_step()
+        assert (read_file(self.outputs[0]) == "3\n")
+        # Settings changed
+        assert self.run_step(settings={"readlen": 40})
+        assert not self.run_step(settings={"readlen": 40})
+        # Output modified after the step
+        write_file(self.outputs[1], "")
+        assert self.run_step(settings={"readlen": 40})
+        assert (read_file(self.outputs[1]) == "4,4,2")
+        assert (self.num_runs == 4)
+
+
+    def test_existing_outputs(self):
+        # Outputs not recorded in the manifest are made again
+        os.makedirs(os.path.dirname(self.outputs[0]))
+        for output_fname in self.outputs:
+            write_file(output_fname, "partial")
+        assert self.run_step()
+        assert (read_file(self.outputs[0]) == "2\n")
+
+
+    def test_killed_step(self):
+        def kill_step(tmp_outputs):
+            write_file(tmp_outputs[0], "partial")
+            os.kill(os.getpid(), signal.SIGKILL)
+        def run_killed_step():
+            cache = artifact_cache.ArtifactCache(self.manifest_fname)
+            cache.run_step("count_reads", [self.input_fname],
+                           self.outputs, kill_step)
+        # Complete the step, then have it killed midway when
+        # it's redone with new inputs
+        assert self.run_step()
+        write_file(self.input_fname, "ACGT\n")
+        proc = multiprocessing.Process(target=run_killed_step)
+        proc.start()
+        proc.join()
+        assert (proc.exitcode == -signal.SIGKILL)
+        # Outputs of the killed step were not moved into place
+        assert (read_file(self.outputs[0]) == "2\n")
+        assert self.run_step()
+        assert (read_file(self.outputs[0]) == "1\n")
+        assert not self.run_step()
+        # Have the step killed while an external tool is writing
+        # its outputs
+        def kill_cmd_step(tmp_outputs):
+            utils.run_cmd("sort %s > %s; kill -9 %d" \
+                          %(self.input_fname, tmp_outputs[0], os.getpid()))
+        def run_killed_cmd_step():
+            cache = artifact_cache.ArtifactCache(self.manifest_fname)
+            cache.run_step("count_reads", [self.input_fname],
+                           self.outputs, kill_cmd_step)
+        write_file(self.input_fname, "TTTT\nACGT\nGG\n")
+        proc = multiprocessing.Process(target=run_killed_cmd_step)
+        proc.start()
+        proc.join()
+        assert (proc.exitcode == -signal.SIGKILL)
+        assert (read_file(self.outputs[0]) == "1\n")
+        assert self.run_step()
+        assert (read_file(self.outputs[0]) == "3\n")
+
+
+    def test_failed_cmd_step(self):
+        def failed_cmd_step(tmp_outputs):
+            for tmp_output in tmp_outputs:
+                utils.run_cmd("sort %s > %s; exit 1" \
+                              %(self.input_fname, tmp_output))
+        cache = artifact_cache.ArtifactCache(self.manifest_fname)
+        try:
+            cache.run_step("count_reads", [self.input_fname],
+                           self.outputs, failed_cmd_step)
+            assert False, "Failed command did not raise."
+        except Exception, e:
+            assert "Command failed" in str(e)
+        # Outputs of the failed tool were not moved into place
+        # and the step is still to be done
+        assert not any([os.path.isfile(f) for f in self.outputs])
+        assert self.run_step()
+
+
+def test_temp_outputs():
+    output_dir = tempfile.mkdtemp()
+    outputs = [os.path.join(output_dir, "reads.fastq.gz"),
+               os.path.join(output_dir, "counts.txt")]
+    # Outputs are renamed into place only if the block completes
+    try:
+        with utils.temp_outputs(outputs) as tmp_outputs:
+            assert tmp_outputs[0].endswith(".gz")
+            for tmp_output in tmp_outputs:
+                write_file(tmp_output, "partial")
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    assert (os.listdir(output_dir) == [])
+    with utils.temp_outputs(outputs) as tmp_outputs:
+        for tmp_output in tmp_outputs:
+            write_file(tmp_output, "done")
+    assert (sorted(os.listdir(output_dir)) == ["counts.txt", "reads.fastq.gz"])
+    assert all([read_file(output) == "done" for output in outputs])
+    shutil.rmtree(output_dir)
@@ -0,0 +1,149 @@
+##
+## Unit testing for parallel processing of BAM files
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from collections import defaultdict
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.bam_parallel as bam_parallel
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.QualityControl as qc
+
+QC_REGION_LABELS = ["merged_exons", "introns", "cds_only.merged_exons",
+                    "3p_utrs", "5p_utrs", "tRNAs"]
+
+
+def format_gff_tag(regions):
+    """
+    Format regions as in BAM produced by tagBam against a GFF.
+    """
+    return ",".join(["gff:%s:%d-%d,exon,.,%s" %(chrom, start, end, strand) \
+                     for chrom, start, end, strand in regions])
+
+
+def format_qc_tag(regions):
+    """
+    Format regions as in BAM produced by tagBam against QC regions.
+    """
+    tag_fields = []
+    for chrom, start, end, strand in regions:
+        label = QC_REGION_LABELS[(start / 7) % len(QC_REGION_LABELS)]
+        tag_fields.append("%s:%s:%d-%d,ENST%d" %(label, chrom, start, end,
+                                                 (start / 11) % 50))
+    return ";".join(tag_fields)
+
+
+def count_reads_in_shard(bam_fname, shard):
+    """
+    Count reads by chromosome in shard.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    counts = defaultdict(int)
+    for read in bam_parallel.fetch_shard_reads(bam_file, shard):
+        counts[shard[0]] += 1
+    bam_file.close()
+    return counts
+
+
+class TestBamParallel:
+    """
+    Test that processing BAM files in parallel gives the
+    same results as processing them serially.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.bam_fname = os.path.join(self.output_dir, "sample.bam")
+        test_utils.make_synthetic_bam(self.bam_fname, 3000)
+        self.regions = test_utils.make_synthetic_regions(400)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def make_tagged_bam(self, format_tag):
+        tagged_bam_fname = os.path.join(self.output_dir, "tagged.bam")
+        return test_utils.make_synthetic_tagged_bam(self.bam_fname,
+                                                    tagged_bam_fname,
+                                                    self.regions,
+                                                    format_tag)
+
+
+    def test_shards(self):
+        """
+        Test that reads are counted once when sharding by region.
+        """
+        bam_file = pysam.Samfile(self.bam_fname, "rb")
+        expected = defaultdict(int)
+        for read in bam_file:
+            expected[bam_file.getrname(read.tid)] += 1
+        bam_file.close()
+        for region_size in [None, 100000, 777777]:
+            shards = bam_parallel.get_bam_shards(self.bam_fname,
+                                                 region_size=region_size)
+            for num_processors in [1, 3]:
+                counts = \
+                    bam_parallel.map_reduce_bam(self.bam_fname,
+                                                count_reads_in_shard,
+                                                bam_parallel.merge_counts,
+                                                num_processors=num_processors,
+                                                shards=shards)
+                assert (dict(counts) == dict(expected)), \
+                       "Wrong counts with region size %s" %(str(region_size))
+
+
+    def test_gff_region_counts(self):
+        """
+        Test counting of reads in GFF regions for RPKMs.
+        """
+        tagged_bam_fname = self.make_tagged_bam(format_gff_tag)
+        serial_counts = rpkm_utils.get_gff_region_counts(tagged_bam_fname)
+        parallel_counts = \
+            rpkm_utils.get_gff_region_counts(tagged_bam_fname,
+                                             num_processors=3)
+        assert (len(serial_counts) > 0)
+        assert (dict(serial_counts) == dict(parallel_counts))
+
+
+    def test_exons_coverage(self):
+        """
+        Test computation of exons coverage statistics.
+        """
+        tagged_bam_fname = self.make_tagged_bam(format_gff_tag)
+        serial_stats = \
+            coverage_utils.get_exons_coverage_from_tagBam(tagged_bam_fname)
+        parallel_stats = \
+            coverage_utils.get_exons_coverage_from_tagBam(tagged_bam_fname,
+                                                          num_processors=3)
+        assert (len(serial_stats) > 0)
+        assert (sorted(serial_stats.keys()) == sorted(parallel_stats.keys()))
+        for exon in serial_stats:
+            assert (str(serial_stats[exon]) == str(parallel_stats[exon]))
+
+
+    def test_qc_region_counts(self):
+        """
+        Test counting of reads in QC regions.
+        """
+        tagged_bam_fname = self.make_tagged_bam(format_qc_tag)
+        serial_counts, serial_by_transcript = \
+            qc.count_qc_regions(tagged_bam_fname)
+        parallel_counts, parallel_by_transcript = \
+            qc.count_qc_regions(tagged_bam_fname, num_processors=3)
+        assert (serial_counts["num_junctions"] > 0)
+        assert (dict(serial_counts) == dict(parallel_counts))
+        assert (sorted(serial_by_transcript.keys()) == \
+                sorted(parallel_by_transcript.keys()))
+        for transcript in serial_by_transcript:
+            for region_type in serial_by_transcript[transcript]:
+                assert (dict(serial_by_transcript[transcript][region_type]) == \
+                        dict(parallel_by_transcript[transcript][region_type]))
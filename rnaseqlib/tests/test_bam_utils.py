@@ -0,0 +1,138 @@
+##
+## Unit testing for BAM utilities
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.bam.bam_utils as bam_utils
+
+
+def get_read_keys(bam_fname):
+    """
+    Return list of (qname, tid, pos) of reads in BAM file.
+    """
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    read_keys = [(read.qname, read.tid, read.pos) for read in bam_file]
+    bam_file.close()
+    return read_keys
+
+
+def test_split_bam_reads(chr_ribo="chrRibo"):
+    """
+    Test that splitting BAM in a single pass gives the same
+    reads as filtering the BAM separately for each output.
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "sample.sorted.bam")
+        test_utils.make_synthetic_bam(bam_fname, 2000)
+        output_fnames = {}
+        for output_type in ["unique", "ribosub", "unique_ribosub"]:
+            output_fnames[output_type] = \
+                os.path.join(output_dir, "sample.%s.bam" %(output_type))
+        num_reads = bam_utils.split_bam_reads(bam_fname, output_fnames,
+                                              chr_ribo=chr_ribo)
+        # Compute expected reads by filtering BAM directly
+        bam_file = pysam.Samfile(bam_fname, "rb")
+        ribo_tid = bam_file.gettid(chr_ribo)
+        all_reads = [read for read in bam_file]
+        bam_file.close()
+        ribo_read_ids = set([read.qname for read in all_reads \
+                             if read.tid == ribo_tid])
+        expected = {"unique": [], "ribosub": [], "unique_ribosub": []}
+        for read in all_reads:
+            read_key = (read.qname, read.tid, read.pos)
+            is_unique = ("NH", 1) in read.tags
+            is_ribo = read.qname in ribo_read_ids
+            if is_unique:
+                expected["unique"].append(read_key)
+            if not is_ribo:
+                expected["ribosub"].append(read_key)
+            if is_unique and (not is_ribo):
+                expected["unique_ribosub"].append(read_key)
+        for output_type in output_fnames:
+            output_fname = output_fnames[output_type]
+            assert os.path.isfile("%s.bai" %(output_fname)), \
+                   "Output %s not indexed." %(output_fname)
+            assert (get_read_keys(output_fname) == expected[output_type]), \
+                   "Wrong reads in %s output." %(output_type)
+            assert (num_reads[output_type] == len(expected[output_type]))
+        # Outputs should contain some reads but not all of them
+        assert (0 < num_reads["unique_ribosub"] < num_reads["unique"])
+        assert (num_reads["ribosub"] < len(all_reads))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_split_bam_reads_unsorted():
+    """
+    Test that splitting a BAM not sorted by coordinate fails.
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "sample.bam")
+        header = {"HD": {"VN": "1.0", "SO": "unsorted"},
+                  "SQ": [{"SN": "chr1", "LN": 1000}]}
+        pysam.Samfile(bam_fname, "wb", header=header).close()
+        output_fnames = {"unique": os.path.join(output_dir, "unique.bam")}
+        try:
+            bam_utils.split_bam_reads(bam_fname, output_fnames)
+        except Exception:
+            pass
+        else:
+            assert False, "Unsorted BAM should not be split."
+        assert (not os.path.isfile(output_fnames["unique"]))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_count_distinct_reads():
+    """
+    Test that distinct reads are counted correctly, with and
+    without spilling read IDs to disk.
+    """
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_fname = os.path.join(output_dir, "sample.sorted.bam")
+        test_utils.make_synthetic_bam(bam_fname, 3000)
+        bam_file = pysam.Samfile(bam_fname, "rb")
+        expected = len(set([read.qname for read in bam_file]))
+        bam_file.close()
+        for buffer_size in [100, 1000000]:
+            num_reads = \
+                bam_utils.count_distinct_reads(bam_fname,
+                                               buffer_size=buffer_size,
+                                               tmp_dir=output_dir)
+            assert (num_reads == expected), \
+                   "Wrong number of reads with buffer size %d" %(buffer_size)
+        # Spilled read IDs should be cleaned up
+        assert (sorted(os.listdir(output_dir)) == \
+                ["sample.sorted.bam", "sample.sorted.bam.bai"])
+        # Count of unique BAM should be taken from index
+        unique_fname = os.path.join(output_dir, "sample.unique.bam")
+        bam_utils.split_bam_reads(bam_fname, {"unique": unique_fname})
+        bam_file = pysam.Samfile(unique_fname, "rb")
+        expected_unique = len(set([read.qname for read in bam_file]))
+        bam_file.close()
+        assert (bam_utils.count_distinct_reads(unique_fname,
+                                               all_unique=True) == \
+                expected_unique)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def main():
+    test_split_bam_reads()
+    test_split_bam_reads_unsorted()
+    test_count_distinct_reads()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+##
+## Unit testing for exons coverage
+##
+import os
+import sys
+import time
+import random
+import tempfile
+
+import numpy as np
+import scipy
+import scipy.stats
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.stats.stats_utils as stats_utils
+import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.utils as utils
+
+
+def make_read(pos, cigar):
+    """
+    Make aligned read starting at 'pos' (0-based) with given cigar.
+    """
+    bam_read = pysam.AlignedSegment()
+    bam_read.pos = pos
+    bam_read.cigar = cigar
+    return bam_read
+
+
+def get_expected_coverage(exon, bam_reads):
+    """
+    Compute coverage of each base of exon one base at a time.
+    """
+    chrom, start, end, strand = utils.parse_dash_coords(exon)
+    coverage = dict([(pos, 0) for pos in range(start, end + 1)])
+    for bam_read in bam_reads:
+        ref_pos = bam_read.pos + 1
+        for cigar_type, cigar_len in bam_read.cigar:
+            if cigar_type in coverage_utils.ALIGNED_CIGAR_OPS:
+                for pos in range(ref_pos, ref_pos + cigar_len):
+                    if pos in coverage:
+                        coverage[pos] += 1
+            if cigar_type in coverage_utils.ALIGNED_CIGAR_OPS + \
+               coverage_utils.REF_CIGAR_OPS:
+                ref_pos += cigar_len
+    return [coverage[pos] for pos in range(start, end + 1)]
+
+
+def make_random_reads(num_reads, max_pos, seed=1):
+    """
+    Make reads with matches, junctions, deletions, insertions
+    and soft clips.
+    """
+    rand = random.Random(seed)
+    bam_reads = []
+    for n in range(num_reads):
+        cigar = []
+        if rand.random() < 0.2:
+            cigar.append((4, rand.randint(1, 5)))
+        cigar.append((0, rand.randint(5, 30)))
+        kind = rand.random()
+        if kind < 0.3:
+            cigar.append((3, rand.randint(10, 200)))
+        elif kind < 0.4:
+            cigar.append((2, rand.randint(1, 3)))
+        elif kind < 0.5:
+            cigar.append((1, rand.randint(1, 3)))
+        cigar.append((0, rand.randint(5, 30)))
+        bam_reads.append(make_read(rand.randint(0, max_pos), cigar))
+    return bam_reads
+
+
+class TestExonsCoverage:
+    """
+    Test array-backed exons coverage against per-base counting.
+    """
+    def setup_method(self, method):
+        self.exons = ["chr1:101-200:+",
+                      "chr1:150-400:-",
+                      "chr1:401-401:+",
+                      "chr1:1000-1100:+"]
+        self.bam_reads = make_random_reads(500, 1100)
+
+
+    def test_cigar_blocks(self):
+        bam_read = make_read(99, [(4, 3), (0, 10), (3, 50), (0, 5),
+                                  (1, 2), (0, 4), (2, 1), (0, 3)])
+        blocks = coverage_utils.get_cigar_blocks(bam_read)
+        assert (blocks == [(100, 110), (160, 165), (165, 169), (170, 173)])
+
+
+    def test_coverage_and_stats(self):
+        # Small flush size so that coverage is flushed many times
+        exons_coverage = coverage_utils.ExonsCoverage(flush_size=100)
+        for bam_read in self.bam_reads:
+            exons_coverage.add_read(bam_read, self.exons)
+        # Split reads between two objects and merge them
+        first = coverage_utils.ExonsCoverage()
+        second = coverage_utils.ExonsCoverage()
+        for n, bam_read in enumerate(self.bam_reads):
+            if n % 2 == 0:
+                first.add_read(bam_read, self.exons[::-1])
+            else:
+                second.add_read(bam_read, self.exons)
+        merged = coverage_utils.merge_exons_coverage([first, second])
+        assert (merged.num_unmatched == exons_coverage.num_unmatched)
+        for curr_coverage, chunk_size in [(exons_coverage, 1000000),
+                                          (merged, 150)]:
+            # Statistics computed in chunks of a few exons
+            stats = curr_coverage.get_stats(chunk_size=chunk_size)
+            assert (sorted(stats.keys()) == sorted(self.exons))
+            for exon in self.exons:
+                expected = get_expected_coverage(exon, self.bam_reads)
+                assert (list(curr_coverage.get_exon_coverage(exon)) == expected)
+                expected_stats = \
+                    {"mean": np.mean(expected),
+                     "std": np.std(expected),
+                     "max": np.max(expected),
+                     "min": np.min(expected),
+                     "kurtosis": scipy.stats.kurtosis(expected, fisher=False),
+                     "cv": stats_utils.coeff_var(expected),
+                     "sqrt_jsd": coverage_utils.coverage_dist_from_uniform(expected)}
+                for stat in expected_stats:
+                    assert np.allclose(stats[exon][stat], expected_stats[stat],
+                                       equal_nan=True), \
+                        "%s of %s differs" %(stat, exon)
+
+
+    def test_uncovered_exon(self):
+        exons_coverage = coverage_utils.ExonsCoverage()
+        exon = "chr1:5000-5010:+"
+        exons_coverage.add_read(make_read(10, [(0, 20)]), [exon])
+        assert (exons_coverage.num_unmatched == 1)
+        stats = exons_coverage.get_stats()[exon]
+        assert (stats["mean"] == 0 and stats["max"] == 0)
+        assert (stats["kurtosis"] == 0)
+        assert np.allclose(stats["sqrt_jsd"],
+                           coverage_utils.coverage_dist_from_uniform([0] * 11))
+
+
+    def test_estimate_coverage_bytes(self):
+        exons = ["chr1:100-199:+", "chr2:5000-5010:-"]
+        exons_coverage = coverage_utils.ExonsCoverage()
+        for exon in exons:
+            exons_coverage.add_exon(exon)
+        gff_fname = tempfile.mktemp(suffix=".gff")
+        with open(gff_fname, "w") as gff_out:
+            gff_out.write("##gff-version 3\n")
+            gff_out.write("chr1\tensGene\tgene\t100\t199\t.\t+\t.\tID=g\n")
+            for exon in exons:
+                chrom, start, end, strand = utils.parse_dash_coords(exon)
+                gff_out.write("%s\tensGene\texon\t%d\t%d\t.\t%s\t.\tID=%s\n" \
+                              %(chrom, start, end, strand, exon))
+        num_bytes = coverage_utils.estimate_exons_coverage_bytes(gff_fname)
+        os.remove(gff_fname)
+        assert (num_bytes == 8 * exons_coverage.total_len + \
+                             coverage_utils.EXON_INFO_BYTES * len(exons))
@@ -0,0 +1,75 @@
+##
+## Unit testing for dinucleotide models of sequences
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.motif.dinuc_freq as dinuc_freq
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+
+def naive_prob(seq, subseq):
+    """
+    Return probability of subseq under the dinucleotide model
+    of seq, scoring one base at a time.
+    """
+    seq = seq.upper().replace("U", "T")
+    num_dinucs = lambda dinuc: \
+        sum(1 for n in xrange(len(seq) - 1) if seq[n:n + 2] == dinuc)
+    prob = seq.count(subseq[0]) / float(len(seq))
+    for prev_base, next_base in zip(subseq, subseq[1:]):
+        dinucs_from = sum(num_dinucs(prev_base + base) for base in "ACGT")
+        if dinucs_from == 0:
+            return 0.
+        prob *= num_dinucs(prev_base + next_base) / float(dinucs_from)
+    return prob
+
+
+class TestDinucFreq:
+    def test_dinuc_model(self):
+        """
+        Test that scoring kmers in many sequences at once matches
+        scoring them one at a time.
+        """
+        rand = np.random.RandomState(1)
+        seqs = ["".join(rand.choice(list("ACGTACGTAAAN"),
+                                    rand.randint(1, 60))) \
+                for seq_num in xrange(50)]
+        seqs.extend(["ACGUacgu", "AAAAAA", "A", "CG"])
+        kmers = kmer_utils.enumerate_kmers(3) + ["A", "GT", "AAAAA"]
+        dinuc_model = dinuc_freq.DinucModel(seqs)
+        probs = dinuc_model.get_kmer_probs(kmers)
+        exp_counts = dinuc_model.get_expected_counts(kmers)
+        assert (probs.shape == (len(seqs), len(kmers)))
+        for seq_num, seq in enumerate(seqs):
+            for kmer_num, kmer in enumerate(kmers):
+                prob = naive_prob(seq, kmer)
+                assert (np.allclose(probs[seq_num, kmer_num], prob))
+                assert (np.allclose(exp_counts[seq_num, kmer_num],
+                                    max(len(seq) - len(kmer) + 1, 0) * prob))
+        # Probabilities of kmers of a length sum to 1 in
+        # sequences without Ns
+        assert (np.allclose(probs[-4, 0:64].sum(), 1))
+        # Invalid kmers
+        probs = dinuc_model.get_kmer_probs(["", "ANA", "acg"])
+        assert ((probs[:, 0:2] == 0).all())
+        assert (np.array_equal(probs[:, 2],
+                               dinuc_model.get_kmer_probs(["ACG"])[:, 0]))
+
+
+    def test_dinuc_freqs(self):
+        freqs = dinuc_freq.DinucFreqs("ACGTAC")
+        assert (freqs.base_freqs["A"] == 2 / 6.)
+        assert (freqs.base_freqs["U"] == freqs.base_freqs["T"])
+        assert (freqs.get_dinuc_freqs_from("A") == [0, 0, 0, 2 / 5.])
+        assert (np.allclose(freqs.prob_score("ACG"), 2 / 6. * 1 * 1))
+        assert (np.allclose(freqs.get_expected_num("ACG"), 4 * 2 / 6.))
+        # Non-overlapping dinucleotides: AC, GT, AC
+        freqs = dinuc_freq.DinucFreqs("ACGTAC", overlapping=False,
+                                      normalize=False)
+        assert (freqs.dinuc_freqs["AC"] == 2)
+        assert (freqs.dinuc_freqs["CG"] == 0)
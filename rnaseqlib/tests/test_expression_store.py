@@ -0,0 +1,204 @@
+##
+## Unit testing for the columnar expression store
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.rpkm.ExpressionStore as expression_store
+import rnaseqlib.rpkm.ExpressionTable as expression_table
+
+
+class Sample:
+    """
+    Sample with an RPKM directory.
+    """
+    def __init__(self, label, rpkm_dir):
+        self.label = label
+        self.rpkm_dir = rpkm_dir
+
+
+def make_rpkm_df(gene_ids, seed=1):
+    rand = np.random.RandomState(seed)
+    counts = rand.randint(0, 100, size=len(gene_ids))
+    exons = ["chr1:%d-%d:+,cds.chr1:%d-%d:+" %(n * 100 + 1, n * 100 + 20,
+                                               n * 100 + 51, n * 100 + 70) \
+             for n in range(len(gene_ids))]
+    return pandas.DataFrame({"gene_id": gene_ids,
+                             "rpkm": counts / 40. * 1e3,
+                             "counts": counts,
+                             "exons": exons})
+
+
+def make_exon_stats(rpkm_df, seed=1):
+    rand = np.random.RandomState(seed)
+    exon_stats_dict = {}
+    for exons in rpkm_df["exons"]:
+        for exon in exons.split(","):
+            exon = exon.split("cds.")[-1]
+            entry = {"exon": exon}
+            for stat in rpkm_utils.COVERAGE_STORE_MATRICES:
+                entry[stat] = rand.rand()
+            exon_stats_dict[exon] = entry
+    return exon_stats_dict
+
+
+def write_sample_rpkms(rpkm_df, exon_stats_dict, output_prefix):
+    """
+    Write RPKM table and RPKM table with exons coverage as
+    done by 'rpkm_utils.write_rpkm_tables'.
+    """
+    rpkm_header = ["gene_id", "rpkm", "counts", "exons"]
+    rpkm_df_with_cov, coverage_cols = \
+        rpkm_utils.add_exons_coverage_to_rpkm_df(rpkm_df, exon_stats_dict)
+    rpkm_df_with_cov.to_csv("%s.coverage.txt" %(output_prefix),
+                            columns=rpkm_header + coverage_cols,
+                            na_rep="NA",
+                            sep="\t",
+                            index=False)
+    rpkm_df.to_csv("%s.rpkm" %(output_prefix),
+                   columns=rpkm_header,
+                   na_rep="NA",
+                   sep="\t",
+                   index=False)
+
+
+class TestExpressionStore:
+    """
+    Test adding samples to the store and reading them back.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.output_dir, "genes.store")
+        self.gene_ids = ["gene%d" %(n) for n in range(50)]
+        self.rows = pandas.DataFrame({"gene_id": self.gene_ids})
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_add_samples(self):
+        store = expression_store.ExpressionStore(self.store_dir,
+                                                 rows=self.rows,
+                                                 matrix_names=["rpkm",
+                                                               "counts"])
+        values = {}
+        for n in range(3):
+            values[n] = np.arange(50) * (n + 1.)
+            store.add_sample("sample%d" %(n), {"rpkm": values[n],
+                                               "counts": values[n] + 1})
+        # Values given as Series, with a missing gene
+        series = pandas.Series(np.arange(49) * 10.,
+                               index=self.gene_ids[::-1][0:49])
+        store.add_sample("sample3", {"rpkm": series})
+        store = expression_store.ExpressionStore(self.store_dir)
+        assert (store.samples == ["sample%d" %(n) for n in range(4)])
+        for n in range(3):
+            assert (store.get_column("rpkm", "sample%d" %(n)) == \
+                    values[n]).all()
+        column = store.get_column("rpkm", "sample3")
+        assert np.isnan(column[0])
+        assert (column[1:] == np.arange(49)[::-1] * 10.).all()
+        assert np.isnan(store.get_column("counts", "sample3")).all()
+        matrix = store.get_matrix("counts")
+        assert (matrix.shape == (50, 4))
+        assert (matrix[5, 2] == values[2][5] + 1)
+        # Replace a sample's values
+        store.add_sample("sample1", {"rpkm": values[0], "counts": values[0]})
+        table = store.get_table("rpkm", samples=["sample2", "sample1"],
+                                prefix="rpkm_")
+        assert (list(table.columns) == ["rpkm_sample2", "rpkm_sample1"])
+        assert (table.loc["gene7", "rpkm_sample1"] == values[0][7])
+        assert (table.loc["gene7", "rpkm_sample2"] == values[2][7])
+
+
+    def test_interrupted_add(self):
+        store = expression_store.ExpressionStore(self.store_dir,
+                                                 rows=self.rows,
+                                                 matrix_names=["rpkm"])
+        store.add_sample("sample0", {"rpkm": np.ones(50)})
+        # Values written without the sample being recorded
+        with open(store.get_matrix_fname("rpkm"), "ab") as matrix_file:
+            matrix_file.write(np.zeros(20).tostring())
+        store = expression_store.ExpressionStore(self.store_dir)
+        assert (store.samples == ["sample0"])
+        store.add_sample("sample1", {"rpkm": np.arange(50.)})
+        assert (os.path.getsize(store.get_matrix_fname("rpkm")) == 50 * 2 * 8)
+        assert (store.get_column("rpkm", "sample0") == 1).all()
+        assert (store.get_column("rpkm", "sample1") == np.arange(50.)).all()
+
+
+    def test_rpkm_stores(self):
+        samples = []
+        rpkm_dfs = {}
+        exon_stats = {}
+        for n in range(3):
+            sample = Sample("sample%d" %(n),
+                            os.path.join(self.output_dir, "sample%d" %(n)))
+            os.makedirs(sample.rpkm_dir)
+            rpkm_dfs[n] = make_rpkm_df(self.gene_ids, seed=n)
+            exon_stats[n] = make_exon_stats(rpkm_dfs[n], seed=n)
+            write_sample_rpkms(rpkm_dfs[n], exon_stats[n],
+                               os.path.join(sample.rpkm_dir, "ensGene"))
+            samples.append(sample)
+        rpkm_store = rpkm_utils.update_rpkm_stores(samples[0:2],
+                                                   self.output_dir,
+                                                   "ensGene")
+        assert (rpkm_store.samples == ["sample0", "sample1"])
+        rpkm_store = rpkm_utils.update_rpkm_stores(samples,
+                                                   self.output_dir,
+                                                   "ensGene")
+        assert (rpkm_store.samples == ["sample0", "sample1", "sample2"])
+        labels = [sample.label for sample in samples]
+        rpkm_table = rpkm_utils.get_rpkm_table_from_store(rpkm_store, labels)
+        assert (list(rpkm_table["gene_id"]) == self.gene_ids)
+        assert (list(rpkm_table["exons"]) == list(rpkm_dfs[0]["exons"]))
+        for n in range(3):
+            assert np.allclose(rpkm_table["rpkm_sample%d" %(n)],
+                               rpkm_dfs[n]["rpkm"])
+            assert (rpkm_table["counts_sample%d" %(n)] == \
+                    rpkm_dfs[n]["counts"]).all()
+        # Exons coverage store
+        coverage_store_dir = \
+            rpkm_utils.get_rpkm_store_dirs(self.output_dir, "ensGene")[1]
+        coverage_store = expression_store.ExpressionStore(coverage_store_dir)
+        assert (coverage_store.samples == labels)
+        assert (sorted(coverage_store.row_ids) == sorted(exon_stats[0].keys()))
+        for n in range(3):
+            column = coverage_store.get_column("sqrt_jsd", "sample%d" %(n))
+            for exon_num, exon in enumerate(coverage_store.row_ids):
+                assert np.allclose(column[exon_num],
+                                   exon_stats[n][exon]["sqrt_jsd"])
+        # Load expression table lazily from the store
+        expr_table = \
+            expression_table.ExpressionTable(from_store=rpkm_store.store_dir,
+                                             store_samples=["sample2"])
+        assert (list(expr_table.data.columns) == ["gene_id", "rpkm_sample2"])
+        assert np.allclose(expr_table.indexed_data["rpkm_sample2"],
+                           rpkm_dfs[2]["rpkm"])
+        counts = expr_table.get_counts_table()
+        assert (list(counts.columns) == labels)
+        assert (counts["sample1"].values == rpkm_dfs[1]["counts"]).all()
+        # Only samples whose RPKMs changed are added again
+        new_rpkm_df = make_rpkm_df(self.gene_ids, seed=10)
+        write_sample_rpkms(new_rpkm_df, exon_stats[1],
+                           os.path.join(samples[1].rpkm_dir, "ensGene"))
+        rpkm_fname = os.path.join(samples[1].rpkm_dir, "ensGene.rpkm")
+        os.utime(rpkm_fname, (1000, 1000))
+        os.remove(os.path.join(samples[0].rpkm_dir, "ensGene.coverage.txt"))
+        rpkm_store = rpkm_utils.update_rpkm_stores(samples,
+                                                   self.output_dir,
+                                                   "ensGene")
+        assert (rpkm_store.samples == labels)
+        assert (rpkm_store.get_column("counts", "sample1") == \
+                new_rpkm_df["counts"]).all()
+        assert (rpkm_store.get_column("counts", "sample0") == \
+                rpkm_dfs[0]["counts"]).all()
@@ -0,0 +1,236 @@
+##
+## Unit testing for scatter/gather processing of FASTQ files
+##
+import os
+import sys
+import time
+import gzip
+import zlib
+import struct
+import shutil
+import tempfile
+import functools
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.fastq_scatter as fastq_scatter
+import rnaseqlib.ribo.ribo_utils as ribo_utils
+import rnaseqlib.drivers.fastq_jobs as fastq_jobs
+
+
+def get_fastq_data(num_entries, seed=1):
+    """
+    Return FASTQ records of varying lengths whose quality lines
+    can start with '@' or '+', with blank lines in between.
+    """
+    rand = np.random.RandomState(seed)
+    entries = []
+    for entry_num in xrange(num_entries):
+        read_len = rand.randint(10, 60)
+        seq = "".join(rand.choice(list("ACGTN"), read_len))
+        if entry_num % 4 == 0:
+            seq += "A" * rand.randint(1, 10)
+        qual = "".join(rand.choice(list("@+IJ#"), len(seq)))
+        header2 = "+" if entry_num % 2 else "+read%d" %(entry_num)
+        entries.append("@read%d\n%s\n%s\n%s\n" %(entry_num, seq,
+                                                 header2, qual))
+        if entry_num % 7 == 0:
+            entries.append("\n")
+    return "".join(entries)
+
+
+def write_gzip_members(gz_fname, data, member_size):
+    """
+    Write data as gzip file with a member per 'member_size'
+    bytes, without BGZF headers.
+    """
+    with open(gz_fname, "wb") as gz_file:
+        for start in xrange(0, len(data), member_size):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            gz_file.write(compressor.compress(data[start:start + member_size]))
+            gz_file.write(compressor.flush())
+
+
+def write_bgzf(gz_fname, data, block_size):
+    """
+    Write data as BGZF file with a block per 'block_size' bytes
+    and an empty end-of-file block (as done by 'bgzip'.)
+    """
+    with open(gz_fname, "wb") as gz_file:
+        starts = range(0, len(data), block_size) + [len(data)]
+        for start in starts:
+            block = data[start:start + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(block) + compressor.flush()
+            gz_file.write(struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0,
+                                      255, 6, 66, 67, 2,
+                                      len(compressed) + 25))
+            gz_file.write(compressed)
+            gz_file.write(struct.pack("<II",
+                                      zlib.crc32(block) & 0xffffffff,
+                                      len(block)))
+
+
+def trim_polyA_transform(records):
+    trimmed_records, trimmed_lens = \
+        ribo_utils.trim_polyA_records(records, min_read_len=15)
+    return fastq_utils.format_fastq_records(trimmed_records)
+
+
+class TestFastqScatter:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.data = get_fastq_data(500)
+        self.fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        with open(self.fastq_fname, "w") as fastq_file:
+            fastq_file.write(self.data)
+        self.gz_fname = os.path.join(self.output_dir, "reads.fastq.gz")
+        with gzip.open(self.gz_fname, "wb") as gz_file:
+            gz_file.write(self.data)
+        self.bgz_fname = os.path.join(self.output_dir, "reads.bgz.fastq.gz")
+        write_bgzf(self.bgz_fname, self.data, 1000)
+        self.members_fname = os.path.join(self.output_dir,
+                                          "reads.members.fastq.gz")
+        write_gzip_members(self.members_fname, self.data, 1000)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def check_chunks(self, fastq_fname, chunk_size):
+        chunks = list(fastq_scatter.get_fastq_chunks(fastq_fname,
+                                                     chunk_size=chunk_size))
+        chunks_data = [chunk.read() for chunk in chunks]
+        # Chunks cover the file and start on records
+        assert ("".join(chunks_data) == self.data)
+        for chunk_data in chunks_data:
+            assert (chunk_data.startswith("@read"))
+        return chunks
+
+
+    def test_chunks(self):
+        for chunk_size in [1, 500, 2000, 10**6]:
+            plain_chunks = self.check_chunks(self.fastq_fname, chunk_size)
+            stream_chunks = self.check_chunks(self.gz_fname, chunk_size)
+            assert (stream_chunks[0].data is not None)
+            indexed_chunks = self.check_chunks(self.bgz_fname, chunk_size)
+            # Gzip files of many members that are not BGZF are
+            # read as a stream
+            members_chunks = self.check_chunks(self.members_fname, chunk_size)
+            assert (members_chunks[0].data is not None)
+            if chunk_size == 2000:
+                assert (len(plain_chunks) > 10)
+                assert (len(stream_chunks) == len(plain_chunks))
+                # Chunks of gzip members are read from the
+                # members
+                assert (len(indexed_chunks) > 10)
+                assert (indexed_chunks[0].data is None)
+                assert (indexed_chunks[-1].access_offset > 0)
+
+
+    def test_gzip_index(self):
+        assert (fastq_scatter.is_bgzf(self.bgz_fname))
+        assert (not fastq_scatter.is_bgzf(self.gz_fname))
+        assert (not fastq_scatter.is_bgzf(self.members_fname))
+        assert (fastq_scatter.get_gzip_index(self.gz_fname) is None)
+        assert (fastq_scatter.get_gzip_index(self.members_fname) is None)
+        index = fastq_scatter.get_gzip_index(self.bgz_fname)
+        # Empty end-of-file block is not indexed
+        assert (len(index) == (len(self.data) + 999) / 1000)
+        assert (index[1][1] == 1000)
+        with open(self.bgz_fname, "rb") as bgz_file:
+            for member_offset, uncompressed_offset in index:
+                assert (fastq_scatter.read_gzip_range(bgz_file, member_offset,
+                                                      0, 10) == \
+                        self.data[uncompressed_offset:uncompressed_offset + 10])
+        assert (fastq_scatter.load_gzip_index(self.bgz_fname) == index)
+        # Index is invalidated when the file changes
+        time.sleep(0.01)
+        write_bgzf(self.bgz_fname, self.data, 500)
+        assert (fastq_scatter.load_gzip_index(self.bgz_fname) is None)
+        assert (len(fastq_scatter.get_gzip_index(self.bgz_fname)) > \
+                len(index))
+
+
+    def test_scatter_gather(self):
+        """
+        Test that transformed chunks match transforming the
+        whole file serially, byte for byte.
+        """
+        records = list(fastq_utils.read_fastq(self.fastq_fname))
+        transforms = [fastq_scatter.fastq_transform,
+                      fastq_scatter.fasta_transform,
+                      functools.partial(fastq_scatter.filter_transform,
+                                        min_read_len=20,
+                                        max_read_len=50),
+                      trim_polyA_transform]
+        for n, transform in enumerate(transforms):
+            expected = transform(records)
+            for fastq_fname in [self.fastq_fname, self.gz_fname,
+                                self.bgz_fname]:
+                for num_procs in [1, 3]:
+                    output_fname = os.path.join(self.output_dir,
+                                                "out%d_%d.txt" %(n,
+                                                                 num_procs))
+                    num_chunks = \
+                        fastq_scatter.scatter_gather(fastq_fname,
+                                                     output_fname,
+                                                     transform,
+                                                     num_procs=num_procs,
+                                                     chunk_size=1500)
+                    assert (num_chunks > 10)
+                    with open(output_fname) as output_file:
+                        assert (output_file.read() == expected)
+        # Gzipped output
+        output_fname = os.path.join(self.output_dir, "out.fa.gz")
+        fastq_scatter.fastq_to_fasta(self.bgz_fname, output_fname,
+                                     num_procs=2, chunk_size=1500)
+        assert (gzip.open(output_fname).read() == \
+                fastq_scatter.fasta_transform(records))
+
+
+    def test_trim_polyA(self):
+        """
+        Test trimming polyAs in parallel matches serial trimming.
+        """
+        output_fnames = []
+        for num_procs in [1, 2]:
+            outdir = os.path.join(self.output_dir, "trimmed%d" %(num_procs))
+            output_fnames.append(ribo_utils.trim_polyA_ends(self.gz_fname,
+                                                            outdir,
+                                                            min_read_len=15,
+                                                            num_procs=\
+                                                            num_procs))
+        trimmed = [gzip.open(fname).read() for fname in output_fnames]
+        assert (trimmed[0] == trimmed[1])
+        assert (trimmed[0].count("\n") > 40)
+        # No temporary files are left behind
+        hist_fname = ribo_utils.get_trimmed_lens_filename(output_fnames[0])
+        assert (sorted(os.listdir(os.path.dirname(output_fnames[0]))) == \
+                sorted([os.path.basename(output_fnames[0]),
+                        os.path.basename(hist_fname)]))
+
+
+    def test_fastq2fasta(self):
+        settings_fname = os.path.join(self.output_dir, "settings.txt")
+        with open(settings_fname, "w") as settings_file:
+            settings_file.write("[pipeline]\ndata_type = rnaseq\n\n"
+                                "[pipeline-files]\ninit_dir = %s\n\n" \
+                                %(self.output_dir))
+            settings_file.write("[mapping]\nreadlen = 40\n\n")
+            settings_file.write("[data]\nindir = %s\n" %(self.output_dir))
+            settings_file.write("sequence_files = [[\"reads.fastq\", "
+                                "\"sample1\"], [\"reads.fastq.gz\", "
+                                "\"sample2\"]]\n")
+        fastq_jobs.fastq2fasta(settings_fname, self.output_dir,
+                               cluster_type="local")
+        expected = \
+            fastq_scatter.fasta_transform(fastq_utils.read_fastq(self.fastq_fname))
+        for fname in ["reads.fastq.fa", "reads.fastq.gz.fa"]:
+            with open(os.path.join(self.output_dir, "fasta", fname)) \
+                     as fasta_file:
+                assert (fasta_file.read() == expected)
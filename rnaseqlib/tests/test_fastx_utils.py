@@ -0,0 +1,177 @@
+##
+## Unit testing for FASTQ/FASTA utilities
+##
+import os
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.fastx_utils as fastx_utils
+
+
+def write_fastq(fastq_fname, num_entries, blank_lines=False):
+    """
+    Write FASTQ file with given number of entries.
+    """
+    if fastq_fname.endswith(".gz"):
+        fastq_file = gzip.open(fastq_fname, "wb")
+    else:
+        fastq_file = open(fastq_fname, "w")
+    for entry_num in xrange(num_entries):
+        fastq_file.write("@read%d\nACGTACGTNN\n+\nIIIIIIIIII\n" %(entry_num))
+        if blank_lines and (entry_num % 3 == 0):
+            fastq_file.write("\n\n")
+    fastq_file.close()
+
+
+class TestCountFastx:
+    """
+    Test counting of entries in FASTQ/FASTA files.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def count_parsed(self, fastx_fname):
+        return len(list(fastx_utils.get_fastx_entries(fastx_fname)))
+
+
+    def test_count_fastq(self):
+        """
+        Test that counts match the number of parsed entries.
+        """
+        for fname, blank_lines in [("reads.fastq", False),
+                                   ("reads_blank.fastq", True),
+                                   ("reads.fastq.gz", True)]:
+            fastq_fname = os.path.join(self.output_dir, fname)
+            write_fastq(fastq_fname, 1001, blank_lines=blank_lines)
+            num_entries = \
+                fastx_utils.count_fastx_entries(fastq_fname,
+                                                use_cache=False)
+            assert (num_entries == 1001)
+            assert (num_entries == self.count_parsed(fastq_fname))
+        # Small chunks should give the same counts
+        fastq_fname = os.path.join(self.output_dir, "reads_blank.fastq")
+        with open(fastq_fname) as fastq_file:
+            num_lines, num_headers = \
+                fastx_utils.count_fastx_lines(fastq_file, chunk_size=7)
+        assert (num_lines == 1001 * 4)
+
+
+    def test_count_fasta(self):
+        fasta_fname = os.path.join(self.output_dir, "seqs.fa")
+        with open(fasta_fname, "w") as fasta_file:
+            for entry_num in xrange(50):
+                fasta_file.write(">seq%d\nACGT\nAC>GT\n" %(entry_num))
+        num_entries = fastx_utils.count_fastx_entries(fasta_fname,
+                                                      use_cache=False)
+        assert (num_entries == 50)
+        assert (num_entries == self.count_parsed(fasta_fname))
+
+
+    def test_count_cache(self):
+        """
+        Test that counts are cached and that the cache is
+        invalidated when the file changes.
+        """
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        write_fastq(fastq_fname, 10)
+        assert (fastx_utils.count_fastx_entries(fastq_fname) == 10)
+        counts_fname = fastx_utils.get_fastx_counts_fname(fastq_fname)
+        assert os.path.isfile(counts_fname)
+        assert (fastx_utils.load_fastx_count(fastq_fname) == 10)
+        # Change the file
+        write_fastq(fastq_fname, 20)
+        assert (fastx_utils.load_fastx_count(fastq_fname) is None)
+        assert (fastx_utils.count_fastx_entries(fastq_fname) == 20)
+        assert (fastx_utils.load_fastx_count(fastq_fname) == 20)
+
+
+class TestFastqIO:
+    """
+    Test batched reading and writing of FASTQ files.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def read_serially(self, fastq_fname):
+        """
+        Parse FASTQ file a record at a time, as done prior to
+        batched parsing.
+        """
+        records = []
+        fastq_file = fastq_utils.read_open_fastq(fastq_fname)
+        lines = [l.strip("\n") for l in fastq_file if l.strip("\n")]
+        for n in xrange(0, len(lines) - 3, 4):
+            records.append((lines[n][1:], lines[n + 1],
+                            lines[n + 2], lines[n + 3]))
+        return records
+
+
+    def test_read_chunks(self):
+        for fname, blank_lines in [("reads.fastq", False),
+                                   ("reads_blank.fastq", True),
+                                   ("reads.fastq.gz", True)]:
+            fastq_fname = os.path.join(self.output_dir, fname)
+            write_fastq(fastq_fname, 1001, blank_lines=blank_lines)
+            expected = self.read_serially(fastq_fname)
+            assert (len(expected) == 1001)
+            assert (list(fastq_utils.read_fastq(fastq_fname)) == expected)
+            # Small blocks split records and lines across blocks
+            for use_gzip_binary in [True, False]:
+                batches = \
+                    list(fastq_utils.read_fastq_chunks(fastq_fname,
+                                                       batch_size=100,
+                                                       block_size=37,
+                                                       use_gzip_binary=\
+                                                       use_gzip_binary))
+                assert ([len(b) for b in batches] == [100] * 10 + [1])
+                assert (sum(batches, []) == expected)
+
+
+    def test_read_invalid(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        write_fastq(fastq_fname, 10)
+        with open(fastq_fname, "a") as fastq_file:
+            fastq_file.write("@read10\nACGT\n-\nIIII\n")
+        try:
+            list(fastq_utils.read_fastq(fastq_fname))
+            assert False, "Invalid header was not detected."
+        except ValueError:
+            pass
+
+
+    def test_write(self):
+        records = [("read%d" %(n), "ACGT", "+", "IIII") for n in range(500)]
+        records.append(("@read500", "AC", "+read500", "II"))
+        for fname in ["out.fastq", "out.fastq.gz"]:
+            fastq_fname = os.path.join(self.output_dir, fname)
+            # Records written one at a time
+            fastq_file = fastq_utils.write_open_fastq(fastq_fname)
+            for record in records:
+                fastq_utils.write_fastq(fastq_file, record)
+            fastq_file.close()
+            expected = fastq_utils.read_open_fastq(fastq_fname).read()
+            for use_gzip_binary in [True, False]:
+                with fastq_utils.FastqWriter(fastq_fname,
+                                             block_size=100,
+                                             use_gzip_binary=\
+                                             use_gzip_binary) as writer:
+                    writer.write_records(records[0:250])
+                    for record in records[250:]:
+                        writer.write(record)
+                assert (fastq_utils.read_open_fastq(fastq_fname).read() == \
+                        expected)
@@ -0,0 +1,131 @@
+##
+## Unit testing for interval index and counting of reads
+## in QC regions without tagBam
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.mapping.IntervalIndex as interval_index
+import rnaseqlib.QualityControl as qc
+
+QC_REGION_LABELS = ["merged_exons", "introns", "cds_only.merged_exons",
+                    "3p_utrs", "5p_utrs", "tRNAs"]
+
+
+def get_region_label(region):
+    return QC_REGION_LABELS[(region[1] / 7) % len(QC_REGION_LABELS)]
+
+
+def get_region_transcripts(region):
+    return "ENST%d,ENST%d" %((region[1] / 11) % 50, (region[2] / 13) % 50)
+
+
+def format_qc_tag(regions):
+    """
+    Format regions as in BAM produced by tagBam against QC regions.
+    """
+    return ";".join(["%s:%s:%d-%d,%s" %(get_region_label(region),
+                                        region[0], region[1], region[2],
+                                        get_region_transcripts(region)) \
+                     for region in regions])
+
+
+class TestIntervalIndex:
+    """
+    Test interval index queries and QC region counts.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.regions = test_utils.make_synthetic_regions(2000,
+                                                         max_len=5000)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_find(self):
+        """
+        Test that contained and overlapping intervals are found,
+        with long intervals among short ones and intervals of
+        length 0 and 1.
+        """
+        chrom, chrom_start = self.regions[0][0], self.regions[0][1]
+        self.regions.extend([(chrom, chrom_start, chrom_start + 10**6, "+"),
+                             (chrom, chrom_start + 5, chrom_start + 6, "-"),
+                             (chrom, chrom_start + 5, chrom_start + 5, "-")])
+        index = interval_index.IntervalIndex()
+        for chrom, start, end, strand in self.regions:
+            index.add_interval(chrom, start, end,
+                               label="region",
+                               strand=strand)
+        index.build()
+        assert (index.num_intervals == len(self.regions))
+        rand = np.random.RandomState(3)
+        for query_num in xrange(500):
+            region = self.regions[rand.randint(0, len(self.regions))]
+            chrom = region[0]
+            start = rand.randint(max(region[1] - 100, 0), region[2])
+            end = start + rand.randint(1, 300)
+            for contained in [True, False]:
+                if contained:
+                    expected = [r for r in self.regions \
+                                if (r[0] == chrom) and (r[1] <= start) \
+                                and (r[2] >= end)]
+                else:
+                    expected = [r for r in self.regions \
+                                if (r[0] == chrom) and (r[1] < end) \
+                                and (r[2] > start)]
+                matches = index.find(chrom, start, end, contained=contained)
+                assert (sorted([(chrom, m[0], m[1], m[4]) for m in matches]) \
+                        == sorted(expected))
+        assert (index.find("chrUnknown", 0, 100) == [])
+
+
+    def test_qc_region_counts(self):
+        """
+        Test that counting reads in QC regions using the index gives
+        the same counts as counting reads in BAM produced by tagBam.
+        """
+        bam_fname = os.path.join(self.output_dir, "sample.bam")
+        test_utils.make_synthetic_bam(bam_fname, 5000)
+        # Write regions of each type to their own BED file
+        region_filenames = []
+        for label in QC_REGION_LABELS:
+            bed_fname = os.path.join(self.output_dir, "%s.bed" %(label))
+            with open(bed_fname, "w") as bed_file:
+                for region in self.regions:
+                    if get_region_label(region) != label:
+                        continue
+                    bed_file.write("%s\t%d\t%d\t%s\t.\t%s\n" \
+                                   %(region[0], region[1], region[2],
+                                     get_region_transcripts(region),
+                                     region[3]))
+            region_filenames.append(bed_fname)
+        tagged_bam_fname = os.path.join(self.output_dir, "tagged.bam")
+        test_utils.make_synthetic_tagged_bam(bam_fname, tagged_bam_fname,
+                                             self.regions, format_qc_tag,
+                                             contained=True)
+        tagged_counts, tagged_by_transcript = \
+            qc.count_qc_regions(tagged_bam_fname)
+        regions_index = qc.load_qc_regions_index(region_filenames,
+                                                 QC_REGION_LABELS)
+        for num_processors in [1, 3]:
+            counts, by_transcript = \
+                qc.count_qc_regions_in_bam(bam_fname, regions_index,
+                                           num_processors=num_processors)
+            assert (sum(counts.values()) > 0)
+            assert (dict(counts) == dict(tagged_counts))
+            assert (sorted(by_transcript.keys()) == \
+                    sorted(tagged_by_transcript.keys()))
+            for transcript in tagged_by_transcript:
+                for region_type in tagged_by_transcript[transcript]:
+                    assert (dict(by_transcript[transcript][region_type]) == \
+                            dict(tagged_by_transcript[transcript][region_type]))
@@ -0,0 +1,97 @@
+##
+## Unit testing for bundling commands into cluster jobs
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.cluster_utils.cluster as cluster
+import rnaseqlib.tests.test_local_queue as test_local_queue
+
+
+class TestJobBundle:
+    """
+    Test bundled commands run as local jobs.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.events_fname = os.path.join(self.output_dir, "events.txt")
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def get_cluster(self, label):
+        return cluster.Cluster("local",
+                               os.path.join(self.output_dir, label),
+                               None,
+                               max_jobs=4,
+                               max_cpus=8)
+
+
+    def get_jobs(self, label, num_jobs):
+        """
+        Jobs that each output a file.
+        """
+        results_dir = os.path.join(self.output_dir, label, "results")
+        os.makedirs(results_dir)
+        jobs = []
+        for n in range(num_jobs):
+            cmd = "echo result %d > %s" %(n * n,
+                                          os.path.join(results_dir,
+                                                       "job%d.txt" %(n)))
+            jobs.append((cmd, "job%d" %(n)))
+        return results_dir, jobs
+
+
+    def read_results(self, results_dir):
+        results = {}
+        for fname in os.listdir(results_dir):
+            with open(os.path.join(results_dir, fname)) as result_file:
+                results[fname] = result_file.read()
+        return results
+
+
+    def test_bundles(self):
+        # One job per command
+        my_cluster = self.get_cluster("unbundled")
+        results_dir, jobs = self.get_jobs("unbundled", 10)
+        job_ids = [my_cluster.launch_job(cmd, job_name) \
+                   for cmd, job_name in jobs]
+        my_cluster.wait_on_jobs(job_ids)
+        unbundled_results = self.read_results(results_dir)
+        # Commands packed into bundles of four
+        bundled_cluster = self.get_cluster("bundled")
+        results_dir, jobs = self.get_jobs("bundled", 10)
+        jobs[7] = ("exit 5", jobs[7][1])
+        bundles = bundled_cluster.launch_bundles(jobs, 4, num_parallel=2)
+        statuses = bundled_cluster.wait_on_bundles(bundles)
+        assert (len(bundled_cluster.local_queue.jobs) == 3)
+        assert (len(my_cluster.local_queue.jobs) == 10)
+        # Status of each command is reported
+        expected_statuses = dict([(job_name, 0) for cmd, job_name in jobs])
+        expected_statuses["job7"] = 5
+        assert (statuses == expected_statuses)
+        # Bundle with a failed command fails as a whole
+        exit_codes = [bundled_cluster.get_exit_code(b.job_id) \
+                      for b in bundles]
+        assert (exit_codes == [0, 1, 0])
+        bundled_results = self.read_results(results_dir)
+        del unbundled_results["job7.txt"]
+        assert (bundled_results == unbundled_results)
+
+
+    def test_bundle_parallelism(self):
+        my_cluster = self.get_cluster("parallel")
+        jobs = [(test_local_queue.get_sleep_cmd(self.events_fname,
+                                                "job%d" %(n), 0.1),
+                 "job%d" %(n)) for n in range(6)]
+        bundles = my_cluster.launch_bundles(jobs, 6, num_parallel=2)
+        statuses = my_cluster.wait_on_bundles(bundles)
+        assert (len(bundles) == 1)
+        assert (set(statuses.values()) == set([0]))
+        assert (test_local_queue.get_max_running(self.events_fname) == 2)
@@ -0,0 +1,92 @@
+##
+## Unit testing for throttling of job submissions
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import pandas
+
+import rnaseqlib
+import rnaseqlib.cluster_utils.cluster as cluster
+import rnaseqlib.cluster_utils.JobThrottle as job_throttle
+import rnaseqlib.tests.test_local_queue as test_local_queue
+
+
+class TestJobThrottle:
+    """
+    Test submissions against jobs run on the local machine.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.events_fname = os.path.join(self.output_dir, "events.txt")
+        self.state_fname = os.path.join(self.output_dir, "run.jobs.txt")
+        self.depth_fname = os.path.join(self.output_dir,
+                                        "run.queue_depth.txt")
+        # Local machine could run more jobs than are let in flight
+        self.my_cluster = cluster.Cluster("local", self.output_dir, None,
+                                          max_jobs=8,
+                                          max_cpus=8)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def get_jobs(self, num_jobs, secs=0.2):
+        return [(test_local_queue.get_sleep_cmd(self.events_fname,
+                                                "job%d" %(n), secs),
+                 "job%d" %(n)) for n in range(num_jobs)]
+
+
+    def get_throttle(self, resume=False):
+        return job_throttle.JobThrottle(self.my_cluster, 3,
+                                        state_fname=self.state_fname,
+                                        resume=resume,
+                                        depth_fname=self.depth_fname,
+                                        min_poll=0.01,
+                                        max_poll=0.05)
+
+
+    def test_max_in_flight(self):
+        throttle = self.get_throttle()
+        t1 = time.time()
+        job_ids = throttle.submit_all(self.get_jobs(9))
+        throttle.finish()
+        t2 = time.time()
+        assert (len(job_ids) == 9)
+        assert (throttle.exit_codes == dict([("job%d" %(n), 0) \
+                                             for n in range(9)]))
+        assert (test_local_queue.get_max_running(self.events_fname) == 3)
+        # Free slots are filled right away: three rounds of jobs
+        assert (t2 - t1 < 5 * 0.2)
+        # Queue depth is logged over time
+        depths = pandas.read_csv(self.depth_fname, sep="\t")
+        assert (depths["in_flight"].max() == 3)
+        assert (depths["pending"].iloc[-1] == 0)
+        assert (depths["in_flight"].iloc[-1] == 0)
+
+
+    def test_resume(self):
+        jobs = self.get_jobs(6, secs=0.05)
+        throttle = self.get_throttle()
+        # Batch interrupted after submitting four jobs, one of which
+        # failed
+        jobs[1] = ("exit 1", jobs[1][1])
+        for cmd, job_name in jobs[0:4]:
+            throttle.submit(cmd, job_name)
+        throttle.finish()
+        assert (throttle.exit_codes["job1"] == 1)
+        # Resume the batch: only the failed job and the jobs that
+        # were not submitted are submitted
+        throttle = self.get_throttle(resume=True)
+        job_ids = throttle.submit_all(self.get_jobs(6, secs=0.05))
+        throttle.finish()
+        assert (sorted(job_ids.keys()) == ["job1", "job4", "job5"])
+        # A new batch submits all jobs
+        throttle = self.get_throttle()
+        job_ids = throttle.submit_all(self.get_jobs(6, secs=0.05))
+        throttle.finish()
+        assert (len(job_ids) == 6)
@@ -0,0 +1,145 @@
+##
+## Unit testing for tracking the completion of cluster jobs
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import rnaseqlib
+import rnaseqlib.cluster_utils.JobTracker as job_tracker
+
+
+class FakeScheduler:
+    """
+    Scheduler stub whose jobs complete after given durations,
+    writing their sentinel files (unless killed.)
+    """
+    def __init__(self):
+        self.end_times = {}
+        self.num_queries = 0
+        self.timers = []
+
+
+    def submit(self, secs, sentinel_fname, exit_code=0, killed=False):
+        job_id = len(self.end_times) + 1
+        self.end_times[job_id] = time.time() + secs
+        if not killed:
+            def write_sentinel():
+                with open(sentinel_fname, "w") as sentinel_file:
+                    sentinel_file.write("%d\n" %(exit_code))
+            timer = threading.Timer(secs, write_sentinel)
+            timer.start()
+            self.timers.append(timer)
+        return job_id
+
+
+    def join(self):
+        for timer in self.timers:
+            timer.join()
+
+
+    def get_done_jobs(self, job_ids):
+        self.num_queries += 1
+        now = time.time()
+        return set([job_id for job_id in job_ids \
+                    if self.end_times[job_id] <= now])
+
+
+def wait_serially(scheduler, job_ids, sleep):
+    """
+    Wait on jobs one at a time, polling the scheduler and
+    sleeping after each job completes (as in waitUntilDone
+    before jobs were tracked together.)
+    """
+    for job_id in job_ids:
+        while len(scheduler.get_done_jobs([job_id])) == 0:
+            time.sleep(sleep)
+        time.sleep(sleep)
+
+
+class TestJobTracker:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def submit_jobs(self, scheduler, tracker, durations, label="job"):
+        job_ids = []
+        for n, secs in enumerate(durations):
+            sentinel_fname = os.path.join(self.output_dir,
+                                          "%s%d.done" %(label, n))
+            job_id = scheduler.submit(secs, sentinel_fname, exit_code=n)
+            if tracker is not None:
+                tracker.add_job(job_id, sentinel_fname)
+            job_ids.append(job_id)
+        return job_ids
+
+
+    def test_latency(self):
+        durations = [0.3, 0.1, 0.5, 0.2, 0.4, 0.1]
+        # Jobs waited on serially with 0.2 second polls
+        scheduler = FakeScheduler()
+        job_ids = self.submit_jobs(scheduler, None, durations,
+                                   label="serial_job")
+        t1 = time.time()
+        wait_serially(scheduler, job_ids, 0.2)
+        serial_secs = time.time() - t1
+        scheduler.join()
+        # Jobs tracked together through their sentinels
+        scheduler = FakeScheduler()
+        tracker = job_tracker.JobTracker(status_func=scheduler.get_done_jobs,
+                                         min_poll=0.02,
+                                         max_poll=0.2,
+                                         query_interval=10)
+        job_ids = self.submit_jobs(scheduler, tracker, durations)
+        t1 = time.time()
+        exit_codes = tracker.wait_on_jobs(job_ids)
+        tracked_secs = time.time() - t1
+        print "Serial wait: %.2f secs, tracked wait: %.2f secs " \
+              "(%.2f secs saved)" %(serial_secs, tracked_secs,
+                                    serial_secs - tracked_secs)
+        assert (exit_codes == dict([(job_id, n) \
+                                    for n, job_id in enumerate(job_ids)]))
+        assert (tracked_secs < max(durations) + 0.2)
+        assert (tracked_secs < serial_secs)
+        # Sentinels made scheduler queries unnecessary
+        assert (scheduler.num_queries == 0)
+        scheduler.join()
+
+
+    def test_killed_job(self):
+        scheduler = FakeScheduler()
+        tracker = job_tracker.JobTracker(status_func=scheduler.get_done_jobs,
+                                         min_poll=0.02,
+                                         max_poll=0.05,
+                                         query_interval=0.2)
+        job_ids = self.submit_jobs(scheduler, tracker, [0.1, 0.1])
+        killed_fname = os.path.join(self.output_dir, "killed.done")
+        killed_id = scheduler.submit(0.1, killed_fname, killed=True)
+        tracker.add_job(killed_id, killed_fname)
+        exit_codes = tracker.wait_on_jobs(job_ids + [killed_id])
+        assert (exit_codes[killed_id] is None)
+        assert (exit_codes[job_ids[1]] == 1)
+        # Outstanding jobs are queried about together
+        assert (scheduler.num_queries == 1)
+        scheduler.join()
+
+
+    def test_sentinel_cmd(self):
+        """
+        Test that commands with sentinels keep their exit code.
+        """
+        for exit_code in [0, 3]:
+            sentinel_fname = os.path.join(self.output_dir,
+                                          "job%d.done" %(exit_code))
+            cmd = job_tracker.add_sentinel_to_cmd("(exit %d)" %(exit_code),
+                                                  sentinel_fname)
+            assert (subprocess.call(cmd, shell=True) == exit_code)
+            assert (job_tracker.read_sentinel(sentinel_fname) == exit_code)
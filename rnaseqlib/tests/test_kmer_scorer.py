@@ -0,0 +1,176 @@
+##
+## Unit testing for scoring of kmers in regions
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.fasta_utils as fasta_utils
+import rnaseqlib.motif.seq_counter as seq_counter
+import rnaseqlib.bindnseq.BindnSeq as bindnseq
+import rnaseqlib.bindnseq.KmerScorer as kmer_scorer
+
+
+def make_regions(num_regions, seed=1):
+    """
+    Return FASTA records of regions on both strands, with
+    some lowercase bases and Ns.
+    """
+    rand = np.random.RandomState(seed)
+    fasta_recs = []
+    for region_num in xrange(num_regions):
+        seq = "".join(rand.choice(list("ACGTACGTacgN"),
+                                  rand.randint(0, 60)))
+        start = rand.randint(1, 10000)
+        strand = "+-"[region_num % 2]
+        header = ">chr%d:%d-%d:%s;region%d" \
+                 %(region_num % 3, start, start + len(seq) - 1, strand,
+                   region_num)
+        fasta_recs.append((header, seq))
+    return fasta_recs
+
+
+class TestKmerScorer:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.fasta_recs = make_regions(300)
+        self.fasta_fname = os.path.join(self.output_dir, "regions.fa")
+        with open(self.fasta_fname, "w") as fasta_out:
+            fasta_utils.write_fasta(fasta_out, self.fasta_recs)
+        self.kmers = ["ACG", "CGT", "AAA", "TTT", "GCA"]
+        self.fc_rank = [3.5, 2.0, 1.5, 2.5, 1.0]
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def check_kmers(self, scorer, kmers):
+        """
+        Check that finding kmers in all regions at once matches
+        counting them in each region.
+        """
+        counts = scorer.count_kmers(kmers)
+        seq_inds, starts, kmer_inds = scorer.find_kmers(kmers)
+        counter = seq_counter.SeqCounter(self.fasta_fname)
+        for seq_num, (header, seq) in enumerate(self.fasta_recs):
+            assert (counts[seq_num].tolist() == \
+                    counter.count_subseqs(seq, kmers).tolist())
+            seq_starts = [(kmer, starts[(seq_inds == seq_num) & \
+                                        (kmer_inds == kmer_num)].tolist()) \
+                          for kmer_num, kmer in enumerate(kmers)]
+            assert (seq_starts == counter.count_subseqs_with_starts(seq, kmers))
+        return counts
+
+
+    def test_count_kmers(self):
+        """
+        Test that counting kmers in all regions at once matches
+        counting them in each region.
+        """
+        scorer = kmer_scorer.load_fasta_scorer(self.fasta_fname)
+        counts = self.check_kmers(scorer, self.kmers)
+        densities_df = scorer.get_densities_df(self.kmers, counts=counts)
+        assert (list(densities_df.index) == \
+                [header[1:] for header, seq in self.fasta_recs])
+        assert (densities_df["sum_counts"].tolist() == \
+                counts.sum(axis=1).tolist())
+        assert (densities_df["obs_counts"].iloc[0] == \
+                ",".join(map(str, counts[0])))
+
+
+    def test_any_kmers(self):
+        """
+        Test that kmers of any lengths and bases are counted as
+        in each region: long kmers, repeated kmers, kmers with
+        lowercase bases or Ns, and kmers that would run across
+        regions.
+        """
+        scorer = kmer_scorer.KmerScorer(self.fasta_recs)
+        seq = self.fasta_recs[2][1]
+        kmers = ["ACG", "ACG", "AC", "acg", "ANA", "NN", "Na", "N",
+                 seq[0:14], seq[-13:], seq[3:35], seq.upper(), "",
+                 "ACGTACGTACGTACG"]
+        counts = self.check_kmers(scorer, kmers)
+        assert (counts[:, 0].tolist() == counts[:, 1].tolist())
+        assert (counts[2, 8] >= 1)
+        # Regions are not joined
+        first_seqs = [self.fasta_recs[n][1] for n in xrange(2)]
+        for length in xrange(1, 4):
+            joined = first_seqs[0][-length:] + "N" + first_seqs[1][0:length]
+            assert (scorer.count_kmers([joined]).sum() == \
+                    sum([seq_counter.overlap_count(seq, joined) \
+                         for header, seq in self.fasta_recs]))
+        # Scanning in chunks finds the same occurrences
+        scorer.found_kmers = None
+        hits = scorer.find_kmers(kmers, chunk_size=7)
+        scorer.found_kmers = None
+        for found, other_found in zip(hits, scorer.find_kmers(kmers)):
+            assert (found.tolist() == other_found.tolist())
+
+
+    def test_rank_weighted_densities(self):
+        """
+        Test that weighted densities of all regions match scoring
+        one region at a time.
+        """
+        scorer = kmer_scorer.load_fasta_scorer(self.fasta_fname)
+        counts = scorer.count_kmers(self.kmers)
+        bns = bindnseq.BindnSeq(self.output_dir, self.output_dir)
+        densities_df = scorer.get_densities_df(self.kmers, counts=counts)
+        densities_df = bns.add_rank_weighted_densities(densities_df,
+                                                       self.fc_rank, 3)
+        fc_rank = np.array(self.fc_rank)
+        for seq_num, seq_counts in enumerate(counts):
+            seq_len = scorer.seq_lens[seq_num]
+            seq_counts = np.where(fc_rank >= bindnseq.FC_FILTER,
+                                  seq_counts, 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                weighted_density = \
+                    max(np.sum(seq_counts / ((seq_len - 3 + 1) / 1000.)),
+                        2**(-8))
+            max_kmer_fc = 2**(-8)
+            if seq_counts.sum() > 0:
+                max_kmer_fc = fc_rank[seq_counts > 0].max()
+            if seq_len < 15:
+                weighted_density = max_kmer_fc = 2**(-8)
+            assert (np.allclose(np.log2(weighted_density),
+                                densities_df["log2_weighted_density"][seq_num]))
+            assert (max_kmer_fc == densities_df["max_kmer_fc"][seq_num])
+
+
+    def test_output_bed(self):
+        """
+        Test that occurrences are output on both strands.
+        """
+        fasta_recs = [(">chr1:101-112:+;a", "GGACGTTTTACG"),
+                      (">chr1:101-112:-;b", "GGACGTTTTACG")]
+        with open(self.fasta_fname, "w") as fasta_out:
+            fasta_utils.write_fasta(fasta_out, fasta_recs)
+        bns = bindnseq.BindnSeq(self.output_dir, self.output_dir)
+        enriched_kmers = pandas.DataFrame({"kmer": ["ACG", "TTT"],
+                                           "rank": [4.0, 1.0]})
+        bed_fname = os.path.join(self.output_dir, "kmers.bed")
+        bns.output_enriched_kmers_as_bed(self.fasta_fname, enriched_kmers,
+                                         {"ACG": 4.0, "TTT": 1.0}, 3,
+                                         bed_fname)
+        with open(bed_fname) as bed_in:
+            bed_lines = [line.strip().split("\t") for line in bed_in]
+        assert (bed_lines[0][0].startswith("track"))
+        # Plus strand: 0-based starts in chromosome from the
+        # region start, minus strand: from the region end
+        assert ([line[0:6] for line in bed_lines[1:]] == \
+                [["chr1", "102", "105", "ACG", "1000", "+"],
+                 ["chr1", "109", "112", "ACG", "1000", "+"],
+                 ["chr1", "105", "108", "TTT", "1", "+"],
+                 ["chr1", "106", "109", "TTT", "1", "+"],
+                 ["chr1", "107", "110", "ACG", "1000", "-"],
+                 ["chr1", "100", "103", "ACG", "1000", "-"],
+                 ["chr1", "104", "107", "TTT", "1", "-"],
+                 ["chr1", "103", "106", "TTT", "1", "-"]])
@@ -0,0 +1,209 @@
+##
+## Unit testing for counting of kmers
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fasta_utils as fasta_utils
+import rnaseqlib.motif.kmer_utils as kmer_utils
+
+
+def make_fasta(fasta_fname, num_seqs, seed=1):
+    """
+    Write FASTA file of sequences of varying lengths with
+    some lowercase bases, Ns and Us.
+    """
+    rand = np.random.RandomState(seed)
+    fasta_recs = []
+    for seq_num in xrange(num_seqs):
+        seq = "".join(rand.choice(list("ACGTACGTACGTacgN"),
+                                  rand.randint(0, 80)))
+        if seq_num % 5 == 0:
+            seq = seq.replace("T", "U")
+        fasta_recs.append((">seq%d" %(seq_num), seq))
+    with open(fasta_fname, "w") as fasta_out:
+        fasta_utils.write_fasta(fasta_out, fasta_recs)
+
+
+class TestKmerUtils:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.fasta_fname = os.path.join(self.output_dir, "seqs.fa")
+        make_fasta(self.fasta_fname, 300)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_kmer_codes(self):
+        kmers = kmer_utils.enumerate_kmers(3)
+        assert (len(kmers) == 64)
+        assert (kmers[0:5] == ["AAA", "AAC", "AAG", "AAT", "ACA"])
+        assert (kmers == sorted(kmers))
+        kmer_codes = kmer_utils.kmers_to_codes(kmers + ["ANA", "AC"], 3)
+        assert (kmer_codes.tolist() == range(64) + [-1, -1])
+        revcomp_codes = kmer_utils.get_revcomp_codes(np.arange(64), 3)
+        assert (kmer_utils.codes_to_kmers(revcomp_codes[0:2], 3) == \
+                ["TTT", "GTT"])
+        # Kmers do not span sequences or invalid bases
+        base_codes = kmer_utils.encode_seqs(["ACGTNAC", "GTA"])
+        assert (kmer_utils.codes_to_kmers(kmer_utils.get_kmer_codes(base_codes,
+                                                                    2), 2) == \
+                ["AC", "CG", "GT", "AC", "GT", "TA"])
+
+
+    def test_count_kmers(self):
+        """
+        Test that counting kmers in process matches counting
+        kmers one at a time, for dense and sparse counts and on
+        both strands.
+        """
+        for kmer_len in [1, 4, 7, kmer_utils.MAX_DENSE_KMER_LEN + 2]:
+            for both_strands in [False, True]:
+                kmers = kmer_utils.Kmers(kmer_len,
+                                         fasta_fname=self.fasta_fname,
+                                         both_strands=both_strands)
+                naive_counts = \
+                    dict(kmers.count_kmers_naive(self.fasta_fname))
+                kmer_counts = kmers.count_kmers(self.fasta_fname,
+                                                self.output_dir)
+                assert (kmer_counts.is_dense == \
+                        (kmer_len <= kmer_utils.MAX_DENSE_KMER_LEN))
+                assert (dict(kmer_counts.iteritems()) == naive_counts)
+                assert (len(kmer_counts) == len(naive_counts))
+                found_kmers = sorted(naive_counts.keys())[0:20]
+                found_counts = kmer_counts.get_counts(found_kmers + ["A" * 40])
+                assert (found_counts.tolist() == \
+                        [naive_counts[kmer] for kmer in found_kmers] + [0])
+                assert (kmer_counts[found_kmers[0]] == \
+                        naive_counts[found_kmers[0]])
+
+
+    def test_count_batches(self):
+        """
+        Test that counts do not depend on the batch size.
+        """
+        kmers = kmer_utils.Kmers(kmer_utils.MAX_DENSE_KMER_LEN + 1)
+        all_counts = []
+        for batch_size in [1, 7, 1000]:
+            kmer_counts = kmers.count_kmers_numpy(self.fasta_fname,
+                                                  batch_size=batch_size)
+            all_counts.append(dict(kmer_counts.iteritems()))
+        assert (all_counts[0] == all_counts[1] == all_counts[2])
+        # Merging kmers into the kmers held after each sequence
+        kmer_counts = kmer_utils.KmerCounts(kmers.kmer_len)
+        for fasta_name, fasta_seq in fasta_utils.read_fasta(self.fasta_fname):
+            kmer_counts.add_seqs([fasta_seq, fasta_seq])
+            kmer_counts.merge_pending()
+        assert (dict(kmer_counts.iteritems()) == \
+                dict([(kmer, 2 * count) \
+                      for kmer, count in all_counts[0].iteritems()]))
+
+
+    def test_dinuc_shuffle(self):
+        """
+        Test that shuffles keep the dinucleotide counts, the
+        first and last bases and the positions of Ns.
+        """
+        rand = np.random.RandomState(1)
+        for seq in ["ACGTTGCAAACCGGTT", "AAAAAAAT", "ACNGTTGACGTANNCCA",
+                    "ACGUacgu", "ACG", "A"]:
+            seq = seq.upper().replace("U", "T")
+            seq_kmers = kmer_utils.KmerCounts(2)
+            seq_kmers.add_seqs([seq])
+            for shuffle_num in xrange(20):
+                shuffled_seq = kmer_utils.dinuc_shuffle_seq(seq, rand)
+                shuffled_kmers = kmer_utils.KmerCounts(2)
+                shuffled_kmers.add_seqs([shuffled_seq])
+                assert (np.array_equal(shuffled_kmers.counts,
+                                       seq_kmers.counts))
+                assert (shuffled_seq[0] == seq[0])
+                assert (shuffled_seq[-1] == seq[-1])
+                assert ([n for n, base in enumerate(shuffled_seq) \
+                         if base == "N"] == \
+                        [n for n, base in enumerate(seq) if base == "N"])
+        # Shuffles are not all the same
+        shuffles = set([kmer_utils.dinuc_shuffle_seq("ACGTTGCAAACCGGTT", rand) \
+                        for n in xrange(20)])
+        assert (len(shuffles) > 1)
+
+
+    def test_count_shuffled_kmers(self):
+        """
+        Test that kmer counts of shuffles do not depend on the
+        number of processes, and match counting the shuffles.
+        """
+        kmers = ["AAA", "ACG", "TTT", "GCA", "NNN"]
+        all_shuffled_counts = \
+            [kmer_utils.count_shuffled_kmers(self.fasta_fname, 3, 5,
+                                             kmers=kmers,
+                                             num_procs=num_procs,
+                                             seed=10) \
+             for num_procs in [1, 2]]
+        assert (all_shuffled_counts[0].shape == (5, len(kmers)))
+        assert (np.array_equal(all_shuffled_counts[0],
+                               all_shuffled_counts[1]))
+        base_codes = \
+            kmer_utils.encode_seqs([seq for name, seq in \
+                                    fasta_utils.read_fasta(self.fasta_fname)])
+        for shuffle_num in xrange(5):
+            rand = np.random.RandomState(10 + shuffle_num)
+            shuffled_codes = kmer_utils.dinuc_shuffle_codes(base_codes, rand)
+            kmer_counts = kmer_utils.KmerCounts(3)
+            kmer_counts.add_base_codes(shuffled_codes)
+            assert (np.array_equal(kmer_counts.get_counts(kmers),
+                                   all_shuffled_counts[0][shuffle_num]))
+        # Dense counts of all kmers
+        shuffled_counts = kmer_utils.count_shuffled_kmers(self.fasta_fname,
+                                                          2, 3)
+        assert (shuffled_counts.shape == (3, 16))
+        # Shuffles keep the dinucleotide counts
+        kmer_counts = kmer_utils.KmerCounts(2)
+        kmer_counts.add_base_codes(base_codes)
+        assert ((shuffled_counts == kmer_counts.counts).all())
+
+
+    def test_subseq_finder(self):
+        """
+        Test that finding many subsequences at once matches
+        finding each subsequence with 'str.find'.
+        """
+        # Subsequences longer than MAX_TABLE_KMER_LEN are looked
+        # up in their sorted codes
+        long_subseq = "G" * (kmer_utils.MAX_TABLE_KMER_LEN + 1)
+        subseqs = ["AC", "ACG", "AAA", "TTT", "ACG", "CGTAC", "acg",
+                   "ANA", "", "G" * (kmer_utils.MAX_KMER_LEN + 1), "T",
+                   long_subseq, long_subseq]
+        subseq_finder = kmer_utils.SubseqFinder(subseqs)
+        assert (subseq_finder.is_coded.tolist() == \
+                [True] * 5 + [True, False, False, False, False, True] + \
+                [True, True])
+        for name, seq in fasta_utils.read_fasta(self.fasta_fname):
+            seq = seq + "AAAA" + "G" * (kmer_utils.MAX_KMER_LEN + 2)
+            counts = subseq_finder.count(seq)
+            all_starts = subseq_finder.find_starts(seq)
+            seq_codes = \
+                kmer_utils.EXACT_BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+            occ_starts, occ_inds = subseq_finder.find_occurrences(seq_codes)
+            for subseq_ind, subseq in enumerate(subseqs):
+                if not subseq_finder.is_coded[subseq_ind]:
+                    assert (all_starts[subseq_ind] is None)
+                    continue
+                starts = []
+                start = seq.find(subseq)
+                while start != -1:
+                    starts.append(start)
+                    start = seq.find(subseq, start + 1)
+                assert (counts[subseq_ind] == len(starts))
+                assert (all_starts[subseq_ind] == starts)
+                assert (sorted(occ_starts[occ_inds == subseq_ind].tolist()) == \
+                        starts)
+        # Sequences shorter than the subsequences
+        assert (subseq_finder.count("A").tolist() == [0] * len(subseqs))
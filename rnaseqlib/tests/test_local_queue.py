@@ -0,0 +1,117 @@
+##
+## Unit testing for running jobs on the local machine
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.cluster_utils.cluster as cluster
+import rnaseqlib.cluster_utils.LocalQueue as local_queue
+
+
+def get_sleep_cmd(events_fname, job_name, secs):
+    """
+    Shell command that records when it starts and ends.
+    """
+    return "echo start %s >> %s; sleep %s; echo end %s >> %s" \
+        %(job_name, events_fname, secs, job_name, events_fname)
+
+
+def get_max_running(events_fname):
+    """
+    Return maximum number of jobs that ran at once.
+    """
+    num_running = 0
+    max_running = 0
+    with open(events_fname) as events_file:
+        for line in events_file:
+            if line.startswith("start"):
+                num_running += 1
+            else:
+                num_running -= 1
+            max_running = max(max_running, num_running)
+    return max_running
+
+
+class TestLocalQueue:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.events_fname = os.path.join(self.output_dir, "events.txt")
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_max_jobs(self):
+        queue = local_queue.LocalQueue(max_jobs=3, max_cpus=8)
+        t1 = time.time()
+        job_ids = [queue.submit(get_sleep_cmd(self.events_fname,
+                                              "job%d" %(n), 0.3),
+                                "job%d" %(n)) \
+                   for n in range(9)]
+        exit_codes = queue.wait_all()
+        t2 = time.time()
+        assert (exit_codes == dict([(job_id, 0) for job_id in job_ids]))
+        assert (get_max_running(self.events_fname) == 3)
+        # Three batches of jobs rather than nine jobs in a row
+        assert (t2 - t1 < 9 * 0.3)
+
+
+    def test_reservations(self):
+        # Jobs reserving 2 of 3 CPUs run one at a time
+        queue = local_queue.LocalQueue(max_jobs=3, max_cpus=3)
+        for n in range(3):
+            queue.submit(get_sleep_cmd(self.events_fname, "job%d" %(n), 0.1),
+                         "job%d" %(n), num_cpus=2)
+        queue.wait_all()
+        assert (get_max_running(self.events_fname) == 1)
+        # Likewise for memory
+        os.remove(self.events_fname)
+        queue = local_queue.LocalQueue(max_jobs=3, max_cpus=8,
+                                       max_mem_gb=4)
+        for n in range(4):
+            queue.submit(get_sleep_cmd(self.events_fname, "job%d" %(n), 0.1),
+                         "job%d" %(n), mem_gb=2)
+        queue.wait_all()
+        assert (get_max_running(self.events_fname) == 2)
+
+
+    def test_retries(self):
+        queue = local_queue.LocalQueue(max_jobs=2, max_cpus=2)
+        counter_fname = os.path.join(self.output_dir, "counter.txt")
+        # Job that fails the first two times it runs
+        flaky_cmd = "echo run >> %s; test `wc -l < %s` -ge 3" \
+            %(counter_fname, counter_fname)
+        log_fname = os.path.join(self.output_dir, "logs", "flaky.out")
+        flaky_id = queue.submit(flaky_cmd, "flaky", num_retries=2,
+                                log_fname=log_fname)
+        failed_id = queue.submit("echo failing; exit 3", "failed",
+                                 num_retries=1)
+        assert (queue.wait(flaky_id) == 0)
+        assert (queue.jobs[flaky_id].exit_codes == [1, 1, 0])
+        assert (queue.wait(failed_id) == 3)
+        assert (queue.jobs[failed_id].num_attempts == 2)
+        assert os.path.isfile(log_fname)
+
+
+    def test_cluster_backend(self):
+        my_cluster = cluster.Cluster("local", self.output_dir, None,
+                                     max_jobs=2,
+                                     max_cpus=2)
+        job_ids = []
+        for n in range(4):
+            job_name = "job%d" %(n)
+            job_ids.append(my_cluster.launch_job(get_sleep_cmd(self.events_fname,
+                                                               job_name, 0.1),
+                                                 job_name))
+        my_cluster.wait_on_jobs(job_ids)
+        assert (get_max_running(self.events_fname) == 2)
+        assert all([my_cluster.get_exit_code(job_id) == 0 \
+                    for job_id in job_ids])
+        # Output of jobs is logged in the output directory
+        logs = os.listdir(os.path.join(self.output_dir, "cluster_scripts"))
+        assert (len(logs) == 4)
@@ -0,0 +1,221 @@
+##
+## Unit testing for QC sequencing cycle profiles
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from collections import defaultdict
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.QualityControl as qc
+
+
+class Sample:
+    def __init__(self, label):
+        self.label = label
+
+
+class SampleQC:
+    """
+    QC object of a sample loaded from its QC output.
+    """
+    def __init__(self, qc_filename):
+        self.qc_header, self.qc_results = qc.load_qc_results(qc_filename)
+
+
+def write_sample_qc(qc_outdir, label, values, mtime):
+    qc_filename = qc.get_qc_filename(qc_outdir, label)
+    if not os.path.isdir(os.path.dirname(qc_filename)):
+        os.makedirs(os.path.dirname(qc_filename))
+    with open(qc_filename, "w") as qc_file:
+        qc_file.write("num_reads\tnum_mapped\tpercent_mapped\n")
+        qc_file.write("\t".join(values) + "\n")
+    # Set modification time explicitly so that rewrites within
+    # the same second are detected
+    os.utime(qc_filename, (mtime, mtime))
+
+
+def write_qc_stats(qc_stats, output_filename):
+    """
+    Write QC stats as done by 'QCStats.to_csv'.
+    """
+    qc_stats.qc_stats.to_csv(output_filename,
+                             sep="\t",
+                             na_rep=qc_stats.na_val,
+                             float_format="%.3f",
+                             index=False,
+                             columns=[qc_stats.sample_header] + \
+                                     qc_stats.qc_header)
+
+
+def get_expected_profile(fastq_fname, num_seqs=None):
+    """
+    Compute per-cycle N counts, base counts and quality counts
+    base by base.
+    """
+    base_counts = defaultdict(lambda: defaultdict(int))
+    qual_counts = defaultdict(lambda: defaultdict(int))
+    num_reads = 0
+    for header, seq, header2, qual in fastq_utils.read_fastq(fastq_fname):
+        if (num_seqs is not None) and (num_reads >= num_seqs):
+            break
+        for n in range(len(seq)):
+            base_counts[n][seq[n]] += 1
+            qual_counts[n][ord(qual[n]) - 33] += 1
+        num_reads += 1
+    return num_reads, base_counts, qual_counts
+
+
+class TestCycleProfile:
+    """
+    Test computation of sequencing cycle profiles.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def check_profile(self, fastq_fname, profile, num_seqs=None):
+        num_reads, base_counts, qual_counts = \
+            get_expected_profile(fastq_fname, num_seqs=num_seqs)
+        assert (profile.num_reads == num_reads)
+        num_cycles = len(base_counts)
+        base_fractions = profile.get_base_fractions()
+        qual_hist = profile.get_qual_hist()
+        assert (len(profile.get_percent_n()) == num_cycles)
+        for n in range(num_cycles):
+            num_cycle_reads = float(sum(base_counts[n].values()))
+            for base in "ACGTN":
+                assert np.allclose(base_fractions[base][n],
+                                   base_counts[n][base] / num_cycle_reads)
+            for qual in qual_counts[n]:
+                assert (qual_hist[n, qual] == qual_counts[n][qual])
+            assert (qual_hist[n].sum() == num_cycle_reads)
+
+
+    def test_fixed_length(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        test_utils.make_synthetic_fastq(fastq_fname, 2000, frac_n=0.05)
+        profile = qc.compute_cycle_profile(fastq_fname, batch_size=300)
+        self.check_profile(fastq_fname, profile)
+        assert (profile.get_percent_n() > 0).all()
+        # First N reads only
+        profile = qc.compute_cycle_profile(fastq_fname, num_seqs=450,
+                                           batch_size=300)
+        self.check_profile(fastq_fname, profile, num_seqs=450)
+
+
+    def test_variable_length(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq.gz")
+        test_utils.make_synthetic_fastq(fastq_fname, 2000,
+                                        min_read_len=20)
+        profile = qc.compute_cycle_profile(fastq_fname, batch_size=300)
+        self.check_profile(fastq_fname, profile)
+        # Later cycles are covered by fewer reads
+        num_cycle_reads = profile.get_num_cycle_reads()
+        assert (num_cycle_reads[0] == 2000)
+        assert (num_cycle_reads[-1] < num_cycle_reads[0])
+
+
+    def test_random_sample(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        test_utils.make_synthetic_fastq(fastq_fname, 3000)
+        seqs, quals = qc.sample_fastq_reads(fastq_fname, 500,
+                                            batch_size=200, seed=3)
+        assert (len(seqs) == 500)
+        all_reads = [(seq, qual) for header, seq, header2, qual \
+                     in fastq_utils.read_fastq(fastq_fname)]
+        assert (set(zip(seqs, quals)) <= set(all_reads))
+        # Sample should come from the whole file, not its start
+        positions = sorted([all_reads.index(read) \
+                            for read in zip(seqs, quals)])
+        assert (positions[-1] > 2500)
+        profile = qc.compute_cycle_profile(fastq_fname, num_seqs=500,
+                                           sampling="random",
+                                           seed=3)
+        assert (profile.num_reads == 500)
+
+
+    def test_blank_lines(self):
+        """
+        Test that profiles skip blank lines like 'read_fastq'.
+        """
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        with open(fastq_fname, "w") as fastq_file:
+            for n in range(10):
+                fastq_file.write("@read%d\nACGT%s\n+\nIIII%s\n" \
+                                 %(n, "A" * (n % 2), "I" * (n % 2)))
+                if n % 3 == 0:
+                    fastq_file.write("\n")
+        profile = qc.compute_cycle_profile(fastq_fname, batch_size=4)
+        self.check_profile(fastq_fname, profile)
+        assert (profile.get_num_cycle_reads().tolist() == [10] * 4 + [5])
+
+
+class TestCompileQC:
+    """
+    Test incremental compilation of QC stats.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.qc_stats_fname = os.path.join(self.output_dir, "qc_stats.txt")
+        self.num_loaded = 0
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def load_qc_object(self, sample):
+        self.num_loaded += 1
+        return SampleQC(qc.get_qc_filename(self.output_dir, sample.label))
+
+
+    def compile_qc(self, samples, qc_stats_fname):
+        qc_stats = qc.compile_qc_stats(samples, self.output_dir,
+                                       qc_stats_fname, {},
+                                       self.load_qc_object)
+        write_qc_stats(qc_stats, qc_stats_fname)
+        qc.save_compiled_fingerprints(qc_stats_fname, qc_stats.fingerprints)
+        return open(qc_stats_fname).read()
+
+
+    def test_incremental_compile(self):
+        samples = [Sample("sample%d" %(n)) for n in range(4)]
+        write_sample_qc(self.output_dir, "sample0", ["100", "90", "0.9"], 1000)
+        write_sample_qc(self.output_dir, "sample1", ["200", "NA", "NA"], 1000)
+        write_sample_qc(self.output_dir, "sample2", ["300", "30", ""], 1000)
+        self.compile_qc(samples[0:3], self.qc_stats_fname)
+        assert (self.num_loaded == 3)
+        # Nothing changed
+        self.num_loaded = 0
+        self.compile_qc(samples[0:3], self.qc_stats_fname)
+        assert (self.num_loaded == 0)
+        # Change a sample and add a new one
+        write_sample_qc(self.output_dir, "sample1", ["200", "50", "0.25"], 2000)
+        write_sample_qc(self.output_dir, "sample3", ["400", "4", "0.01"], 1000)
+        self.num_loaded = 0
+        compiled = self.compile_qc(samples, self.qc_stats_fname)
+        assert (self.num_loaded == 2)
+        # Same output as compiling from scratch
+        full_fname = os.path.join(self.output_dir, "full_qc_stats.txt")
+        self.num_loaded = 0
+        assert (compiled == self.compile_qc(samples, full_fname))
+        assert (self.num_loaded == 4)
+        assert ("sample1\t200\t50\t0.25" in compiled)
+        # A modified compiled output is compiled from scratch
+        with open(self.qc_stats_fname, "a") as qc_stats_file:
+            qc_stats_file.write("\n")
+        self.num_loaded = 0
+        self.compile_qc(samples, self.qc_stats_fname)
+        assert (self.num_loaded == 4)
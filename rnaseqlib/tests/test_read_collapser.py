@@ -0,0 +1,116 @@
+##
+## Unit testing for collapsing of duplicate reads
+##
+import os
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+
+from collections import Counter
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.clip.ReadCollapser as read_collapser
+
+
+def make_duplicated_fastq(fastq_fname, num_reads, num_distinct, seed=1):
+    """
+    Write FASTQ file with reads drawn from 'num_distinct'
+    sequences of varying lengths, each read with its own
+    qualities.
+    """
+    rand = np.random.RandomState(seed)
+    distinct_seqs = ["".join(rand.choice(list("ACGTN"),
+                                         rand.randint(15, 30))) \
+                     for n in xrange(num_distinct)]
+    records = []
+    for read_num in xrange(num_reads):
+        seq = distinct_seqs[min(int(rand.exponential(num_distinct / 10.)),
+                                num_distinct - 1)]
+        qual = "".join(rand.choice(list("#@IJ+"), len(seq)))
+        records.append(("read%d" %(read_num), seq, "+", qual))
+    with fastq_utils.FastqWriter(fastq_fname) as writer:
+        writer.write_records(records)
+    return records
+
+
+class TestReadCollapser:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.fastq_fname = os.path.join(self.output_dir, "reads.fastq.gz")
+        self.records = make_duplicated_fastq(self.fastq_fname, 5000, 300)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def collapse(self, label, max_seqs):
+        collapser = read_collapser.ReadCollapser(self.output_dir,
+                                                 max_seqs=max_seqs)
+        for start in range(0, len(self.records), 700):
+            collapser.add_records(self.records[start:start + 700])
+        num_runs = len(collapser.run_fnames)
+        collapsed_fname = os.path.join(self.output_dir,
+                                       "%s.fastq.gz" %(label))
+        counts_fname = os.path.join(self.output_dir, "%s.txt" %(label))
+        stats = collapser.output_collapsed(collapsed_fname, counts_fname)
+        return num_runs, stats, \
+            gzip.open(collapsed_fname).read(), open(counts_fname).read()
+
+
+    def test_collapse(self):
+        num_runs, stats, collapsed, counts = self.collapse("in_memory",
+                                                           10**6)
+        assert (num_runs == 0)
+        seq_counts = Counter([rec[1] for rec in self.records])
+        assert (stats["num_reads"] == 5000)
+        assert (stats["num_seqs"] == len(seq_counts))
+        assert (stats["max_reads_per_seq"] == max(seq_counts.values()))
+        # Collapsed reads are sorted by sequence and keep the
+        # qualities of the first read with the sequence
+        first_quals = {}
+        for header, seq, header2, qual in self.records:
+            first_quals.setdefault(seq, qual)
+        collapsed_records = \
+            fastq_utils.parse_fastq_data(collapsed)
+        assert ([rec[1] for rec in collapsed_records] == \
+                sorted(seq_counts.keys()))
+        for n, (header, seq, header2, qual) in enumerate(collapsed_records):
+            assert (header == "%d-%d" %(n + 1, seq_counts[seq]))
+            assert (qual == first_quals[seq])
+        # Table of reads per sequence
+        lines = counts.splitlines()
+        assert (lines[0] == "read_id\tsequence\tnum_reads")
+        assert (lines[1:] == ["%s\t%s\t%d" %(rec[0], rec[1],
+                                             seq_counts[rec[1]]) \
+                              for rec in collapsed_records])
+
+
+    def test_spill(self):
+        """
+        Test that spilling runs to disk gives the same output.
+        """
+        in_memory = self.collapse("in_memory", 10**6)
+        spilled = self.collapse("spilled", 50)
+        assert (spilled[0] > 3)
+        assert (in_memory[1:] == spilled[1:])
+        # Runs are removed
+        assert (len([fname for fname in os.listdir(self.output_dir) \
+                     if fname.startswith("collapse_run")]) == 0)
+
+
+    def test_collapse_fastq(self):
+        collapsed_fname = read_collapser.collapse_fastq(self.fastq_fname,
+                                                        self.output_dir,
+                                                        max_seqs=100)
+        assert (collapsed_fname.endswith("reads.collapsed.fastq.gz"))
+        num_collapsed = sum([int(rec[0].split("-")[1]) for rec \
+                             in fastq_utils.read_fastq(collapsed_fname)])
+        assert (num_collapsed == 5000)
+        assert os.path.isfile(os.path.join(self.output_dir,
+                                           "reads.collapsed.counts.txt"))
@@ -0,0 +1,102 @@
+##
+## Unit testing for Ribo-Seq utilities
+##
+import os
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fastq_utils as fastq_utils
+import rnaseqlib.ribo.ribo_utils as ribo_utils
+import rnaseqlib.tests.test_utils as test_utils
+
+
+def trim_serially(records, min_polyA_len=3, min_read_len=22):
+    """
+    Trim polyA ends one read at a time, as done prior to
+    batch trimming.
+    """
+    trimmed_records = []
+    for header, seq, header2, qual in records:
+        if not seq.endswith("A"):
+            continue
+        if seq[-min_polyA_len:] != ("A" * min_polyA_len):
+            continue
+        stripped_seq = ribo_utils.rstrip_stretch(seq, "A")
+        if len(stripped_seq) < min_read_len:
+            continue
+        trimmed_records.append((header, stripped_seq, header2,
+                                qual[0:len(stripped_seq)]))
+    return trimmed_records
+
+
+class TestTrimPolyA:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_polyA_lens(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        polyA_lens = test_utils.make_polyA_fastq(fastq_fname, 1000,
+                                                 read_len=30,
+                                                 max_polyA_len=30)
+        seqs = [rec[1] for rec in fastq_utils.read_fastq(fastq_fname)]
+        assert (ribo_utils.get_polyA_lens(seqs) == polyA_lens).all()
+        # Sequences of different lengths
+        seqs = ["ACGTAAA", "", "AAAA", "ACG", "GAAAAAAAAAAAAA", "AT"]
+        assert (ribo_utils.get_polyA_lens(seqs).tolist() == \
+                [3, 0, 4, 0, 13, 0])
+
+
+    def test_trim_records(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq")
+        test_utils.make_polyA_fastq(fastq_fname, 2000, read_len=40)
+        records = list(fastq_utils.read_fastq(fastq_fname))
+        # Reads of different lengths and qualities longer than
+        # sequences
+        records.extend([("odd1", "ACGTAAAAA", "+", "IIIIIIIIIII"),
+                        ("odd2", "AAAAAAAA", "+", "IIIIIIII"),
+                        ("odd3", "CCCCCCCCCCCCCCCCCCCCCCCCCAAAA", "+",
+                         "JJJJJJJJJJJJJJJJJJJJJJJJJJJJJ")])
+        for min_polyA_len, min_read_len in [(3, 22), (1, 0), (10, 5)]:
+            trimmed_records, trimmed_lens = \
+                ribo_utils.trim_polyA_records(records,
+                                              min_polyA_len=min_polyA_len,
+                                              min_read_len=min_read_len)
+            expected = trim_serially(records,
+                                     min_polyA_len=min_polyA_len,
+                                     min_read_len=min_read_len)
+            assert (trimmed_records == expected)
+            assert (trimmed_lens.tolist() == \
+                    [len(rec[1]) for rec in expected])
+
+
+    def test_trim_polyA_ends(self):
+        fastq_fname = os.path.join(self.output_dir, "reads.fastq.gz")
+        polyA_lens = test_utils.make_polyA_fastq(fastq_fname, 3000,
+                                                 read_len=40)
+        trimmed_fname = ribo_utils.trim_polyA_ends(fastq_fname,
+                                                   self.output_dir,
+                                                   min_read_len=25)
+        trimmed_records = list(fastq_utils.read_fastq(trimmed_fname))
+        expected = trim_serially(fastq_utils.read_fastq(fastq_fname),
+                                 min_read_len=25)
+        assert (trimmed_records == expected)
+        # Histogram of trimmed read lengths
+        kept = (polyA_lens >= 3) & (40 - polyA_lens >= 25)
+        expected_hist = np.bincount(40 - polyA_lens[kept])
+        hist_fname = ribo_utils.get_trimmed_lens_filename(trimmed_fname)
+        with open(hist_fname) as hist_file:
+            assert (hist_file.readline() == "read_len\tnum_reads\n")
+            hist = dict([map(int, line.split("\t")) for line in hist_file])
+        assert (hist == dict([(read_len, num_reads) for read_len, num_reads \
+                              in enumerate(expected_hist) if num_reads > 0]))
@@ -0,0 +1,144 @@
+##
+## Unit testing for RPKM computation
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from collections import defaultdict
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.tests.test_utils as test_utils
+import rnaseqlib.tables as tables
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.coverage.coverage_utils as coverage_utils
+
+
+def format_gff_tag(regions):
+    """
+    Format regions as in BAM produced by tagBam against a GFF.
+    """
+    return ",".join(["gff:%s:%d-%d,exon,.,%s" %(chrom, start, end, strand) \
+                     for chrom, start, end, strand in regions])
+
+
+def make_const_exons(output_dir, table_name, regions,
+                     exons_per_gene=3):
+    """
+    Write constitutive exons GFF and genes to exons table for
+    the given regions, grouping consecutive regions into genes.
+    Returns the loaded ConstExons object.
+    """
+    gff_fname = os.path.join(output_dir, "%s.const_exons.gff" %(table_name))
+    genes_fname = os.path.join(output_dir,
+                               "%s.const_exons.to_genes.txt" %(table_name))
+    with open(gff_fname, "w") as gff_file:
+        for chrom, start, end, strand in regions:
+            gff_file.write("%s\tconst\texon\t%d\t%d\t.\t%s\t.\t" \
+                           "ID=%s:%d-%d:%s\n" %(chrom, start + 1, end, strand,
+                                                chrom, start + 1, end, strand))
+    with open(genes_fname, "w") as genes_file:
+        genes_file.write("gene_id\texons\n")
+        for gene_num, first in enumerate(range(0, len(regions),
+                                               exons_per_gene)):
+            exons = ["%s:%d-%d:%s" %(chrom, start + 1, end, strand) \
+                     for chrom, start, end, strand \
+                     in regions[first:first + exons_per_gene]]
+            if gene_num % 2 == 1:
+                exons = ["cds.%s" %(exon) for exon in exons]
+            genes_file.write("gene%d\t%s\n" %(gene_num, ",".join(exons)))
+        genes_file.write("gene_na\tNA\n")
+    return tables.ConstExons(table_name, from_dir=output_dir)
+
+
+def get_expected_rpkms(region_to_count, num_mapped, const_exons):
+    """
+    Compute RPKM of each gene one gene at a time.
+    """
+    expected = {}
+    for gene_info in const_exons.genes_to_exons:
+        if gene_info["exons"] == "NA":
+            continue
+        exons = gene_info["exons"].split(",")
+        sum_counts = sum([region_to_count.get(rpkm_utils.get_region_key(e), 0) \
+                          for e in exons])
+        sum_lens = sum([const_exons.exon_lens[e] for e in exons])
+        expected[gene_info["gene_id"]] = \
+            (sum_counts, rpkm_utils.compute_rpkm(sum_counts, sum_lens,
+                                                 num_mapped))
+    return expected
+
+
+class TestRPKM:
+    """
+    Test that counting reads with an index of the constitutive
+    exons gives the same results as counting reads in BAM
+    produced by tagBam.
+    """
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.bam_fname = os.path.join(self.output_dir, "sample.bam")
+        test_utils.make_synthetic_bam(self.bam_fname, 3000)
+        # Exons on the genome's chromosomes but not on chrRibo
+        self.regions = \
+            test_utils.make_synthetic_regions(2000,
+                                              chroms=test_utils.SYNTHETIC_CHROMS[:2],
+                                              max_len=1000)
+        self.const_exons = make_const_exons(self.output_dir, "ensGene",
+                                            self.regions)
+        self.tagged_bam_fname = os.path.join(self.output_dir, "tagged.bam")
+        test_utils.make_synthetic_tagged_bam(self.bam_fname,
+                                             self.tagged_bam_fname,
+                                             self.regions,
+                                             format_gff_tag,
+                                             contained=True)
+        self.exons_index = \
+            rpkm_utils.load_gff_regions_index(self.const_exons.gff_filename)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_region_counts(self):
+        tagged_counts = rpkm_utils.get_gff_region_counts(self.tagged_bam_fname)
+        for num_processors in [1, 3]:
+            counts = \
+                rpkm_utils.get_gff_region_counts_from_bam(self.bam_fname,
+                                                          self.exons_index,
+                                                          num_processors=num_processors)
+            assert (len(counts) > 0)
+            assert (dict(counts) == dict(tagged_counts))
+
+
+    def test_gene_rpkms(self):
+        region_counts = \
+            rpkm_utils.get_gff_region_counts_from_bam(self.bam_fname,
+                                                      self.exons_index)
+        num_mapped = 3000
+        rpkm_df = rpkm_utils.compute_gene_rpkms(region_counts, num_mapped,
+                                                self.const_exons)
+        expected = get_expected_rpkms(region_counts, num_mapped,
+                                      self.const_exons)
+        assert (len(rpkm_df) == len(expected))
+        assert (rpkm_df["counts"].sum() > 0)
+        for row_num, row in rpkm_df.iterrows():
+            expected_counts, expected_rpkm = expected[row["gene_id"]]
+            assert (row["counts"] == expected_counts)
+            assert (row["rpkm"] == expected_rpkm)
+
+
+    def test_exons_coverage(self):
+        tagged_stats = \
+            coverage_utils.get_exons_coverage_from_tagBam(self.tagged_bam_fname)
+        stats = coverage_utils.get_exons_coverage_from_bam(self.bam_fname,
+                                                           self.exons_index,
+                                                           num_processors=3)
+        assert (len(stats) > 0)
+        assert (sorted(stats.keys()) == sorted(tagged_stats.keys()))
+        for exon in stats:
+            assert (str(stats[exon]) == str(tagged_stats[exon]))
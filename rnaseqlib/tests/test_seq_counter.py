@@ -0,0 +1,117 @@
+##
+## Unit testing for counting of subsequences
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.fasta_utils as fasta_utils
+import rnaseqlib.motif.seq_counter as seq_counter
+import rnaseqlib.motif.dinuc_freq as dinuc_freq
+
+
+class TestSeqCounter:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+        self.fasta_fname = os.path.join(self.output_dir, "seqs.fa")
+        rand = np.random.RandomState(1)
+        self.fasta_recs = \
+            [(">seq%d" %(seq_num),
+              "".join(rand.choice(list("ACGTACGTacgN"),
+                                  rand.randint(5, 100)))) \
+             for seq_num in xrange(250)]
+        with open(self.fasta_fname, "w") as fasta_out:
+            fasta_utils.write_fasta(fasta_out, self.fasta_recs)
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_count_subseqs(self):
+        """
+        Test that counting all subsequences at once matches
+        counting them one at a time.
+        """
+        subseqs = ["ACG", "CGT", "AAA", "acg", "ANA", "GT", "ACG"]
+        counter = seq_counter.SeqCounter(self.fasta_fname)
+        for name, seq in self.fasta_recs:
+            counts = counter.count_subseqs(seq, subseqs)
+            assert (counts.tolist() == \
+                    [seq_counter.overlap_count(seq, subseq) \
+                     for subseq in subseqs])
+            starts = counter.count_subseqs_with_starts(seq, subseqs)
+            assert (starts == \
+                    [(subseq,
+                      seq_counter.overlap_count_with_starts(seq, subseq)[1]) \
+                     for subseq in subseqs])
+
+
+    def test_obs_exp_counts(self):
+        """
+        Test that expected counts do not depend on the number of
+        sequences modelled at once, and that all sequences are
+        counted.
+        """
+        subseqs = ["ACG", "CGT", "AAAA"]
+        all_counts = []
+        for batch_size in [1, 7, 1000]:
+            counter = seq_counter.SeqCounter(self.fasta_fname)
+            seq_counts = \
+                counter.iter_obs_exp_counts_dinuc(subseqs,
+                                                  batch_size=batch_size)
+            all_counts.append(list(seq_counts))
+        assert (len(all_counts[0]) == len(self.fasta_recs))
+        for counts, other_counts in zip(all_counts[0], all_counts[2]):
+            assert (counts[0] == other_counts[0])
+            assert (np.array_equal(counts[1], other_counts[1]))
+            assert (np.allclose(counts[2], other_counts[2]))
+        for counts, (name, seq) in zip(all_counts[1], self.fasta_recs):
+            obs_counts, exp_counts = counter.count_dinuc_subseqs(seq, subseqs)
+            assert (counts[0] == name[1:])
+            assert (np.array_equal(counts[1], obs_counts))
+            assert (np.allclose(counts[2], exp_counts))
+
+
+    def test_obs_over_exp_counts(self):
+        """
+        Test table of observed over expected counts of all
+        sequences, sorted by maximum ratio.
+        """
+        subseqs = ["ACG", "CGT", "AAAA"]
+        counter = seq_counter.SeqCounter(self.fasta_fname)
+        ratios_df = counter.obs_over_exp_counts_dinuc(subseqs, batch_size=7)
+        assert (sorted(ratios_df.index) == \
+                sorted([name[1:] for name, seq in self.fasta_recs]))
+        # Sequences with no defined ratio are sorted last
+        max_ratios = ratios_df["max_ratio"].values
+        num_defined = np.sum(~np.isnan(max_ratios))
+        assert (num_defined > 0)
+        assert (not np.any(np.isnan(max_ratios[0:num_defined])))
+        assert (np.all(max_ratios[0:num_defined - 1] >= \
+                       max_ratios[1:num_defined]))
+        seqs = dict(self.fasta_recs)
+        for name in ratios_df.index[0:10]:
+            obs_counts, exp_counts = \
+                counter.count_dinuc_subseqs(seqs[">" + name], subseqs)
+            assert (ratios_df.loc[name, "obs_counts"] == \
+                    ",".join(["%d" %(c) for c in obs_counts]))
+            assert (np.isclose(ratios_df.loc[name, "max_ratio"],
+                               np.nanmax(obs_counts / exp_counts)))
+
+
+    def test_subseq_densities(self):
+        """
+        Test table of densities of subsequences, sorted by
+        density.
+        """
+        counter = seq_counter.SeqCounter(self.fasta_fname)
+        densities_df = counter.get_subseq_densities(["ACG", "CGT"])
+        assert (len(densities_df) == len(self.fasta_recs))
+        sum_densities = densities_df["sum_density"].values
+        assert (np.all(sum_densities[:-1] >= sum_densities[1:]))
@@ -0,0 +1,131 @@
+##
+## Unit testing for scheduling of pipeline steps
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import rnaseqlib
+import rnaseqlib.StepScheduler as step_scheduler
+
+
+class StepsRecorder:
+    """
+    Record order in which steps start and end, and the
+    CPUs used by the steps running at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.used_cpus = 0
+        self.max_used_cpus = 0
+
+
+    def get_step(self, name, num_cpus=1, secs=0.05):
+        def step_func():
+            with self.lock:
+                self.events.append(("start", name))
+                self.used_cpus += num_cpus
+                self.max_used_cpus = max(self.max_used_cpus, self.used_cpus)
+            time.sleep(secs)
+            with self.lock:
+                self.used_cpus -= num_cpus
+                self.events.append(("end", name))
+        return step_func
+
+
+    def get_order(self, event_type):
+        return [name for curr_type, name in self.events \
+                if curr_type == event_type]
+
+
+def add_steps(scheduler, recorder):
+    """
+    Add steps shaped like the steps of a sample: mapping
+    followed by steps that fan out from it.
+    """
+    scheduler.add_step("map", recorder.get_step("map", num_cpus=2),
+                       num_cpus=2)
+    scheduler.add_step("qc", recorder.get_step("qc"), depends_on=["map"])
+    scheduler.add_step("rpkm", recorder.get_step("rpkm", num_cpus=2),
+                       depends_on=["qc"], num_cpus=2)
+    scheduler.add_step("bed", recorder.get_step("bed"), depends_on=["map"])
+    scheduler.add_step("clusters", recorder.get_step("clusters"),
+                       depends_on=["bed"])
+    scheduler.add_step("bigwig", recorder.get_step("bigwig"),
+                       depends_on=["map"])
+
+
+class TestStepScheduler:
+    def setup_method(self, method):
+        self.output_dir = tempfile.mkdtemp()
+
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_serial(self):
+        recorder = StepsRecorder()
+        scheduler = step_scheduler.StepScheduler(max_cpus=1)
+        add_steps(scheduler, recorder)
+        scheduler.run()
+        # Steps run one at a time, in the order they were added
+        order = ["map", "qc", "rpkm", "bed", "clusters", "bigwig"]
+        assert (recorder.get_order("start") == order)
+        assert (recorder.get_order("end") == order)
+        assert (recorder.max_used_cpus == 2)
+
+
+    def test_concurrent(self):
+        recorder = StepsRecorder()
+        scheduler = step_scheduler.StepScheduler(max_cpus=3)
+        add_steps(scheduler, recorder)
+        scheduler.run()
+        starts = recorder.get_order("start")
+        ends = recorder.get_order("end")
+        assert (sorted(starts) == sorted(scheduler.steps_by_name.keys()))
+        # Steps start after the steps they depend on end
+        for step in scheduler.steps:
+            for dep_name in step.depends_on:
+                dep_end = recorder.events.index(("end", dep_name))
+                assert (dep_end < recorder.events.index(("start", step.name)))
+        assert (recorder.max_used_cpus <= 3)
+        assert (recorder.max_used_cpus > 2)
+        # Timings of all steps are recorded
+        timings_fname = os.path.join(self.output_dir, "timings.txt")
+        scheduler.output_timings(timings_fname)
+        with open(timings_fname) as timings_file:
+            lines = timings_file.readlines()
+        assert (len(lines) == len(scheduler.steps) + 1)
+        assert (lines[1].split("\t")[0] == "map")
+
+
+    def test_mem_budget(self):
+        recorder = StepsRecorder()
+        scheduler = step_scheduler.StepScheduler(max_cpus=4, max_mem_gb=2)
+        for n in range(3):
+            name = "step%d" %(n)
+            scheduler.add_step(name, recorder.get_step(name), mem_gb=2)
+        scheduler.run()
+        assert (recorder.max_used_cpus == 1)
+
+
+    def test_failed_step(self):
+        recorder = StepsRecorder()
+        scheduler = step_scheduler.StepScheduler(max_cpus=2)
+        def fail():
+            raise ValueError("step failed")
+        scheduler.add_step("map", recorder.get_step("map"))
+        scheduler.add_step("qc", fail, depends_on=["map"])
+        scheduler.add_step("rpkm", recorder.get_step("rpkm"),
+                           depends_on=["qc"])
+        try:
+            scheduler.run()
+            assert False, "Failed step did not raise an error."
+        except ValueError:
+            pass
+        assert (recorder.get_order("start") == ["map"])
@@ -16,3 +16,245 @@ def load_test_data(name):
     
     
     
+    
+
+##
+## Synthetic data used by tests and benchmarks
+##
+SYNTHETIC_CHROMS = [("chr1", 5000000),
+                    ("chr2", 3000000),
+                    ("chrRibo", 50000)]
+
+def make_synthetic_bam(bam_fname, num_reads,
+                       chroms=SYNTHETIC_CHROMS,
+                       read_len=36,
+                       frac_multi=0.3,
+                       frac_ribo=0.1,
+                       frac_junctions=0.1,
+                       seed=1):
+    """
+    Write a coordinate-sorted, indexed BAM file of 'num_reads'
+    synthetic reads. A fraction of the reads are multi-mapping
+    (with NH tag > 1), a fraction have alignments on the last
+    chromosome of 'chroms' (the rRNA chromosome) and a fraction
+    are junction reads.
+    """
+    import numpy as np
+    import pysam
+    rand = np.random.RandomState(seed)
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": chrom, "LN": chrom_len} \
+                     for chrom, chrom_len in chroms]}
+    ribo_tid = len(chroms) - 1
+    alignments = []
+    for read_num in xrange(num_reads):
+        num_hits = 1
+        if rand.rand() < frac_multi:
+            num_hits = rand.randint(2, 4)
+        for hit_num in xrange(num_hits):
+            tid = rand.randint(0, ribo_tid)
+            if rand.rand() < frac_ribo:
+                tid = ribo_tid
+            pos = rand.randint(0, chroms[tid][1] - (2 * read_len) - 1000)
+            if rand.rand() < frac_junctions:
+                first_len = read_len / 2
+                cigar = [(0, first_len),
+                         (3, rand.randint(50, 1000)),
+                         (0, read_len - first_len)]
+            else:
+                cigar = [(0, read_len)]
+            alignments.append((tid, pos, read_num, num_hits,
+                               rand.rand() < 0.5, cigar))
+    alignments.sort()
+    bases = np.array(list("ACGT"))
+    bam_file = pysam.Samfile(bam_fname, "wb", header=header)
+    for tid, pos, read_num, num_hits, is_reverse, cigar in alignments:
+        read = pysam.AlignedSegment()
+        read.qname = "read%d" %(read_num)
+        read.seq = "".join(bases[rand.randint(0, 4, size=read_len)])
+        read.flag = 16 if is_reverse else 0
+        read.tid = tid
+        read.pos = pos
+        read.mapq = 50 if num_hits == 1 else 0
+        read.cigar = cigar
+        read.qual = "I" * read_len
+        read.tags = [("NH", num_hits)]
+        bam_file.write(read)
+    bam_file.close()
+    pysam.index(bam_fname)
+    return bam_fname
+
+
+def make_synthetic_regions(num_regions,
+                           chroms=SYNTHETIC_CHROMS,
+                           min_len=50,
+                           max_len=2000,
+                           seed=2):
+    """
+    Return a list of synthetic regions as (chrom, start, end, strand)
+    tuples in 0-based BED coordinates, sorted by coordinate.
+    """
+    import numpy as np
+    rand = np.random.RandomState(seed)
+    regions = []
+    for region_num in xrange(num_regions):
+        chrom, chrom_len = chroms[rand.randint(0, len(chroms))]
+        start = rand.randint(0, chrom_len - max_len)
+        end = start + rand.randint(min_len, max_len)
+        strand = "+" if rand.rand() < 0.5 else "-"
+        regions.append((chrom, start, end, strand))
+    regions.sort()
+    return regions
+
+
+def make_synthetic_tagged_bam(bam_fname, tagged_bam_fname, regions,
+                              format_tag,
+                              contained=False):
+    """
+    Write a copy of the given BAM file where each read is
+    tagged (with a 'YB' tag, like tagBam does) with the regions
+    it overlaps. Reads that overlap no region are not written.
+
+    Args:
+    - bam_fname: input BAM
+    - tagged_bam_fname: output BAM
+    - regions: list of (chrom, start, end, ...) regions in
+      0-based BED coordinates
+    - format_tag: function that takes the list of overlapping
+      regions and returns the tag value
+
+    Kwargs:
+    - contained: if True, only tag reads with the regions that
+      contain them (like tagBam -f 1)
+    """
+    import bisect
+    import pysam
+    from collections import defaultdict
+    regions_by_chrom = defaultdict(list)
+    for region in sorted(regions):
+        regions_by_chrom[region[0]].append(region)
+    region_starts = dict([(chrom, [r[1] for r in regions_by_chrom[chrom]]) \
+                          for chrom in regions_by_chrom])
+    max_region_len = max([r[2] - r[1] for r in regions])
+    bam_file = pysam.Samfile(bam_fname, "rb")
+    tagged_bam = pysam.Samfile(tagged_bam_fname, "wb", template=bam_file)
+    for read in bam_file:
+        chrom = bam_file.getrname(read.tid)
+        read_start, read_end = read.pos, read.aend
+        # Only look at regions that start close enough to the read
+        # to possibly overlap it
+        chrom_regions = regions_by_chrom[chrom]
+        first = bisect.bisect_left(region_starts.get(chrom, []),
+                                   read_start - max_region_len)
+        last = bisect.bisect_left(region_starts.get(chrom, []), read_end)
+        if contained:
+            overlapping = [region for region in chrom_regions[first:last] \
+                           if (region[1] <= read_start) and \
+                              (region[2] >= read_end)]
+        else:
+            overlapping = [region for region in chrom_regions[first:last] \
+                           if (region[1] < read_end) and \
+                              (region[2] > read_start)]
+        if len(overlapping) == 0:
+            continue
+        read.tags = read.tags + [("YB", format_tag(overlapping))]
+        tagged_bam.write(read)
+    tagged_bam.close()
+    bam_file.close()
+    pysam.index(tagged_bam_fname)
+    return tagged_bam_fname
+
+
+def make_synthetic_fastq(fastq_fname, num_reads,
+                         read_len=36,
+                         min_read_len=None,
+                         frac_n=0.01,
+                         seed=1,
+                         batch_size=100000):
+    """
+    Write FASTQ file with 'num_reads' random reads. Gzipped
+    if the filename ends in '.gz'.
+
+    Kwargs:
+    - read_len: length of reads
+    - min_read_len: if given, read lengths are chosen uniformly
+      between 'min_read_len' and 'read_len'
+    - frac_n: fraction of bases that are 'N'
+    """
+    import gzip
+    import numpy as np
+    rand = np.random.RandomState(seed)
+    bases = np.array([ord(b) for b in "ACGT"], dtype=np.uint8)
+    if fastq_fname.endswith(".gz"):
+        fastq_file = gzip.open(fastq_fname, "wb")
+    else:
+        fastq_file = open(fastq_fname, "w")
+    for batch_start in xrange(0, num_reads, batch_size):
+        num_batch = min(batch_size, num_reads - batch_start)
+        seqs = bases[rand.randint(0, 4, size=(num_batch, read_len))]
+        seqs[rand.rand(num_batch, read_len) < frac_n] = ord("N")
+        # Qualities decrease along the read
+        quals = 33 + np.clip(40 - np.arange(read_len) / 3 - \
+                             rand.randint(0, 10, size=(num_batch, read_len)),
+                             2, 41)
+        quals = quals.astype(np.uint8)
+        seqs_str = seqs.tostring()
+        quals_str = quals.tostring()
+        lens = [read_len] * num_batch
+        if min_read_len is not None:
+            lens = rand.randint(min_read_len, read_len + 1,
+                                size=num_batch).tolist()
+        lines = []
+        for n in xrange(num_batch):
+            start = n * read_len
+            end = start + lens[n]
+            lines.append("@read%d\n%s\n+\n%s\n" %(batch_start + n,
+                                                  seqs_str[start:end],
+                                                  quals_str[start:end]))
+        fastq_file.write("".join(lines))
+    fastq_file.close()
+    return fastq_fname
+
+
+def make_polyA_fastq(fastq_fname, num_reads,
+                     read_len=50,
+                     max_polyA_len=20,
+                     seed=1):
+    """
+    Write FASTQ file with 'num_reads' random reads ending in
+    polyA tails of random lengths (between 0 and 'max_polyA_len'.)
+    Gzipped if the filename ends in '.gz'.
+
+    Returns array with the length of the polyA tail of each read.
+    """
+    import gzip
+    import numpy as np
+    rand = np.random.RandomState(seed)
+    bases = np.array([ord(b) for b in "ACGT"], dtype=np.uint8)
+    seqs = bases[rand.randint(0, 4, size=(num_reads, read_len))]
+    polyA_lens = rand.randint(0, max_polyA_len + 1, size=num_reads)
+    positions = np.arange(read_len)
+    tail_starts = read_len - polyA_lens
+    seqs[positions >= tail_starts[:, None]] = ord("A")
+    # Base before the tail is not an A
+    has_body = (tail_starts > 0)
+    seqs[np.nonzero(has_body)[0], tail_starts[has_body] - 1] = ord("C")
+    quals = 33 + rand.randint(2, 42, size=(num_reads, read_len))
+    seqs_str = seqs.tostring()
+    quals_str = quals.astype(np.uint8).tostring()
+    if fastq_fname.endswith(".gz"):
+        fastq_file = gzip.open(fastq_fname, "wb")
+    else:
+        fastq_file = open(fastq_fname, "w")
+    lines = []
+    for n in xrange(num_reads):
+        start = n * read_len
+        end = start + read_len
+        lines.append("@read%d\n%s\n+\n%s\n" %(n, seqs_str[start:end],
+                                              quals_str[start:end]))
+        if len(lines) == 100000:
+            fastq_file.write("".join(lines))
+            lines = []
+    fastq_file.write("".join(lines))
+    fastq_file.close()
+    return polyA_lens
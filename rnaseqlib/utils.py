@@ -8,6 +8,7 @@ import datetime
 from time import gmtime, strftime
 import glob
 import re
+import contextlib
 
 import operator
 
@@ -209,6 +210,17 @@ def which(program):
             if is_exe(exe_file):
                 return exe_file
     return None
+
+
+def run_cmd(cmd, logger=None):
+    """
+    Run shell command, raising an exception if it fails.
+    """
+    if logger is not None:
+        logger.info("Executing: %s" %(cmd))
+    ret_val = os.system(cmd)
+    if ret_val != 0:
+        raise Exception, "Command failed (%d): %s" %(ret_val, cmd)
             
 
 def count_lines(fname, skipstart="#"):
@@ -449,9 +461,77 @@ def get_strtime():
     return strftime("%Y-%m-%d %H:%M:%S", gmtime())
 
 
+def get_files_fingerprint(filenames):
+    """
+    Return fingerprint of files: a string made of the size and
+    modification time of each file. Returns None if any of the
+    files does not exist.
+    """
+    fields = []
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            return None
+        file_stat = os.stat(filename)
+        fields.append("%d:%r" %(file_stat.st_size,
+                                float(file_stat.st_mtime)))
+    return ",".join(fields)
 
 
-    
+def load_fingerprints(fingerprints_fname):
+    """
+    Load mapping from keys (e.g. sample labels) to fingerprints
+    from file. Returns an empty mapping if the file does not exist.
+    """
+    fingerprints = {}
+    if not os.path.isfile(fingerprints_fname):
+        return fingerprints
+    with open(fingerprints_fname) as fingerprints_file:
+        for line in fingerprints_file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 2:
+                continue
+            fingerprints[fields[0]] = fields[1]
+    return fingerprints
 
 
+def save_fingerprints(fingerprints_fname, fingerprints):
+    """
+    Save mapping from keys to fingerprints to file. Keys with
+    no fingerprint (None) are not saved.
+    """
+    tmp_fname = "%s.tmp.%d" %(fingerprints_fname, os.getpid())
+    with open(tmp_fname, "w") as fingerprints_file:
+        for key in sorted(fingerprints.keys()):
+            if fingerprints[key] is None:
+                continue
+            fingerprints_file.write("%s\t%s\n" %(key, fingerprints[key]))
+    os.rename(tmp_fname, fingerprints_fname)
+
+
+@contextlib.contextmanager
+def temp_outputs(output_fnames):
+    """
+    Context manager yielding temporary filenames to write the
+    given output files to. The temporary files are renamed to
+    the outputs only if the block completes, so that an
+    interrupted run does not leave partial outputs behind;
+    otherwise they are removed.
 
+    Temporary filenames keep the '.gz' extension of the outputs,
+    for writers that compress by extension.
+    """
+    tmp_fnames = []
+    for output_fname in output_fnames:
+        tmp_fname = "%s.tmp.%d" %(output_fname, os.getpid())
+        if output_fname.endswith(".gz"):
+            tmp_fname += ".gz"
+        tmp_fnames.append(tmp_fname)
+    try:
+        yield tmp_fnames
+    except:
+        for tmp_fname in tmp_fnames:
+            if os.path.isfile(tmp_fname):
+                os.remove(tmp_fname)
+        raise
+    for tmp_fname, output_fname in zip(tmp_fnames, output_fnames):
+        os.rename(tmp_fname, output_fname)